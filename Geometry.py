@@ -3,7 +3,8 @@
 The Fields Class which has as attributes (apart from the name) 
 the strength of the field, 
 the length over which it's active, 
-and the drifting length (in free space) after the field finished to be non-zero.
+the drifting length (in free space) after the field finished to be non-zero,
+and the z at which it starts to be non-zero (0 by default, i.e. at the aperture. see regions.py for E and B regions which do not coincide).
 
 The Electrode class is helpful to check if clipping occurs during the particles flight in the detector.
 Has as an attribute the y-coordinate of the bottom electrode (in a geometry where the E-field is along positive y-direction)
@@ -15,16 +16,17 @@ The create_Geometry_Objects() function helps translating user-input to actual ge
 """
 
 class Field:
-    def __init__(self, name, strength, l, D):
+    def __init__(self, name, strength, l, D, z_start=0.0):
         self._name = name # protected attribute (proceeded by _).
         self._strength = strength # a private attribute would be preceeded by __ , and can only be accessed from within the Field class. or by using _object.__name = new_name_for_Field, but no-one does this
         self._l = l
         self._D = D 
+        self._z_start = z_start
 
     def __str__(self):
         return "{} is a {}-field with strength={} , l_{}={} , D_{}={} , all in SI units".format(self, self.name, self.strength, self.name, self.l, self.name, self.D)
     def __repr__(self):
-        return f'Field(name={self._name}, strength={self._strength}, l={self._l}, D={self._D})'
+        return f'Field(name={self._name}, strength={self._strength}, l={self._l}, D={self._D}, z_start={self._z_start})'
   
 class Electrode:
     def __init__(self, name, y_electrode):
@@ -45,9 +47,9 @@ class Detector_Screen:
     def __repr__(self):
         return f'Detector_Screen(z_det={self._z_det})'
 
-def create_Geometry_Objects(E, l_E, D_E, B, l_B, D_B, z_det, y_electrode_bottom):
-    Efieldobj = Field("E-field", E,   l_E,  D_E)
-    Bfieldobj = Field("B-field", B,   l_B,  D_B)
+def create_Geometry_Objects(E, l_E, D_E, B, l_B, D_B, z_det, y_electrode_bottom, z_E=0.0, z_B=0.0):
+    Efieldobj = Field("E-field", E,   l_E,  D_E, z_E)
+    Bfieldobj = Field("B-field", B,   l_B,  D_B, z_B)
     detector_obj = Detector_Screen("detector", z_det)
     electrode_bottom_obj = Electrode("bottom_electrode", y_electrode_bottom)
-    return Efieldobj, Bfieldobj, detector_obj, electrode_bottom_obj
\ No newline at end of file
+    return Efieldobj, Bfieldobj, detector_obj, electrode_bottom_obj
\ No newline at end of file
@@ -1,5 +1,7 @@
+import time
 import numpy as np
 from scipy.constants import c
+import instrumentation, fieldmap
 
 
 def derivatives(t, vec, qonm, E, B): # vec is a numpy array: [x,y,z, u_x, u_y, u_z]. does it actually have to be a numpy array or can it be a simple list?
@@ -101,9 +103,51 @@ def get_RKF5_approx_efficiently(t, vec, dt, Ks, qonm, E, B):
     RKF5 = vec + dt * (  (16./135.)*Ks[0] + (6656./12825.)*Ks[2] + (28561./56430.)*Ks[3] - (9./50.)*Ks[4]  +(2./55.)*K6  )
     return RKF5 # RKF5 will contain 6 floats ''in it''
 
-#no_of_particles_which_haveexitB = 0
-#no_of_particles_which_havehitelectrode = 0
-def RK45integrator(x,y,z,ux,uy,uz, yscal, tol,  l_B, y_bottom_elec, qonm, E, B):
+# Step-size control (PI controller, see Hairer, Norsett, Wanner, Solving ODEs I, section II.4 and Hairer, Wanner, Solving ODEs II, section IV.2).
+# The error estimate RKF5 - RKF4 is of order 5 in dt, hence the exponents below are fractions of 1/5.
+safety = 0.9 # safety factor applied to the optimal timestep
+facmin = 0.2 # the timestep is never decreased by more than 5x in one step
+facmax = 5.0 # the timestep is never increased by more than 5x in one step
+alpha_PI = 0.7 / 5. # proportional exponent of the PI controller
+beta_PI = 0.4 / 5. # integral exponent of the PI controller
+
+
+def initial_step_size(vec, qonm, E, B, yscal, tol):
+    """ Automatic estimate of the first timestep of the RK45 integration, based on the norms of the state and of its derivatives.
+
+    Algorithm from Hairer, Norsett, Wanner, Solving ODEs I, section II.4, with the norm used by RK45integrator() (max over x,y,z of |value / yscal|).
+    As the particles start from the aperture (x = y = z = 0), the size of the state is taken as at least 1 (i.e. yscal).
+
+    Parameters
+    ----------
+    vec : np.array shape (6, ) (initial x,y,z, ux,uy,uz of the particle)
+    qonm : float (charge/mass ratio of the particle, in SI)
+    E : float (value in SI (V/m) of the static electrical field)
+    B : float (value in SI (T) of the static magnetic field)
+    yscal : list of 3 floats (maximum values (in modulus) the x,y,z coordinates of the particle can attain)
+    tol : float (the tolerance, see RK45integrator())
+
+    Returns
+    -------
+    dt : float (the first timestep to try)
+    """
+
+    f0 = derivatives(0.0, vec, qonm, E, B)
+    d0 = max([abs(vec[i] / yscal[i]) for i in range(3)])
+    d1 = max([abs(f0[i] / yscal[i]) for i in range(3)])
+    if (d1 == 0.0): # particle at rest. nothing better than the old tiny first try
+        return 10**(-50)
+    h0 = 0.01 * max(d0, 1.0) / d1 # time needed to travel 1% of the size of the state
+    f1 = derivatives(h0, vec + h0 * f0, qonm, E, B) # explicit Euler step
+    d2 = max([abs((f1[i] - f0[i]) / yscal[i]) for i in range(3)]) / h0
+    if (max(d1, d2) <= 10**(-15)):
+        h1 = 100 * h0
+    else:
+        h1 = (0.01 * tol / max(d1, d2))**(1./5.)
+    return min(100 * h0, h1)
+
+
+def RK45integrator(x,y,z,ux,uy,uz, yscal, tol,  l_B, y_bottom_elec, qonm, E, B, recorder=None, particle_id=0):
     """ Integrates the relativistic EOMs for a given particle. 
 
     From given initial coordinates with given initial velocities (6 boundary conditions, sufficient for solving 6 coupled first-order ODE's),
@@ -127,12 +171,16 @@ def RK45integrator(x,y,z,ux,uy,uz, yscal, tol,  l_B, y_bottom_elec, qonm, E, B):
     qonm : float (charge/mass ratio of the particle, in SI (no tricks, just total charge / total mass))
     E : float (value in SI (V/m) of the static electrical field through which particles move)
     B : float (value in SI (T) of the static magnetic field through which the particles move)
+    recorder : Trajectory.Trajectory_Recorder or None (if given, decimated samples of the trajectory are kept in it. by default only the current state is kept)
+    particle_id : int (id of this particle for the recorder)
 
     Returns
     -------
     no_of_particles_which_haveexitB : int (number of particles which have exit the fields region (so successfully capturated on the detector screen))
     no_of_particles_which_hitelectrode : int (number of particles which have hit the bottom electrode (clipping))
-    results[-1, :] : np.array shape (6, ) : the x,y,z, ux, uy, uz all in SI, at the end of the integration doen by this function.
+    vec : np.array shape (6, ) : the x,y,z, ux, uy, uz all in SI, at the end of the integration doen by this function (last accepted step).
+    steps_accepted : int (number of accepted integration steps)
+    steps_rejected : int (number of rejected integration steps, each of them having cost as many derivatives evaluations as an accepted one)
     """
 
     no_of_particles_which_hitelectrode = 0
@@ -140,17 +188,17 @@ def RK45integrator(x,y,z,ux,uy,uz, yscal, tol,  l_B, y_bottom_elec, qonm, E, B):
     counter = 0
     nmax = 10**5
     steps_accepted = 0
+    steps_rejected = 0
     epsilon_0 = tol 
-    # 10**(-50)
     t = 0
-    dt = 10**(-50) # initial try for the timestep dt
-    ts = []
-    beta = 0.9
     vec = np.array([x,y,z,  ux,uy,uz])
+    dt = initial_step_size(vec, qonm, E, B, yscal, tol) # initial try for the timestep dt
+    err_prev = 10**(-4) # (scaled) error of the previous accepted step, for the integral part of the PI controller
+    last_rejected = False
     z_to_compare = 0.0 # initial z-value for the comparison used to see if we need to stop RK45 routine or not
     y_to_compare = 0.0  # initial y-value for the comparison used to see if we need to stop RK45 routine or not
-    results = []
-    ERRCON = (beta/5.)**(5) # cryptic value taken and used as from Press and Teukolsky, 1992, Adaptive Stepsize RK Integration paper
+    if recorder is not None:
+        recorder.record([particle_id], [vec], force=True)
     #global no_of_particles_which_haveexitB 
     #global no_of_particles_which_havehitelectrode 
     while(counter <= nmax):
@@ -165,37 +213,447 @@ def RK45integrator(x,y,z,ux,uy,uz, yscal, tol,  l_B, y_bottom_elec, qonm, E, B):
         RKF4 = container_from_RKF4method[0] # RKF4 method's approximation for the 6 odes' solutions at t_{n+1}. returns a np array of 6 floats because we have x,y,z,ux,uy,uz
         Ks =  container_from_RKF4method[1:] # a list of 5 np arrays (K1--->K5), each np array containing 6 floats
         RKF5 = get_RKF5_approx_efficiently(t, vec, dt, Ks, qonm, E , B) # a np.array with 6 floats in it
-        y_to_compare = RKF4[1]
-        z_to_compare = RKF4[2]
         scaled_errors_at_this_step = [ abs( (RKF5[i] - RKF4[i]) / yscal[i] ) for i in range(3) ] # i runs from 0-->2 (including 2), only care about error on x,y,z and not on ux,uy,uz 
-        max_from_scalederrors_at_this_step = np.max(scaled_errors_at_this_step)
-        if (max_from_scalederrors_at_this_step < epsilon_0 and max_from_scalederrors_at_this_step != 0.0): # good!
-            # yes, step accepted! need optimal timestep (can increase it!)
+        err = float(np.max(scaled_errors_at_this_step)) / epsilon_0 # error relative to the tolerance: step is good if err <= 1
+        if (err <= 1.0): # good!
+            # yes, step accepted! PI controller for the next timestep
             steps_accepted += 1
-            ts.append(t)
-            dt_new = beta * dt * (epsilon_0/max_from_scalederrors_at_this_step)**(0.25) 
-            if (max_from_scalederrors_at_this_step <= (ERRCON * epsilon_0)): # fractional error is not that small, can increase timestep according to the found optimal value
-                dt_new = 5 * dt
-            dt = dt_new
-            results.append(RKF4)
-            vec = RKF4 # for next iteration of the while-loop
+            t += dt
+            if (err == 0.0): # it's perfect! grow as much as allowed
+                fac = facmax
+            else:
+                fac = safety * err**(-alpha_PI) * err_prev**(beta_PI)
+                fac = min(facmax, max(facmin, fac))
+            if (last_rejected): # do not increase the timestep right after a rejection
+                fac = min(1.0, fac)
+            dt = dt * fac
+            err_prev = max(err, 10**(-4))
+            last_rejected = False
+            vec = RKF4 # for next iteration of the while-loop. only the current state is kept
+            if recorder is not None:
+                recorder.record([particle_id], [vec])
+            y_to_compare = RKF4[1] # only accepted steps can end the integration
+            z_to_compare = RKF4[2]
         else:
-            if (max_from_scalederrors_at_this_step == 0.0): # it's perfect!
-                steps_accepted += 1
-                ts.append(t)
-                t += dt
-                dt_new = 10 * dt # artificially increase the timestep, but not as dt_new dictates (that increase would dictate dt_new = inf for when errors = 0)
-                dt = dt_new
-                results.append(RKF4)
-                vec = RKF4
-            else: # means that max_from_scalederrors_at_this_step > epsilon_0 and max_from_scalederrors_at_this_step != 0
-                # no, step not accepted. reiterate step using a lower timestep
-                dt_new = beta * dt * (epsilon_0/max_from_scalederrors_at_this_step)**(0.2)
-                if (dt_new < 0.01 * dt): # dt_new is really really small
-                    dt_new = 0.01 * dt
-                dt = dt_new
-    print("we exited the while-loop!")
-    ts = np.array(ts)
-    results = np.array(results) # all the integration timesteps laid down vertically. x,y,z, ux,uy,uz laid down horizontally across each line (across each integration timestep)
-    return no_of_particles_which_haveexitB, no_of_particles_which_hitelectrode, results[-1, :] # these results are from when: 1) particle has just hit bottom detector OR 2) particle has just exited the fields region at z = l_B
-    # returned results[-1, :] is shape (6,)
+            # no, step not accepted. reiterate step using a lower timestep (only the proportional part of the controller)
+            steps_rejected += 1
+            dt = dt * max(facmin, safety * err**(-0.2))
+            last_rejected = True
+    instrumentation.logger.debug("particle %d: exited B = %d, hit electrode = %d after %d accepted and %d rejected steps", particle_id, no_of_particles_which_haveexitB, no_of_particles_which_hitelectrode, steps_accepted, steps_rejected)
+    if recorder is not None:
+        recorder.record([particle_id], [vec], force=True)
+    return no_of_particles_which_haveexitB, no_of_particles_which_hitelectrode, vec, steps_accepted, steps_rejected # vec is from when: 1) particle has just hit bottom detector OR 2) particle has just exited the fields region at z = l_B
+
+
+def derivatives_batch(vecs, qonms, E, B):
+    """ Vectorized version of derivatives(): returns the 6 Right-Hand Sides of the 6 coupled ODEs (EOM's) for a whole batch of particles at once.
+
+    Parameters
+    ----------
+    vecs : np.array of shape (N, 6) containing the x,y,z, ux,uy,uz of the N particles at the current timestep (one particle per row).
+    qonms : np.array of shape (N, ) (charge/mass ratio of each particle, in SI)
+    E : float (value in SI (V/m) of the static electrical field through which particles move), or fieldmap.Field_Map (non-uniform E and B, both read from the map)
+    B : float (value in SI (T) of the static magnetic field through which the particles move. ignored if E is a fieldmap.Field_Map)
+
+    Returns
+    -------
+    np.array shape (N, 6) containing the RHSides of the 6 coupled ODE's at the current timestep, for each particle.
+    """
+
+    metrics = instrumentation.metrics # None unless the run is instrumented
+    if metrics is not None:
+        start = time.perf_counter()
+    if isinstance(E, fieldmap.Field_Map):
+        K = E.derivatives_batch(vecs, qonms)
+    else:
+        gammas = np.sqrt( 1.0 + (np.sum(vecs[:, 3:]**2.0, axis=1) / (c**2.0)) ) # shape (N, ), one gamma factor per particle
+        K = np.empty_like(vecs)
+        K[:, 0:3] = vecs[:, 3:6] / gammas[:, None] # dx/dt, dy/dt, dz/dt
+        K[:, 3] = (-qonms * B / gammas) * vecs[:, 5] # du_x/dt
+        K[:, 4] = qonms * E # du_y/dt
+        K[:, 5] = (qonms * B / gammas) * vecs[:, 3] # du_z/dt
+    if metrics is not None:
+        metrics.add_time('derivatives', time.perf_counter() - start, vecs.shape[0])
+    return K
+
+
+def get_RKF45_approx_batch(vecs, dts, qonms, E, B):
+    """ Computes both the 4-th and the 5-th order RK45 Fehlberg approximations for a batch of particles, each with its own timestep.
+
+    Same Butcher tableau as get_RKF4_approx() and get_RKF5_approx_efficiently(), the 6 derivatives evaluations being shared between the 2 orders.
+
+    Parameters
+    ----------
+    vecs : np.array shape (N, 6) : values at current time for x,y,z, ux, uy, uz of each particle
+    dts : np.array shape (N, ) : current timestep value of each particle
+    qonms : np.array shape (N, ) (charge/mass ratio of each particle, in SI)
+    E : float (value in SI (V/m) of the static electrical field through which particles move)
+    B : float (value in SI (T) of the static magnetic field through which the particles move)
+
+    Returns
+    -------
+    RKF4, RKF5 : np.arrays shape (N, 6) with the 4-th and 5-th order approximations of the 6 ODEs at the next timestep.
+    """
+
+    h = dts[:, None] # shape (N, 1), broadcasts against the (N, 6) arrays below
+    K1 = derivatives_batch(vecs, qonms, E, B)
+    K2 = derivatives_batch(vecs + (h/4.)*K1, qonms, E, B)
+    K3 = derivatives_batch(vecs + h*( (3./32.)*K1 + (9./32.)*K2 ), qonms, E, B)
+    K4 = derivatives_batch(vecs + h*( (1932./2197.)*K1 - (7200./2197.)*K2 + (7296./2197.)*K3 ), qonms, E, B)
+    K5 = derivatives_batch(vecs + h*( (439./216.)*K1 - 8.*K2 + (3680./513.)*K3 - (845./4104)*K4 ), qonms, E, B)
+    K6 = derivatives_batch(vecs + h*( -(8./27.)*K1 + 2.*K2 - (3544./2565.)*K3 + (1859./4104.)*K4 - (11./40.)*K5 ), qonms, E, B)
+    RKF4 = vecs + h * ( (25./216)*K1 + (1408/2565.)*K3 + (2197./4104.)*K4 - (1./5.)*K5 )
+    RKF5 = vecs + h * ( (16./135.)*K1 + (6656./12825.)*K3 + (28561./56430.)*K4 - (9./50.)*K5 + (2./55.)*K6 )
+    return RKF4, RKF5
+
+
+def initial_step_size_batch(vecs, qonms, E, B, yscal, tol):
+    """ Vectorized version of initial_step_size(): automatic estimate of the first timestep of each particle of a batch.
+
+    Parameters
+    ----------
+    vecs : np.array shape (N, 6) (initial x,y,z, ux,uy,uz of each particle)
+    qonms : np.array shape (N, ) (charge/mass ratio of each particle, in SI)
+    E : float (value in SI (V/m) of the static electrical field)
+    B : float (value in SI (T) of the static magnetic field)
+    yscal : np.array shape (3, ) (maximum values (in modulus) the x,y,z coordinates of the particles can attain)
+    tol : float (the tolerance, see RK45integrator())
+
+    Returns
+    -------
+    dts : np.array shape (N, ) (the first timestep to try, for each particle)
+    """
+
+    dts = np.full(vecs.shape[0], 10**(-50)) # for the particles at rest, as in initial_step_size()
+    f0 = derivatives_batch(vecs, qonms, E, B)
+    d0 = np.max(np.abs(vecs[:, :3] / yscal), axis=1)
+    d1 = np.max(np.abs(f0[:, :3] / yscal), axis=1)
+    moving = (d1 != 0.0)
+    if moving.any():
+        h0 = 0.01 * np.maximum(d0[moving], 1.0) / d1[moving]
+        f1 = derivatives_batch(vecs[moving] + h0[:, None] * f0[moving], qonms[moving], E, B)
+        d2 = np.max(np.abs((f1[:, :3] - f0[moving, :3]) / yscal), axis=1) / h0
+        d12 = np.maximum(d1[moving], d2)
+        h1 = 100 * h0
+        smooth = ~(d12 <= 10**(-15))
+        h1[smooth] = (0.01 * tol / d12[smooth])**(1./5.)
+        dts[moving] = np.where(h1 < 100 * h0, h1, 100 * h0)
+    return dts
+
+
+def RK45integrator_batch(states, qonms, yscal, tol, l_B, y_bottom_elec, E, B, nmax=10**5, recorder=None, particle_ids=None):
+    """ Integrates the relativistic EOMs for a whole batch of particles at once.
+
+    Batch counterpart of RK45integrator(): every particle keeps its own adaptive timestep and its own accept/reject decision,
+    the initial timestep estimate and the PI step-size control being the ones of RK45integrator() (vectorized NumPy powers may differ from the scalar ones
+    in the last bit, so the two agree to within the tolerance rather than bit for bit). Particles are dropped from the active set as soon as they
+    exit the fields region (z >= l_B) or hit the bottom electrode (y >= y_bottom_elec), so the remaining NumPy work only
+    concerns the particles still in flight.
+
+    Parameters
+    ----------
+    states : np.array shape (N, 6) (initial x,y,z, ux,uy,uz of each particle, one particle per row)
+    qonms : np.array shape (N, ) (charge/mass ratio of each particle, in SI)
+    yscal : list of 3 floats. contains the maximum values (in modulus) the x,y,z coordinates of the particles can attain.
+    tol : float (the tolerance: the maximum relative error of the current timestep (relative to the maximum value of the variable inputted in yscal))
+    l_B : float (Geometry: the length along which E/B fields extend along z-axis, in SI (meters))
+    y_bottom_elec : float (the y-coordinate of the bottom electrode, in SI (meters))
+    E : float (value in SI (V/m) of the static electrical field through which particles move), or fieldmap.Field_Map (non-uniform E and B, see derivatives_batch())
+    B : float (value in SI (T) of the static magnetic field through which the particles move)
+    nmax : int (maximum number of iterations of the integration loop, per particle)
+    recorder : Trajectory.Trajectory_Recorder or None (if given, decimated samples of the trajectories are kept in it. by default only the current states are kept)
+    particle_ids : np.array shape (N, ) of ints or None (ids of the particles for the recorder. default: their row numbers in states)
+
+    Returns
+    -------
+    exited_B : np.array shape (N, ) of ints (1 if the particle has exit the fields region, 0 otherwise)
+    hit_E : np.array shape (N, ) of ints (1 if the particle has hit the bottom electrode, 0 otherwise)
+    final_states : np.array shape (N, 6) : the x,y,z, ux,uy,uz of each particle at the end of its integration (last accepted step).
+    steps_accepted : np.array shape (N, ) of ints (number of accepted integration steps of each particle)
+    steps_rejected : np.array shape (N, ) of ints (number of rejected integration steps of each particle)
+    """
+
+    states = np.asarray(states, dtype=float)
+    no_of_parts = states.shape[0]
+    qonms = np.broadcast_to(np.asarray(qonms, dtype=float), (no_of_parts,))
+    yscal = np.asarray(yscal, dtype=float)[:3]
+    epsilon_0 = tol
+
+    exited_B = np.zeros(no_of_parts, dtype=int)
+    hit_E = np.zeros(no_of_parts, dtype=int)
+    final_states = states.copy()
+    steps_accepted = np.zeros(no_of_parts, dtype=int)
+    steps_rejected = np.zeros(no_of_parts, dtype=int)
+
+    # state of the particles still being integrated. idx maps each active row back to its row in the input arrays.
+    idx = np.arange(no_of_parts)
+    vecs = states.copy()
+    qs = qonms.copy()
+    dts = initial_step_size_batch(vecs, qs, E, B, yscal, tol) # initial try for the timestep dt, for each particle
+    err_prev = np.full(no_of_parts, 10**(-4)) # (scaled) error of the previous accepted step, for the integral part of the PI controller
+    last_rejected = np.zeros(no_of_parts, dtype=bool)
+    if recorder is not None:
+        particle_ids = np.arange(no_of_parts) if particle_ids is None else np.asarray(particle_ids)
+        recorder.record(particle_ids, states, force=True)
+    z_to_compare = np.zeros(no_of_parts) # as in RK45integrator(), the comparisons start from 0.0 and then use the latest accepted step
+    y_to_compare = np.zeros(no_of_parts)
+
+    counter = 0 # all active particles do one iteration per pass of the loop, so a single counter is enough
+    while (counter <= nmax and idx.size > 0):
+        counter += 1
+        exited_now = (z_to_compare >= l_B)
+        hit_now = (~exited_now) & (y_to_compare >= y_bottom_elec)
+        done = exited_now | hit_now
+        if done.any():
+            exited_B[idx[exited_now]] = 1
+            hit_E[idx[hit_now]] = 1
+            final_states[idx[done]] = vecs[done]
+            keep = ~done
+            idx, vecs, qs, dts = idx[keep], vecs[keep], qs[keep], dts[keep]
+            err_prev, last_rejected = err_prev[keep], last_rejected[keep]
+            z_to_compare, y_to_compare = z_to_compare[keep], y_to_compare[keep]
+            if idx.size == 0:
+                break
+
+        RKF4, RKF5 = get_RKF45_approx_batch(vecs, dts, qs, E, B)
+        errs = np.max( np.abs( (RKF5[:, :3] - RKF4[:, :3]) / yscal ), axis=1 ) / epsilon_0 # only care about error on x,y,z and not on ux,uy,uz
+
+        # PI controller, exactly as in RK45integrator()
+        accepted = (errs <= 1.0)
+        rejected = ~accepted
+        perfect = accepted & (errs == 0.0)
+        good = accepted & (~perfect)
+        facs = np.full(idx.size, facmax) # the perfect ones
+        fac_good = safety * errs[good]**(-alpha_PI) * err_prev[good]**(beta_PI)
+        fac_good = np.where(fac_good > facmin, fac_good, facmin)
+        facs[good] = np.where(fac_good < facmax, fac_good, facmax)
+        after_rejection = accepted & last_rejected
+        facs[after_rejection] = np.where(facs[after_rejection] < 1.0, facs[after_rejection], 1.0)
+        fac_bad = safety * errs[rejected]**(-0.2)
+        facs[rejected] = np.where(fac_bad > facmin, fac_bad, facmin)
+        dts = dts * facs
+        err_prev[accepted] = np.where(errs[accepted] > 10**(-4), errs[accepted], 10**(-4))
+        last_rejected = rejected
+        steps_accepted[idx[accepted]] += 1
+        steps_rejected[idx[rejected]] += 1
+        vecs[accepted] = RKF4[accepted] # for next iteration of the while-loop. rejected particles keep their current state
+        if recorder is not None:
+            recorder.record(particle_ids[idx[accepted]], vecs[accepted])
+        y_to_compare = vecs[:, 1] # only accepted steps can end the integration
+        z_to_compare = vecs[:, 2]
+
+    final_states[idx] = vecs # particles which have done nmax iterations without exiting / hitting the electrode
+    instrumentation.count('particles_nmax_exhausted', idx.size)
+    if recorder is not None:
+        recorder.record(particle_ids, final_states, force=True)
+    return exited_B, hit_E, final_states, steps_accepted, steps_rejected
+
+
+# Dormand-Prince 5(4) Butcher tableau (Dormand and Prince, J. Comp. Appl. Math. 6, 19 (1980)).
+# The 7th stage is evaluated at the new (5-th order) solution, so it is the 1st stage of the next step (FSAL: First Same As Last).
+DP_A = [[],
+        [1./5.],
+        [3./40., 9./40.],
+        [44./45., -56./15., 32./9.],
+        [19372./6561., -25360./2187., 64448./6561., -212./729.],
+        [9017./3168., -355./33., 46732./5247., 49./176., -5103./18656.],
+        [35./384., 0., 500./1113., 125./192., -2187./6784., 11./84.]]
+DP_B5 = np.array([35./384., 0., 500./1113., 125./192., -2187./6784., 11./84., 0.]) # 5-th order weights (= last row of DP_A)
+DP_E = np.array([-71./57600., 0., 71./16695., -71./1920., 17253./339200., -22./525., 1./40.]) # 5-th order minus 4-th order weights
+# dense output: y(t + theta*dt) = y + dt * sum_i K_i * (DP_P[i] . [theta, theta^2, theta^3, theta^4]), a 4-th order continuous extension (Shampine, 1986)
+DP_P = np.array([[1., -8048581381./2820520608., 8663915743./2820520608., -12715105075./11282082432.],
+                 [0., 0., 0., 0.],
+                 [0., 131558114200./32700410799., -68118460800./10900136933., 87487479700./32700410799.],
+                 [0., -1754552775./470086768., 14199869525./1410260304., -10690763975./1880347072.],
+                 [0., 127303824393./49829197408., -318862633887./49829197408., 701980252875./199316789632.],
+                 [0., -282668133./205662961., 2019193451./616988883., -1453857185./822651844.],
+                 [0., 40617522./29380423., -110615467./29380423., 69997945./29380423.]])
+
+
+def get_DOPRI54_approx_batch(vecs, dts, K1, qonms, E, B):
+    """ Computes one Dormand-Prince 5(4) step for a batch of particles, each with its own timestep.
+
+    Only 6 derivatives evaluations are done, the first stage K1 being given (it is the last stage of the previous accepted step).
+
+    Parameters
+    ----------
+    vecs : np.array shape (N, 6) : values at current time for x,y,z, ux, uy, uz of each particle
+    dts : np.array shape (N, ) : current timestep value of each particle
+    K1 : np.array shape (N, 6) : derivatives at the current time (vecs)
+    qonms : np.array shape (N, ) (charge/mass ratio of each particle, in SI)
+    E : float (value in SI (V/m) of the static electrical field through which particles move)
+    B : float (value in SI (T) of the static magnetic field through which the particles move)
+
+    Returns
+    -------
+    DP5 : np.array shape (N, 6) with the 5-th order approximations of the 6 ODEs at the next timestep.
+    DP_err : np.array shape (N, 6) with the difference between the 5-th and the 4-th order approximations (the error estimate).
+    Ks : np.array shape (7, N, 6) with the 7 stages. Ks[6] are the derivatives at DP5.
+    """
+
+    h = dts[:, None]
+    Ks = np.empty((7,) + vecs.shape)
+    Ks[0] = K1
+    for i in range(1, 7):
+        increment = DP_A[i][0] * Ks[0]
+        for j in range(1, i):
+            if DP_A[i][j] != 0.0:
+                increment = increment + DP_A[i][j] * Ks[j]
+        Ks[i] = derivatives_batch(vecs + h * increment, qonms, E, B)
+    DP5 = vecs + h * np.tensordot(DP_B5, Ks, axes=1)
+    DP_err = h * np.tensordot(DP_E, Ks, axes=1)
+    return DP5, DP_err, Ks
+
+
+def dense_output_DOPRI54(vecs, dts, Ks, thetas):
+    """ Evaluates the continuous extension of Dormand-Prince 5(4) steps at the fractions thetas (between 0 and 1) of the steps.
+
+    Parameters
+    ----------
+    vecs : np.array shape (N, 6) (state at the beginning of the step of each particle)
+    dts : np.array shape (N, ) (timestep of each particle)
+    Ks : np.array shape (7, N, 6) (the stages of the step, as returned by get_DOPRI54_approx_batch())
+    thetas : np.array shape (N, ) (fraction of the step at which the state is wanted)
+
+    Returns
+    -------
+    np.array shape (N, 6) with the interpolated x,y,z, ux,uy,uz of each particle.
+    """
+
+    powers = np.cumprod(np.repeat(thetas[:, None], 4, axis=1), axis=1) # [theta, theta^2, theta^3, theta^4], shape (N, 4)
+    weights = powers @ DP_P.T # shape (N, 7): weight of each stage
+    return vecs + dts[:, None] * np.einsum('ni,inj->nj', weights, Ks)
+
+
+def locate_event_DOPRI54(vecs, dts, Ks, component, value, n_iter=60):
+    """ Finds, by bisection on the dense output, the fraction theta of the step at which vec[component] crosses value (from below).
+
+    The crossing is known to happen during the step (at the beginning of the step vec[component] < value, at its end >= value).
+
+    Parameters
+    ----------
+    vecs, dts, Ks : see dense_output_DOPRI54()
+    component : int (1 for y, 2 for z)
+    value : float (l_B or y_bottom_elec)
+    n_iter : int (number of bisections. 60 halvings of [0, 1] reach double precision)
+
+    Returns
+    -------
+    thetas : np.array shape (N, )
+    """
+
+    low = np.zeros(vecs.shape[0])
+    high = np.ones(vecs.shape[0])
+    for _ in range(n_iter):
+        mid = 0.5 * (low + high)
+        above = dense_output_DOPRI54(vecs, dts, Ks, mid)[:, component] >= value
+        high = np.where(above, mid, high)
+        low = np.where(above, low, mid)
+    return high
+
+
+def DOPRI54integrator_batch(states, qonms, yscal, tol, l_B, y_bottom_elec, E, B, nmax=10**5, recorder=None, particle_ids=None):
+    """ Integrates the relativistic EOMs for a whole batch of particles with the Dormand-Prince 5(4) embedded method.
+
+    Compared to RK45integrator_batch():
+    1) the particles are advanced with the 5-th order solution and the 7th stage of a step is re-used as the 1st stage of the next one (FSAL),
+       so a step of this 7-stage method costs 6 new derivatives evaluations, like a Fehlberg step, while being one order more accurate.
+    2) the step during which a particle exits the fields (z = l_B) or hits the bottom electrode (y = y_bottom_elec) is not simply the last one:
+       the exact crossing point is located inside the step using the dense output, so the returned state is ON the boundary, not beyond it.
+    The initial timestep and the PI step-size control are the ones of RK45integrator_batch().
+
+    Parameters
+    ----------
+    same as RK45integrator_batch()
+
+    Returns
+    -------
+    exited_B : np.array shape (N, ) of ints (1 if the particle has exit the fields region, 0 otherwise)
+    hit_E : np.array shape (N, ) of ints (1 if the particle has hit the bottom electrode, 0 otherwise)
+    final_states : np.array shape (N, 6) : the x,y,z, ux,uy,uz of each particle at the boundary it has reached (z = l_B or y = y_bottom_elec).
+    steps_accepted : np.array shape (N, ) of ints (number of accepted integration steps of each particle)
+    steps_rejected : np.array shape (N, ) of ints (number of rejected integration steps of each particle)
+    """
+
+    states = np.asarray(states, dtype=float)
+    no_of_parts = states.shape[0]
+    qonms = np.broadcast_to(np.asarray(qonms, dtype=float), (no_of_parts,))
+    yscal = np.asarray(yscal, dtype=float)[:3]
+    epsilon_0 = tol
+
+    exited_B = np.zeros(no_of_parts, dtype=int)
+    hit_E = np.zeros(no_of_parts, dtype=int)
+    final_states = states.copy()
+    steps_accepted = np.zeros(no_of_parts, dtype=int)
+    steps_rejected = np.zeros(no_of_parts, dtype=int)
+
+    idx = np.arange(no_of_parts)
+    vecs = states.copy()
+    qs = qonms.copy()
+    dts = initial_step_size_batch(vecs, qs, E, B, yscal, tol)
+    K1 = derivatives_batch(vecs, qs, E, B)
+    err_prev = np.full(no_of_parts, 10**(-4))
+    last_rejected = np.zeros(no_of_parts, dtype=bool)
+    if recorder is not None:
+        particle_ids = np.arange(no_of_parts) if particle_ids is None else np.asarray(particle_ids)
+        recorder.record(particle_ids, states, force=True)
+
+    counter = 0
+    while (counter <= nmax and idx.size > 0):
+        counter += 1
+        DP5, DP_err, Ks = get_DOPRI54_approx_batch(vecs, dts, K1, qs, E, B)
+        errs = np.max(np.abs(DP_err[:, :3] / yscal), axis=1) / epsilon_0 # only care about error on x,y,z and not on ux,uy,uz
+
+        # PI controller, as in RK45integrator_batch()
+        accepted = (errs <= 1.0)
+        rejected = ~accepted
+        good = accepted & (errs != 0.0)
+        facs = np.full(idx.size, facmax)
+        fac_good = safety * errs[good]**(-alpha_PI) * err_prev[good]**(beta_PI)
+        facs[good] = np.clip(fac_good, facmin, facmax)
+        facs[accepted & last_rejected] = np.minimum(facs[accepted & last_rejected], 1.0)
+        facs[rejected] = np.maximum(safety * errs[rejected]**(-0.2), facmin)
+        err_prev[accepted] = np.maximum(errs[accepted], 10**(-4))
+        last_rejected = rejected
+        steps_accepted[idx[accepted]] += 1
+        steps_rejected[idx[rejected]] += 1
+
+        # accepted steps which cross a boundary: locate the crossing inside the step
+        crosses_z = accepted & (DP5[:, 2] >= l_B)
+        crosses_y = accepted & (DP5[:, 1] >= y_bottom_elec)
+        done = crosses_z | crosses_y
+        if done.any():
+            d = np.flatnonzero(done)
+            theta_z = np.full(d.size, np.inf)
+            theta_y = np.full(d.size, np.inf)
+            cz = crosses_z[d]
+            cy = crosses_y[d]
+            if cz.any():
+                theta_z[cz] = locate_event_DOPRI54(vecs[d[cz]], dts[d[cz]], Ks[:, d[cz]], 2, l_B)
+            if cy.any():
+                theta_y[cy] = locate_event_DOPRI54(vecs[d[cy]], dts[d[cy]], Ks[:, d[cy]], 1, y_bottom_elec)
+            exits = theta_z <= theta_y # the first boundary reached wins
+            thetas = np.minimum(theta_z, theta_y)
+            at_boundary = dense_output_DOPRI54(vecs[d], dts[d], Ks[:, d], thetas)
+            at_boundary[exits, 2] = l_B
+            at_boundary[~exits, 1] = y_bottom_elec
+            exited_B[idx[d[exits]]] = 1
+            hit_E[idx[d[~exits]]] = 1
+            final_states[idx[d]] = at_boundary
+
+        vecs[accepted] = DP5[accepted]
+        if recorder is not None:
+            recorder.record(particle_ids[idx[accepted & ~done]], vecs[accepted & ~done]) # the boundary states are recorded at the end
+        K1[accepted] = Ks[6][accepted] # FSAL
+        dts = dts * facs
+
+        if done.any():
+            keep = ~done
+            idx, vecs, qs, dts, K1 = idx[keep], vecs[keep], qs[keep], dts[keep], K1[keep]
+            err_prev, last_rejected = err_prev[keep], last_rejected[keep]
+
+    final_states[idx] = vecs # particles which have done nmax iterations without exiting / hitting the electrode
+    instrumentation.count('particles_nmax_exhausted', idx.size)
+    if recorder is not None:
+        recorder.record(particle_ids, final_states, force=True)
+    return exited_B, hit_E, final_states, steps_accepted, steps_rejected
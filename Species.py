@@ -1,8 +1,120 @@
 import numpy as np
 
+# status of each particle of a ParticleBatch
+status_in_flight = 0 # not pushed yet
+status_exited = 1 # exited the E/B fields region, thus reaches the screen
+status_hit_electrode = 2 # hit the bottom electrode
+status_stuck = 3 # neither exited the fields region nor hit the electrode (e.g. turned around in the B-field)
+
+
+class ParticleBatch:
+    """ Structure-of-arrays container for many particles, replacing one Species object per particle.
+
+    The states of all the particles are kept in one contiguous np.array shape (N, 6), the layout the batch integrators work on,
+    so a ParticleBatch (or any slice of it) feeds RKint / propagation directly, with no per-particle Python objects.
+
+    Attributes
+    ----------
+    states : np.array shape (N, 6) (x,y,z, ux,uy,uz of each particle, one particle per row)
+    qonms : np.array shape (N, ) (charge/mass ratio of each particle, in SI)
+    species_ids : np.array shape (N, ) of ints (index of the species of each particle in species_names)
+    status : np.array shape (N, ) of ints (status_in_flight, status_exited, status_hit_electrode or status_stuck)
+    species_names : list of str (names of the species, as in databases.all_possible_names)
+    weights : np.array shape (N, ) (statistical weight of each particle, 1 unless drawn by a variance-reduced sampling, see sources.py)
+    x, y, z, ux, uy, uz : np.arrays shape (N, ) (views of the columns of states)
+
+    Methods
+    -------
+    sub_batches(size):
+        Yields consecutive ParticleBatch slices of at most size particles (views, not copies).
+    set_outcomes(exited_B, hit_E):
+        Sets the status of the particles from the outcome of the propagation through the fields.
+    particle(i):
+        Returns a Species view on the particle i.
+    @staticmethod
+    concatenate(batches):
+        Returns a ParticleBatch with the particles of all the batches, in order.
+    """
+
+    def __init__(self, states, qonms, species_ids=None, status=None, species_names=None, weights=None):
+        self.states = np.ascontiguousarray(states, dtype=float).reshape(-1, 6)
+        no_of_parts = self.states.shape[0]
+        self.qonms = np.ascontiguousarray(np.broadcast_to(np.asarray(qonms, dtype=float), (no_of_parts,)))
+        self.species_ids = np.zeros(no_of_parts, dtype=np.int32) if species_ids is None else np.ascontiguousarray(np.broadcast_to(np.asarray(species_ids, dtype=np.int32), (no_of_parts,)))
+        self.status = np.full(no_of_parts, status_in_flight, dtype=np.int8) if status is None else np.asarray(status, dtype=np.int8)
+        self.species_names = list(species_names) if species_names is not None else []
+        self.weights = np.ones(no_of_parts) if weights is None else np.ascontiguousarray(np.broadcast_to(np.asarray(weights, dtype=float), (no_of_parts,)))
+
+    @classmethod
+    def from_species(cls, name, mass, charge, initial_xs, initial_ys, initial_uzs, species_names, weights=None):
+        """ Creates a batch of particles of one species, entering the aperture at z = 0 with velocities along z only.
+
+        Parameters
+        ----------
+        name : str (name of the species, in species_names)
+        mass : float (mass in SI of the species), charge : float (charge in SI of the species)
+        initial_xs, initial_ys : floats or np.arrays shape (N, ) (initial x and y coordinates of the particles, in SI)
+        initial_uzs : np.array shape (N, ) (initial velocities along z of the particles, in SI)
+        species_names : list of str (the species id of the particles is the index of name in it)
+        weights : np.array shape (N, ) or None (statistical weights of the particles, see sources.py. None: 1 for all)
+        """
+
+        initial_uzs = np.asarray(initial_uzs, dtype=float)
+        states = np.zeros((initial_uzs.shape[0], 6))
+        states[:, 0] = initial_xs
+        states[:, 1] = initial_ys
+        states[:, 5] = initial_uzs
+        return cls(states, charge / mass, species_names.index(name), species_names=species_names, weights=weights)
+
+    def __len__(self):
+        return self.states.shape[0]
+
+    def __repr__(self):
+        return f'ParticleBatch(no_of_parts={len(self)}, species={sorted(set(self.species_names[i] for i in np.unique(self.species_ids).tolist())) if self.species_names else np.unique(self.species_ids).tolist()})'
+
+    def __getitem__(self, index): # slices give views, index arrays / masks give copies (as for np.arrays)
+        return ParticleBatch(self.states[index], self.qonms[index], self.species_ids[index], self.status[index], self.species_names, self.weights[index])
+
+    x = property(lambda self: self.states[:, 0])
+    y = property(lambda self: self.states[:, 1])
+    z = property(lambda self: self.states[:, 2])
+    ux = property(lambda self: self.states[:, 3])
+    uy = property(lambda self: self.states[:, 4])
+    uz = property(lambda self: self.states[:, 5])
+
+    def sub_batches(self, size):
+        for start in range(0, len(self), max(1, int(size))):
+            yield self[start:start + size]
+
+    def set_outcomes(self, exited_B, hit_E):
+        self.status[:] = status_stuck
+        self.status[np.asarray(exited_B) == 1] = status_exited
+        self.status[np.asarray(hit_E) == 1] = status_hit_electrode
+
+    def particle(self, i):
+        name = self.species_names[self.species_ids[i]] if self.species_names else ''
+        return Species._view(self, i, "{}_{}".format(name, i + 1))
+
+    @staticmethod
+    def concatenate(batches):
+        batches = list(batches)
+        if len(batches) == 0:
+            return ParticleBatch(np.zeros((0, 6)), np.zeros(0))
+        return ParticleBatch(np.concatenate([b.states for b in batches]), np.concatenate([b.qonms for b in batches]),
+                             np.concatenate([b.species_ids for b in batches]), np.concatenate([b.status for b in batches]), batches[0].species_names,
+                             np.concatenate([b.weights for b in batches]))
+
+
+def _state_component(k): # property reading / writing the component k of the state of a Species in its batch
+    return property(lambda self: float(self._batch.states[self._index, k]), lambda self, value: self._batch.states.__setitem__((self._index, k), value))
+
+
 class Species:
     """ Class used to represent 1 "particle". This is usually an ion, but can be anything as long as its name is in the list. 
 
+    A Species is a thin view on one row of a ParticleBatch: its coordinates and velocities are read from (and written to) the batch.
+    A Species created directly owns a batch of 1 particle. Many particles should be kept in a ParticleBatch, not as many Species objects.
+
     Attributes
     ----------
     _name : str
@@ -38,33 +150,34 @@ class Species:
             z_det: float, represents where the detector (screen) is placed along z-axis, in SI (meters)
     """
 
+    __slots__ = ('_name', '_mass', '_charge', '_qonm', '_batch', '_index') # no per-object __dict__
+
     def __init__(self, name, mass, charge, r, velo):
         # r is a np array of shape (3,) , velo is a np array of shape (3,)
         self._name = name # for identification purposes
         self._mass = mass # underscore means the attribute is protected
         self._charge = charge
         self._qonm = charge / mass
-        x, y, z = r # unpack the input argument to __init__()
-        self.x = x
-        self.y = y
-        self.z = z
-        #mean, sigma = distr # unpack distr (a list of 2 floats)
-        #self._mean = mean
-        #self._sigma = sigma
-        # self._no_of_parts = uzs_at_t0.shape[0]
-        #self._uzs_at_t0 = self.draw_from_Gaussian()
-        ux, uy, uz = velo # velo is an input argument to the CTOR
-        #self.ux = np.zeros( (self._no_of_parts, ) ) # at t0
-        self.ux = ux
-        self.uy = uy
-        self.uz = uz
-        #self.uy = np.zeros( (self._no_of_parts, ) ) # at t0
-        #self.uz = uzs_at_t0 # at t0
+        self._batch = ParticleBatch(np.concatenate([np.asarray(r, dtype=float), np.asarray(velo, dtype=float)]), self._qonm)
+        self._index = 0
+
+    @classmethod
+    def _view(cls, batch, index, name): # a Species looking at the particle index of batch (no copy)
+        view = cls.__new__(cls)
+        view._name = name
+        view._mass = None # not stored per particle in a ParticleBatch
+        view._charge = None
+        view._qonm = float(batch.qonms[index])
+        view._batch = batch
+        view._index = index
+        return view
+
+    x, y, z, ux, uy, uz = (_state_component(k) for k in range(6))
 
     def __str__(self):
-        return "A {} species with mass={} , charge={}, no_of_parts={},".format(self._name, self._mass, self._charge, self._no_of_parts)
+        return "A {} species with mass={} , charge={}, at r=({}, {}, {}) with u=({}, {}, {})".format(self._name, self._mass, self._charge, self.x, self.y, self.z, self.ux, self.uy, self.uz)
     def __repr__(self):
-        return f'Species(name={self._name}, mass={self._mass}, charge={self._charge}, r=[{self.x, self.y, self.z}], distr=[{self._mean, self._sigma}], no_of_parts={self._no_of_parts})'
+        return f'Species(name={self._name}, mass={self._mass}, charge={self._charge}, r=[{self.x, self.y, self.z}], velo=[{self.ux, self.uy, self.uz}])'
     
     def Species_get_xyz(self):
         return np.array([self.x, self.y, self.z]) # shape (3,)
@@ -173,8 +286,9 @@ class Source:
 
     Methods
     -------
-    draw_from_Gaussian():
-        Returns a np array shape (_no_of_parts, ) containing floats representing the initial velocities along z of the particles entering the aperture.
+    draw_from_Gaussian(rng):
+        Returns a np array shape (_no_of_parts, ) containing floats representing the initial velocities along z of the particles entering the aperture,
+        drawn from rng (a numpy.random.Generator, a fresh unseeded one if None).
     """
 
     def __init__(self, name, distr, no_of_parts):
@@ -190,6 +304,7 @@ class Source:
     def __repr__(self):
         pass
 
-    def draw_from_Gaussian(self):
-        uzs_at_t0 = np.random.normal(self._mean, self._sigma, self._no_of_parts) # returns shape (self._no_of_parts,)
+    def draw_from_Gaussian(self, rng=None):
+        rng = np.random.default_rng() if rng is None else rng
+        uzs_at_t0 = rng.normal(self._mean, self._sigma, self._no_of_parts) # returns shape (self._no_of_parts,)
         return uzs_at_t0 # a numpy array shape (self._no_of_parts, )
@@ -0,0 +1,101 @@
+""" Optional recording of particles' trajectories during the integration through the E/B fields.
+
+By default the integrators only keep the current state of each particle. For debugging runs, a Trajectory_Recorder can be handed to them:
+it records decimated samples (every k-th accepted step and/or every time the particle has advanced by dz along z) of the chosen particles only,
+into a preallocated buffer, which lives either in memory or in a memory-mapped .npy file on disk.
+"""
+
+import numpy as np
+
+
+class Trajectory_Recorder:
+    """ Preallocated buffer of trajectory samples for a chosen set of particles.
+
+    Attributes
+    ----------
+    _particle_ids : np.array shape (n, ) of ints (ids of the particles to record; the other particles are ignored)
+    _max_samples : int (maximum number of samples kept per particle. samples beyond it are dropped and counted in _dropped)
+    _every_k_steps : int or None (record every k-th accepted step of a particle)
+    _every_dz : float or None (record each time a particle has advanced by at least dz along z since its last sample)
+    _filename : str or None (if given, the buffer is a memory-mapped .npy file, so long tracks do not need to fit in memory)
+    samples : np.array shape (n, _max_samples, 6) (x,y,z, ux,uy,uz of each sample, nan where there is no sample)
+    counts : np.array shape (n, ) of ints (number of samples recorded for each particle by this process)
+
+    Methods
+    -------
+    record(ids, vecs, force=False):
+        Offers the current states of the particles ids to the recorder, which keeps the ones due for a sample.
+    get_trajectory(particle_id):
+        Returns a np.array shape (m, 6) with the m samples recorded for the particle particle_id.
+    """
+
+    def __init__(self, particle_ids, max_samples, every_k_steps=1, every_dz=None, filename=None):
+        self._particle_ids = np.asarray(particle_ids, dtype=int)
+        self._max_samples = int(max_samples)
+        self._every_k_steps = every_k_steps
+        self._every_dz = every_dz
+        self._filename = filename
+        shape = (self._particle_ids.size, self._max_samples, 6)
+        if filename is None:
+            self.samples = np.full(shape, np.nan)
+        else:
+            self.samples = np.lib.format.open_memmap(filename, mode='w+', dtype=float, shape=shape)
+            self.samples[:] = np.nan
+        self.counts = np.zeros(self._particle_ids.size, dtype=int)
+        self._dropped = np.zeros(self._particle_ids.size, dtype=int)
+        self._steps = np.zeros(self._particle_ids.size, dtype=int) # accepted steps offered so far, per recorded particle
+        self._last_z = np.full(self._particle_ids.size, -np.inf)
+        self._slot_of = {pid: i for i, pid in enumerate(self._particle_ids.tolist())} # particle id -> row of the buffer
+
+    def __repr__(self):
+        return f'Trajectory_Recorder(particle_ids={self._particle_ids.tolist()}, max_samples={self._max_samples}, every_k_steps={self._every_k_steps}, every_dz={self._every_dz}, filename={self._filename})'
+
+    def __getstate__(self): # a memory-mapped buffer is re-opened (not copied) by the worker processes
+        state = self.__dict__.copy()
+        if self._filename is not None:
+            state['samples'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._filename is not None:
+            self.samples = np.load(self._filename, mmap_mode='r+')
+
+    def record(self, ids, vecs, force=False):
+        """ Offers the current states of some particles to the recorder.
+
+        Parameters
+        ----------
+        ids : np.array shape (m, ) of ints (ids of the particles whose states are given)
+        vecs : np.array shape (m, 6) (their current x,y,z, ux,uy,uz)
+        force : bool (if True, every recorded particle among ids gets a sample, e.g. for the initial and final states,
+                      unless its last sample is already this very state, e.g. its last accepted step)
+        """
+
+        ids = np.asarray(ids)
+        wanted = np.flatnonzero(np.isin(ids, self._particle_ids)) # cheap vectorized filter, the loop below only sees the recorded particles
+        for i in wanted.tolist():
+            slot = self._slot_of[int(ids[i])]
+            due = force
+            if not force:
+                self._steps[slot] += 1
+            if not due and self._every_k_steps is not None:
+                due = (self._steps[slot] % self._every_k_steps == 0)
+            if not due and self._every_dz is not None:
+                due = (vecs[i][2] - self._last_z[slot] >= self._every_dz)
+            if not due:
+                continue
+            if force and self.counts[slot] > 0 and np.array_equal(self.samples[slot, self.counts[slot] - 1], vecs[i]):
+                continue
+            if self.counts[slot] < self._max_samples:
+                self.samples[slot, self.counts[slot]] = vecs[i]
+                self.counts[slot] += 1
+                self._last_z[slot] = vecs[i][2]
+            else:
+                self._dropped[slot] += 1
+
+    def get_trajectory(self, particle_id):
+        # samples are read back from the buffer itself (not from counts), as they may have been written by worker processes
+        slot = self._slot_of[particle_id]
+        samples = np.array(self.samples[slot])
+        return samples[~np.isnan(samples[:, 0])]
@@ -0,0 +1,280 @@
+""" Accuracy-vs-cost harness: every way of pushing particles to the screen, checked against exact solutions, at a ladder of tolerances.
+
+benchmark.py tells whether a change made the code faster or slower, not whether the particles still land at the right place on the screen.
+Here, the propagation modes are run on scenarios whose answer is known in closed form:
+
+    pure_B : B-field only (E = 0). cyclotron rotation in the x-z plane
+    pure_E : E-field only (B = 0). relativistic constant-force acceleration along y
+    EB_nonrelativistic : E || B at energies of 0.1 to 1 MeV, where the traces on the screen are the textbook parabolas
+    drift : no field. straight lines from the aperture to the screen
+    EB_zero_divergence : E || B at 1 to 10 MeV, with no divergence (u_x = u_y = 0 at the aperture): the particles the 'map' mode interpolates
+                         (with a divergence, every particle falls back to integration and the map itself is never checked)
+
+The exact screen positions are computed here independently of the propagators (the exit from the fields is found by Newton iterations on
+the closed-form z(tau), not by analytic_prop.py's inversion). Modes:
+
+    rk45_scalar : RKint.RK45integrator() particle by particle, then Species.Species_push_from_endoffields_to_detector() (the original path)
+    rk45, dopri54, analytic, map : propagation.push_batch_to_endoffields(), then propagation.push_batch_from_endoffields_to_detector()
+
+For each scenario, mode and tolerance, the harness reports the max and rms distance on the screen to the exact positions (in meters), the
+particles whose outcome differs from the exact one (exit / no exit), the derivatives evaluations per particle and the wall time, as
+cost/accuracy tables. The one-off cost of building the response map of the 'map' mode (time and derivatives evaluations) is not in the
+cost per particle: each map (one per E, B and tolerance) is built once, from scratch, before it is used, and its cost reported in a table
+of its own, whichever scenarios share it. Given a baseline (the .json written by an earlier run), a row whose error or derivatives
+evaluations (or a map build whose derivatives evaluations) grew by more than the threshold (errors below error_floor being round-off,
+they are never flagged) is a regression. The wall
+times being noisy, they only count as a regression past the wider wall_threshold and when they grew by more than wall_floor_s seconds.
+
+CLI:
+    $ python3 accuracy_harness.py [--particles 1000] [--scalar-particles 100] [--modes rk45 dopri54] [--scenarios pure_B drift] [--tols 1e-6 1e-8]
+                                  [--output accuracy.json] [--baseline old.json] [--threshold 0.1] [--wall-threshold 1.0]
+exits with status 1 if there is a regression.
+"""
+
+import os, sys, json, time, shutil, tempfile, argparse
+import numpy as np
+from scipy.constants import c
+import RKint, propagation, response_map, instrumentation, utility_fns, databases, Species
+
+# scenario -> fields, species, range of kinetic energies (in MeV) and rms divergence (in rad) of the particles
+scenarios = {
+    'pure_B': {'E': 0.0, 'B': 0.5, 'species': ['proton', 'C6+'], 'energy_MeV': (1.0, 10.0), 'divergence': 0.01},
+    'pure_E': {'E': 1e6, 'B': 0.0, 'species': ['proton', 'C6+'], 'energy_MeV': (1.0, 10.0), 'divergence': 0.01},
+    'EB_nonrelativistic': {'E': 1e5, 'B': 0.5, 'species': ['proton'], 'energy_MeV': (0.1, 1.0), 'divergence': 0.01},
+    'drift': {'E': 0.0, 'B': 0.0, 'species': ['proton', 'C6+'], 'energy_MeV': (1.0, 10.0), 'divergence': 0.01},
+    'EB_zero_divergence': {'E': 1e5, 'B': 0.5, 'species': ['proton', 'C6+'], 'energy_MeV': (1.0, 10.0), 'divergence': 0.0},
+}
+geometry = {'l_B': 0.05, 'z_det': 0.5, 'y_bottom_elec': 1.0, 'yscal': [0.05, 0.02, 0.05]} # the electrode is out of the way: every particle exits
+modes = ['rk45_scalar'] + propagation.propagation_modes
+default_tols = [1e-4, 1e-6, 1e-8, 1e-10]
+error_floor = 1e-12 # screen errors below this (in meters) are round-off, never flagged as regressions
+# metric -> -1 (smaller is better) for each compared metric of a row (the wall times are compared apart, see compare())
+compared_metrics = {'max_error_m': -1, 'outcome_mismatches': -1, 'derivative_evaluations_per_particle': -1}
+wall_metrics = ['wall_s']
+# the same for the map builds: metric -> True for a wall time
+compared_build_metrics = {'derivative_evaluations': False, 'seconds': True}
+wall_floor_s = 0.05 # growths of the wall times below this (in seconds) are timer noise, never flagged as regressions
+
+
+def scenario_particles(name, no_of_particles, seed=0):
+    """ Returns the initial states (np.array shape (N, 6)) and q/m's (np.array shape (N, )) of the particles of a scenario:
+    energies uniform in the range of the scenario, 1 mm aperture, Gaussian angles with the divergence of the scenario, the species taking turns. """
+
+    scenario = scenarios[name]
+    rng = np.random.default_rng(seed)
+    names = [scenario['species'][i % len(scenario['species'])] for i in range(no_of_particles)]
+    qonms = np.array([databases.charges[s] / databases.masses[s] for s in names])
+    speeds = utility_fns.from_KEineV_to_uzinit(rng.uniform(*scenario['energy_MeV'], no_of_particles) * (10**6))
+    angles = rng.normal(0.0, scenario['divergence'], (no_of_particles, 2))
+    states = np.zeros((no_of_particles, 6))
+    states[:, 0:2] = rng.uniform(-0.0005, 0.0005, (no_of_particles, 2))
+    states[:, 3:5] = speeds[:, None] * np.sin(angles)
+    states[:, 5] = speeds * np.sqrt(1.0 - np.sum(np.sin(angles)**2, axis=1))
+    return states, qonms
+
+
+def exact_screen_positions(states, qonms, E, B, l_B, z_det, n_newton=50):
+    """ Exact x,y on the screen (np.array shape (N, 2)) of particles starting at z = 0 in the uniform E || B fields (along +y) ending at z = l_B.
+
+    In the proper time tau, u_x and u_z rotate at Omega = qonm * B (z(tau) = [uz sin(Omega tau) + ux (1 - cos(Omega tau))] / Omega, inverted for z = l_B
+    by Newton iterations) and u_y = C sinh(phi0 + a tau / c), a = qonm * E, C^2 = c^2 + ux^2 + uz^2. Then straight lines to the screen.
+    """
+
+    x0, y0, z0, ux, uy, uz = states.T
+    omegas = qonms * B
+    rotating = (omegas != 0.0)
+    safe_omegas = np.where(rotating, omegas, 1.0)
+    taus = (l_B - z0) / uz # first guess: no rotation
+    for _ in range(n_newton):
+        thetas = omegas * taus
+        z = np.where(rotating, z0 + (uz * np.sin(thetas) + ux * 2.0 * np.sin(thetas / 2.0)**2) / safe_omegas, z0 + uz * taus)
+        taus = taus - (z - l_B) / (uz * np.cos(thetas) + ux * np.sin(thetas)) # dz/dtau = u_z(tau)
+    thetas = omegas * taus
+    x = np.where(rotating, x0 + (ux * np.sin(thetas) - uz * 2.0 * np.sin(thetas / 2.0)**2) / safe_omegas, x0 + ux * taus)
+    ux_exit = ux * np.cos(thetas) - uz * np.sin(thetas)
+    uz_exit = uz * np.cos(thetas) + ux * np.sin(thetas)
+
+    accs = qonms * E
+    accelerating = (accs != 0.0)
+    safe_accs = np.where(accelerating, accs, 1.0)
+    Cs = np.sqrt(c**2 + ux**2 + uz**2)
+    phi0 = np.arcsinh(uy / Cs)
+    half_s = accs * taus / (2.0 * c)
+    y = np.where(accelerating, y0 + (2.0 * Cs * c / safe_accs) * np.sinh(phi0 + half_s) * np.sinh(half_s), y0 + uy * taus)
+    uy_exit = Cs * np.sinh(phi0 + 2.0 * half_s)
+
+    drift = (z_det - l_B) / uz_exit
+    return np.column_stack([x + ux_exit * drift, y + uy_exit * drift])
+
+
+def push_to_screen(states, qonms, E, B, tol, mode):
+    """ Pushes the particles to the screen in mode (one of modes). Returns their x,y on the screen (nan if they did not exit) and the number of derivatives evaluations. """
+
+    yscal = np.array(geometry['yscal'])
+    if mode == 'rk45_scalar':
+        coords = np.full((states.shape[0], 2), np.nan)
+        evaluations = 0
+        for i in range(states.shape[0]):
+            exited, hit, vec, accepted, rejected = RKint.RK45integrator(*states[i], yscal, tol, geometry['l_B'], geometry['y_bottom_elec'], qonms[i], E, B)
+            evaluations += 6 * (accepted + rejected) # RKint.derivatives() is not instrumented: 6 evaluations per step
+            if exited == 1:
+                coords[i] = Species.Species.Species_push_from_endoffields_to_detector(vec, geometry['z_det'])
+        return coords, evaluations
+    with instrumentation.collecting() as metrics:
+        exited_B, hit_E, final_states, steps_accepted, steps_rejected = propagation.push_batch_to_endoffields(states, qonms, yscal, tol, geometry['l_B'], geometry['y_bottom_elec'],
+                                                                                                                E, B, mode=mode, z_det=geometry['z_det'])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            coords = propagation.push_batch_from_endoffields_to_detector(final_states, geometry['z_det'])
+    coords[exited_B != 1] = np.nan
+    return coords, metrics.timers.get('derivatives', {}).get('items', 0)
+
+
+def build_map(E, B, tol):
+    """ Builds the response map of the 'map' mode for E, B and tol from scratch (not from the cache of this process, nor from the disk cache,
+    the working directory being a fresh one), and leaves it in the cache of this process for the pushes. Returns its cost, as a map build of run_harness(). """
+
+    yscal = np.array(geometry['yscal'])[:3]
+    start = time.perf_counter()
+    with instrumentation.collecting() as metrics:
+        response_map.Response_Map(E, B, geometry['l_B'], geometry['z_det'], yscal, tol)
+    seconds = time.perf_counter() - start
+    response_map.get_response_map(E, B, geometry['l_B'], geometry['z_det'], yscal, tol) # loaded from the disk cache just written, out of the timed pushes
+    return {'E': E, 'B': B, 'tol': tol, 'seconds': seconds, 'derivative_evaluations': metrics.timers.get('derivatives', {}).get('items', 0)}
+
+
+def build_label(build):
+    return 'map E={} B={}'.format(build['E'], build['B'])
+
+
+def run_harness(scenario_names, mode_names, tols, no_of_particles, no_of_scalar_particles, seed=0):
+    """ Runs every mode at every tolerance on every scenario, in a temporary directory (where the response maps of the 'map' mode are built).
+
+    Returns
+    -------
+    dict with the settings, the rows {'scenario', 'mode', 'tol', 'particles', 'max_error_m', 'rms_error_m', 'outcome_mismatches',
+    'derivative_evaluations_per_particle', 'wall_s'} and the map builds {'E', 'B', 'tol', 'seconds', 'derivative_evaluations'} (ready to be saved as .json).
+    The response map of each E, B and tolerance of the 'map' mode is built once, from scratch, before the first particles are pushed through it,
+    so that wall_s and the derivatives evaluations per particle of the 'map' rows are those of pushing the particles through the map.
+    """
+
+    results = {'settings': {'particles': no_of_particles, 'scalar_particles': no_of_scalar_particles, 'seed': seed, 'tols': tols, 'geometry': geometry}, 'rows': [], 'map_builds': []}
+    built = set()
+    workdir = tempfile.mkdtemp(prefix='accuracy_')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        for name in scenario_names:
+            E, B = scenarios[name]['E'], scenarios[name]['B']
+            for mode in mode_names:
+                states, qonms = scenario_particles(name, no_of_scalar_particles if mode == 'rk45_scalar' else no_of_particles, seed)
+                exact = exact_screen_positions(states, qonms, E, B, geometry['l_B'], geometry['z_det'])
+                for tol in tols:
+                    if mode == 'map' and (E, B, tol) not in built:
+                        results['map_builds'].append(build_map(E, B, tol))
+                        built.add((E, B, tol))
+                    start = time.perf_counter()
+                    coords, evaluations = push_to_screen(states, qonms, E, B, tol, mode)
+                    wall = time.perf_counter() - start
+                    reached = np.isfinite(coords).all(axis=1)
+                    errors = np.hypot(*(coords[reached] - exact[reached]).T)
+                    results['rows'].append({'scenario': name, 'mode': mode, 'tol': tol, 'particles': states.shape[0],
+                                            'max_error_m': float(errors.max()) if errors.size > 0 else 0.0,
+                                            'rms_error_m': float(np.sqrt(np.mean(errors**2))) if errors.size > 0 else 0.0,
+                                            'outcome_mismatches': int((~reached).sum()), # every particle exits in these scenarios
+                                            'derivative_evaluations_per_particle': evaluations / states.shape[0],
+                                            'wall_s': wall})
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def print_tables(results):
+    """ Prints one cost/accuracy table per scenario, and the table of the map builds. """
+
+    for name in dict.fromkeys(row['scenario'] for row in results['rows']):
+        print("\n{}".format(name))
+        print("{:12s} {:>8s} {:>12s} {:>12s} {:>10s} {:>14s} {:>10s}".format('mode', 'tol', 'max err [m]', 'rms err [m]', 'mismatches', 'evals/particle', 'wall [s]'))
+        for row in results['rows']:
+            if row['scenario'] == name:
+                print("{:12s} {:>8.0e} {:>12.3e} {:>12.3e} {:>10d} {:>14.1f} {:>10.4f}".format(row['mode'], row['tol'], row['max_error_m'], row['rms_error_m'],
+                                                                                      row['outcome_mismatches'], row['derivative_evaluations_per_particle'], row['wall_s']))
+    if results.get('map_builds'):
+        print("\nmap builds")
+        print("{:24s} {:>8s} {:>12s} {:>14s}".format('fields', 'tol', 'build [s]', 'evals'))
+        for build in results['map_builds']:
+            print("{:24s} {:>8.0e} {:>12.4f} {:>14d}".format(build_label(build), build['tol'], build['seconds'], build['derivative_evaluations']))
+
+
+def compare(results, baseline, threshold=0.1, wall_threshold=1.0):
+    """ Compares results with a baseline (both as returned by run_harness()), row by row (same scenario, mode and tolerance),
+    and map build by map build (same E, B and tolerance, reported as the scenario 'map E=... B=...' of the 'map' mode). The errors and derivatives evaluations are deterministic and compared with threshold. The wall times (wall_metrics) are noisy: they are
+    compared with the wider wall_threshold, and only a growth of more than wall_floor_s seconds can be a regression.
+
+    Returns
+    -------
+    rows : list of (scenario, mode, tol, metric, baseline value, new value, bool: worse than the baseline by more than threshold)
+    """
+
+    old_rows = {(row['scenario'], row['mode'], row['tol']): row for row in baseline.get('rows', [])}
+    compared = []
+    for row in results['rows']:
+        old = old_rows.get((row['scenario'], row['mode'], row['tol']))
+        if old is None:
+            continue
+        for metric in compared_metrics:
+            regression = row[metric] > old[metric] * (1.0 + threshold) and row[metric] > old[metric]
+            if metric == 'max_error_m':
+                regression = regression and row[metric] > error_floor
+            compared.append((row['scenario'], row['mode'], row['tol'], metric, old[metric], row[metric], regression))
+        for metric in wall_metrics:
+            if metric not in old:
+                continue
+            regression = row[metric] > old[metric] * (1.0 + wall_threshold) and row[metric] - old[metric] > wall_floor_s
+            compared.append((row['scenario'], row['mode'], row['tol'], metric, old[metric], row[metric], regression))
+    old_builds = {(build['E'], build['B'], build['tol']): build for build in baseline.get('map_builds', [])}
+    for build in results.get('map_builds', []):
+        old = old_builds.get((build['E'], build['B'], build['tol']))
+        if old is None:
+            continue
+        for metric, is_wall in compared_build_metrics.items():
+            if is_wall:
+                regression = build[metric] > old[metric] * (1.0 + wall_threshold) and build[metric] - old[metric] > wall_floor_s
+            else:
+                regression = build[metric] > old[metric] * (1.0 + threshold) and build[metric] > old[metric]
+            compared.append((build_label(build), 'map', build['tol'], metric, old[metric], build[metric], regression))
+    return compared
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="Checks the accuracy on the screen and the cost of the propagation modes against exact solutions.")
+    parser.add_argument('--particles', type=int, default=1000, help="number of particles of each scenario")
+    parser.add_argument('--scalar-particles', type=int, default=100, help="number of particles of each scenario for the (slow) rk45_scalar mode")
+    parser.add_argument('--modes', nargs='+', default=modes, choices=modes)
+    parser.add_argument('--scenarios', nargs='+', default=list(scenarios.keys()), choices=list(scenarios.keys()))
+    parser.add_argument('--tols', nargs='+', type=float, default=default_tols)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='accuracy.json', help="where the results are written")
+    parser.add_argument('--baseline', default=None, help="results of an earlier run to compare with")
+    parser.add_argument('--threshold', type=float, default=0.1, help="relative growth of an error or of the derivatives evaluations counted as a regression")
+    parser.add_argument('--wall-threshold', type=float, default=1.0, help="relative growth of a wall time counted as a regression (if also more than {} s)".format(wall_floor_s))
+    args = parser.parse_args(argv)
+
+    results = run_harness(args.scenarios, args.modes, args.tols, args.particles, args.scalar_particles, args.seed)
+    print_tables(results)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print("\nResults written to {}".format(args.output))
+    if args.baseline is None:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    compared = compare(results, baseline, args.threshold, args.wall_threshold)
+    for name, mode, tol, metric, old, new, regression in compared:
+        if regression:
+            print("{:18s} {:12s} {:>8.0e} {:36s} {:>12.4g} -> {:>12.4g}  REGRESSION".format(name, mode, tol, metric, old, new))
+    return 1 if any(row[-1] for row in compared) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(cli(sys.argv[1:]))
@@ -0,0 +1,242 @@
+""" Closed-form propagation of particles through the uniform, parallel E and B fields region.
+
+For E and B both constant and both along +y (the only field setup RKint.derivatives() models), the relativistic EOMs have an exact
+solution when written in terms of the proper time tau of the particle (dt/dtau = gamma, dr/dtau = u):
+
+    u_x, u_z rotate at the constant angular frequency omega = qonm * B (cyclotron rotation in the x-z plane, u_perp conserved)
+    u_y(tau) = C sinh(phi0 + a tau / c) , with a = qonm * E , C^2 = c^2 + u_perp^2 and sinh(phi0) = u_y(0) / C
+
+so x, y, z are closed-form functions of tau, for any gamma (the non-relativistic limit being recovered for u << c).
+The exit from the fields region (z = l_B) is found by inverting z(tau) for the first positive root,
+the hit on the bottom electrode (y = y_bottom_elec) by inverting y(tau), thus no time stepping at all is needed.
+
+The only errors of this propagator are round-off errors, which get amplified for particles which exit the fields region (almost) tangentially.
+For these ones (and for the ones which turn around in the B-field before reaching l_B) the caller is told to fall back to RK45 integration.
+
+The same closed forms give a cheap pre-screen for the integrating modes (prescreen_batch()): the particles which certainly hit the bottom
+electrode before leaving the fields (by a safety margin) are not integrated at all, their state on the electrode being known exactly.
+"""
+
+import numpy as np
+from scipy.constants import c
+
+
+def exit_phase(dz, uxs, uzs, Omegas):
+    """ Returns the smallest positive rotation angle theta = Omega * tau after which z(tau) - z(0) = dz, for a cyclotron rotation in the x-z plane.
+
+    z(theta) - z(0) = [uz sin(theta) + ux (1 - cos(theta))] / Omega  is rewritten as  u_perp sin(theta - delta) = Omega dz - ux,
+    with delta = atan2(ux, uz), and inverted in closed form.
+
+    Parameters
+    ----------
+    dz : np.array shape (N, ) (distance along z to be travelled, in SI (meters))
+    uxs : np.array shape (N, ) (initial velocity along x-axis, with the sign of omega absorbed in it)
+    uzs : np.array shape (N, ) (initial velocity along z-axis)
+    Omegas : np.array shape (N, ) (|omega| = |qonm * B|, strictly positive)
+
+    Returns
+    -------
+    thetas : np.array shape (N, ) (np.nan where the particle turns around before travelling dz, i.e. the equation has no root)
+    s : np.array shape (N, ) (the sine being inverted, needed for the round-off error estimate)
+    """
+
+    u_perp = np.hypot(uxs, uzs)
+    delta = np.arctan2(uxs, uzs)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = (Omegas * dz - uxs) / u_perp
+    no_root = ~(np.abs(s) <= 1.0) # also catches nan's (u_perp = 0)
+    asin_s = np.arcsin(np.clip(s, -1.0, 1.0))
+    theta1 = np.mod(delta + asin_s, 2 * np.pi) # the 2 families of solutions of sin(theta - delta) = s
+    theta2 = np.mod(delta + np.pi - asin_s, 2 * np.pi)
+    thetas = np.minimum(theta1, theta2)
+    thetas[no_root] = np.nan
+    return thetas, s
+
+
+def proper_time_to_y(states, qonms, y_target, E):
+    """ Returns the proper time at which each particle first reaches y = y_target going up (along +y), in the uniform E-field along +y.
+
+    y(tau) - y0 = (C c / a) (cosh(phi) - cosh(phi0)), with phi = phi0 + a tau / c, does not depend on B (the rotation in the x-z plane
+    conserves u_perp, thus C), so it is inverted in closed form.
+
+    Parameters
+    ----------
+    states : np.array shape (N, 6) (initial x,y,z, ux,uy,uz of each particle)
+    qonms : np.array shape (N, ) (charge/mass ratio of each particle, in SI)
+    y_target : float or np.array shape (N, ) (in SI (meters), above the initial y of the particles)
+    E : float (value in SI (V/m) of the static electrical field)
+
+    Returns
+    -------
+    taus : np.array shape (N, ) (np.nan where y_target is never reached)
+    """
+
+    x0, y0, z0, ux0, uy0, uz0 = states.T
+    accs = qonms * E
+    Cs = np.sqrt(c**2 + ux0**2 + uz0**2)
+    phi0 = np.arcsinh(uy0 / Cs)
+    accelerating = (accs != 0.0)
+    safe_accs = np.where(accelerating, accs, 1.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        R = np.cosh(phi0) + safe_accs * (y_target - y0) / (Cs * c)
+        taus = np.where(accelerating, c * (np.arccosh(np.where(R >= 1.0, R, np.nan)) - phi0) / safe_accs,
+                        np.where(uy0 > 0.0, (y_target - y0) / uy0, np.nan))
+    taus[~(taus >= 0.0)] = np.nan
+    return taus
+
+
+def proper_time_to_z(states, qonms, z_target, B):
+    """ Returns the proper time at which each particle first reaches z = z_target, in the uniform B-field along +y (np.nan where it turns around before).
+    The rotation in the x-z plane does not depend on E. """
+
+    x0, y0, z0, ux0, uy0, uz0 = states.T
+    omegas = qonms * B
+    Omegas = np.abs(omegas)
+    rotating = (Omegas != 0.0)
+    thetas, s = exit_phase(z_target - z0, np.sign(omegas) * ux0, uz0, np.where(rotating, Omegas, 1.0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        taus = np.where(rotating, thetas / np.where(rotating, Omegas, 1.0), np.where(uz0 > 0.0, (z_target - z0) / uz0, np.nan))
+    taus[~(taus >= 0.0)] = np.nan
+    return taus
+
+
+def state_at_proper_time(states, qonms, taus, E, B):
+    """ Evaluates the closed-form solution of the EOMs in the uniform E || B fields at the proper times taus.
+
+    Parameters
+    ----------
+    states : np.array shape (N, 6) (initial x,y,z, ux,uy,uz of each particle)
+    qonms : np.array shape (N, ) (charge/mass ratio of each particle, in SI)
+    taus : np.array shape (N, ) (proper time elapsed for each particle, in SI (seconds))
+    E : float (value in SI (V/m) of the static electrical field)
+    B : float (value in SI (T) of the static magnetic field)
+
+    Returns
+    -------
+    np.array shape (N, 6) with the x,y,z, ux,uy,uz of each particle at its proper time taus.
+    """
+
+    x0, y0, z0, ux0, uy0, uz0 = states.T
+    omegas = qonms * B
+    accs = qonms * E
+    thetas = omegas * taus
+    out = np.empty_like(states)
+
+    # cyclotron rotation in the x-z plane. 1 - cos(theta) = 2 sin(theta/2)^2 avoids cancellations for small angles
+    sin_t = np.sin(thetas)
+    one_minus_cos = 2.0 * np.sin(thetas / 2.0)**2
+    rotating = (omegas != 0.0)
+    safe_omegas = np.where(rotating, omegas, 1.0)
+    out[:, 0] = np.where(rotating, x0 + (ux0 * sin_t - uz0 * one_minus_cos) / safe_omegas, x0 + ux0 * taus)
+    out[:, 2] = np.where(rotating, z0 + (uz0 * sin_t + ux0 * one_minus_cos) / safe_omegas, z0 + uz0 * taus)
+    out[:, 3] = ux0 * np.cos(thetas) - uz0 * sin_t
+    out[:, 5] = uz0 * np.cos(thetas) + ux0 * sin_t
+
+    # acceleration along y. cosh(phi0 + s) - cosh(phi0) = 2 sinh(phi0 + s/2) sinh(s/2)
+    Cs = np.sqrt(c**2 + ux0**2 + uz0**2)
+    phi0 = np.arcsinh(uy0 / Cs)
+    half_s = accs * taus / (2.0 * c)
+    accelerating = (accs != 0.0)
+    safe_accs = np.where(accelerating, accs, 1.0)
+    out[:, 1] = np.where(accelerating, y0 + (2.0 * Cs * c / safe_accs) * np.sinh(phi0 + half_s) * np.sinh(half_s), y0 + uy0 * taus)
+    out[:, 4] = Cs * np.sinh(phi0 + 2.0 * half_s)
+    return out
+
+
+def analytic_propagator_batch(states, qonms, yscal, tol, l_B, y_bottom_elec, E, B):
+    """ Propagates a batch of particles from their initial conditions to the end of the fields region (z = l_B) or to the bottom electrode.
+
+    Same returns as RKint.RK45integrator_batch(), plus a mask of the particles for which the closed-form solution is not trusted
+    (estimated round-off error above tol, or no exit from the fields region at all) and which have to be integrated by RK45 instead.
+
+    Parameters
+    ----------
+    states : np.array shape (N, 6) (initial x,y,z, ux,uy,uz of each particle, one particle per row)
+    qonms : np.array shape (N, ) (charge/mass ratio of each particle, in SI)
+    yscal : list of 3 floats (maximum values the x,y,z coordinates can attain, used to scale the error estimate as in RKint)
+    tol : float (maximum scaled error accepted. tolerances below double precision are taken as a few machine epsilons)
+    l_B : float (Geometry: the length along which E/B fields extend along z-axis, in SI (meters))
+    y_bottom_elec : float (the y-coordinate of the bottom electrode, in SI (meters))
+    E : float (value in SI (V/m) of the static electrical field)
+    B : float (value in SI (T) of the static magnetic field)
+
+    Returns
+    -------
+    exited_B : np.array shape (N, ) of ints (1 if the particle has exit the fields region, 0 otherwise)
+    hit_E : np.array shape (N, ) of ints (1 if the particle has hit the bottom electrode, 0 otherwise)
+    final_states : np.array shape (N, 6) : the x,y,z, ux,uy,uz of each particle when exiting the fields / hitting the electrode.
+    needs_fallback : np.array shape (N, ) of bools (True where RK45 integration has to be used instead)
+    """
+
+    states = np.asarray(states, dtype=float)
+    no_of_parts = states.shape[0]
+    qonms = np.broadcast_to(np.asarray(qonms, dtype=float), (no_of_parts,))
+    yscal = np.asarray(yscal, dtype=float)[:3]
+    eps = np.finfo(float).eps
+    x0, y0, z0, ux0, uy0, uz0 = states.T
+    omegas = qonms * B
+
+    # 1) proper time at which z = l_B
+    dz = l_B - z0
+    Omegas = np.abs(omegas)
+    rotating = (Omegas != 0.0)
+    thetas, s = exit_phase(dz, np.sign(omegas) * ux0, uz0, np.where(rotating, Omegas, 1.0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tau_exit = np.where(rotating, thetas / np.where(rotating, Omegas, 1.0), np.where(uz0 > 0.0, dz / uz0, np.nan))
+        # round-off error on the exit phase: relative error of theta, plus the error on s amplified by d(asin(s))/ds
+        dtheta = eps * (np.abs(thetas) + np.abs(s) / np.sqrt(np.maximum(1.0 - s**2, 0.0)))
+        dtau = np.where(rotating, dtheta / np.where(rotating, Omegas, 1.0), eps * np.abs(tau_exit))
+    exits = np.isfinite(tau_exit) & (tau_exit >= 0.0)
+
+    # 2) proper time at which y = y_bottom_elec (if ever)
+    tau_hit = proper_time_to_y(states, qonms, y_bottom_elec, E)
+    hits = np.isfinite(tau_hit) & ((~exits) | (tau_hit < tau_exit))
+
+    exited_B = (exits & ~hits).astype(int)
+    hit_E = hits.astype(int)
+    taus = np.where(hits, tau_hit, np.where(exits, tau_exit, 0.0))
+    final_states = state_at_proper_time(states, qonms, taus, E, B)
+    final_states[exited_B == 1, 2] = l_B # exactly at the end of the fields region
+
+    # 3) which particles are not trusted: an error on tau moves the particle by |u| dtau along each axis
+    scaled_errors = np.max(np.abs(final_states[:, 3:6]) * dtau[:, None] / yscal, axis=1)
+    needs_fallback = ~(exits | hits) | (exited_B.astype(bool) & ~(scaled_errors <= max(tol, 10 * eps)))
+    return exited_B, hit_E, final_states, needs_fallback
+
+
+def prescreen_batch(states, qonms, l_B, y_bottom_elec, E, B, margin=0.01):
+    """ Sorts a batch of particles into certain clips, certain passes and the uncertain band, before any integration.
+
+    A particle certainly clips if it reaches y_bottom_elec + margin |y_bottom_elec| before (1 - margin) of the proper time it needs to reach z = l_B
+    (or never reaches l_B at all), and certainly passes if it does not reach y_bottom_elec - margin |y_bottom_elec| before (1 + margin) of this time.
+    The margins keep the particles close to the corner of the electrode, whose fate the integrators decide step by step, in the uncertain band.
+
+    Parameters
+    ----------
+    states : np.array shape (N, 6) (initial x,y,z, ux,uy,uz of each particle)
+    qonms : np.array shape (N, ) (charge/mass ratio of each particle, in SI)
+    l_B : float (Geometry: the length along which E/B fields extend along z-axis, in SI (meters))
+    y_bottom_elec : float (the y-coordinate of the bottom electrode, in SI (meters))
+    E, B : floats (values in SI of the static electrical and magnetic fields)
+    margin : float (relative safety margin on the proper times and on the height of the electrode)
+
+    Returns
+    -------
+    certain_clip : np.array shape (N, ) of bools
+    certain_pass : np.array shape (N, ) of bools
+    at_electrode : np.array shape (n_clip, 6) (the x,y,z, ux,uy,uz of the certain clips when they hit the electrode, in the order of the batch)
+    """
+
+    states = np.asarray(states, dtype=float)
+    qonms = np.broadcast_to(np.asarray(qonms, dtype=float), (states.shape[0],))
+    tau_exit = proper_time_to_z(states, qonms, l_B, B)
+    tau_clip = proper_time_to_y(states, qonms, y_bottom_elec + margin * abs(y_bottom_elec), E)
+    tau_near = proper_time_to_y(states, qonms, y_bottom_elec - margin * abs(y_bottom_elec), E)
+    above = (states[:, 1] >= y_bottom_elec) # already at the electrode, as the integrators see it before their first step
+    certain_clip = above | (np.isfinite(tau_clip) & ~(tau_clip >= (1.0 - margin) * tau_exit)) # no exit: tau_exit = nan, the comparison is False
+    certain_pass = ~above & np.isfinite(tau_exit) & ~(tau_near <= (1.0 + margin) * tau_exit)
+    clips = np.flatnonzero(certain_clip)
+    tau_hit = np.where(above[clips], 0.0, proper_time_to_y(states[clips], qonms[clips], y_bottom_elec, E))
+    at_electrode = state_at_proper_time(states[clips], qonms[clips], tau_hit, E, B)
+    at_electrode[~above[clips], 1] = y_bottom_elec
+    return certain_clip, certain_pass, at_electrode
@@ -0,0 +1,163 @@
+""" Benchmarks of the whole pipeline on a fixed set of canonical Thomson Parabola scenarios, to tell whether a change made the code faster or slower.
+
+Scenarios (run specs, see simulation.py, scaled to the requested number of particles):
+    protons_mono : monoenergetic 5 MeV protons, pointlike aperture (option 1, sub-option 1)
+    C6_gaussian : C6+ ions, energies drawn from a Gaussian around 5 MeV (option 1, sub-option 2)
+    Xe_charge_scan : 5 MeV Xe ions, all charge states Xe0+ ... Xe54+, one chunk per charge state
+    aperture_option2 : 5 MeV protons from a 1 mm x 1 mm aperture, energies drawn from a Gaussian (option 2, sub-option 2)
+
+Each scenario is run in its own fresh process (so that its peak memory is its own) through the code of a run itself: the particles are drawn
+by simulation.Simulation.draw_particles() and pushed by main.push_chunks_to_screen() (memo, parallel executor, hits file, detector images,
+checkpoints), then the results are saved and plotted as main.py does. The stages are timed by the instrumentation of the run
+(see instrumentation.py, the metrics being collected for the scenario only): sampling (drawing the particles), integration (pushing them
+through the fields), drift (to the screen), output (hits file, detector images, .npz archive) and plotting. For each scenario the benchmark
+reports the particles per second (over the whole scenario, the overheads between the stages included), the derivatives evaluations per particle,
+the accepted / rejected integration steps, the peak resident memory and the time of each stage.
+
+CLI:
+    $ python3 benchmark.py [--particles 10000] [--mode rk45] [--workers 1] [--scenarios protons_mono C6_gaussian] [--output benchmark.json] [--baseline old.json] [--threshold 0.1]
+writes the results to a .json file and, given a baseline (a .json file written earlier), prints the ratio of each metric to the baseline
+and exits with status 1 if a metric got worse by more than the threshold.
+"""
+
+import os, sys, json, time, shutil, platform, resource, tempfile, argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import simulation, checkpoint, plotting, instrumentation, main
+
+geometry = {"E": 1e5, "B": 0.5, "l_E": 0.05, "D_E": 0.45, "z_det": 0.5, "y_bottom_elec": 0.02}
+scenarios = {
+    'protons_mono': [{"species": "proton", "share": 1.0, "energy_MeV": 5.0, "tol": 1e-6, "option": 1, "sub_option": 1}],
+    'C6_gaussian': [{"species": "C6+", "share": 1.0, "energy_MeV": 5.0, "tol": 1e-6, "option": 1, "sub_option": 2}],
+    'Xe_charge_scan': [{"species": "Xe%d+" % i, "share": 1.0 / 55, "energy_MeV": 5.0, "tol": 1e-6, "option": 1, "sub_option": 2} for i in range(55)],
+    'aperture_option2': [{"species": "proton", "share": 1.0, "energy_MeV": 5.0, "tol": 1e-6, "option": 2, "sub_option": 2,
+                          "aperture_x": True, "aperture_y": True, "Rx": 0.001, "Ry": 0.001}],
+}
+stages = ['sampling', 'integration', 'drift', 'output', 'plotting']
+# metric -> +1 if a larger value is better, -1 if a smaller value is better (used to flag regressions against a baseline)
+compared_metrics = {'particles_per_s': 1, 'integration_particles_per_s': 1, 'derivative_evaluations_per_particle': -1, 'steps_per_particle': -1, 'peak_rss_MB': -1}
+
+
+def scenario_spec(name, no_of_particles, mode='rk45', seed=0, n_workers=1):
+    """ Returns the run spec (see simulation.py) of the scenario name, with no_of_particles particles in total. """
+
+    chunks = []
+    for chunk in scenarios[name]:
+        chunk = dict(chunk)
+        chunk['no_of_particles'] = max(1, int(round(chunk.pop('share') * no_of_particles)))
+        chunks.append(chunk)
+    return {**simulation.default_spec, 'geometry': dict(geometry), 'propagation_mode': mode, 'n_workers': n_workers, 'seed': seed, 'chunks': chunks}
+
+
+def run_scenario(name, no_of_particles, mode='rk45', seed=0, n_workers=1):
+    """ Runs one scenario in the current process, in a temporary directory, and returns its metrics (a dict, see the docstring of this module). """
+
+    spec = scenario_spec(name, no_of_particles, mode, seed, n_workers)
+    no_of_parts = sum(chunk['no_of_particles'] for chunk in spec['chunks'])
+    workdir = tempfile.mkdtemp(prefix='benchmark_')
+    cwd = os.getcwd()
+    os.chdir(workdir) # response maps and outputs are written there
+    try:
+        with instrumentation.collecting() as run_metrics:
+            start = time.perf_counter()
+            with run_metrics.timer('sampling', no_of_parts):
+                sim = simulation.Simulation(spec)
+                particle_batches = sim.draw_particles()
+            g = spec['geometry']
+            names, tols = [chunk['species'] for chunk in spec['chunks']], [chunk['tol'] for chunk in spec['chunks']]
+            coords, big_dict, detector_histogram = main.push_chunks_to_screen(particle_batches, names, tols, sim.geometry(), mode, n_workers, 'results',
+                                                                              checkpoint.Run_Checkpoint('results_checkpoint.pkl'))
+            with run_metrics.timer('output'):
+                main.save_results('results', big_dict, g['E'], g['B'], g['l_E'], g['z_det'], g['y_bottom_elec'], tols)
+            with run_metrics.timer('plotting'):
+                plotting.plot_detector_picture(['results.pdf'], coords=[(names[k], coords[k][names[k]]) for k in range(len(names))], detector_histogram=detector_histogram,
+                                               title=name, mode=main.plot_mode)
+            wall_s = time.perf_counter() - start
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    timings = {stage: run_metrics.timers.get(stage, {}).get('seconds', 0.0) for stage in stages}
+    derivative_evaluations = run_metrics.timers.get('derivatives', {}).get('items', 0)
+    steps_accepted, steps_rejected = run_metrics.counters['steps_accepted'], run_metrics.counters['steps_rejected']
+    return {'no_of_particles': no_of_parts,
+            'mode': mode,
+            'n_workers': n_workers,
+            'wall_s': wall_s,
+            'particles_per_s': no_of_parts / wall_s,
+            'integration_particles_per_s': no_of_parts / max(timings['integration'] + timings['drift'], 1e-12),
+            'derivative_evaluations': derivative_evaluations,
+            'derivative_evaluations_per_particle': derivative_evaluations / no_of_parts,
+            'steps_accepted': steps_accepted,
+            'steps_rejected': steps_rejected,
+            'steps_per_particle': (steps_accepted + steps_rejected) / no_of_parts,
+            'memo_hit_rate': run_metrics.info.get('memo', {}).get('hit_rate', 0.0),
+            'peak_rss_MB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, # kB on Linux
+            'stage_s': timings}
+
+
+def run_benchmarks(names, no_of_particles, mode='rk45', seed=0, n_workers=1):
+    """ Runs the scenarios names, each in a fresh process, and returns the results (a dict ready to be saved as .json). """
+
+    results = {'machine': {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count()},
+               'settings': {'no_of_particles': no_of_particles, 'mode': mode, 'seed': seed, 'n_workers': n_workers},
+               'scenarios': {}}
+    for name in names:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool: # fresh process: its own peak memory
+            results['scenarios'][name] = pool.submit(run_scenario, name, no_of_particles, mode, seed, n_workers).result()
+        metrics = results['scenarios'][name]
+        print("{:18s} {:>10.0f} particles/s  {:>8.1f} derivatives evaluations/particle  {:>6.1f} steps/particle  {:>8.1f} MB  ".format(
+              name, metrics['particles_per_s'], metrics['derivative_evaluations_per_particle'], metrics['steps_per_particle'], metrics['peak_rss_MB'])
+              + "  ".join("{} {:.3f}s".format(stage, metrics['stage_s'][stage]) for stage in stages))
+    return results
+
+
+def compare(results, baseline, threshold=0.1):
+    """ Compares results with a baseline (both as returned by run_benchmarks()).
+
+    Returns
+    -------
+    rows : list of (scenario, metric, baseline value, new value, new / baseline, bool: worse than the baseline by more than threshold)
+    """
+
+    rows = []
+    for name, metrics in results['scenarios'].items():
+        if name not in baseline.get('scenarios', {}):
+            continue
+        for metric, sign in compared_metrics.items():
+            old, new = baseline['scenarios'][name][metric], metrics[metric]
+            ratio = new / old if old != 0 else np.inf if new != 0 else 1.0
+            regression = (ratio < 1.0 - threshold) if sign > 0 else (ratio > 1.0 + threshold)
+            rows.append((name, metric, old, new, ratio, regression))
+    return rows
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the Thomson Parabola simulation on canonical scenarios.")
+    parser.add_argument('--particles', type=int, default=10**4, help="number of particles of each scenario")
+    parser.add_argument('--mode', default='rk45', help="propagation mode (see propagation.py)")
+    parser.add_argument('--workers', type=int, default=1, help="number of worker processes pushing the particles (see parallel_exec.py)")
+    parser.add_argument('--scenarios', nargs='+', default=list(scenarios.keys()), choices=list(scenarios.keys()))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json', help="where the results are written")
+    parser.add_argument('--baseline', default=None, help="results of an earlier benchmark to compare with")
+    parser.add_argument('--threshold', type=float, default=0.1, help="relative change of a metric counted as a regression")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.scenarios, args.particles, args.mode, args.seed, args.workers)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print("Results written to {}".format(args.output))
+    if args.baseline is None:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    rows = compare(results, baseline, args.threshold)
+    for name, metric, old, new, ratio, regression in rows:
+        print("{:18s} {:38s} {:>14.4g} -> {:>14.4g}  x{:.3f}{}".format(name, metric, old, new, ratio, "  REGRESSION" if regression else ""))
+    return 1 if any(row[-1] for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(cli(sys.argv[1:]))
@@ -0,0 +1,94 @@
+""" Checkpoints of a run of main.py, so that an interrupted run can be resumed instead of started over.
+
+A Run_Checkpoint records every answer given to the prompts of the run, the seed the particles are drawn from, and how far the run went:
+the chunks done, the particles done in the current chunk, and how many records had been written to the hits file (see hit_store.py) at that point. The detector images (see histogram.py) are not part of it: main.py saves the image of each chunk
+to its own file when the chunk is done, and the resumed run bins again the particles of its current chunk already in the hits file.
+It is saved (atomically, by replacing the previous file) after every block of particles.
+
+Resuming ($ python3 main.py --resume name_checkpoint.pkl) replays the recorded answers instead of prompting again, re-uses the seed,
+so the very same particles are drawn, drops the records written after the last checkpoint and skips the particles already done.
+Particles do not interact and their pushing is deterministic, thus the results are bit-for-bit those of an uninterrupted run.
+"""
+
+import os, pickle
+import numpy as np
+
+
+class Run_Checkpoint:
+    """ Answers, seed and progress of a run.
+
+    Attributes
+    ----------
+    filename : str or None (where the checkpoint is saved. None until the name of the run is known)
+    answers : list of str (all the answers given to the prompts so far)
+    seed : int or None (entropy of the np.random.SeedSequence the particles of the run are drawn from)
+    chunks_done : int (number of chunks completely done)
+    particles_done : int (number of particles done in the chunk chunks_done)
+    records_written : int (number of records in the hits file at the time of the checkpoint)
+    resumed : bool (True if this checkpoint was loaded from disk)
+
+    Methods
+    -------
+    ask(prompt):
+        Replacement of input(): replays the next recorded answer when resuming, asks the user otherwise, and records the answer.
+    seed_sequence():
+        Returns the np.random.SeedSequence of the run, from fresh entropy (recorded) or from the recorded seed when resuming.
+    save(chunks_done, particles_done, records_written):
+        Records the progress of the run and writes the checkpoint to filename.
+    @classmethod
+    load(filename):
+        Returns the Run_Checkpoint saved in filename, ready to replay its answers.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.answers = []
+        self.seed = None
+        self.chunks_done = 0
+        self.particles_done = 0
+        self.records_written = 0
+        self.resumed = False
+        self._to_replay = []
+
+    def __repr__(self):
+        return f'Run_Checkpoint(filename={self.filename}, answers={len(self.answers)}, chunks_done={self.chunks_done}, particles_done={self.particles_done}, records_written={self.records_written})'
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_to_replay'] = []
+        state['resumed'] = False
+        return state
+
+    def ask(self, prompt):
+        if len(self._to_replay) > 0:
+            answer = self._to_replay.pop(0)
+            print(prompt + answer) # so that the log of the resumed run reads as the original one
+        else:
+            answer = input(prompt)
+        self.answers.append(answer)
+        return answer
+
+    def save(self, chunks_done, particles_done, records_written):
+        self.chunks_done = chunks_done
+        self.particles_done = particles_done
+        self.records_written = records_written
+        if self.filename is None:
+            return
+        with open(self.filename + '.tmp', 'wb') as f:
+            pickle.dump(self, f)
+        os.replace(self.filename + '.tmp', self.filename) # a crash during the saving keeps the previous checkpoint
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            checkpoint = pickle.load(f)
+        checkpoint.filename = filename
+        checkpoint._to_replay = list(checkpoint.answers)
+        checkpoint.answers = []
+        checkpoint.resumed = True
+        return checkpoint
+
+    def seed_sequence(self):
+        if not (self.resumed and self.seed is not None):
+            self.seed = np.random.SeedSequence().entropy
+        return np.random.SeedSequence(self.seed)
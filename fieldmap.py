@@ -0,0 +1,160 @@
+""" Non-uniform E and B fields (fringe fields, measured or simulated magnets and electrodes) given on a regular 3D grid.
+
+A field map is a directory holding:
+
+    grid.json   : {"origin": [x0, y0, z0], "spacing": [dx, dy, dz], "shape": [nx, ny, nz]} (in SI (meters))
+    fields.npy  : np.array shape (nx, ny, nz, 6), the Ex, Ey, Ez (V/m), Bx, By, Bz (T) at the nodes origin + (i*dx, j*dy, k*dz)
+
+fields.npy is memory-mapped, so only the parts of the map the particles go through are read from disk. The fields between the nodes
+are obtained by trilinear interpolation, vectorized over a whole batch of particles, and are 0 outside of the map.
+The 8 corner values of the cells are kept in a direct-mapped cache (cell number modulo the number of slots), so the many particles
+of a batch which are in the same few cells, step after step, do not gather them again from the map.
+
+With a field map, RKint's batch integrators push the particles with the full Lorentz force q/m (E + u/gamma x B) of the interpolated fields
+(see Field_Map.derivatives_batch()), up to the end of the map or of the E/B region, whichever is further along z.
+"""
+
+import os, json
+import numpy as np
+from scipy.constants import c
+import instrumentation
+
+# offsets of the 8 corners of a cell, in the order used for the trilinear weights
+corner_offsets = np.array([[i, j, k] for i in (0, 1) for j in (0, 1) for k in (0, 1)])
+
+
+class Field_Map:
+    """ A memory-mapped 3D map of the E and B fields, with vectorized trilinear interpolation.
+
+    Attributes
+    ----------
+    _dirname : str (directory of the map)
+    _origin, _spacing : np.arrays shape (3, ) (position of the node (0,0,0) and distance between nodes, along x,y,z, in SI (meters))
+    _shape : np.array shape (3, ) of ints (number of nodes along x,y,z)
+    _fields : np.memmap shape (nx, ny, nz, 6) (Ex, Ey, Ez, Bx, By, Bz at the nodes)
+    _cache_cells : np.array shape (cache_slots, ) of ints (the cell held by each slot of the cache, -1 if none)
+    _cache_values : np.array shape (cache_slots, 8, 6) (the fields at the 8 corners of these cells)
+
+    Methods
+    -------
+    fields_at(positions):
+        Returns np.array shape (N, 6) with the Ex, Ey, Ez, Bx, By, Bz at the positions of N particles.
+    derivatives_batch(vecs, qonms):
+        Same as RKint.derivatives_batch(), for the fields of the map.
+    """
+
+    def __init__(self, dirname, cache_slots=2**16):
+        self._dirname = dirname
+        with open(os.path.join(dirname, 'grid.json')) as f:
+            grid = json.load(f)
+        self._origin = np.array(grid['origin'], dtype=float)
+        self._spacing = np.array(grid['spacing'], dtype=float)
+        self._shape = np.array(grid['shape'], dtype=np.int64)
+        self._fields = np.load(os.path.join(dirname, 'fields.npy'), mmap_mode='r')
+        if tuple(self._fields.shape) != tuple(self._shape.tolist()) + (6,) or (self._shape < 2).any():
+            raise ValueError("{}: fields.npy has shape {}, grid.json asks for {} (at least 2 nodes along each axis).".format(dirname, self._fields.shape, tuple(self._shape.tolist()) + (6,)))
+        self._cache_cells = np.full(int(cache_slots), -1, dtype=np.int64)
+        self._cache_values = np.zeros((int(cache_slots), 8, 6))
+
+    def __repr__(self):
+        return f'Field_Map(dirname={self._dirname}, origin={self._origin.tolist()}, spacing={self._spacing.tolist()}, shape={self._shape.tolist()})'
+
+    @property
+    def z_start(self):
+        return float(self._origin[2])
+
+    @property
+    def z_end(self):
+        return float(self._origin[2] + self._spacing[2] * (self._shape[2] - 1))
+
+    def _corner_values(self, flat_cells):
+        # fields at the 8 corners of each cell: each distinct cell is looked up once, from the cache or else from the map
+        unique_cells, inverse = np.unique(flat_cells, return_inverse=True)
+        slots = unique_cells % self._cache_cells.shape[0]
+        cached = (self._cache_cells[slots] == unique_cells)
+        values = np.empty((unique_cells.shape[0], 8, 6))
+        values[cached] = self._cache_values[slots[cached]]
+        missing = unique_cells[~cached]
+        if missing.shape[0] > 0:
+            cells = np.column_stack(np.unravel_index(missing, tuple((self._shape - 1).tolist()))) # shape (M, 3)
+            corners = cells[:, None, :] + corner_offsets[None, :, :] # shape (M, 8, 3)
+            gathered = np.asarray(self._fields[corners[..., 0], corners[..., 1], corners[..., 2]]) # shape (M, 8, 6)
+            values[~cached] = gathered
+            self._cache_cells[slots[~cached]] = missing # when 2 cells of this batch share a slot, the last one stays
+            self._cache_values[slots[~cached]] = gathered
+        instrumentation.count('fieldmap_cells_cached', cached.sum())
+        instrumentation.count('fieldmap_cells_read', missing.shape[0])
+        return values[inverse.reshape(-1)]
+
+    def fields_at(self, positions):
+        positions = np.asarray(positions, dtype=float)
+        s = (positions - self._origin) / self._spacing # position in units of the spacing of the grid
+        inside = ((s >= 0.0) & (s <= self._shape - 1)).all(axis=1)
+        fields = np.zeros((positions.shape[0], 6))
+        if not inside.any():
+            return fields
+        s = s[inside]
+        cells = np.minimum(np.floor(s).astype(np.int64), self._shape - 2) # the last node belongs to the last cell
+        t = s - cells # position inside the cell, between 0 and 1 along each axis
+        flat_cells = np.ravel_multi_index((cells[:, 0], cells[:, 1], cells[:, 2]), tuple((self._shape - 1).tolist()))
+        weights = np.prod(np.where(corner_offsets[None, :, :] == 1, t[:, None, :], 1.0 - t[:, None, :]), axis=2) # shape (n, 8)
+        fields[inside] = np.einsum('nc,ncf->nf', weights, self._corner_values(flat_cells))
+        return fields
+
+    def derivatives_batch(self, vecs, qonms):
+        """ The 6 Right-Hand Sides of the relativistic EOMs of a batch of particles in the fields of the map: dr/dt = u/gamma, du/dt = q/m (E + u/gamma x B). """
+
+        fields = self.fields_at(vecs[:, 0:3])
+        gammas = np.sqrt( 1.0 + (np.sum(vecs[:, 3:]**2.0, axis=1) / (c**2.0)) )
+        K = np.empty_like(vecs)
+        K[:, 0:3] = vecs[:, 3:6] / gammas[:, None]
+        K[:, 3:6] = qonms[:, None] * (fields[:, 0:3] + np.cross(K[:, 0:3], fields[:, 3:6]))
+        return K
+
+
+_loaded_maps = dict() # dirname -> Field_Map, so each process opens a map once
+
+
+def get_field_map(dirname):
+    """ Returns the Field_Map of the directory dirname, opened once per process (the geometry of a run only carries the name of the directory). """
+
+    if dirname not in _loaded_maps:
+        _loaded_maps[dirname] = Field_Map(dirname)
+    return _loaded_maps[dirname]
+
+
+def save_field_map(dirname, origin, spacing, fields):
+    """ Writes a field map: fields is a np.array shape (nx, ny, nz, 6) with the Ex, Ey, Ez, Bx, By, Bz at the nodes origin + (i*dx, j*dy, k*dz). """
+
+    os.makedirs(dirname, exist_ok=True)
+    fields = np.asarray(fields, dtype=float)
+    np.save(os.path.join(dirname, 'fields.npy'), fields)
+    with open(os.path.join(dirname, 'grid.json'), 'w') as f:
+        json.dump({'origin': list(map(float, origin)), 'spacing': list(map(float, spacing)), 'shape': list(fields.shape[:3])}, f)
+    _loaded_maps.pop(dirname, None)
+
+
+def fringe_field_map(dirname, E, B, l_B, fringe, x_range, y_range, z_range, shape):
+    """ Writes the map of the E || B (along +y) fields of main.py, with soft edges: the fields rise and fall along z as
+    f(z) = (tanh(z / fringe) - tanh((z - l_B) / fringe)) / 2 instead of being switched on at z = 0 and off at z = l_B.
+    To keep the fields curl-free (first order in y, measured from the mid-plane y = 0), they get the z-components E y f'(z) and B y f'(z).
+
+    Parameters
+    ----------
+    E, B : floats (strength of the fields in the middle of the region, in SI)
+    l_B : float (length of the region, between the half-height points of the fields, in SI (meters))
+    fringe : float (length of the fringes, in SI (meters). fringe -> 0 gives the hard-edged fields of main.py)
+    x_range, y_range, z_range : tuples (min, max) (extent of the map, in SI (meters))
+    shape : tuple of 3 ints (number of nodes along x, y, z)
+    """
+
+    xs, ys, zs = [np.linspace(r[0], r[1], n) for r, n in zip([x_range, y_range, z_range], shape)]
+    profile = 0.5 * (np.tanh(zs / fringe) - np.tanh((zs - l_B) / fringe))
+    slope = 0.5 / fringe * (np.tanh((zs - l_B) / fringe)**2 - np.tanh(zs / fringe)**2) # f'(z)
+    fields = np.zeros(tuple(shape) + (6,))
+    fields[..., 1] = E * profile[None, None, :]
+    fields[..., 2] = E * ys[None, :, None] * slope[None, None, :]
+    fields[..., 4] = B * profile[None, None, :]
+    fields[..., 5] = B * ys[None, :, None] * slope[None, None, :]
+    spacing = [(r[1] - r[0]) / (n - 1) for r, n in zip([x_range, y_range, z_range], shape)]
+    save_field_map(dirname, [x_range[0], y_range[0], z_range[0]], spacing, fields)
@@ -0,0 +1,264 @@
+""" On-the-fly 2D histograms (images) of the hits on the detector screen, one image per species.
+
+Instead of keeping the x,y of every particle, the hits are binned into a pixel grid as the blocks of particles come back from the fields,
+so the memory used is O(pixels) instead of O(particles) and the detector image exists as soon as the run ends.
+
+The images can count the particles, or weight each of them by its kinetic energy (in MeV) or by its charge (in units of e).
+Each hit is also multiplied by the statistical weight of its particle (1 unless it was drawn by a variance-reduced sampling, see sources.py),
+so the images of weighted particles are unbiased estimates of the images of plainly sampled ones.
+Histograms with the same grids are merged by summing their images: partial() gives an empty histogram with the grids of this one
+(e.g. for a worker, a shard of the hits file or a point of a sweep), and merge() (or +=) adds a partial image to the total one.
+
+The grid of a species is either given (extents), and then fixed, or set from the hits of this species. Hits falling outside a fixed grid
+are not binned, their total weight is kept in outside[species] (and a warning is logged).
+A grid set from the hits only depends on the bounding box of all the hits of the species so far, widened by a margin: it is the aligned grid
+(pixels a power of 2 of meters wide, starting at a multiple of their width) with the narrowest pixels covering the widened box.
+When hits fall outside of the box, the grid grows: its pixels can only get wider (by powers of 2), so each new pixel is the sum of whole
+old pixels and no hit is lost or moved to another pixel than the one it would have had in the grown grid. Histograms of the same hits
+thus end up with the same grid whatever the order of the blocks, and grids of different widths (e.g. those set by the different shards
+of a hits file from their own hits) are merged the same way, on the grid of the union of their boxes.
+"""
+
+import os, logging
+import numpy as np
+from scipy.constants import e as e_charge
+import hit_store, databases, Species, instrumentation
+
+histogram_weightings = ['counts', 'energy', 'charge']
+
+
+def hit_weights(weighting, mass, charge, final_states):
+    """ Weight of each hit on the screen.
+
+    Parameters
+    ----------
+    weighting : str (one of histogram_weightings)
+    mass : float (mass of the species, in SI (Kg's))
+    charge : float (charge of the species, in SI (C's))
+    final_states : np.array shape (n, 6) (x,y,z, ux,uy,uz of the particles at the end of the fields, their flight to the screen being ballistic)
+
+    Returns
+    -------
+    np.array shape (n, ): 1, the kinetic energy in MeV, or the charge in units of e, of each particle
+    """
+
+    n = final_states.shape[0]
+    if weighting == 'counts':
+        return np.ones(n)
+    if weighting == 'energy':
+        return 0.5 * mass * np.einsum('ij,ij->i', final_states[:, 3:6], final_states[:, 3:6]) / e_charge / (10**6)
+    if weighting == 'charge':
+        return np.full(n, charge / e_charge)
+    raise ValueError("Unknown weighting '{}'. Choose from {}.".format(weighting, histogram_weightings))
+
+
+def _aligned_extent(low, high, n):
+    # the extent of n pixels of the narrowest power of 2 width which cover [low, high], starting at a multiple of their width
+    width = 2.0**np.ceil(np.log2((high - low) / n))
+    while np.floor(high / width) - np.floor(low / width) + 1 > n:
+        width *= 2.0
+    start = np.floor(low / width) * width
+    return (float(start), float(start + n * width))
+
+
+def _rebinned(image, extents, new_extents):
+    # the image of the aligned grid extents summed into the pixels of the aligned grid new_extents (whose pixels are 2**k times as wide)
+    pixel_maps = []
+    for axis, n in enumerate(image.shape):
+        width, new_width = (extents[axis][1] - extents[axis][0]) / n, (new_extents[axis][1] - new_extents[axis][0]) / n
+        scale = int(round(new_width / width))
+        pixel_maps.append((int(round(extents[axis][0] / width)) + np.arange(n)) // scale - int(round(new_extents[axis][0] / new_width)))
+    # the old pixels mapped outside of the new grid are empty ones, of the margin of the old grid
+    within = ((pixel_maps[0] >= 0) & (pixel_maps[0] < image.shape[0]))[:, None] & ((pixel_maps[1] >= 0) & (pixel_maps[1] < image.shape[1]))[None, :]
+    flat = (pixel_maps[0][:, None] * image.shape[1] + pixel_maps[1][None, :])[within]
+    return np.bincount(flat, weights=image[within], minlength=image.size).reshape(image.shape)
+
+
+class Detector_Histogram:
+    """ Per-species images of the detector screen, accumulated block by block and mergeable by summing.
+
+    Attributes
+    ----------
+    n_bins : tuple of 2 ints (number of pixels along x and along y)
+    weighting : str (one of histogram_weightings)
+    extents : dict (species name -> ((x_min, x_max), (y_min, y_max)), the grid of this species, in SI (meters))
+    fixed : set of str (the species whose grid was given, thus does not grow)
+    bounds : dict (species name -> ((x_min, y_min), (x_max, y_max)), the bounding box of all the hits binned, which sets the grid of the species if not fixed)
+    images : dict (species name -> np.array shape n_bins, the summed weights of the hits in each pixel. images[s][i, j] is pixel x_i, y_j)
+    outside : dict (species name -> float, summed weights of the hits falling outside a fixed grid)
+    _margin : float (fraction of the width of the hits added on each side when a grid is set or grown from them)
+
+    Methods
+    -------
+    add(species, coords_at_detector, mass, charge, final_states, weights=None):
+        Bins the hits of a block of particles of a species.
+    partial():
+        Returns an empty Detector_Histogram with the same pixel grids.
+    merge(other):
+        Adds the images of other to this histogram (aligned grids being merged on the coarser one, fixed grids having to be the same).
+    edges(species):
+        Returns the x and y edges of the pixels of the grid of the species.
+    save(filename):
+        Saves the images, grids and settings to a .npz archive (written to a temporary file, then renamed).
+    @classmethod
+    load(filename):
+        Returns the Detector_Histogram saved in filename.
+    """
+
+    def __init__(self, n_bins=(512, 512), weighting='counts', extents=None, margin=0.05):
+        if weighting not in histogram_weightings:
+            raise ValueError("Unknown weighting '{}'. Choose from {}.".format(weighting, histogram_weightings))
+        self.n_bins = (int(n_bins[0]), int(n_bins[1]))
+        self.weighting = weighting
+        self.extents = {} if extents is None else {species: (tuple(extent[0]), tuple(extent[1])) for species, extent in extents.items()}
+        self.fixed = set(self.extents.keys())
+        self.bounds = {}
+        self.images = {}
+        self.outside = {}
+        self._margin = margin
+
+    def __repr__(self):
+        return f'Detector_Histogram(n_bins={self.n_bins}, weighting={self.weighting}, species={list(self.images.keys())}, total={[float(image.sum()) for image in self.images.values()]})'
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def _set_grid(self, species, lows, highs):
+        # grid of a species: given, or the aligned grid of the bounding box of its hits (lows, highs included) widened by the margin (at least 0.1 mm on each side)
+        if species not in self.images:
+            self.images[species] = np.zeros(self.n_bins)
+            self.outside[species] = 0.0
+        if species in self.fixed:
+            return
+        if species in self.bounds:
+            lows, highs = np.minimum(lows, self.bounds[species][0]), np.maximum(highs, self.bounds[species][1])
+        self.bounds[species] = (tuple(float(low) for low in lows), tuple(float(high) for high in highs))
+        pads = np.maximum(self._margin * (np.asarray(highs) - np.asarray(lows)), 1e-4)
+        new_extents = tuple(_aligned_extent(lows[axis] - pads[axis], highs[axis] + pads[axis], self.n_bins[axis]) for axis in range(2))
+        if new_extents != self.extents.get(species):
+            self._regrid(species, new_extents)
+
+    def _regrid(self, species, new_extents):
+        if species in self.extents:
+            self.images[species] = _rebinned(self.images[species], self.extents[species], new_extents)
+        self.extents[species] = new_extents
+
+    def add(self, species, coords_at_detector, mass, charge, final_states, weights=None):
+        """ Bins the hits of a block of particles of one species. The particles which did not reach the screen (nan coordinates) are ignored.
+
+        Parameters
+        ----------
+        species : str (name of the species)
+        coords_at_detector : np.array shape (n, 2) (x, y on the screen)
+        mass, charge : floats (of the species, in SI)
+        final_states : np.array shape (n, 6) (states at the end of the fields, used by the energy weighting)
+        weights : np.array shape (n, ) or None (statistical weights of the particles. None: 1 for all)
+        """
+
+        reached = np.isfinite(coords_at_detector).all(axis=1)
+        coords = coords_at_detector[reached]
+        if coords.shape[0] == 0:
+            return
+        weights = hit_weights(self.weighting, mass, charge, final_states[reached]) * (1.0 if weights is None else np.asarray(weights, dtype=float)[reached])
+        self._set_grid(species, coords.min(axis=0), coords.max(axis=0))
+        (x_min, x_max), (y_min, y_max) = self.extents[species]
+        ix = np.floor((coords[:, 0] - x_min) / (x_max - x_min) * self.n_bins[0]).astype(np.int64)
+        iy = np.floor((coords[:, 1] - y_min) / (y_max - y_min) * self.n_bins[1]).astype(np.int64)
+        if species in self.fixed:
+            inside = (ix >= 0) & (ix < self.n_bins[0]) & (iy >= 0) & (iy < self.n_bins[1])
+        else: # the grid covers all the hits, up to the rounding of the division at its edges
+            ix, iy = np.clip(ix, 0, self.n_bins[0] - 1), np.clip(iy, 0, self.n_bins[1] - 1)
+            inside = np.ones(ix.shape[0], dtype=bool)
+        self.images[species] += np.bincount(ix[inside] * self.n_bins[1] + iy[inside], weights=weights[inside], minlength=self.n_bins[0] * self.n_bins[1]).reshape(self.n_bins)
+        if not inside.all():
+            if self.outside[species] == 0.0:
+                instrumentation.log_event(logging.WARNING, 'histogram_hits_outside', species=species, extents=self.extents[species], hits=int((~inside).sum()))
+            self.outside[species] += float(weights[~inside].sum())
+
+    def partial(self):
+        histogram = Detector_Histogram(self.n_bins, self.weighting, None, self._margin)
+        histogram.extents, histogram.fixed, histogram.bounds = dict(self.extents), set(self.fixed), dict(self.bounds)
+        return histogram
+
+    def merge(self, other):
+        if other.n_bins != self.n_bins or other.weighting != self.weighting:
+            raise ValueError("Cannot merge {} into {}: different pixels or weighting.".format(other, self))
+        for species, image in other.images.items():
+            if species not in self.images:
+                self.images[species] = np.zeros(self.n_bins)
+                self.outside[species] = 0.0
+            if species not in self.extents or species in self.fixed or species in other.fixed:
+                if species in self.extents and self.extents[species] != other.extents[species]:
+                    raise ValueError("Cannot merge the images of {}: different grids {} and {}.".format(species, self.extents[species], other.extents[species]))
+                self.extents[species] = other.extents[species]
+                if species in other.fixed:
+                    self.fixed.add(species)
+                if species in other.bounds:
+                    self.bounds[species] = other.bounds[species]
+            else: # both on the grid of the union of their bounding boxes
+                self._set_grid(species, *other.bounds[species])
+                if other.extents[species] != self.extents[species]:
+                    image = _rebinned(image, other.extents[species], self.extents[species])
+            self.images[species] += image
+            self.outside[species] += other.outside[species]
+        return self
+
+    def edges(self, species):
+        (x_min, x_max), (y_min, y_max) = self.extents[species]
+        return np.linspace(x_min, x_max, self.n_bins[0] + 1), np.linspace(y_min, y_max, self.n_bins[1] + 1)
+
+    def save(self, filename):
+        species = list(self.images.keys())
+        temporary = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(temporary, 'wb') as f:
+            np.savez_compressed(f, species=np.array(species, dtype=str), n_bins=np.array(self.n_bins), weighting=np.array(self.weighting), margin=np.array(self._margin),
+                                extents=np.array([self.extents[s] for s in species], dtype=float).reshape(len(species), 2, 2),
+                                fixed=np.array([s in self.fixed for s in species], dtype=bool),
+                                bounds=np.array([self.bounds.get(s, ((np.nan, np.nan), (np.nan, np.nan))) for s in species], dtype=float).reshape(len(species), 2, 2),
+                                outside=np.array([self.outside[s] for s in species], dtype=float),
+                                images=np.array([self.images[s] for s in species], dtype=float).reshape((len(species),) + self.n_bins))
+        os.replace(temporary, filename) # a crash during the saving keeps the previous images
+
+    @classmethod
+    def load(cls, filename):
+        archive = np.load(filename)
+        species = archive['species'].tolist()
+        fixed = archive['fixed'].tolist() if 'fixed' in archive.files else [True] * len(species) # images saved before the grids could grow
+        histogram = cls(tuple(archive['n_bins'].tolist()), str(archive['weighting']), None, float(archive['margin']))
+        for i, s in enumerate(species):
+            histogram.extents[s] = tuple(tuple(extent) for extent in archive['extents'][i].tolist())
+            if fixed[i]:
+                histogram.fixed.add(s)
+            else:
+                histogram.bounds[s] = tuple(tuple(bound) for bound in archive['bounds'][i].tolist())
+            histogram.images[s] = archive['images'][i].copy()
+            histogram.outside[s] = float(archive['outside'][i])
+        return histogram
+
+
+def histogram_from_hits(hits_dir, histogram, chunk=None):
+    """ Bins all the particles of a hits file (see hit_store.py) which reached the screen, one partial histogram per shard, merged into histogram.
+
+    Parameters
+    ----------
+    hits_dir : str (the hits directory of a run)
+    histogram : Detector_Histogram (the partial images are added to it, which is returned)
+    chunk : int or None (if given, only the particles of this chunk are binned)
+    """
+
+    reader = hit_store.Hit_Reader(hits_dir)
+    for shard in reader.shards():
+        partial = histogram.partial()
+        exited = (np.asarray(shard['status']) == Species.status_exited)
+        if chunk is not None:
+            exited &= (np.asarray(shard['chunk']) == chunk)
+        species_ids = np.asarray(shard['species_id'])[exited]
+        coords = np.column_stack([np.asarray(shard['screen_x'])[exited], np.asarray(shard['screen_y'])[exited]])
+        final_states = np.column_stack([np.asarray(shard[name])[exited] for name in ['exit_x', 'exit_y', 'exit_z', 'exit_ux', 'exit_uy', 'exit_uz']])
+        weights = np.asarray(shard['weight'])[exited] if reader.has_column('weight') else np.ones(species_ids.shape[0]) # runs written before the weights were stored
+        for species_id in np.unique(species_ids).tolist():
+            name = databases.all_possible_names[species_id]
+            of_species = (species_ids == species_id)
+            partial.add(name, coords[of_species], databases.masses[name], databases.charges[name], final_states[of_species], weights[of_species])
+        histogram.merge(partial)
+    return histogram
@@ -0,0 +1,197 @@
+""" Streaming, columnar on-disk storage of the particles reaching (or not) the detector screen.
+
+A run is stored in a directory, with one sub-directory (a shard) per writer, holding one raw binary file per column:
+
+    run_dir/columns.json                      (name and dtype of the columns)
+    run_dir/shard_<writer name>/<column>.bin  (the values of this column for all the records of this writer, appended in order)
+
+Records are buffered by the writer and appended block_size records at a time, so the memory used does not grow with the number of particles
+and a crashed run keeps everything written before the crash. Each writer only ever appends to its own shard, thus several processes
+can write to the same run at the same time without any locking. A reader memory-maps the column files; a record is complete once it is
+in all the columns of its shard, so the reader keeps, for each shard, the records present in all its columns.
+It can therefore open a run which is still being written, and call refresh() to see the new records.
+"""
+
+import os, json
+import numpy as np
+import Species
+
+# the columns of a record, one record per particle
+hit_columns = [('species_id', '<i4'), # index of the species in databases.all_possible_names
+               ('particle_id', '<i8'), # index of the particle in the run (running over all the chunks)
+               ('chunk', '<i4'), # index of the chunk of particles
+               ('status', '<i1'), # Species.status_exited, status_hit_electrode or status_stuck
+               ('screen_x', '<f8'), ('screen_y', '<f8'), # x, y on the detector screen (nan if the particle does not reach it)
+               ('exit_x', '<f8'), ('exit_y', '<f8'), ('exit_z', '<f8'), ('exit_ux', '<f8'), ('exit_uy', '<f8'), ('exit_uz', '<f8'), # state at the end of the fields
+               ('weight', '<f8')] # statistical weight of the particle (1 unless drawn by a variance-reduced sampling, see sources.py)
+
+
+class Hit_Writer:
+    """ Appends records to one shard of a run, block_size records at a time.
+
+    Attributes
+    ----------
+    _run_dir : str (directory of the run)
+    _shard_dir : str (sub-directory written by this writer)
+    _block_size : int (records are buffered and written to disk block_size at a time)
+    _files : dict (column name -> file opened in append mode)
+    _buffer : list of dicts (column name -> np.array) not written yet
+    records_written : int (number of records already on disk)
+    (keep_records : int or None. if given, the shard is cut back to its first keep_records records, e.g. to resume a run from a checkpoint)
+
+    Methods
+    -------
+    append(species_ids, particle_ids, chunk, status, coords_at_detector, final_states, weights=None):
+        Buffers the records of a batch of particles, and writes full blocks to disk.
+    flush():
+        Writes all the buffered records to disk.
+    close():
+        Flushes and closes the column files.
+    """
+
+    def __init__(self, run_dir, writer_name=None, block_size=2**14, keep_records=None):
+        self._run_dir = run_dir
+        writer_name = str(os.getpid()) if writer_name is None else str(writer_name)
+        self._shard_dir = os.path.join(run_dir, 'shard_{}'.format(writer_name))
+        self._block_size = max(1, int(block_size))
+        os.makedirs(self._shard_dir, exist_ok=True)
+        columns_file = os.path.join(run_dir, 'columns.json')
+        if not os.path.exists(columns_file): # the same content for all writers, so a race between writers is harmless
+            with open(columns_file, 'w') as f:
+                json.dump(hit_columns, f)
+        if keep_records is not None:
+            for name, dtype in hit_columns:
+                filename = os.path.join(self._shard_dir, '{}.bin'.format(name))
+                with open(filename, 'ab') as f:
+                    f.truncate(min(os.path.getsize(filename), keep_records * np.dtype(dtype).itemsize))
+        self._files = {name: open(os.path.join(self._shard_dir, '{}.bin'.format(name)), 'ab') for name, dtype in hit_columns}
+        self._buffer = []
+        self._buffered = 0
+        self.records_written = os.path.getsize(os.path.join(self._shard_dir, '{}.bin'.format(hit_columns[0][0]))) // np.dtype(hit_columns[0][1]).itemsize
+
+    def __repr__(self):
+        return f'Hit_Writer(shard_dir={self._shard_dir}, block_size={self._block_size}, records_written={self.records_written}, buffered={self._buffered})'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, species_ids, particle_ids, chunk, status, coords_at_detector, final_states, weights=None):
+        """ Buffers the records of a batch of particles. Full blocks are written to disk straight away.
+
+        Parameters
+        ----------
+        species_ids : np.array shape (n, ) of ints (or an int, for all the particles)
+        particle_ids : np.array shape (n, ) of ints
+        chunk : int or np.array shape (n, ) of ints
+        status : np.array shape (n, ) of ints (see Species.ParticleBatch.status)
+        coords_at_detector : np.array shape (n, 2) (x, y on the screen; set to nan here for the particles which do not reach it)
+        final_states : np.array shape (n, 6) (x,y,z, ux,uy,uz at the end of the fields)
+        weights : np.array shape (n, ) or None (statistical weights of the particles. None: 1 for all)
+        """
+
+        particle_ids = np.asarray(particle_ids)
+        n = particle_ids.shape[0]
+        status = np.asarray(status)
+        reached = (status == Species.status_exited)
+        coords_at_detector = np.where(reached[:, None], coords_at_detector, np.nan)
+        final_states = np.asarray(final_states, dtype=float)
+        values = [species_ids, particle_ids, chunk, status, coords_at_detector[:, 0], coords_at_detector[:, 1]] + [final_states[:, i] for i in range(6)] + [1.0 if weights is None else weights]
+        self._buffer.append({name: np.ascontiguousarray(np.broadcast_to(np.asarray(value, dtype=dtype), (n,))) for (name, dtype), value in zip(hit_columns, values)})
+        self._buffered += n
+        if self._buffered >= self._block_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffered == 0:
+            return
+        for name, dtype in hit_columns:
+            self._files[name].write(np.concatenate([block[name] for block in self._buffer]).tobytes())
+            self._files[name].flush() # visible to the readers from now on
+        self.records_written += self._buffered
+        self._buffer = []
+        self._buffered = 0
+
+    def close(self):
+        self.flush()
+        for f in self._files.values():
+            f.close()
+        self._files = dict()
+
+
+class Hit_Reader:
+    """ Memory-mapped, read-only view on all the shards of a run, which can be opened while the run is still being written.
+
+    Attributes
+    ----------
+    _run_dir : str (directory of the run)
+    _columns : list of (name, dtype) (read from columns.json)
+    _shards : dict (shard name -> dict column name -> np.memmap of the complete records of this shard)
+
+    Methods
+    -------
+    refresh():
+        Re-maps the column files, to see the records written since the last refresh.
+    has_column(name):
+        Returns True if the run stores the column name (the runs written by older versions lack some of hit_columns).
+    shards():
+        Returns a list with, for each shard, a dict column name -> np.memmap of its complete records (to go through a run shard by shard).
+    column(name):
+        Returns a np.array with the values of the column name, for the records of all the shards.
+    select(chunk=None, status=None):
+        Returns a dict column name -> np.array with the records of the given chunk and/or status only.
+    screen_coords(chunk):
+        Returns a np.array shape (n, 2) with the x, y on the screen of the particles of the chunk which reached it, in particle_id order.
+    """
+
+    def __init__(self, run_dir):
+        self._run_dir = run_dir
+        with open(os.path.join(run_dir, 'columns.json')) as f:
+            self._columns = [tuple(column) for column in json.load(f)]
+        self.refresh()
+
+    def __repr__(self):
+        return f'Hit_Reader(run_dir={self._run_dir}, shards={len(self._shards)}, records={len(self)})'
+
+    def __len__(self):
+        return sum(shard[self._columns[0][0]].shape[0] for shard in self._shards.values())
+
+    def refresh(self):
+        self._shards = dict()
+        for entry in sorted(os.listdir(self._run_dir)):
+            shard_dir = os.path.join(self._run_dir, entry)
+            if not (entry.startswith('shard_') and os.path.isdir(shard_dir)):
+                continue
+            filenames = {name: os.path.join(shard_dir, '{}.bin'.format(name)) for name, dtype in self._columns}
+            if not all(os.path.exists(filename) for filename in filenames.values()):
+                continue
+            count = min(os.path.getsize(filenames[name]) // np.dtype(dtype).itemsize for name, dtype in self._columns) # complete records only
+            self._shards[entry] = {name: (np.memmap(filenames[name], dtype=dtype, mode='r', shape=(count,)) if count > 0 else np.zeros(0, dtype=dtype))
+                                   for name, dtype in self._columns}
+
+    def has_column(self, name):
+        return name in dict(self._columns)
+
+    def shards(self):
+        return list(self._shards.values())
+
+    def column(self, name):
+        pieces = [shard[name] for shard in self._shards.values()]
+        if len(pieces) == 0:
+            return np.zeros(0, dtype=dict(self._columns)[name])
+        return pieces[0] if len(pieces) == 1 else np.concatenate(pieces)
+
+    def select(self, chunk=None, status=None):
+        mask = np.ones(len(self), dtype=bool)
+        if chunk is not None:
+            mask &= (self.column('chunk') == chunk)
+        if status is not None:
+            mask &= (self.column('status') == status)
+        return {name: np.asarray(self.column(name)[mask]) for name, dtype in self._columns}
+
+    def screen_coords(self, chunk):
+        records = self.select(chunk=chunk, status=Species.status_exited)
+        order = np.argsort(records['particle_id'], kind='stable')
+        return np.column_stack([records['screen_x'][order], records['screen_y'][order]])
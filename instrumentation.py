@@ -0,0 +1,194 @@
+""" Instrumentation of a run: levelled logging, counters, timers and an optional sampling profiler, written as a JSON metrics file at the end of the run.
+
+Nothing is printed per particle any more. The hot paths report to the module-level Run_Metrics `metrics`, which is None while the
+instrumentation is disabled, so the cost of a disabled instrumentation is one global lookup and one `is None` test per call of RKint.derivatives_batch()
+(and per block of particles elsewhere). Use:
+
+    instrumentation.enable()                 # metrics = Run_Metrics()
+    instrumentation.count('particles_exited', n)
+    with instrumentation.timer('plotting'):
+        ...
+    instrumentation.metrics.save('name_metrics.json')
+
+The worker processes of parallel_exec.py collect their own Run_Metrics, which are merged into the one of the main process.
+
+Messages go through the standard logging module, to the logger named 'ThomsonParabola' (see configure_logging()), as an event name
+followed by key=value fields, e.g. "chunk_done chunk=0 species=proton particles=1000 seconds=1.25".
+"""
+
+import json, time, signal, logging, contextlib
+from collections import Counter
+
+logger = logging.getLogger('ThomsonParabola')
+metrics = None # the Run_Metrics of the current process, None while the instrumentation is disabled
+
+
+def configure_logging(level='INFO'):
+    """ Sends the messages of level >= level ('DEBUG', 'INFO', 'WARNING', ...) to the standard error stream. """
+
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+        logger.addHandler(handler)
+    logger.setLevel(level)
+
+
+def log_event(level, event, **fields):
+    """ Logs the event name followed by its key=value fields (formatted only if the level is enabled). """
+
+    if logger.isEnabledFor(level):
+        logger.log(level, ' '.join([event] + ['{}={}'.format(key, value) for key, value in fields.items()]))
+
+
+class Run_Metrics:
+    """ Counters and timers of a run.
+
+    Attributes
+    ----------
+    counters : collections.Counter (name -> count, e.g. 'steps_accepted', 'particles_hit_electrode')
+    timers : dict (name -> {'seconds': total time, 'calls': number of timed calls, 'items': number of items (e.g. particles) processed by these calls})
+    chunks : list of dicts (one per chunk of particles: its timer and outcome counts, see record_chunk())
+    info : dict (anything else worth keeping with the metrics, e.g. the settings of the run)
+
+    Methods
+    -------
+    count(name, n=1):
+        Adds n to the counter name.
+    add_time(name, seconds, items=0):
+        Adds a timed call to the timer name.
+    timer(name, items=0):
+        Context manager timing its block into the timer name.
+    record_chunk(**fields):
+        Appends the metrics of a chunk of particles.
+    merge(snapshot):
+        Adds the counters and timers of a snapshot (e.g. from a worker process).
+    snapshot():
+        Returns the counters and timers as a plain dict.
+    save(filename):
+        Writes all the metrics to a JSON file.
+    """
+
+    def __init__(self):
+        self.counters = Counter()
+        self.timers = dict()
+        self.chunks = []
+        self.info = dict()
+        self._start = time.perf_counter()
+
+    def __repr__(self):
+        return f'Run_Metrics(counters={dict(self.counters)}, timers={list(self.timers.keys())}, chunks={len(self.chunks)})'
+
+    def count(self, name, n=1):
+        self.counters[name] += int(n)
+
+    def add_time(self, name, seconds, items=0):
+        timer = self.timers.setdefault(name, {'seconds': 0.0, 'calls': 0, 'items': 0})
+        timer['seconds'] += seconds
+        timer['calls'] += 1
+        timer['items'] += int(items)
+
+    @contextlib.contextmanager
+    def timer(self, name, items=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start, items)
+
+    def record_chunk(self, **fields):
+        self.chunks.append(fields)
+
+    def merge(self, snapshot):
+        self.counters.update(snapshot['counters'])
+        for name, timer in snapshot['timers'].items():
+            total = self.timers.setdefault(name, {'seconds': 0.0, 'calls': 0, 'items': 0})
+            for key in total:
+                total[key] += timer[key]
+
+    def snapshot(self):
+        return {'counters': dict(self.counters), 'timers': {name: dict(timer) for name, timer in self.timers.items()}}
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'wall_s': time.perf_counter() - self._start, **self.snapshot(), 'chunks': self.chunks, 'info': self.info}, f, indent=1, default=float)
+
+
+def enable():
+    """ Starts collecting metrics in this process (a new, empty Run_Metrics). Returns it. """
+
+    global metrics
+    metrics = Run_Metrics()
+    return metrics
+
+
+def disable():
+    global metrics
+    metrics = None
+
+
+def count(name, n=1):
+    if metrics is not None:
+        metrics.count(name, n)
+
+
+@contextlib.contextmanager
+def timer(name, items=0):
+    if metrics is None:
+        yield
+    else:
+        with metrics.timer(name, items):
+            yield
+
+
+@contextlib.contextmanager
+def collecting():
+    """ Collects the metrics of its block into a fresh Run_Metrics (yielded), the metrics of the process being restored afterwards (used by the workers). """
+
+    global metrics
+    previous = metrics
+    metrics = Run_Metrics()
+    try:
+        yield metrics
+    finally:
+        metrics = previous
+
+
+class Sampling_Profiler:
+    """ Statistical profiler of the main process: every interval seconds of CPU time, the Python stack being executed is sampled.
+
+    The samples are written in the "collapsed stacks" format (one line per distinct stack: "module:function;module:function;... count"),
+    read by flame graph tools (e.g. flamegraph.pl, speedscope). Relies on signal.setitimer(), i.e. on a Unix-like system;
+    only the main thread of the main process is sampled (not the worker processes).
+
+    Methods
+    -------
+    start():
+        Starts sampling.
+    stop(filename):
+        Stops sampling and writes the collapsed stacks to filename.
+    """
+
+    def __init__(self, interval=0.005):
+        self._interval = interval
+        self._samples = Counter()
+
+    def __repr__(self):
+        return f'Sampling_Profiler(interval={self._interval}, samples={sum(self._samples.values())})'
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            stack.append('{}:{}'.format(frame.f_globals.get('__name__', '?'), frame.f_code.co_name))
+            frame = frame.f_back
+        self._samples[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self._interval, self._interval)
+
+    def stop(self, filename):
+        signal.setitimer(signal.ITIMER_PROF, 0.0, 0.0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        with open(filename, 'w') as f:
+            for stack, samples in self._samples.most_common():
+                f.write('{} {}\n'.format(stack, samples))
@@ -1,15 +1,32 @@
-import Species, Geometry, utility_fns, databases, RKint # why not from TS_mypkg import ... ? <--- gives ERROR
+import Species, Geometry, utility_fns, databases, propagation, regions, tolerance_tuning, parallel_exec, memo, hit_store, checkpoint, sources, histogram, plotting, instrumentation, Trajectory # why not from TS_mypkg import ... ? <--- gives ERROR
+import os, sys, time, shutil, logging
 import numpy as np
-from matplotlib import pyplot as plt
-from matplotlib.pyplot import cm # facilitates an easy workflow to have a different color for each curve on the plot at the end
 
 all_possible_names = databases.all_possible_names
 masses = databases.masses
 charges = databases.charges
+batch_size = 10**4 # how many particles of a chunk are pushed together through the E/B fields (and sent at once to a worker process)
+memo_maxsize = 10**4 # how many unique (q/m, initial state) results are remembered over the run, to push identical particles only once
+gaussian_sampling = 'plain' # how the u_z's of the sub-option 2 chunks (Gaussian) are drawn: 'plain', or 'importance' / 'stratified' to populate the high-energy tail, the particles then carrying statistical weights (see sources.py)
+gaussian_tail_decades = 6 # decades of the tail probability of the Gaussian sampled evenly by the 'importance' and 'stratified' samplings
+histogram_bins = (512, 512) # pixels (along x, along y) of the detector image of each species
+histogram_weighting = 'counts' # what the pixels of the detector images sum up: 'counts', 'energy' (kinetic energies in MeV) or 'charge' (charges in units of e)
+plot_mode = 'auto' # how the detector screen pictures are drawn: 'auto', 'scatter', 'rasterized' or 'density' (see plotting.py)
+plot_formats = ['pdf'] # one picture is saved per format, e.g. ['pdf', 'png']
+log_level = 'INFO' # messages of this level and above are shown: 'DEBUG' (e.g. every sub-batch done by a worker), 'INFO' (every chunk, and the progress of the workers), 'WARNING', ...
+progress_interval = 10.0 # at most how many seconds between two messages (at INFO level) with the particles done by each worker. None: only at DEBUG level, after every sub-batch
+metrics_enabled = True # if True, counters and timers of the run are written to name_metrics.json at the end of the run (see instrumentation.py)
+profile_interval = None # if set (in seconds of CPU time), the main process is sampled by instrumentation.Sampling_Profiler and the samples written to name_profile.txt
+field_map = None # directory of a map of non-uniform E and B fields (e.g. with fringe fields, see fieldmap.py). if set, it replaces the uniform E and B fields (rk45 and dopri54 modes only)
+target_screen_accuracy = 10**(-6) # accuracy (in meters, on the detector screen) to which the tolerance of the chunks answered 'auto' is tuned (see tolerance_tuning.py)
+checkpoint_every = 10**5 # how many particles of a chunk are pushed between two checkpoints of the run
+trajectory_particle_ids = [] # for debugging runs: ids (index over all the chunks, as particle_id in the hits file) of the particles whose trajectories through the fields are recorded to name_trajectories.npy (see Trajectory.py)
+trajectory_max_samples = 10**3 # samples kept per recorded particle
+trajectory_every_k_steps = 1 # one sample every k accepted integration steps of a recorded particle
 """
 # Geometry explanation: initial velocity of particles along z axis.
 # E and B fields parallel one to each other and oriented along positive y direction.
-# Both E and B fields stop (instantly go to 0 value) at same z location, denoted by l_B below.
+# Both E and B fields stop (instantly go to 0 value) at same z location, denoted by l_B below, unless the lengths l_E and l_B (or the z's at which the fields start) given by the user differ (see regions.py).
 # Both E and B fields are constant and not influenced in any way by the passing, moving, particles.
 # The code asks for geometry input from the user.
 
@@ -23,52 +40,59 @@ charges = databases.charges
 # Option 2 allows to interacetively select an aperture which is non-pointlike only along X or only along Y, or along both directions (thus 3 different possibilities if option 2 is chosen)
 """
 
-def dictated_by_1(no_of_parts, input_MeVs, opt1_velosopt_value):
+def dictated_by_1(no_of_parts, input_MeVs, opt1_velosopt_value, velocity_file=None, rng=None, sampling='plain', tail_decades=6):
     """  Method to return initial conditions for a chunk of particles inputted using option 1.
 
-    Returns 2 things:
+    Returns 3 things:
     1) Returns a list of len 1 containing a np.array of size (3,). Array contains the x,y,z initial coordinates of the particles from the chunk.
     2) Returns a np.array of shape (no_of_parts, ) containing the initial velocities along z axis of the particles from the chunk.
     The velocities are obtained by drawing from a Gaussian distribution with mean equal to the input argument input_MeVs of this function and sigma = mean/10.
+    3) Returns a np.array of shape (no_of_parts, ) containing the statistical weights of the particles (all 1 unless the Gaussian is drawn with variance-reduced sampling).
 
     Parameters
     ----------
     no_of_parts : int (how many particles of a given species to deal with)
     input_MeVs : float (mean KEnergy, in MeVs)
     opt1_velosopt_value : int (0, 1, 2, or 3)
+    velocity_file : str (for sub-option 3: .npy or .csv file whose last column holds the initial velocities along z, see sources.File_Source)
+    rng : numpy.random.Generator or None (what the velocities are drawn from. None: a fresh unseeded one)
+    sampling : str (sub-option 2 only: 'plain', 'importance' or 'stratified', see sources.py)
+    tail_decades : int (sub-option 2 only: decades of the tail probability sampled evenly by the 'importance' and 'stratified' samplings)
 
 
     Returns
     -------
-    list of len 1, np.array shape (no_of_parts, )
+    list of len 1, np.array shape (no_of_parts, ), np.array shape (no_of_parts, )
     """
 
     uz_init = utility_fns.from_KEineV_to_uzinit(input_MeVs * (10**6))
+    weights = np.ones(no_of_parts)
 
     if (opt1_velosopt_value == 1): # return same velocity for all particles
         initial_uzs = np.empty( (no_of_parts,) )
         initial_uzs.fill(uz_init)
     elif (opt1_velosopt_value == 2): # draw from a gaussian
-        initial_uzs = Species.Source('Source_for_1', np.array([uz_init, uz_init/10.0]), no_of_parts).draw_from_Gaussian() # a np array shape (no_of_parts, )
+        rng = np.random.default_rng() if rng is None else rng
+        initial_uzs, weights = sources.Gaussian_Source(input_MeVs, sampling=sampling, tail_decades=tail_decades).draw_weighted_speeds(rng, no_of_parts) # np arrays shape (no_of_parts, )
     elif(opt1_velosopt_value == 3): # get velocities from an input file
-        print("You need to provide the input file! For the moment, I will just return garbage values.")
-        initial_uzs = np.empty( (no_of_parts,) )
+        initial_uzs = sources.File_Source(velocity_file).read_uzs(no_of_parts)
     else:
         print("I cannot get the initial velocities of the particles from this chunk because the sub-option introduced differs from 0, 1, or 2. I will just return random values (garbage in Python)")
         initial_uzs = np.empty( (no_of_parts,) )
 
     initial_coords = np.array([0.0, 0.0, 0.0]) # x, y, z
 
-    return [initial_coords], initial_uzs # initial coords is a np.array shape (3,), initial_uzs is shape (no_of_parts, )
+    return [initial_coords], initial_uzs, weights # initial coords is a np.array shape (3,), initial_uzs and weights are shape (no_of_parts, )
 
 
-def dictated_by_2(no_of_parts, input_MeVs, Xtrue, Ytrue, Rx, Ry, opt2_velosopt_value): # dispersion due to aperture for fixed incident MeV energy
+def dictated_by_2(no_of_parts, input_MeVs, Xtrue, Ytrue, Rx, Ry, opt2_velosopt_value, velocity_file=None, rng=None, sampling='plain', tail_decades=6): # dispersion due to aperture for fixed incident MeV energy
     """  Method to return initial conditions for a chunk of particles inputted using option 2.
 
-    Returns 2 things:
+    Returns 3 things:
     1) Returns a list of len 2 containing 2 np.arrays of size (no_of_parts, ). Array contains the x (and y respectively in the 2nd array), initial coordinates of the particles from the chunk.
     2) Returns a np.array of shape (no_of_parts, ) containing the initial velocities along z axis of the particles from the chunk.
     Initial velocities returned array is filled with the exact same float.
+    3) Returns a np.array of shape (no_of_parts, ) containing the statistical weights of the particles (all 1 unless the Gaussian is drawn with variance-reduced sampling).
 
     Parameters
     ----------
@@ -77,12 +101,19 @@ def dictated_by_2(no_of_parts, input_MeVs, Xtrue, Ytrue, Rx, Ry, opt2_velosopt_v
     Rx : float (major (minor) axis of the aperture, in SI units (meters), X-axis)
     Ry : float (minor (major) axis of the aperture, in SI units (meters), Y-axis)
     opt2_velosopt_value : int (0, 1, 2, or 3)
+    velocity_file : str (for sub-option 3: .npy or .csv file whose last column holds the initial velocities along z, see sources.File_Source)
+    rng : numpy.random.Generator or None (what the positions over the aperture and the velocities are drawn from. None: a fresh unseeded one)
+    sampling : str (sub-option 2 only: 'plain', 'importance' or 'stratified', see sources.py)
+    tail_decades : int (sub-option 2 only: decades of the tail probability sampled evenly by the 'importance' and 'stratified' samplings)
 
     Returns
     -------
-    list of len 2, np.array shape (no_of_parts, )
+    list of len 2, np.array shape (no_of_parts, ), np.array shape (no_of_parts, )
     """
 
+    rng = np.random.default_rng() if rng is None else rng
+    weights = np.ones(no_of_parts)
+
     want_aperture_notpointlike_along_x = Xtrue
     want_aperture_notpointlike_along_y = Ytrue
 
@@ -92,26 +123,25 @@ def dictated_by_2(no_of_parts, input_MeVs, Xtrue, Ytrue, Rx, Ry, opt2_velosopt_v
         initial_uzs = np.empty( (no_of_parts,) ) # shape (no_of_parts, ), same float in all the no_of_parts locations of the array
         initial_uzs.fill(uz_init)    
     elif (opt2_velosopt_value == 2):
-        initial_uzs = Species.Source('Source_for_2_2', np.array([uz_init, uz_init/10.0]), no_of_parts).draw_from_Gaussian() # returns a np array shape (self._no_of_parts, )
+        initial_uzs, weights = sources.Gaussian_Source(input_MeVs, sampling=sampling, tail_decades=tail_decades).draw_weighted_speeds(rng, no_of_parts) # np arrays shape (no_of_parts, )
     elif (opt2_velosopt_value == 3):
-        print("need to provide the input file")
-        initial_uzs = np.empty( (no_of_parts,) ) # garbage values
+        initial_uzs = sources.File_Source(velocity_file).read_uzs(no_of_parts)
 
     if (want_aperture_notpointlike_along_x == True and want_aperture_notpointlike_along_y == False):
-        initial_xs = np.random.uniform(0, 1, no_of_parts) * Rx # aperture has radius 0.005 m = 0.5 cm. top x = 0. , bottom x = 0.01 m, center x = 0.005m
+        initial_xs = rng.uniform(0, 1, no_of_parts) * Rx # aperture has radius 0.005 m = 0.5 cm. top x = 0. , bottom x = 0.01 m, center x = 0.005m
         initial_ys = np.zeros(no_of_parts)
     elif (want_aperture_notpointlike_along_x == False and want_aperture_notpointlike_along_y == True):
-        initial_ys = np.random.uniform(0, 1, no_of_parts) * Ry # aperture has radius 0.005 m = 0.5 cm. top y = 0. , bottom y = 0.01 m, center y = 0.005m
+        initial_ys = rng.uniform(0, 1, no_of_parts) * Ry # aperture has radius 0.005 m = 0.5 cm. top y = 0. , bottom y = 0.01 m, center y = 0.005m
         initial_xs = np.zeros(no_of_parts)
     elif (want_aperture_notpointlike_along_x == True and want_aperture_notpointlike_along_y == True):
-        initial_xs = np.random.uniform(0, 1, no_of_parts) * Rx # aperture has radius 0.005 m = 0.5 cm. top coord = 0. , bottom coord = 0.01 m, center coord = 0.005m
-        initial_ys = np.random.uniform(0, 1, no_of_parts) * Ry
+        initial_xs = rng.uniform(0, 1, no_of_parts) * Rx # aperture has radius 0.005 m = 0.5 cm. top coord = 0. , bottom coord = 0.01 m, center coord = 0.005m
+        initial_ys = rng.uniform(0, 1, no_of_parts) * Ry
     
-    return [initial_xs, initial_ys] , initial_uzs
+    return [initial_xs, initial_ys] , initial_uzs, weights
     #initial_coords_container = []
     #initial_coords_container.append([0.0, 0.0, initial_xs[i]] for i in range(no_of_parts))
 
-def get_particles_init_conds(no_of_parts, input_MeV, what_you_want_to_do, Xtrue, Ytrue, Rx, Ry, opt1_velosopt_value, opt2_velosopt_value):
+def get_particles_init_conds(no_of_parts, input_MeV, what_you_want_to_do, Xtrue, Ytrue, Rx, Ry, opt1_velosopt_value, opt2_velosopt_value, velocity_file=None, rng=None, sampling='plain', tail_decades=6):
     """ This function is used to return initial x,y,z coordinates of the particles and initial velocities along z-axis of the particles FROM A GIVEN CHUNK.
     
     Given how many particles of a given species you simulate, their initial KEnergy (mean or fixed, depending on option choice), the option choice (and if option is 2, aperture type)
@@ -127,6 +157,9 @@ def get_particles_init_conds(no_of_parts, input_MeV, what_you_want_to_do, Xtrue,
     or are drawn from a Gaussian Distr with mean and sigma=mean/10 (option 2_2)
     or come from an input file (option 2_3).
 
+    The Gaussian of options 1_2 and 2_2 can be drawn with variance-reduced sampling (sampling = 'importance' or 'stratified', see sources.py),
+    populating its high-energy tail with particles of statistical weights below 1 (the weights are 1 for the other options).
+
     Parameters
     ----------
     no_of_parts : int ()
@@ -138,32 +171,33 @@ def get_particles_init_conds(no_of_parts, input_MeV, what_you_want_to_do, Xtrue,
     Ry : float (minor (major) axis of the aperture, in SI units (meters)). only used in this function if option was chosen to be 2 for this chunk.
     opt1_velosopt_value : int (0, 1, 2 or 3)
     opt2_velosopt_value : int (0, 1, 2 or 3)
+    velocity_file : str or None (only used for sub-option 3: the file holding the initial velocities along z, see sources.File_Source)
+    rng : numpy.random.Generator or None (what the random positions and velocities are drawn from, e.g. seeded per chunk. None: a fresh unseeded one)
+    sampling : str ('plain', 'importance' or 'stratified': how the Gaussian of sub-option 2 is drawn)
+    tail_decades : int (decades of the tail probability sampled evenly by the 'importance' and 'stratified' samplings)
 
     Returns
     -------
-    list of len 1 or 2, np.array shape (no_of_parts, )
+    list of len 1 or 2, np.array shape (no_of_parts, ) (initial velocities along z), np.array shape (no_of_parts, ) (statistical weights)
     """
 
     if (what_you_want_to_do == 1): # aperture is pointlike (xinit = yinit = zinit = 0.0), no aperture effects considered.
-        initial_coords, initial_uzs = dictated_by_1(no_of_parts, input_MeV, opt1_velosopt_value) # returned initial_coords is a list of 3 floats
-        return initial_coords, initial_uzs # initial coords is a list of len 1. initial_uzs is np.array of shape (no_of_parts, )
+        initial_coords, initial_uzs, weights = dictated_by_1(no_of_parts, input_MeV, opt1_velosopt_value, velocity_file, rng, sampling, tail_decades) # returned initial_coords is a list of 3 floats
+        return initial_coords, initial_uzs, weights # initial coords is a list of len 1. initial_uzs and weights are np.arrays of shape (no_of_parts, )
     else:
         if (what_you_want_to_do == 2): # aperture effects are considered. can get velocities from conversion(input_MeV) or to draw from Gaussian or to get them from input file.
-            initial_coords, initial_uzs = dictated_by_2(no_of_parts, input_MeV, Xtrue, Ytrue, Rx, Ry, opt2_velosopt_value)
-            return initial_coords, initial_uzs # initial coords is a list of len 2. initial_uzs is np.array of shape (no_of_parts, )
+            initial_coords, initial_uzs, weights = dictated_by_2(no_of_parts, input_MeV, Xtrue, Ytrue, Rx, Ry, opt2_velosopt_value, velocity_file, rng, sampling, tail_decades)
+            return initial_coords, initial_uzs, weights # initial coords is a list of len 2. initial_uzs and weights are np.arrays of shape (no_of_parts, )
         else:
             print("say again what you want to do?")
 
 
-def create_Species_Objects(name, mass, charge, r, velo, no_of_particles, dict_to_put_in): # creates 100 (say) Species objects, all of same species
-    """ This function creates no_of_particles objects of Species-type, based on the species characteristics and initial conditions.
+def create_ParticleBatch(name, mass, charge, r, velo, no_of_particles, weights=None): # creates 100 (say) particles, all of same species
+    """ This function creates a ParticleBatch of no_of_particles particles, based on the species characteristics and initial conditions.
 
     Based on the name of the species (proton, Carbon0+, Carbon1+..., Carbon6+, Xe0+, ... Xe54+) and its mass and charge,
-    together with initial x,y,z coordinates and initial ux,uy,uz velocities, creates no_of_particles objects of Species type and
-    stores them in a dictionary dict_to_put_in.
-    Object number 1 is stored as the value for the key = 'particle_1', object number 2 is stored at the value for the key = 'particle_2' ...
-    up until the counter reaches no_of_particles and the last object is stored for the key = 'particle_%d' % (no_of_particles).
-    Returns the dictionary created with these objects as its values for its keys.
+    together with initial x,y,z coordinates and initial ux,uy,uz velocities, fills the columns of a Species.ParticleBatch
+    (one row per particle, no per-particle Python object).
 
     Parameters
     ----------
@@ -175,43 +209,174 @@ def create_Species_Objects(name, mass, charge, r, velo, no_of_particles, dict_to
     if len 2, r[0][i] is the initial x-coordinate in SI of the particle i (i runs from 0 to no_of_particles-1), r[1][i] is the initial y-coordinate in SI of the smae particle
     velo : list len no_of_particles (contains the initial z-velocities in SI of the particles you want to be initiated)
     no_of_particles : int (how many particles you want to be initiated)
-    dict_to_put_in : dictionary (returned 'container' which holds the initiated particles, i.e. the initiated Species objects)
+    weights : np.array shape (no_of_particles, ) or None (statistical weights of the particles. None: 1 for all)
 
     Returns
     -------
-    dict_to_put_in : dictionary containing as its keys' values the Species objects created by this function using the input parameters.
+    Species.ParticleBatch with the no_of_particles particles, their species id being the index of name in all_possible_names.
     """
 
-    # nonlocal Species_Objs_dict
-    for i in range(no_of_particles): # for each particle out of this chunk of 100 (say) particles
-        if (len(r) == 1): # it's option 1 then
-            coords = r[0] # np array shape (3,)
-        else:
-            coords = np.empty( (3,) )
-            if (len(r) == 2): # it's option 2 then
-                coords[0] = r[0][i] # the x for this particle
-                coords[1] = r[1][i] # the y for this particle
-                coords[2] = 0.0 # the z for this particle
+    if (len(r) == 1): # it's option 1 then
+        initial_xs, initial_ys = r[0][0], r[0][1]
+    elif (len(r) == 2): # it's option 2 then
+        initial_xs, initial_ys = r[0], r[1]
+    else:
+        print("Error at creating the batch of particles!")
+        # raise ValueError('A very specific bad thing happened.')
+    return Species.ParticleBatch.from_species(name, mass, charge, initial_xs, initial_ys, np.asarray(velo, dtype=float)[:no_of_particles], all_possible_names,
+                                             None if weights is None else np.asarray(weights, dtype=float)[:no_of_particles])
+
+def push_chunks_to_screen(particle_batches, names, tols, geometry, propagation_mode, n_workers, title_of_graph, run_checkpoint, yscals=None, trajectory_ids=()):
+    """ Pushes all the chunks of particles to the detector screen, streaming the results to disk and checkpointing the run as it goes.
+
+    Parameters
+    ----------
+    particle_batches : list of Species.ParticleBatch or sources.Source_Batch (one per chunk of particles, sliced checkpoint_every particles at a time)
+    names : list of str (name of the species of each chunk)
+    tols : list of floats (integration tolerance of each chunk)
+    geometry : dict with keys 'E', 'B', 'l_B', 'y_bottom_elec', 'z_det', 'yscal', 'field_map', 'l_E', 'z_E', 'z_B' (see parallel_exec.push_sub_batch())
+    propagation_mode : str (one of propagation.propagation_modes)
+    n_workers : int (how many worker processes push the particles of each chunk in parallel)
+    title_of_graph : str (the records of the particles are written to the directory title_of_graph + '_hits')
+    run_checkpoint : checkpoint.Run_Checkpoint (saved after each block of checkpoint_every particles. if resumed, the work it records as done is skipped)
+    yscals : list of np.arrays shape (3, ) or None's, or None (yscal of each chunk, see tolerance_tuning.tune_chunks(). None: the yscal of the geometry)
+    trajectory_ids : list of ints (ids over the whole run of the particles whose trajectories are recorded to title_of_graph + '_trajectories.npy', one row
+                     per id in this order, see Trajectory.Trajectory_Recorder. these particles are pushed without the memo. empty: no recording)
+
+    Returns
+    -------
+    final_coords_at_detectorscreen : list of dictionaries {name of the chunk: np.array shape (n, 2) with the x,y on the screen of the n particles of the chunk reaching it}
+    big_dict : dictionary with all the keys-values pairs of final_coords_at_detectorscreen (a later chunk of the same species overwrites an earlier one)
+    detector_histogram : histogram.Detector_Histogram (the detector image of each species, all chunks of a species together, binned as the particles come back)
+    """
+
+    # the particles are streamed to disk (see hit_store.py) as their chunks finish, instead of being kept in memory until the end of the run
+    hits_dir = '{}_hits'.format(title_of_graph)
+    # the detector images are not part of the checkpoint: the image of each chunk is saved to its own file when the chunk is done,
+    # and a run resumed in the middle of a chunk bins again the particles of this chunk already in the hits file
+    images_dir = '{}_image_chunks'.format(title_of_graph)
+    detector_histogram = histogram.Detector_Histogram(histogram_bins, histogram_weighting)
+    if run_checkpoint.resumed: # keep what was written up to the last checkpoint
+        hit_writer = hit_store.Hit_Writer(hits_dir, writer_name='main', keep_records=run_checkpoint.records_written)
+        for k in range(run_checkpoint.chunks_done):
+            detector_histogram.merge(histogram.Detector_Histogram.load(os.path.join(images_dir, 'chunk_{}.npz'.format(k))))
+    else:
+        shutil.rmtree(hits_dir, ignore_errors=True) # a new run with the same name overwrites the previous one, as for the .npz file
+        shutil.rmtree(images_dir, ignore_errors=True)
+        os.makedirs(images_dir)
+        hit_writer = hit_store.Hit_Writer(hits_dir, writer_name='main')
+        run_checkpoint.save(0, 0, 0)
+    executor = parallel_exec.Parallel_Executor(n_workers, batch_size, progress_interval)
+    recorder = None
+    if len(trajectory_ids) > 0: # memory-mapped, so the worker processes write to it too
+        recorder = Trajectory.Trajectory_Recorder(trajectory_ids, trajectory_max_samples, trajectory_every_k_steps, filename='{}_trajectories.npy'.format(title_of_graph))
+    propagation_memo = memo.Propagation_Memo(memo_maxsize)
+    for k in range(len(particle_batches)): # for each chunk of particles
+        if (k < run_checkpoint.chunks_done): # already done before the run was interrupted
+            continue
+        name_of_particles_from_chunk = names[k]
+        particle_ids_offset = sum(len(particle_batches[i]) for i in range(k))
+        chunk_geometry = {**geometry, 'tol': tols[k]}
+        if yscals is not None and yscals[k] is not None:
+            chunk_geometry['yscal'] = yscals[k]
+        total_steps_accepted, total_steps_rejected, no_of_parts_pushed = 0, 0, 0
+        chunk_outcomes = np.zeros(4, dtype=int) # number of particles of the chunk in flight (none at the end), exited, hit the electrode, stuck (see Species.status_*)
+        chunk_start = time.perf_counter()
+        counters_before = dict() if instrumentation.metrics is None else dict(instrumentation.metrics.counters)
+        chunk_histogram = detector_histogram.partial() # the image of this chunk only
+        if run_checkpoint.particles_done > 0: # resumed in the middle of this chunk
+            histogram.histogram_from_hits(hits_dir, chunk_histogram, chunk=k)
+        # the chunk is done checkpoint_every particles at a time, with a checkpoint after each block
+        for start in range(run_checkpoint.particles_done, len(particle_batches[k]), checkpoint_every):
+            batch = particle_batches[k][start:start + checkpoint_every]
+            # push the particles of this block batch_size at a time, the batches being shared between the n_workers worker processes
+            # identical particles (same q/m and initial state, whatever their species) are pushed only once, see memo.py (blocks without any go straight to the executor)
+            particle_ids = particle_ids_offset + start + np.arange(len(batch))
+            if recorder is not None and np.isin(particle_ids, trajectory_ids).any(): # the recorded particles need their own ids, which the memo would merge
+                pushed = executor.push_chunk(batch.states, batch.qonms, chunk_geometry, propagation_mode, name_of_particles_from_chunk, recorder, particle_ids)
             else:
-                print("Error at creating Species objects!")
-                # raise ValueError('A very specific bad thing happened.')
+                pushed = propagation_memo.push(batch.states, batch.qonms, chunk_geometry, propagation_mode,
+                                               lambda unique_states, unique_qonms: executor.push_chunk(unique_states, unique_qonms, chunk_geometry, propagation_mode, name_of_particles_from_chunk))
+            exited_Bs, hit_Es, results_at_endoffields, steps_accepted, steps_rejected, coords_at_detector_all = pushed
+            batch.set_outcomes(exited_Bs, hit_Es)
+            chunk_outcomes += np.bincount(batch.status, minlength=4) # the particles which do not reach the screen are counted, not printed one by one
+            output_start = time.perf_counter()
+            hit_writer.append(batch.species_ids, particle_ids, k, batch.status, coords_at_detector_all, results_at_endoffields, batch.weights)
+            hit_writer.flush()
+            chunk_histogram.add(name_of_particles_from_chunk, np.where((batch.status == Species.status_exited)[:, None], coords_at_detector_all, np.nan),
+                                   masses[name_of_particles_from_chunk], charges[name_of_particles_from_chunk], results_at_endoffields, batch.weights)
+            run_checkpoint.save(k, start + len(batch), hit_writer.records_written)
+            if instrumentation.metrics is not None:
+                instrumentation.metrics.add_time('output', time.perf_counter() - output_start, len(batch))
+            total_steps_accepted, total_steps_rejected, no_of_parts_pushed = total_steps_accepted + steps_accepted.sum(), total_steps_rejected + steps_rejected.sum(), no_of_parts_pushed + len(batch)
+        chunk_histogram.save(os.path.join(images_dir, 'chunk_{}.npz'.format(k))) # before the checkpoint which records the chunk as done
+        detector_histogram.merge(chunk_histogram)
+        run_checkpoint.save(k + 1, 0, hit_writer.records_written)
+        chunk_metrics = {'chunk': k, 'species': name_of_particles_from_chunk, 'particles': no_of_parts_pushed, 'seconds': time.perf_counter() - chunk_start,
+                         'steps_accepted': int(total_steps_accepted), 'steps_rejected': int(total_steps_rejected), 'exited': int(chunk_outcomes[Species.status_exited]),
+                         'hit_electrode': int(chunk_outcomes[Species.status_hit_electrode]), 'stuck': int(chunk_outcomes[Species.status_stuck]), 'memo_hit_rate': round(propagation_memo.hit_rate(), 4)}
+        if instrumentation.metrics is not None:
+            # the particles screened out before any pushing (see analytic_prop.prescreen_batch()), counted once per unique particle of the memo
+            for outcome in ['clip', 'pass']:
+                counter = 'particles_prescreened_{}'.format(outcome)
+                chunk_metrics['prescreened_' + outcome] = instrumentation.metrics.counters[counter] - counters_before.get(counter, 0)
+            instrumentation.metrics.record_chunk(**chunk_metrics)
+            instrumentation.metrics.count('particles_exited', chunk_metrics['exited'])
+            instrumentation.metrics.count('particles_hit_electrode', chunk_metrics['hit_electrode'])
+            instrumentation.metrics.count('particles_stuck', chunk_metrics['stuck'])
+        instrumentation.log_event(logging.INFO, 'chunk_done', of_chunks=len(particle_batches), **chunk_metrics)
+    executor.close()
+    hit_writer.close()
+    if instrumentation.metrics is not None:
+        instrumentation.metrics.info['memo'] = {'hits': propagation_memo.hits, 'misses': propagation_memo.misses, 'evictions': propagation_memo.evictions, 'hit_rate': propagation_memo.hit_rate()}
+    hits = hit_store.Hit_Reader(hits_dir)
+    final_coords_at_detectorscreen = [{names[k]: hits.screen_coords(k)} for k in range(len(particle_batches))] # x,y coordinates at the detector screen of the particles of each chunk reaching it
+    big_dict = {}
+    for chunk_dict in final_coords_at_detectorscreen:
+        big_dict = {**big_dict, **chunk_dict}
+    detector_histogram.save('{}_image.npz'.format(title_of_graph))
+    return final_coords_at_detectorscreen, big_dict, detector_histogram
+
+def fields_description(E, B, l_E, l_B=None, z_E=0.0, z_B=0.0):
+    """ Returns the E, B fields and their regions as written in the results .txt file and in the titles of the pictures. """
+
+    if not regions.needs_regions(l_E, l_E if l_B is None else l_B, z_E, z_B):
+        return "E = {} V/m , B = {} T , l_E = l_B = {} m".format(E, B, l_E)
+    return "E = {} V/m , B = {} T , l_E = {} m from z = {} m , l_B = {} m from z = {} m".format(E, B, l_E, z_E, l_B, z_B)
 
-        dict_to_put_in['particle_%d' %(i+1)] = Species.Species("{}_{}".format(name, (i+1)), mass, charge, coords, [0.0, 0.0, velo[i]])
-    return dict_to_put_in
+def save_results(title_of_graph, big_dict, E, B, l_E, z_det, y_bottom_elec, tols, l_B=None, z_E=0.0, z_B=0.0):
+    """ Saves the x,y coordinates at the detector screen of each chunk in title_of_graph.npz, and the keys of the archive in title_of_graph.txt. """
+
+    # the full records stay in the title_of_graph + '_hits' directory, readable with hit_store.Hit_Reader
+    np.savez_compressed('{}.npz'.format(title_of_graph), **big_dict)
+    list_of_keys= list(big_dict.keys())
+    with open("{}.txt".format(title_of_graph), "w") as f:
+        f.write("{}.npz\n".format(title_of_graph))
+        f.write("{} , z_det = {} m , y_bottom_elec = {} m , Accuracy = {}\n".format(fields_description(E, B, l_E, l_B, z_E, z_B), z_det, y_bottom_elec, tols))
+        for item in list_of_keys:
+            f.write("%s\n" % item)
 
-def main():
+def main(resume_from=None):
     """ Function being called at the execution of the code via $ python3 main.py. From here the program starts running.
 
+    An interrupted run is resumed via $ python3 main.py --resume name_checkpoint.pkl (resume_from = 'name_checkpoint.pkl'):
+    the answers to all the prompts are replayed from the checkpoint and the particles already done are skipped (see checkpoint.py).
+
     Inputs from user from keyboard:
     -------------------------------
     E : float (E-field value in SI units (V/m))
     B : float (B-field value in SI units (T))
-    l_E : float (length in SI units (meters) along z-axis across which E-field value is non-zero), made equal to l_B in the code
-    D_E : float (length in SI units (meters) along z-axis from the end of the E-field to the detector screen), made equal to D_B in the code
+    l_E : float (length in SI units (meters) along z-axis across which E-field value is non-zero)
+    l_B : float (length in SI units (meters) along z-axis across which B-field value is non-zero), equal to l_E if left empty
+    z_E, z_B : floats (z at which the E-field and B-field regions start, in SI units (meters)), 0 if left empty
+    D_E : float (length in SI units (meters) along z-axis from the end of the E-field to the detector screen). D_B follows from it and from the regions
     z_det : float (z coordinate (measured from the aperture, i.e. from the origin) in SI units (meters) at which the detector screen in placed)
     y_electrode_bottom : float (y coordinate of the bottom electrode. helpful to see if clipping occurs or not)
+    propagation_mode : str (how particles are pushed through the E/B fields: 'rk45' or 'dopri54' integration, or 'analytic' closed-form solution)
+    n_workers : int (how many worker processes push the particles of each chunk in parallel)
     various info about the chunks of particles : various types, see below
     tols : list of floats. for each chunk of particle, the relative error tolerance "toler" is saved in the list "tols". "toler" can be different for different chunks of particles.
+           answering 'auto' tunes "toler" (and yscal) of the chunk to target_screen_accuracy, see tolerance_tuning.py
 
 
     Results whoch can be used at end of script execution.
@@ -220,17 +385,28 @@ def main():
                                      each dictionary contains the x,y coordinates on the detector screen for the particles from that chunk.
     """
 
-    E = float(input("Please enter the fields and geometry details. E = ? [V/m] \n"))
-    B = float(input("B = ? [T] \n"))
-    l_E = float(input("l_E = ? [m] \n"))
-    l_B = l_E
-    D_E = float(input("D_E = ? [m] \n"))
-    D_B = D_E
-    z_det = float(input("Distance at which the screen is placed from the source (distance measured across z): ? [m] \n"))
-    y_electrode_bottom = float(input("Distance at which the bottom electrode is placed from the origin (distance measured along +y): ? [m] \n"))
-
-    Efieldobj, Bfieldobj, detector_obj, electrode_bottom_obj = Geometry.create_Geometry_Objects(E, l_E, D_E, B, l_B, D_B, z_det, y_electrode_bottom)
+    instrumentation.configure_logging(log_level)
+    run_checkpoint = checkpoint.Run_Checkpoint() if resume_from is None else checkpoint.Run_Checkpoint.load(resume_from)
+    E = float(run_checkpoint.ask("Please enter the fields and geometry details. E = ? [V/m] \n"))
+    B = float(run_checkpoint.ask("B = ? [T] \n"))
+    l_E = float(run_checkpoint.ask("l_E = ? [m] \n"))
+    l_B = float(run_checkpoint.ask("l_B = ? [m] (leave empty for l_B = l_E) \n") or l_E)
+    z_E = float(run_checkpoint.ask("z at which the E-field region starts? [m] (leave empty for 0, i.e. at the aperture) \n") or 0.0)
+    z_B = float(run_checkpoint.ask("z at which the B-field region starts? [m] (leave empty for 0, i.e. at the aperture) \n") or 0.0)
+    D_E = float(run_checkpoint.ask("D_E = ? [m] \n"))
+    D_B = D_E + (z_E + l_E) - (z_B + l_B)
+    z_det = float(run_checkpoint.ask("Distance at which the screen is placed from the source (distance measured across z): ? [m] \n"))
+    y_electrode_bottom = float(run_checkpoint.ask("Distance at which the bottom electrode is placed from the origin (distance measured along +y): ? [m] \n"))
+    propagation_mode = run_checkpoint.ask("How do you want to push the particles through the E/B fields? [rk45/dopri54/analytic/map] \n")
+    while (propagation_mode not in propagation.propagation_modes):
+        print("Invalid propagation mode. Try again. \n")
+        propagation_mode = run_checkpoint.ask("How do you want to push the particles through the E/B fields? [rk45/dopri54/analytic/map] \n")
+    n_workers = int(run_checkpoint.ask("How many worker processes do you want to use? [1 = run everything in this process] \n"))
+
+    Efieldobj, Bfieldobj, detector_obj, electrode_bottom_obj = Geometry.create_Geometry_Objects(E, l_E, D_E, B, l_B, D_B, z_det, y_electrode_bottom, z_E, z_B)
     l_B = Bfieldobj._l #
+    z_E = Efieldobj._z_start
+    z_B = Bfieldobj._z_start
     E = Efieldobj._strength
     B = Bfieldobj._strength
     z_det = detector_obj._z_det
@@ -239,12 +415,13 @@ def main():
 
     counter_chunks_of_input = 0
     names, no_of_particles, input_MeV, whats, apsX, apsY, opt1_velosopts_container, opt2_velosopts_container, general_velosopts_container, tols = [], [], [], [], [], [], [], [], [], []
+    velocity_files = [] # for each chunk, the file holding the initial velocities of its particles (sub-option 3), None for the other sub-options
     contor_what_equal_2 = 0 # helpful not to ask for input from user multiple times if he already asked for option2 for at least 1 chunk.
     while (True):
-        response = input("Do you want to create another chunk of particles? [Y/N] \n")
+        response = run_checkpoint.ask("Do you want to create another chunk of particles? [Y/N] \n")
         if (response == "Y" or response == "y"):
             counter_chunks_of_input += 1
-            name = input("Species Name? can only choose from (careful not to introduce typos!): [proton; C0+...6+; Xe0+...54+] \n")
+            name = run_checkpoint.ask("Species Name? can only choose from (careful not to introduce typos!): [proton; C0+...6+; Xe0+...54+] \n")
             condnames = True
             while (condnames):
                 if name in all_possible_names:
@@ -254,27 +431,27 @@ def main():
                 else:
                     print("Error: You introduced a wrong name of Species. ABORT")
                     print("Try again. Please introduce a valid species name!")
-                    name = input("Species Name? can only choose from (careful not to introduce typos!): [proton; C0+...6+; Xe0+...54+] \n")
+                    name = run_checkpoint.ask("Species Name? can only choose from (careful not to introduce typos!): [proton; C0+...6+; Xe0+...54+] \n")
             
-            number_of_particles = int(input("How many {}s ? \n".format(name)))
+            number_of_particles = int(run_checkpoint.ask("How many {}s ? \n".format(name)))
             no_of_particles.append(number_of_particles)
-            input_energy = float(input("Initial KEnergy in MeV ? \n"))
+            input_energy = float(run_checkpoint.ask("Initial KEnergy in MeV ? \n"))
             input_MeV.append(input_energy)
-            toler = float(input("Tolerance (for integration purposes) for this chunk of particles? \n"))
-            tols.append(toler) # for each chunk of particles
-            what = int(input("What do you want to do with this chunk of particles? [1/2] \n"))
+            toler = run_checkpoint.ask("Tolerance (for integration purposes) for this chunk of particles? [or auto, to tune it to the accuracy wanted on the screen] \n")
+            tols.append(None if toler.strip() == 'auto' else float(toler)) # for each chunk of particles. None: tuned once the particles are drawn
+            what = int(run_checkpoint.ask("What do you want to do with this chunk of particles? [1/2] \n"))
             whats.append(what)
 
             if (what == 2): # if you want to consider aperture effects for this chunk
                 contor_what_equal_2 += 1
-                aperture_nonpoint_alongX = input("Do you want the aperture to be NON-pointlike along X? [Y/N] \n")
+                aperture_nonpoint_alongX = run_checkpoint.ask("Do you want the aperture to be NON-pointlike along X? [Y/N] \n")
                 condX = True
                 while (condX):
                     if (aperture_nonpoint_alongX =='Y' or aperture_nonpoint_alongX =='y' or aperture_nonpoint_alongX =='Yes' or aperture_nonpoint_alongX =='YES'):
                         aperture_nonpoint_alongX = True
                         apsX.append(aperture_nonpoint_alongX)
                         if (contor_what_equal_2 == 1): # only happens for the first chunk of particles which requests aperture effects
-                            Rx = float(input("Aperture radius R in meters for X-axis? [non-zero, positive value needed] \n"))
+                            Rx = float(run_checkpoint.ask("Aperture radius R in meters for X-axis? [non-zero, positive value needed] \n"))
                         condX = False
                     elif (aperture_nonpoint_alongX =='N' or aperture_nonpoint_alongX =='n' or aperture_nonpoint_alongX =='No' or aperture_nonpoint_alongX =='NO'):
                         aperture_nonpoint_alongX = False
@@ -283,16 +460,16 @@ def main():
                         condX = False
                     else:
                         print("wrong answer for X-direction aperture type")
-                        aperture_nonpoint_alongX = input("Do you want the aperture to be NON-pointlike along X? [Y/N] \n")
+                        aperture_nonpoint_alongX = run_checkpoint.ask("Do you want the aperture to be NON-pointlike along X? [Y/N] \n")
 
-                aperture_nonpoint_alongY = input("Do you want the aperture to be NON-pointlike along Y? [Y/N] \n")
+                aperture_nonpoint_alongY = run_checkpoint.ask("Do you want the aperture to be NON-pointlike along Y? [Y/N] \n")
                 condY = True
                 while(condY):
                     if (aperture_nonpoint_alongY == 'Y' or aperture_nonpoint_alongY == 'y' or aperture_nonpoint_alongY == 'Yes' ): # only happens for the first chunk of particles which requests aperture effects
                         aperture_nonpoint_alongY = True
                         apsY.append(aperture_nonpoint_alongY)
                         if (contor_what_equal_2 == 1): # only happens for 1st chunk of particles which request aperture effects, else Ry already set.
-                            Ry = float(input("Aperture radius R in meters for Y-axis? [non-zero, positive value needed] \n"))
+                            Ry = float(run_checkpoint.ask("Aperture radius R in meters for Y-axis? [non-zero, positive value needed] \n"))
                         condY = False
                     elif (aperture_nonpoint_alongY == 'N' or aperture_nonpoint_alongY == 'n'):
                         aperture_nonpoint_alongY = False
@@ -302,19 +479,20 @@ def main():
                         condY = False
                     else:
                         print("wrong answer for Y-direction aperture type")
-                        aperture_nonpoint_alongY = input("Do you want the aperture to be NON-pointlike along Y? [Y/N] \n")
+                        aperture_nonpoint_alongY = run_checkpoint.ask("Do you want the aperture to be NON-pointlike along Y? [Y/N] \n")
                 # for what = 2 , where do you want velocities to come from?
-                opt2_velosopt = int(input("How do you want to deal with this chunks' incident particles' velocities? [1/2/3] \n"))
+                opt2_velosopt = int(run_checkpoint.ask("How do you want to deal with this chunks' incident particles' velocities? [1/2/3] \n"))
                 condopt2velos = True
                 while (condopt2velos):
                     if (opt2_velosopt == 1 or opt2_velosopt == 2 or opt2_velosopt == 3):
                         opt2_velosopts_container.append(opt2_velosopt)
                         opt1_velosopts_container.append(0)
                         general_velosopts_container.append(opt2_velosopt)
+                        velocity_files.append(run_checkpoint.ask("File with the initial velocities along z of this chunk's particles? [.npy or .csv, in m/s, last column used] \n") if opt2_velosopt == 3 else None)
                         condopt2velos = False
                     else:
                         print("Invalid response for velocities distribution behaviour. Try again. \n")
-                        opt2_velosopt = int(input("How do you want to deal with this chunks' incident particles' velocities? [1/2/3] \n"))
+                        opt2_velosopt = int(run_checkpoint.ask("How do you want to deal with this chunks' incident particles' velocities? [1/2/3] \n"))
                     
             else: # what = 1, it seems you don't want aperture effects.
                 Rx = 0.0
@@ -322,111 +500,89 @@ def main():
                 apsX.append(False)
                 apsY.append(False) 
                 # for what = 1, where do you want the velocities to come from?
-                opt1_velosopt = int(input("How do you want to deal with this chunks' incident particles' velocities? [1,2,3] ; 3 doesn't work at the moment \n"))
+                opt1_velosopt = int(run_checkpoint.ask("How do you want to deal with this chunks' incident particles' velocities? [1,2,3] \n"))
                 condopt1velos = True
                 while (condopt1velos):
                     if (opt1_velosopt == 1 or opt1_velosopt == 2 or opt1_velosopt == 3):
                         opt1_velosopts_container.append(opt1_velosopt)
                         opt2_velosopts_container.append(0) # signifies that this chunk doesn't deal with option2 and any of its suboptions.
                         general_velosopts_container.append(opt1_velosopt)
+                        velocity_files.append(run_checkpoint.ask("File with the initial velocities along z of this chunk's particles? [.npy or .csv, in m/s, last column used] \n") if opt1_velosopt == 3 else None)
                         condopt1velos = False # to allow exiting the while-loop
                     else:
                         print("Invalid response for velocities distribution behaviour. Try again. \n")
-                        opt1_velosopt = int(input("How do you want to deal with this chunks' incident particles' velocities? [1/2/3] ; 3 doesn't work at the moment \n"))
+                        opt1_velosopt = int(run_checkpoint.ask("How do you want to deal with this chunks' incident particles' velocities? [1/2/3] \n"))
         else:
             if(response == "N" or response == "n"): # user doesn't want any other chunks of particles. break
                 break # go out of the while-loop and continue executing instructions appearing after the while-loop.
             else:
                 print("invalid response! try again!")
                 continue
-    title_of_graph = input("Please specify under which name you want to save results at detector screen. It will save a .npz file, a .txt file, and plot 2 graphs, all saved with the name you give, in the current directory. \n")
-
-    list_of_dicts_containing_Species_Objs = []
-    for j in range(counter_chunks_of_input): # for each chunk of particles, i.e. j counts the chunk of particle at which we are at.
-        initial_coords, initial_uzs = get_particles_init_conds(no_of_particles[j], input_MeV[j], whats[j], apsX[j], apsY[j], Rx, Ry, opt1_velosopts_container[j], opt2_velosopts_container[j]) 
-        # initial_uzs is a np.array shape (no_of_particles, ). it can be populated with same float, OR with floats extracted from a Gaussian. This depends on which sub-option you chose.
-        Species_Objs_dict = dict() # for this current chunk of particles
-        print(initial_uzs)
-        Species_Objs_dict = create_Species_Objects(names[j], masses[names[j]], charges[names[j]], initial_coords, initial_uzs, no_of_particles[j], Species_Objs_dict)
-        list_of_dicts_containing_Species_Objs.append(Species_Objs_dict)
-
-    final_coords_at_detectorscreen = [] # will be populated by dictionaries , 1 dictionary for each chunk of particles
-    big_dict = {}
-    for k in range(len(list_of_dicts_containing_Species_Objs)): # for each chunk of particles
-        name_of_particles_from_chunk = list_of_dicts_containing_Species_Objs[k]['particle_1']._name[:-2]
-        results = [] # for this chunk of particles
-        coords_at_detector_forthischunk_all = [] # for this chunk of particles
-        for j in range(len(list_of_dicts_containing_Species_Objs[k].keys())): # for each particle out of this chunk
-        # push each particle from this chunk
-            parti_obj = list_of_dicts_containing_Species_Objs[k]['particle_%d'%(j+1)]
-            exited_B, hit_E, results_for_this_part = RKint.RK45integrator(parti_obj.x, parti_obj.y, parti_obj.z, parti_obj.ux, parti_obj.uy, parti_obj.uz, yscal_maxvalues, tols[k], l_B, y_bottom_elec, parti_obj._qonm, E, B )
-            if (exited_B == 1 and hit_E == 0 ):
-                results.append( results_for_this_part )   # results is appended with conditions (x,y,z,ux,uy,uz) from end of RK45 integration (end of E/B fields)
-                coords_at_detector = Species.Species.Species_push_from_endoffields_to_detector( results[-1], z_det ) # use the values just appended to results list
-            elif (exited_B == 0 or hit_E == 1):
-                print("either it didn't exit the B-field region or it hit the bottom electrode")
-                if(hit_E == 1):
-                    print("it hit the electrode!")
-                if(exited_B == 0 and hit_E == 1):
-                    print("it hit the electode and it didn't exit the B-field!")
-                continue # go to next j, i.e. next iteration of this for-loop, i.e. to the next particle of this chunk of particles. don't push particle to screen anymore, it's stuck in the E/B fields
-            coords_at_detector_forthischunk_all.append(coords_at_detector) # coords_at_detector is a numpy array of shape (2,), thus the x-y position for 1 particle from this current chunk
-            if (j+1) % 100 == 0:
-                print("I finished processing {} particles out of a total of {} particles from this chunk.".format(j+1, len(list_of_dicts_containing_Species_Objs[k].keys())))
-        coords_at_detector_forthischunk_all = np.array(coords_at_detector_forthischunk_all) # will be shape (no_of_particles-bad_particles, 2), where no_of_particles is for this particular chunk of particles and bad_particles is again for this particular chunk (the ones which hit the bottom electrode or did not exit B-field)
-    
-        final_coords_at_detectorscreen.append( {name_of_particles_from_chunk : coords_at_detector_forthischunk_all} ) # a list of dictionaries
-        big_dict = {**big_dict, **{name_of_particles_from_chunk : coords_at_detector_forthischunk_all}}
-        print("We finished processing chunk number {} out of a total of {} chunks of particles.".format(k+1, len(list_of_dicts_containing_Species_Objs)))
-    
+    title_of_graph = run_checkpoint.ask("Please specify under which name you want to save results at detector screen. It will save a .npz file, a .txt file, and plot 2 graphs, all saved with the name you give, in the current directory. \n")
+    if not run_checkpoint.resumed:
+        run_checkpoint.filename = '{}_checkpoint.pkl'.format(title_of_graph)
+
+    if metrics_enabled:
+        instrumentation.enable().info.update({'run': title_of_graph, 'propagation_mode': propagation_mode, 'n_workers': n_workers, 'batch_size': batch_size, 'names': names, 'tols': tols})
+    if profile_interval is not None:
+        profiler = instrumentation.Sampling_Profiler(profile_interval)
+        profiler.start()
+
+    chunk_seeds = run_checkpoint.seed_sequence().spawn(counter_chunks_of_input) # one Generator per chunk. a resumed run draws the very same particles
+    particle_batches = [] # one Species.ParticleBatch per chunk of particles
+    with instrumentation.timer('sampling', sum(no_of_particles)):
+        for j in range(counter_chunks_of_input): # for each chunk of particles, i.e. j counts the chunk of particle at which we are at.
+            initial_coords, initial_uzs, weights = get_particles_init_conds(no_of_particles[j], input_MeV[j], whats[j], apsX[j], apsY[j], Rx, Ry, opt1_velosopts_container[j], opt2_velosopts_container[j], velocity_files[j],
+                                                                          np.random.default_rng(chunk_seeds[j]), gaussian_sampling, gaussian_tail_decades)
+            # initial_uzs is a np.array shape (no_of_particles, ). it can be populated with same float, OR with floats extracted from a Gaussian. This depends on which sub-option you chose.
+            instrumentation.log_event(logging.INFO, 'chunk_drawn', chunk=j, species=names[j], particles=no_of_particles[j], uz_min=np.min(initial_uzs), uz_mean=np.mean(initial_uzs), uz_max=np.max(initial_uzs))
+            particle_batches.append(create_ParticleBatch(names[j], masses[names[j]], charges[names[j]], initial_coords, initial_uzs, no_of_particles[j], weights))
+
+    geometry = {'E': E, 'B': B, 'l_B': l_B, 'y_bottom_elec': y_bottom_elec, 'z_det': z_det, 'yscal': yscal_maxvalues, 'field_map': field_map, 'l_E': l_E, 'z_E': z_E, 'z_B': z_B}
+    with instrumentation.timer('tolerance_tuning'):
+        labels = [{'species': names[j], 'energy_MeV': input_MeV[j], 'option': whats[j], 'sub_option': general_velosopts_container[j]} for j in range(counter_chunks_of_input)]
+        tols, yscals = tolerance_tuning.tune_chunks(particle_batches, tols, labels, geometry, propagation_mode, target_screen_accuracy, '{}_tolerance_tunings'.format(title_of_graph))
+    final_coords_at_detectorscreen, big_dict, detector_histogram = push_chunks_to_screen(particle_batches, names, tols, geometry, propagation_mode, n_workers, title_of_graph, run_checkpoint, yscals,
+                                                                                         trajectory_particle_ids)
+
     # xx = np.dstack(final_coords_at_detectorscreen_container) # shape (no_of_chunks, )
     # xx = np.rollaxis(xx, -1) # shall be now shape ()
 
     # saving results to a .npz file
     # ------------------------------
-    np.savez_compressed('{}.npz'.format(title_of_graph), **big_dict)
-    list_of_keys= list(big_dict.keys())
-    with open("{}.txt".format(title_of_graph), "w") as f:
-        f.write("{}.npz\n".format(title_of_graph))
-        f.write("E = {} V/m , B = {} T , l_E = l_B = {} m , z_det = {} m , y_bottom_elec = {} m , Accuracy = {}\n".format(E, B, l_E, z_det, y_bottom_elec, tols))
-        for item in list_of_keys:
-            f.write("%s\n" % item)
-    
-    print("We start plotting now! Please wait ... ")
+    with instrumentation.timer('output'):
+        save_results(title_of_graph, big_dict, E, B, l_E, z_det, y_bottom_elec, tols, l_B, z_E, z_B)
+
+    instrumentation.log_event(logging.INFO, 'plotting_started')
+    plotting_start = time.perf_counter()
 
     # plotting in the non-safe way
     # -----------------------------
-    colors = iter(cm.rainbow(np.linspace(0,1, 2 * len(final_coords_at_detectorscreen)))) # if you have many chunks of particles (many species), this helps select 1 DIFFERENT color to represent each chunk. 
-    plt.figure()
+    colors = plotting.species_colors(2 * len(final_coords_at_detectorscreen)) # if you have many chunks of particles (many species), this helps select 1 DIFFERENT color to represent each chunk. 
     res = np.load('{}.npz'.format(title_of_graph))
-    for key in names: # for each chunk
-        print(key)
-        c = next(colors)
-        c = np.reshape(c, (1, c.shape[0]) )
-        plt.scatter(res[key][:, 0], res[key][:, 1], s=0.2, label=key, c=c)
-    plt.xlabel("Deflection along x axis [meters]")
-    plt.ylabel("Deflection along y axis [meters]")
-    plt.title("This graph is plotted just to check that we indeed saved the right things in that .npz file. \n" + " This graph shall agree with the more elaborate one which doesn't contain the non_safe identifier in its name.")
-    plt.legend()
-    plt.savefig("{}_nonsafe.pdf".format(title_of_graph), bbox_inches='tight')
+    plotting.plot_detector_picture(["{}_nonsafe.{}".format(title_of_graph, fmt) for fmt in plot_formats], coords=[(key, res[key]) for key in names], colors=colors[:len(final_coords_at_detectorscreen)],
+                                   title="This graph is plotted just to check that we indeed saved the right things in that .npz file. \n" + " This graph shall agree with the more elaborate one which doesn't contain the non_safe identifier in its name.",
+                                   mode=('rasterized' if plot_mode == 'density' else plot_mode))
 
     # plotting in the safe way
     # -------------------------
-    plt.figure()
-    for j in range(len(final_coords_at_detectorscreen)): # for each chunk of particles
-        c = next(colors)
-        c = np.reshape(c, (1, c.shape[0]) )
-        for key in final_coords_at_detectorscreen[j]: # this for-loop will only make 1 iteration as the dictionary final_coords_at_detectorscreen[j] has 1 key only
-            value_from_that_key = final_coords_at_detectorscreen[j][key]
-            plt.scatter(value_from_that_key[:, 0], value_from_that_key[:, 1] , s=0.2, label=key, c=c) # key is a str
+    # one layer per chunk of particles, the dictionary final_coords_at_detectorscreen[j] having 1 key only
+    coords = [(key, final_coords_at_detectorscreen[j][key]) for j in range(len(final_coords_at_detectorscreen)) for key in final_coords_at_detectorscreen[j]]
     if (whats[0] == 1):
-        plt.title("Detector screen picture showing the captured ions. \n" + " Input energies in MeV = {} \n".format(input_MeV) + "Species = {} \n".format(names) + "Options chosen = {} ".format(whats) + "Sub-options chosen = {} \n".format(general_velosopts_container) + "Integration tolerances = {} \n".format(tols) + "E = {} V/m , B = {} T , l_E = l_B = {} m , z_det = {} m \n".format(E, B, l_E, z_det) + "Number of simulated particles = {}".format(no_of_particles))
+        title = "Detector screen picture showing the captured ions. \n" + " Input energies in MeV = {} \n".format(input_MeV) + "Species = {} \n".format(names) + "Options chosen = {} ".format(whats) + "Sub-options chosen = {} \n".format(general_velosopts_container) + "Integration tolerances = {} \n".format(tols) + "{} , z_det = {} m \n".format(fields_description(E, B, l_E, l_B, z_E, z_B), z_det) + "Number of simulated particles = {}".format(no_of_particles)
     elif (whats[0] == 2):
-        plt.title("Detector screen picture showing the captured ions. \n" + " Input energies in MeV = {} \n".format(input_MeV) + "Species = {} \n".format(names) + "Options chosen = {}".format(whats) + "Sub-options chosen = {} \n".format(general_velosopts_container)  + "Aperture size(s): Rx = {} m, Ry = {} m \n".format(Rx, Ry) + "Integration tolerances = {} \n".format(tols) + "E = {} V/m , B = {} T , l_E = l_B = {} m , z_det = {} m \n".format(E, B, l_E, z_det) + "Number of simulated particles = {}".format(no_of_particles))
-    plt.xlabel("Deflection along x axis [meters]")
-    plt.ylabel("Deflection along y axis [meters]")
-    plt.legend()
-    plt.savefig("{}.pdf".format(title_of_graph), bbox_inches='tight')
+        title = "Detector screen picture showing the captured ions. \n" + " Input energies in MeV = {} \n".format(input_MeV) + "Species = {} \n".format(names) + "Options chosen = {}".format(whats) + "Sub-options chosen = {} \n".format(general_velosopts_container)  + "Aperture size(s): Rx = {} m, Ry = {} m \n".format(Rx, Ry) + "Integration tolerances = {} \n".format(tols) + "{} , z_det = {} m \n".format(fields_description(E, B, l_E, l_B, z_E, z_B), z_det) + "Number of simulated particles = {}".format(no_of_particles)
+    plotting.plot_detector_picture(["{}.{}".format(title_of_graph, fmt) for fmt in plot_formats], coords=coords, detector_histogram=detector_histogram,
+                                   colors=colors[len(final_coords_at_detectorscreen):], title=title, mode=plot_mode)
+    if instrumentation.metrics is not None:
+        instrumentation.metrics.add_time('plotting', time.perf_counter() - plotting_start)
+
+    if profile_interval is not None:
+        profiler.stop('{}_profile.txt'.format(title_of_graph))
+    if instrumentation.metrics is not None:
+        instrumentation.metrics.save('{}_metrics.json'.format(title_of_graph))
+        instrumentation.log_event(logging.INFO, 'metrics_saved', filename='{}_metrics.json'.format(title_of_graph))
+        instrumentation.disable()
 
     # signal that the script has finished running by playing a short sound.
     # import os
@@ -435,4 +591,7 @@ def main():
     # os.system('play -nq -t alsa synth {} sine {}'.format(duration, freq)) # Doesn't work on WSL1 on Win10-64bit workstation.
 
 if __name__ == '__main__':
-    main()
+    if ('--resume' in sys.argv):
+        main(resume_from=sys.argv[sys.argv.index('--resume') + 1])
+    else:
+        main()
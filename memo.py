@@ -0,0 +1,150 @@
+""" Memoization of the pushing of particles, for chunks with many identical particles.
+
+Particles do not interact, so two particles with the same charge/mass ratio and the same initial state end up at the same place on the screen,
+whatever their species. A chunk with no aperture effects and a fixed energy (option 1, sub-option 1) is made of N copies of a single particle,
+and different species can share their q/m (e.g. C6+ and a deuteron-like ratio).
+
+A Propagation_Memo stores the end-of-fields state and the screen coordinates of each (q/m, initial state) it has seen, for given geometry,
+tolerance and propagation mode. Each new (q/m, initial state) is pushed once and the result is fanned out to all the matching particles,
+so the cost of a chunk scales with its number of unique particles, not with its number of particles.
+The memo is only used for the batches which hold identical particles (as found by np.unique): a batch of distinct particles, e.g. drawn from
+a continuous spectrum, is pushed directly, without any bookkeeping per particle.
+The memo holds at most maxsize entries, the least recently used ones being evicted first. The results are kept in preallocated arrays
+(grown up to maxsize), one row per entry, the keys only mapping to their row.
+"""
+
+from collections import OrderedDict
+import numpy as np
+import utility_fns
+
+
+class Propagation_Memo:
+    """ Bounded LRU cache of pushed particles, keyed by (geometry, tolerance, propagation mode, q/m, initial state).
+
+    Attributes
+    ----------
+    _maxsize : int (maximum number of entries kept)
+    _entries : collections.OrderedDict (key -> row of the entry in the arrays below, least recently used first)
+    _exited_B, _hit_E : np.array shape (n, ) of int8 (outcome flags of the entries)
+    _final_states : np.array shape (n, 6) (end-of-fields states of the entries)
+    _coords_at_detector : np.array shape (n, 2) (screen coordinates of the entries)
+    hits : int (particles whose result came from the memo, or from an identical particle of the same batch)
+    misses : int (particles which had to be pushed, including the ones of batches without identical particles)
+    evictions : int (entries dropped to keep the memo within _maxsize)
+
+    Methods
+    -------
+    push(states, qonms, geometry, mode, push_unique):
+        Pushes a batch of particles, calling push_unique only for the (q/m, initial state) pairs not in the memo (or for all of them, if they are all distinct).
+    hit_rate():
+        Returns the fraction of particles served by the memo so far.
+    """
+
+    def __init__(self, maxsize=10**4):
+        self._maxsize = max(0, int(maxsize))
+        self._entries = OrderedDict()
+        self._exited_B = np.zeros(0, dtype=np.int8)
+        self._hit_E = np.zeros(0, dtype=np.int8)
+        self._final_states = np.zeros((0, 6))
+        self._coords_at_detector = np.zeros((0, 2))
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return f'Propagation_Memo(maxsize={self._maxsize}, entries={len(self._entries)}, hits={self.hits}, misses={self.misses}, evictions={self.evictions})'
+
+    def __len__(self):
+        return len(self._entries)
+
+    def push(self, states, qonms, geometry, mode, push_unique):
+        """ Pushes a batch of particles, each unique (q/m, initial state) being pushed at most once.
+
+        Parameters
+        ----------
+        states : np.array shape (N, 6) (initial x,y,z, ux,uy,uz of each particle)
+        qonms : np.array shape (N, ) (charge/mass ratio of each particle, in SI)
+        geometry : dict with keys 'E', 'B', 'l_B', 'y_bottom_elec', 'z_det', 'yscal', 'tol'
+        mode : str (one of propagation.propagation_modes)
+        push_unique : function (states, qonms) -> exited_B, hit_E, final_states, steps_accepted, steps_rejected, coords_at_detector
+                      (e.g. parallel_exec.Parallel_Executor.push_chunk() with the other arguments fixed)
+
+        Returns
+        -------
+        exited_B, hit_E, final_states, steps_accepted, steps_rejected, coords_at_detector, in the order of the particles.
+        The steps are only counted for the particles which were actually pushed (0 for the others).
+        """
+
+        states = np.asarray(states, dtype=float)
+        no_of_parts = states.shape[0]
+        qonms = np.broadcast_to(np.asarray(qonms, dtype=float), (no_of_parts,))
+        rows = np.column_stack([qonms, states]) # shape (N, 7)
+        unique_rows, first_of, inverse = np.unique(rows, axis=0, return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        no_of_unique = unique_rows.shape[0]
+        if no_of_unique == no_of_parts: # no identical particles: nothing to fan out, and the memo would hardly be hit by such batches
+            self.misses += no_of_parts
+            return push_unique(states, qonms)
+        settings = utility_fns.geometry_key(mode=mode, **geometry)
+        keys = [(settings, row.tobytes()) for row in unique_rows]
+
+        exited_B = np.zeros(no_of_unique, dtype=int)
+        hit_E = np.zeros(no_of_unique, dtype=int)
+        final_states = np.zeros((no_of_unique, 6))
+        coords_at_detector = np.zeros((no_of_unique, 2))
+        steps_accepted = np.zeros(no_of_parts, dtype=int)
+        steps_rejected = np.zeros(no_of_parts, dtype=int)
+
+        to_push = []
+        found, found_at = [], []
+        for u, key in enumerate(keys):
+            slot = self._entries.get(key)
+            if slot is None:
+                to_push.append(u)
+            else:
+                self._entries.move_to_end(key)
+                found.append(u)
+                found_at.append(slot)
+        if len(found) > 0:
+            exited_B[found], hit_E[found] = self._exited_B[found_at], self._hit_E[found_at]
+            final_states[found], coords_at_detector[found] = self._final_states[found_at], self._coords_at_detector[found_at]
+
+        if len(to_push) > 0:
+            to_push = np.array(to_push)
+            pushed = push_unique(unique_rows[to_push, 1:], unique_rows[to_push, 0])
+            exited_B[to_push], hit_E[to_push], final_states[to_push] = pushed[0], pushed[1], pushed[2]
+            coords_at_detector[to_push] = pushed[5]
+            steps_accepted[first_of[to_push]] = pushed[3] # the steps were made by one particle of each pushed group only
+            steps_rejected[first_of[to_push]] = pushed[4]
+            slots = [self._slot_for(keys[u]) for u in to_push.tolist()]
+            stored = np.array([slot is not None for slot in slots], dtype=bool)
+            if stored.any():
+                at = np.array([slot for slot in slots if slot is not None])
+                self._exited_B[at], self._hit_E[at] = exited_B[to_push[stored]], hit_E[to_push[stored]]
+                self._final_states[at], self._coords_at_detector[at] = final_states[to_push[stored]], coords_at_detector[to_push[stored]]
+
+        self.misses += len(to_push)
+        self.hits += no_of_parts - len(to_push)
+        return exited_B[inverse], hit_E[inverse], final_states[inverse], steps_accepted, steps_rejected, coords_at_detector[inverse]
+
+    def _slot_for(self, key):
+        """ Returns the row of the arrays where the entry of key is to be written (None if the memo keeps nothing). """
+        if self._maxsize == 0:
+            return None
+        if len(self._entries) < self._maxsize:
+            slot = len(self._entries)
+            if slot >= self._final_states.shape[0]: # grown by doubling, up to _maxsize
+                size = min(self._maxsize, max(64, 2 * self._final_states.shape[0]))
+                self._exited_B = np.resize(self._exited_B, size)
+                self._hit_E = np.resize(self._hit_E, size)
+                self._final_states = np.resize(self._final_states, (size, 6))
+                self._coords_at_detector = np.resize(self._coords_at_detector, (size, 2))
+        else:
+            _, slot = self._entries.popitem(last=False) # least recently used, its row is reused
+            self.evictions += 1
+        self._entries[key] = slot
+        return slot
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
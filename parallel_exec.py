@@ -0,0 +1,160 @@
+""" Parallel execution of the pushing of the particles of a chunk, from the aperture to the detector screen.
+
+The particles of a chunk are split into sub-batches which are sent, together with the geometry, to a pool of worker processes.
+Each worker pushes its sub-batch through the E/B fields (propagation.push_batch_to_endoffields()) and then to the screen,
+and the results are stitched back together in the original order of the particles.
+Particles do not interact, so the results do not depend on the number of workers or on the sub-batch size.
+When the run is instrumented, each worker also sends back the counters and timers of its sub-batch (see instrumentation.py).
+The progress of each worker (particles done) is logged at INFO level at most every progress_interval seconds and when a chunk is done,
+and after every sub-batch at DEBUG level.
+"""
+
+import os, time, logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import propagation, response_map, regions, Species, instrumentation
+
+
+def push_sub_batch(states, qonms, geometry, mode, instrumented=False, recorder=None, particle_ids=None):
+    """ Pushes one sub-batch of particles from the aperture to the detector screen. This is the function run by the workers.
+
+    Parameters
+    ----------
+    states : np.array shape (n, 6) (initial x,y,z, ux,uy,uz of the particles of the sub-batch)
+    qonms : np.array shape (n, ) (charge/mass ratio of each particle, in SI)
+    geometry : dict with keys 'E', 'B', 'l_B', 'y_bottom_elec', 'z_det', 'yscal', 'tol' (and optionally 'field_map', 'l_E', 'z_E', 'z_B', see propagation.push_batch_to_endoffields())
+    mode : str (one of propagation.propagation_modes)
+    instrumented : bool (if True, the counters and timers of this sub-batch are collected and returned)
+    recorder : Trajectory.Trajectory_Recorder or None (records the trajectories of its particles, see propagation.push_batch_to_endoffields().
+               with several workers, it must write to a memory-mapped file, the workers getting copies of it)
+    particle_ids : np.array shape (n, ) of ints or None (ids of the particles of the sub-batch for the recorder, e.g. their index over the whole run)
+
+    Returns
+    -------
+    exited_B, hit_E, final_states, steps_accepted, steps_rejected (see propagation.push_batch_to_endoffields()), np.array shape (n, 2) of screen x,y coordinates, the pid of the worker,
+    and the snapshot of the metrics of this sub-batch (see instrumentation.Run_Metrics.snapshot()), None if not instrumented.
+    """
+
+    if not instrumented:
+        exited_B, hit_E, final_states, steps_accepted, steps_rejected = propagation.push_batch_to_endoffields(states, qonms, geometry['yscal'], geometry['tol'], geometry['l_B'], geometry['y_bottom_elec'], geometry['E'], geometry['B'], mode=mode, z_det=geometry['z_det'], field_map=geometry.get('field_map'), l_E=geometry.get('l_E'), z_E=geometry.get('z_E', 0.0), z_B=geometry.get('z_B', 0.0),
+                                                                                                                             recorder=recorder, particle_ids=particle_ids)
+        with np.errstate(divide='ignore', invalid='ignore'): # particles which did not exit the fields have no meaningful screen coordinates
+            coords_at_detector = propagation.push_batch_from_endoffields_to_detector(final_states, geometry['z_det'])
+        return exited_B, hit_E, final_states, steps_accepted, steps_rejected, coords_at_detector, os.getpid(), None
+    with instrumentation.collecting() as metrics:
+        with metrics.timer('integration', states.shape[0]):
+            exited_B, hit_E, final_states, steps_accepted, steps_rejected = propagation.push_batch_to_endoffields(states, qonms, geometry['yscal'], geometry['tol'], geometry['l_B'], geometry['y_bottom_elec'], geometry['E'], geometry['B'], mode=mode, z_det=geometry['z_det'], field_map=geometry.get('field_map'), l_E=geometry.get('l_E'), z_E=geometry.get('z_E', 0.0), z_B=geometry.get('z_B', 0.0),
+                                                                                                                                 recorder=recorder, particle_ids=particle_ids)
+        with metrics.timer('drift', states.shape[0]), np.errstate(divide='ignore', invalid='ignore'):
+            coords_at_detector = propagation.push_batch_from_endoffields_to_detector(final_states, geometry['z_det'])
+        metrics.count('particles_pushed', states.shape[0])
+        metrics.count('steps_accepted', steps_accepted.sum())
+        metrics.count('steps_rejected', steps_rejected.sum())
+    return exited_B, hit_E, final_states, steps_accepted, steps_rejected, coords_at_detector, os.getpid(), metrics.snapshot()
+
+
+def prepare_geometry(geometry, mode):
+    """ Builds (or loads from the disk cache) in this process what every worker would otherwise build on its own: the response map of the 'map' mode.
+    Called before the sub-batches are dispatched, so the workers only load the cached map. """
+
+    if mode == 'map' and geometry.get('field_map') is None and not regions.needs_regions(geometry.get('l_E'), geometry['l_B'], geometry.get('z_E', 0.0), geometry.get('z_B', 0.0)):
+        response_map.get_response_map(geometry['E'], geometry['B'], geometry['l_B'], geometry['z_det'], np.asarray(geometry['yscal'], dtype=float)[:3], geometry['tol'])
+
+
+class Parallel_Executor:
+    """ A pool of worker processes, kept alive over all the chunks of a run, which pushes the particles of the chunks to the screen.
+
+    Attributes
+    ----------
+    _n_workers : int (number of worker processes. 1 means everything runs serially in the current process, without any pool)
+    _sub_batch_size : int (at most how many particles are sent to a worker at once. a chunk is split into at least n_workers sub-batches, so small chunks use all the workers too)
+    _pool : concurrent.futures.ProcessPoolExecutor or None
+    _progress_interval : float or None (at most how many seconds between two progress messages at INFO level. None: progress at DEBUG level only)
+
+    Methods
+    -------
+    push_chunk(states, qonms, geometry, mode, chunk_name, recorder=None, particle_ids=None):
+        Pushes all the particles of a chunk and returns exited_B, hit_E, final_states, steps_accepted, steps_rejected, coords_at_detector, in the original order of the particles.
+    close():
+        Shuts down the pool of workers.
+    """
+
+    def __init__(self, n_workers, sub_batch_size, progress_interval=10.0):
+        self._n_workers = max(1, int(n_workers))
+        self._sub_batch_size = max(1, int(sub_batch_size))
+        self._progress_interval = progress_interval
+        self._pool = ProcessPoolExecutor(max_workers=self._n_workers) if self._n_workers > 1 else None
+
+    def __repr__(self):
+        return f'Parallel_Executor(n_workers={self._n_workers}, sub_batch_size={self._sub_batch_size})'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def push_chunk(self, states, qonms, geometry, mode, chunk_name='', recorder=None, particle_ids=None):
+        """ Splits the chunk into sub-batches, pushes them (in parallel if there is more than 1 worker) and stitches the results back together.
+
+        Parameters
+        ----------
+        states : np.array shape (N, 6) (initial x,y,z, ux,uy,uz of the particles of the chunk)
+        qonms : np.array shape (N, ) (charge/mass ratio of each particle, in SI)
+        geometry : dict with keys 'E', 'B', 'l_B', 'y_bottom_elec', 'z_det', 'yscal', 'tol'
+        mode : str (one of propagation.propagation_modes)
+        chunk_name : str (only used in the progress messages)
+        recorder, particle_ids : see push_sub_batch() (particle_ids has shape (N, ), one id per particle of the chunk)
+
+        Returns
+        -------
+        exited_B : np.array shape (N, ) of ints
+        hit_E : np.array shape (N, ) of ints
+        final_states : np.array shape (N, 6)
+        steps_accepted : np.array shape (N, ) of ints
+        steps_rejected : np.array shape (N, ) of ints
+        coords_at_detector : np.array shape (N, 2) (only meaningful where exited_B == 1 and hit_E == 0)
+        """
+
+        batch = Species.ParticleBatch(states, qonms)
+        no_of_parts = len(batch)
+        sub_batch_size = min(self._sub_batch_size, -(-no_of_parts // self._n_workers)) # about ceil(N / n_workers), capped at the sub-batch size
+        sub_batches = list(batch.sub_batches(sub_batch_size)) # views on the chunk, only the sub-batches themselves are pickled to the workers
+        sub_ids = [None if particle_ids is None else np.asarray(particle_ids)[start:start + sub_batch_size] for start in range(0, no_of_parts, max(1, sub_batch_size))]
+        pieces = [None] * len(sub_batches)
+        done_per_worker = dict() # pid -> how many particles this worker has finished for this chunk
+        no_of_parts_done = 0
+        last_progress = time.perf_counter()
+
+        instrumented = (instrumentation.metrics is not None)
+        if self._pool is not None and no_of_parts > 0:
+            prepare_geometry(geometry, mode)
+        if self._pool is None:
+            outcomes = ((i, push_sub_batch(sub.states, sub.qonms, geometry, mode, instrumented, recorder, sub_ids[i])) for i, sub in enumerate(sub_batches))
+        else:
+            futures = {self._pool.submit(push_sub_batch, sub.states, sub.qonms, geometry, mode, instrumented, recorder, sub_ids[i]): i for i, sub in enumerate(sub_batches)}
+            outcomes = ((futures[future], future.result()) for future in as_completed(futures))
+
+        for i, outcome in outcomes:
+            pieces[i] = outcome[:6]
+            pid = outcome[6]
+            n = outcome[0].shape[0]
+            done_per_worker[pid] = done_per_worker.get(pid, 0) + n
+            no_of_parts_done += n
+            if outcome[7] is not None:
+                instrumentation.metrics.merge(outcome[7])
+            # INFO: rate-limited, and once the chunk is done, with what each worker did
+            due = (self._progress_interval is not None) and (no_of_parts_done == no_of_parts or time.perf_counter() - last_progress >= self._progress_interval)
+            if due:
+                last_progress = time.perf_counter()
+            instrumentation.log_event(logging.INFO if due else logging.DEBUG, 'sub_batch_done', worker=pid, worker_particles=done_per_worker[pid], chunk=chunk_name,
+                                      particles_done=no_of_parts_done, particles=no_of_parts, per_worker=dict(done_per_worker))
+
+        if len(pieces) == 0:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros((0, 6)), np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros((0, 2))
+        return tuple(np.concatenate([piece[i] for piece in pieces]) for i in range(6)) # exited_B, hit_E, final_states, steps_accepted, steps_rejected, coords_at_detector
@@ -0,0 +1,91 @@
+""" Pictures of the detector screen which stay small and fast to write for millions of particles.
+
+A vector scatter plot writes one marker per particle, so at 10^6 particles the .pdf is hundreds of MB and takes minutes to write and to open.
+Three ways of drawing the picture are available:
+
+    'scatter'    : one vector marker per particle (as main.py used to do). Only sensible for small runs.
+    'rasterized' : the same scatter, but the markers are rendered into a bitmap inside the .pdf (axes, labels and legend stay vectors).
+    'density'    : the detector images of histogram.py, one colour layer per species, with a logarithmic colour scale.
+    'auto'       : 'scatter' up to vector_scatter_max particles, else 'density' if the detector images are given, else 'rasterized'.
+
+The non-interactive Agg backend is used, so no display is needed. The format of each output file (.png, .pdf, ...) is given by its extension.
+"""
+
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib import pyplot as plt
+from matplotlib import cm, colors as mcolors, patches
+import numpy as np
+
+plot_modes = ['auto', 'scatter', 'rasterized', 'density']
+vector_scatter_max = 10**4 # up to this many particles, 'auto' keeps one vector marker per particle
+
+
+def species_colors(no_of_layers):
+    """ Returns no_of_layers distinct colours (RGBA), one per chunk / species, as main.py picks them. """
+
+    return [np.reshape(c, (1, c.shape[0])) for c in cm.rainbow(np.linspace(0, 1, no_of_layers))]
+
+
+def _density_layer(ax, image, extent, color, vmax):
+    # one species: transparent where there is no hit, then more and more opaque / saturated with the (log) number of hits
+    cmap = mcolors.LinearSegmentedColormap.from_list('layer', [np.append(color[0, :3] * 0.3, 0.4), np.append(color[0, :3], 1.0)])
+    cmap.set_bad(alpha=0.0)
+    (x_min, x_max), (y_min, y_max) = extent
+    return ax.imshow(np.ma.masked_less_equal(image.T, 0.0), origin='lower', extent=(x_min, x_max, y_min, y_max), aspect='auto', interpolation='nearest',
+                     cmap=cmap, norm=mcolors.LogNorm(vmin=max(vmax * 1e-6, np.min(image[image > 0])), vmax=vmax))
+
+
+def plot_detector_picture(filenames, coords=None, detector_histogram=None, colors=None, title='', mode='auto', dpi=200):
+    """ Draws the picture of the detector screen and saves it to each of filenames.
+
+    Parameters
+    ----------
+    filenames : list of str (e.g. ['name.pdf', 'name.png'])
+    coords : list of (label, np.array shape (n, 2)) or None (x,y on the screen of the particles of each layer, needed by 'scatter' and 'rasterized')
+    detector_histogram : histogram.Detector_Histogram or None (needed by 'density'. one layer per species)
+    colors : list of RGBA arrays shape (1, 4) or None (colour of each layer, see species_colors())
+    title : str
+    mode : str (one of plot_modes)
+    dpi : int (resolution of the bitmaps: the .png files, and the rasterized layers of the .pdf files)
+
+    Returns
+    -------
+    str: the mode actually used
+    """
+
+    if mode not in plot_modes:
+        raise ValueError("Unknown plotting mode '{}'. Choose from {}.".format(mode, plot_modes))
+    no_of_parts = 0 if coords is None else sum(values.shape[0] for label, values in coords)
+    if mode == 'auto':
+        if coords is not None and no_of_parts <= vector_scatter_max:
+            mode = 'scatter'
+        else:
+            mode = 'density' if detector_histogram is not None else 'rasterized'
+    if mode == 'density' and detector_histogram is None or mode != 'density' and coords is None:
+        raise ValueError("The '{}' plotting mode needs {}.".format(mode, 'the detector images' if mode == 'density' else 'the coordinates of the particles'))
+
+    fig, ax = plt.subplots()
+    if mode == 'density':
+        species = [s for s in detector_histogram.images if detector_histogram.images[s].max() > 0]
+        colors = species_colors(len(species)) if colors is None else colors
+        handles = []
+        for s, c in zip(species, colors):
+            _density_layer(ax, detector_histogram.images[s], detector_histogram.extents[s], c, detector_histogram.images[s].max())
+            handles.append(patches.Patch(color=c[0], label=s))
+        if len(species) > 0:
+            ax.set_xlim(min(detector_histogram.extents[s][0][0] for s in species), max(detector_histogram.extents[s][0][1] for s in species))
+            ax.set_ylim(min(detector_histogram.extents[s][1][0] for s in species), max(detector_histogram.extents[s][1][1] for s in species))
+            ax.legend(handles=handles)
+    else:
+        colors = species_colors(len(coords)) if colors is None else colors
+        for (label, values), c in zip(coords, colors):
+            ax.scatter(values[:, 0], values[:, 1], s=0.2, label=label, c=c, rasterized=(mode == 'rasterized'))
+        ax.legend(loc=('best' if mode == 'scatter' else 'upper right')) # finding the 'best' place goes through all the points
+    ax.set_xlabel("Deflection along x axis [meters]")
+    ax.set_ylabel("Deflection along y axis [meters]")
+    ax.set_title(title)
+    for filename in filenames:
+        fig.savefig(filename, bbox_inches='tight', dpi=dpi)
+    plt.close(fig)
+    return mode
@@ -0,0 +1,141 @@
+""" Chooses how a batch of particles is pushed from the aperture to the end of the E/B fields region.
+
+Propagation modes:
+------------------
+'rk45' : adaptive step-size RK45 Fehlberg integration of every particle (RKint.RK45integrator_batch()).
+'dopri54' : adaptive step-size Dormand-Prince 5(4) integration (RKint.DOPRI54integrator_batch()), which returns the states exactly at the boundaries.
+'analytic' : closed-form solution of the EOMs in the uniform E || B fields (analytic_prop.analytic_propagator_batch()),
+             falling back automatically to RK45 for the particles the closed-form solution is not trusted for.
+'map' : interpolation in the precomputed response map of the geometry (response_map.Response_Map), built once and cached on disk,
+        falling back automatically to Dormand-Prince 5(4) integration for the particles outside of the map's trusted cells.
+
+With a field map (fieldmap.py) instead of the uniform E and B, only the 'rk45' and 'dopri54' modes are available, the others relying on uniform fields.
+When the E-field and B-field regions do not coincide (l_E != l_B, or a region starting further than the aperture), the particles are pushed
+segment by segment by regions.py, with the closed-form solutions where at most one field is on ('map' is not available then).
+
+A Trajectory.Trajectory_Recorder can be given (recorder, with the ids of the particles over the whole run): the integrators sample the steps of the
+recorded particles, and the initial and final states (and, with separate regions, the state at the end of every segment) are always recorded.
+
+In the uniform fields region, the 'rk45', 'dopri54' and 'map' modes first pre-screen the batch (analytic_prop.prescreen_batch()): the particles
+which certainly hit the bottom electrode get their state on it in closed form and are not pushed at all, only the others go on to the integrator / map.
+"""
+
+import numpy as np
+import RKint, analytic_prop, response_map, fieldmap, regions, instrumentation
+
+propagation_modes = ['rk45', 'dopri54', 'analytic', 'map']
+
+
+def push_batch_to_endoffields(states, qonms, yscal, tol, l_B, y_bottom_elec, E, B, mode='rk45', z_det=None, field_map=None, l_E=None, z_E=0.0, z_B=0.0, prescreen=True, recorder=None, particle_ids=None):
+    """ Pushes a batch of particles from their initial conditions to the end of the E/B fields region (or to the bottom electrode).
+
+    Parameters
+    ----------
+    states : np.array shape (N, 6) (initial x,y,z, ux,uy,uz of each particle, one particle per row)
+    qonms : np.array shape (N, ) (charge/mass ratio of each particle, in SI)
+    yscal : list of 3 floats (maximum values (in modulus) the x,y,z coordinates of the particles can attain)
+    tol : float (the tolerance, see RKint.RK45integrator())
+    l_B : float (Geometry: the length along which E/B fields extend along z-axis, in SI (meters))
+    y_bottom_elec : float (the y-coordinate of the bottom electrode, in SI (meters))
+    E : float (value in SI (V/m) of the static electrical field)
+    B : float (value in SI (T) of the static magnetic field)
+    mode : str (one of propagation_modes)
+    z_det : float (where the detector (screen) is placed along z-axis, in SI (meters). only needed by the 'map' mode, which validates its interpolation on the screen)
+    field_map : str or None (directory of a fieldmap.Field_Map. if given, its fields replace E and B, and the particles are integrated up to the end of the map or l_B, whichever is further)
+    l_E : float or None (length of the E-field region, in SI (meters). None means l_E = l_B)
+    z_E, z_B : floats (z at which the E-field and B-field regions start, in SI (meters). see regions.py)
+    prescreen : bool (if True, the particles which certainly hit the bottom electrode are found in closed form and not pushed by the 'rk45', 'dopri54' and 'map' modes)
+    recorder : Trajectory.Trajectory_Recorder or None (if given, samples of the trajectories of its particles are kept in it)
+    particle_ids : np.array shape (N, ) of ints or None (ids of the particles for the recorder, e.g. their index over all the chunks of the run. default: their row numbers)
+
+    Returns
+    -------
+    exited_B : np.array shape (N, ) of ints (1 if the particle has exit the fields region, 0 otherwise)
+    hit_E : np.array shape (N, ) of ints (1 if the particle has hit the bottom electrode, 0 otherwise)
+    final_states : np.array shape (N, 6) : the x,y,z, ux,uy,uz of each particle at the end of the propagation.
+    steps_accepted : np.array shape (N, ) of ints (accepted RK45 steps of each particle, 0 for the particles propagated analytically / by the map)
+    steps_rejected : np.array shape (N, ) of ints (rejected RK45 steps of each particle, 0 for the particles propagated analytically / by the map)
+    """
+
+    if recorder is not None:
+        states = np.asarray(states, dtype=float)
+        particle_ids = np.arange(states.shape[0]) if particle_ids is None else np.asarray(particle_ids)
+        recorder.record(particle_ids, states, force=True)
+    if field_map is not None:
+        if mode not in ('rk45', 'dopri54'):
+            raise ValueError("The '{}' propagation mode needs uniform E and B fields. Use 'rk45' or 'dopri54' with a field map.".format(mode))
+        E = fieldmap.get_field_map(field_map)
+        l_B = max(l_B, E.z_end)
+    elif regions.needs_regions(l_E, l_B, z_E, z_B):
+        if mode == 'map':
+            raise ValueError("The 'map' propagation mode needs the E and B fields over the same region. Use 'rk45', 'dopri54' or 'analytic' with separate regions.")
+        segments = regions.field_segments(E, l_B if l_E is None else l_E, z_E, B, l_B, z_B)
+        return regions.push_batch_through_regions(states, qonms, yscal, tol, segments, y_bottom_elec, mode, recorder, particle_ids)
+    elif prescreen and mode in ('rk45', 'dopri54', 'map'):
+        states = np.asarray(states, dtype=float)
+        qonms = np.broadcast_to(np.asarray(qonms, dtype=float), (states.shape[0],))
+        certain_clip, certain_pass, at_electrode = analytic_prop.prescreen_batch(states, qonms, l_B, y_bottom_elec, E, B)
+        instrumentation.count('particles_prescreened_clip', certain_clip.sum())
+        instrumentation.count('particles_prescreened_pass', certain_pass.sum())
+        if certain_clip.any():
+            rest = ~certain_clip
+            exited_B = np.zeros(states.shape[0], dtype=int)
+            hit_E = certain_clip.astype(int)
+            final_states = states.copy()
+            final_states[certain_clip] = at_electrode
+            if recorder is not None:
+                recorder.record(particle_ids[certain_clip], at_electrode, force=True)
+            steps_accepted = np.zeros(states.shape[0], dtype=int)
+            steps_rejected = np.zeros(states.shape[0], dtype=int)
+            if rest.any():
+                exited_B[rest], hit_E[rest], final_states[rest], steps_accepted[rest], steps_rejected[rest] = push_batch_to_endoffields(states[rest], qonms[rest], yscal, tol, l_B, y_bottom_elec, E, B, mode, z_det, prescreen=False,
+                                                                                                                                  recorder=recorder, particle_ids=None if recorder is None else particle_ids[rest])
+            return exited_B, hit_E, final_states, steps_accepted, steps_rejected
+    if (mode == 'rk45'):
+        return RKint.RK45integrator_batch(states, qonms, yscal, tol, l_B, y_bottom_elec, E, B, recorder=recorder, particle_ids=particle_ids)
+    elif (mode == 'dopri54'):
+        return RKint.DOPRI54integrator_batch(states, qonms, yscal, tol, l_B, y_bottom_elec, E, B, recorder=recorder, particle_ids=particle_ids)
+    elif (mode == 'analytic'):
+        states = np.asarray(states, dtype=float)
+        qonms = np.broadcast_to(np.asarray(qonms, dtype=float), (states.shape[0],))
+        exited_B, hit_E, final_states, needs_fallback = analytic_prop.analytic_propagator_batch(states, qonms, yscal, tol, l_B, y_bottom_elec, E, B)
+        steps_accepted = np.zeros(states.shape[0], dtype=int)
+        steps_rejected = np.zeros(states.shape[0], dtype=int)
+        if needs_fallback.any():
+            exited_B[needs_fallback], hit_E[needs_fallback], final_states[needs_fallback], steps_accepted[needs_fallback], steps_rejected[needs_fallback] = RKint.RK45integrator_batch(states[needs_fallback], qonms[needs_fallback], yscal, tol, l_B, y_bottom_elec, E, B,
+                                                                                                                                                                                                 recorder=recorder, particle_ids=None if recorder is None else particle_ids[needs_fallback])
+        if recorder is not None:
+            recorder.record(particle_ids, final_states, force=True)
+        return exited_B, hit_E, final_states, steps_accepted, steps_rejected
+    elif (mode == 'map'):
+        states = np.asarray(states, dtype=float)
+        qonms = np.broadcast_to(np.asarray(qonms, dtype=float), (states.shape[0],))
+        the_map = response_map.get_response_map(E, B, l_B, z_det, yscal[:3], tol)
+        exited_B, hit_E, final_states, needs_integration = the_map.map_to_endoffields(states, qonms, y_bottom_elec)
+        steps_accepted = np.zeros(states.shape[0], dtype=int)
+        steps_rejected = np.zeros(states.shape[0], dtype=int)
+        if needs_integration.any():
+            exited_B[needs_integration], hit_E[needs_integration], final_states[needs_integration], steps_accepted[needs_integration], steps_rejected[needs_integration] = RKint.DOPRI54integrator_batch(states[needs_integration], qonms[needs_integration], yscal, tol, l_B, y_bottom_elec, E, B,
+                                                                                                                                                                                                                        recorder=recorder, particle_ids=None if recorder is None else particle_ids[needs_integration])
+        if recorder is not None:
+            recorder.record(particle_ids, final_states, force=True)
+        return exited_B, hit_E, final_states, steps_accepted, steps_rejected
+    else:
+        raise ValueError("Unknown propagation mode '{}'. Choose from {}.".format(mode, propagation_modes))
+
+
+def push_batch_from_endoffields_to_detector(final_states, z_det):
+    """ Vectorized version of Species.Species.Species_push_from_endoffields_to_detector(): ballistic flight of a batch of particles to the screen.
+
+    Parameters
+    ----------
+    final_states : np.array shape (N, 6) (x,y,z, ux,uy,uz of each particle at the end of the E/B fields region)
+    z_det : float (where the detector (screen) is placed along z-axis, in SI (meters))
+
+    Returns
+    -------
+    np.array shape (N, 2) with the x,y coordinates of each particle on the detector screen.
+    """
+
+    drift_times = (z_det - final_states[:, 2]) / final_states[:, 5] # z_difference / u_z at exit
+    return final_states[:, 0:2] + final_states[:, 3:5] * drift_times[:, None]
@@ -0,0 +1,127 @@
+""" Piecewise propagation through an E-field region and a B-field region which do not coincide (l_E != l_B, or plates offset along z).
+
+The E-field (electrode plates) extends over z_E <= z <= z_E + l_E, the B-field (magnet) over z_B <= z <= z_B + l_B, both along +y as in main.py.
+The beamline from the aperture (z = 0) to the end of the last region is cut at every edge of the two regions into segments, each with
+constant fields, so each segment is one of:
+
+    'drift' : no field. straight line (closed form)
+    'B'     : B-field only. cyclotron rotation in the x-z plane at constant speed (closed form)
+    'E'     : E-field only. relativistic constant-force acceleration along y (closed form)
+    'EB'    : both fields. Dormand-Prince 5(4) integration, or the closed-form E || B solution in the 'analytic' propagation mode
+
+The closed forms are the ones of analytic_prop.py with E = 0 and/or B = 0 (which then only amounts to a few NumPy operations per particle),
+and the integrator locates the end of its segment on the dense output of the step, so every particle starts the next segment exactly
+on its boundary. The bottom electrode only exists along the E-field plates: particles can only hit it in the 'E' and 'EB' segments,
+or at its front edge if they reach the plates already beyond y_bottom_elec (their final state is then the one at the start of the plates).
+"""
+
+import numpy as np
+import RKint, analytic_prop, instrumentation
+
+segment_kinds = ['drift', 'B', 'E', 'EB']
+
+
+def needs_regions(l_E, l_B, z_E=0.0, z_B=0.0):
+    """ True unless both fields extend over the same 0 <= z <= l_B (the single region which the propagation modes of propagation.py model). """
+
+    return (l_E is not None and l_E != l_B) or z_E != 0.0 or z_B != 0.0
+
+
+def field_segments(E, l_E, z_E, B, l_B, z_B):
+    """ Cuts the beamline, from the aperture (z = 0) to the end of the last field region, into segments of constant fields.
+
+    Parameters
+    ----------
+    E, B : floats (values in SI of the static electrical and magnetic fields)
+    l_E, l_B : floats (lengths along z of the E-field and B-field regions, in SI (meters))
+    z_E, z_B : floats (z at which the E-field and B-field regions start, in SI (meters))
+
+    Returns
+    -------
+    list of tuples (z_start, z_end, E, B, electrode), one per segment in order along z, with the fields inside the segment (0.0 if off)
+    and electrode = True if the segment lies along the E-field plates (so the particles can hit the bottom electrode there).
+    """
+
+    if min(l_E, l_B) <= 0.0 or min(z_E, z_B) < 0.0:
+        raise ValueError("The field regions must have positive lengths and start at z >= 0 (l_E = {}, l_B = {}, z_E = {}, z_B = {}).".format(l_E, l_B, z_E, z_B))
+    edges = sorted({0.0, z_E, z_E + l_E, z_B, z_B + l_B})
+    segments = []
+    for z_start, z_end in zip(edges[:-1], edges[1:]):
+        in_E = (z_E <= z_start and z_end <= z_E + l_E)
+        in_B = (z_B <= z_start and z_end <= z_B + l_B)
+        segments.append((z_start, z_end, E if in_E else 0.0, B if in_B else 0.0, in_E))
+    return segments
+
+
+def segment_kind(E, B):
+    """ One of segment_kinds, for the fields E and B of a segment. """
+
+    return segment_kinds[int(E != 0.0) * 2 + int(B != 0.0)]
+
+
+def push_batch_through_regions(states, qonms, yscal, tol, segments, y_bottom_elec, mode='dopri54', recorder=None, particle_ids=None):
+    """ Pushes a batch of particles through the segments of field_segments(), up to the end of the last one (or to the bottom electrode).
+
+    Parameters
+    ----------
+    states : np.array shape (N, 6) (initial x,y,z, ux,uy,uz of each particle, one particle per row)
+    qonms : np.array shape (N, ) (charge/mass ratio of each particle, in SI)
+    yscal : list of 3 floats (maximum values (in modulus) the x,y,z coordinates of the particles can attain)
+    tol : float (the tolerance, see RKint.RK45integrator())
+    segments : list of tuples (see field_segments())
+    y_bottom_elec : float (the y-coordinate of the bottom electrode, in SI (meters))
+    mode : str ('analytic' uses the closed-form solution in the 'EB' segments too, any other mode integrates them)
+    recorder : Trajectory.Trajectory_Recorder or None (if given, the integration steps and the state at the end of every segment of its particles are recorded)
+    particle_ids : np.array shape (N, ) of ints or None (ids of the particles for the recorder. default: their row numbers)
+
+    Returns
+    -------
+    Same as propagation.push_batch_to_endoffields(), the end of the fields being the end of the last segment.
+    """
+
+    states = np.asarray(states, dtype=float)
+    no_of_parts = states.shape[0]
+    qonms = np.broadcast_to(np.asarray(qonms, dtype=float), (no_of_parts,))
+    final_states = states.copy()
+    hit_E = np.zeros(no_of_parts, dtype=int)
+    steps_accepted = np.zeros(no_of_parts, dtype=int)
+    steps_rejected = np.zeros(no_of_parts, dtype=int)
+    in_flight = np.ones(no_of_parts, dtype=bool)
+    if recorder is not None:
+        particle_ids = np.arange(no_of_parts) if particle_ids is None else np.asarray(particle_ids)
+
+    for z_start, z_end, E, B, electrode in segments:
+        idx = np.flatnonzero(in_flight)
+        y_stop = y_bottom_elec if electrode else np.inf
+        if electrode:
+            blocked = (final_states[idx, 1] >= y_stop) # already past the electrode when reaching the plates: hit its front edge
+            hit_E[idx[blocked]] = 1
+            in_flight[idx[blocked]] = False
+            idx = idx[~blocked]
+        if idx.size == 0:
+            break
+        kind = segment_kind(E, B)
+        accepted = np.zeros(idx.size, dtype=int)
+        rejected = np.zeros(idx.size, dtype=int)
+        with instrumentation.timer('region_' + kind, idx.size):
+            if kind == 'EB' and mode != 'analytic':
+                exited, hit, at_end, accepted, rejected = RKint.DOPRI54integrator_batch(final_states[idx], qonms[idx], yscal, tol, z_end, y_stop, E, B,
+                                                                                        recorder=recorder, particle_ids=None if recorder is None else particle_ids[idx])
+            else:
+                exited, hit, at_end, needs_fallback = analytic_prop.analytic_propagator_batch(final_states[idx], qonms[idx], yscal, tol, z_end, y_stop, E, B)
+                if kind != 'EB':
+                    needs_fallback &= (exited == 1) | (hit == 1) # with one field at most, no exit (e.g. turning around in the B-field) is exact
+                if needs_fallback.any():
+                    f = np.flatnonzero(needs_fallback)
+                    exited[f], hit[f], at_end[f], accepted[f], rejected[f] = RKint.DOPRI54integrator_batch(final_states[idx[f]], qonms[idx[f]], yscal, tol, z_end, y_stop, E, B,
+                                                                                                           recorder=recorder, particle_ids=None if recorder is None else particle_ids[idx[f]])
+        instrumentation.count('region_{}_particles'.format(kind), idx.size)
+        final_states[idx] = at_end
+        if recorder is not None:
+            recorder.record(particle_ids[idx], at_end, force=True)
+        steps_accepted[idx] += accepted
+        steps_rejected[idx] += rejected
+        hit_E[idx[hit == 1]] = 1
+        in_flight[idx[exited != 1]] = False # hit the electrode, or never reached the end of the segment
+
+    return in_flight.astype(int), hit_E, final_states, steps_accepted, steps_rejected
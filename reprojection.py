@@ -0,0 +1,85 @@
+""" Re-projection of a finished run onto detector screens placed at other z_det's, without pushing the particles through the fields again.
+
+Only the ballistic flight after the end of the fields depends on z_det. The hits file of a run (see hit_store.py) keeps the state of every
+particle at the end of the fields (x,y,z, ux,uy,uz at z = l_B), so the screen pictures for any list of z_det values are obtained
+in a single vectorized pass over these stored states, block_size particles at a time.
+
+CLI:
+    $ python3 reprojection.py name_hits 0.4 0.5 0.6 [--output name]
+writes name_zdet_0.4.npz, name_zdet_0.5.npz, name_zdet_0.6.npz, with the same layout as the .npz archive written by main.py.
+"""
+
+import sys, argparse
+import numpy as np
+import hit_store, databases, Species
+
+
+def reproject(final_states, z_dets):
+    """ Ballistic flight of a batch of particles from the end of the fields to several detector screens at once.
+
+    Same arithmetic as propagation.push_batch_from_endoffields_to_detector(), so the coordinates are bit-for-bit those of a run with each z_det.
+
+    Parameters
+    ----------
+    final_states : np.array shape (N, 6) (x,y,z, ux,uy,uz of each particle at the end of the E/B fields region)
+    z_dets : np.array shape (M, ) (where the detector screens are placed along z-axis, in SI (meters))
+
+    Returns
+    -------
+    np.array shape (M, N, 2) with the x,y coordinates of each particle on each screen.
+    """
+
+    z_dets = np.asarray(z_dets, dtype=float)
+    drift_times = (z_dets[:, None] - final_states[None, :, 2]) / final_states[None, :, 5] # shape (M, N)
+    return final_states[None, :, 0:2] + final_states[None, :, 3:5] * drift_times[:, :, None]
+
+
+def reproject_run(hits_dir, z_dets, block_size=10**6):
+    """ Re-projects all the particles of a run which exited the fields onto the screens placed at z_dets.
+
+    Parameters
+    ----------
+    hits_dir : str (the hits directory of the run, e.g. name_hits)
+    z_dets : list of floats (where the detector screens are placed along z-axis, in SI (meters))
+    block_size : int (how many particles are re-projected at once)
+
+    Returns
+    -------
+    list (one element per z_det) of dictionaries {name of the species of a chunk: np.array shape (n, 2) with the x,y on this screen
+    of the n particles of the chunk which exited the fields}. as in main.py, a later chunk of the same species overwrites an earlier one.
+    """
+
+    hits = hit_store.Hit_Reader(hits_dir)
+    records = hits.select(status=Species.status_exited)
+    order = np.lexsort((records['particle_id'], records['chunk'])) # by chunk, then in the order of the particles
+    final_states = np.column_stack([records[name][order] for name in ['exit_x', 'exit_y', 'exit_z', 'exit_ux', 'exit_uy', 'exit_uz']])
+    chunks = records['chunk'][order]
+    species_ids = records['species_id'][order]
+
+    screens = np.empty((len(z_dets), final_states.shape[0], 2))
+    for start in range(0, final_states.shape[0], block_size): # one pass over the stored states
+        screens[:, start:start + block_size] = reproject(final_states[start:start + block_size], z_dets)
+
+    pictures = [dict() for z_det in z_dets]
+    for chunk in np.unique(chunks).tolist():
+        in_chunk = (chunks == chunk)
+        name = databases.all_possible_names[species_ids[in_chunk][0]]
+        for m in range(len(z_dets)):
+            pictures[m][name] = screens[m, in_chunk]
+    return pictures
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="Re-projects a finished run onto detector screens placed at other z_det's.")
+    parser.add_argument('hits_dir', help="the hits directory of the run (name_hits)")
+    parser.add_argument('z_dets', type=float, nargs='+', help="positions of the detector screens along z, in meters")
+    parser.add_argument('--output', default=None, help="prefix of the .npz archives written (default: the name of the run)")
+    args = parser.parse_args(argv)
+    output = args.output if args.output is not None else args.hits_dir.rstrip('/\\')[:-len('_hits')] if args.hits_dir.rstrip('/\\').endswith('_hits') else args.hits_dir
+    for z_det, picture in zip(args.z_dets, reproject_run(args.hits_dir, args.z_dets)):
+        np.savez_compressed('{}_zdet_{}.npz'.format(output, z_det), **picture)
+        print("Saved {}_zdet_{}.npz".format(output, z_det))
+
+
+if __name__ == '__main__':
+    cli(sys.argv[1:])
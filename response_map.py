@@ -0,0 +1,194 @@
+""" Precomputed response of a given geometry, for mass-production runs.
+
+In the uniform E and B fields, the end-of-fields state of a particle entering the aperture with velocity along z only depends on its q/m and its u_z,
+its initial x and y (the aperture offsets) simply shifting the exit x and y by the same amounts. So, for a given geometry (E, B, l_B, z_det),
+a grid over log(q/m) x log(u_z) of end-of-fields states is integrated once (with the bottom electrode removed), interpolated by bicubic splines,
+and whole particle arrays are then mapped to their end-of-fields states (hence to the screen) with no integration at all:
+    x_exit = x0 + dx_exit(q/m, u_z) , y_exit = y0 + dy_exit(q/m, u_z) , u_exit = u_exit(q/m, u_z) , z_exit = l_B
+and a particle hits the bottom electrode if y0 + max(dy_exit, 0) >= y_bottom_elec (y is monotonic along the path when u_x = u_y = 0 at the aperture).
+
+The interpolation error is controlled: the screen positions predicted at the centre of every grid cell are compared to integrated ones,
+and the grid is refined until all cells are within error_bound (in meters, on the screen). Cells which are still not within error_bound,
+or which touch particles turning around in the B-field, are marked as untrusted, and the particles falling into them are integrated instead.
+The maps are cached on disk, in a .npz file named after a hash of the geometry, tolerance and grid settings.
+"""
+
+import os
+import numpy as np
+from scipy.interpolate import RectBivariateSpline
+import RKint, utility_fns, databases
+
+# default extent of the maps: all the charged species of the databases, and velocities from 1e5 m/s to 1e9 m/s (proper velocities, > c allowed)
+_nonzero_qonms = [databases.charges[name] / databases.masses[name] for name in databases.all_possible_names if databases.charges[name] != 0.0]
+default_qonm_range = (min(_nonzero_qonms), max(_nonzero_qonms))
+default_uz_range = (10**5, 10**9)
+
+_loaded_maps = dict() # key -> Response_Map, so that each process builds / loads a given map only once
+
+
+class Response_Map:
+    """ Interpolated end-of-fields states over a log(q/m) x log(u_z) grid, for one geometry.
+
+    Attributes
+    ----------
+    _E, _B, _l_B, _z_det : floats (the geometry, in SI)
+    _yscal : np.array shape (3, ), _tol : float (settings of the integrations of the grid, see RKint.DOPRI54integrator_batch())
+    _error_bound : float (maximum interpolation error accepted on the screen, in meters)
+    key : str (hash of all the above and of the grid settings; name of the cache file)
+    log_qonms, log_uzs : np.arrays (the axes of the final grid)
+    values : np.array shape (n_qonm, n_uz, 5) (dx_exit, dy_exit, ux_exit, uy_exit, uz_exit at the grid nodes)
+    trusted : np.array shape (n_qonm - 1, n_uz - 1) of bools (cells within error_bound)
+    max_error : float (largest validated interpolation error over the trusted cells, in meters on the screen)
+
+    Methods
+    -------
+    map_to_endoffields(states, qonms, y_bottom_elec):
+        Maps a batch of particles to their end-of-fields states. Returns exited_B, hit_E, final_states and a mask of the particles which still need integration.
+    """
+
+    def __init__(self, E, B, l_B, z_det, yscal, tol, qonm_range=default_qonm_range, uz_range=default_uz_range, n_qonm=17, n_uz=33, error_bound=10**(-6), max_refinements=3, cache_dir='response_maps'):
+        self._E, self._B, self._l_B, self._z_det = E, B, l_B, z_det
+        self._yscal = np.asarray(yscal, dtype=float)[:3]
+        self._tol = tol
+        self._error_bound = error_bound
+        self.key = utility_fns.geometry_key(E=E, B=B, l_B=l_B, z_det=z_det, yscal=self._yscal, tol=tol, qonm_range=qonm_range, uz_range=uz_range,
+                                            n_qonm=n_qonm, n_uz=n_uz, error_bound=error_bound, max_refinements=max_refinements)
+        filename = os.path.join(cache_dir, 'response_map_{}.npz'.format(self.key))
+        if os.path.exists(filename):
+            cached = np.load(filename)
+            self.log_qonms, self.log_uzs, self.values, self.trusted = cached['log_qonms'], cached['log_uzs'], cached['values'], cached['trusted']
+            self.max_error = float(cached['max_error'])
+        else:
+            self._build(qonm_range, uz_range, n_qonm, n_uz, max_refinements)
+            os.makedirs(cache_dir, exist_ok=True)
+            temporary = '{}.{}.tmp'.format(filename, os.getpid()) # written aside and moved into place, so no process ever loads a half-written map
+            with open(temporary, 'wb') as f:
+                np.savez(f, log_qonms=self.log_qonms, log_uzs=self.log_uzs, values=self.values, trusted=self.trusted, max_error=self.max_error)
+            os.replace(temporary, filename)
+        self._fit_splines()
+
+    def __repr__(self):
+        return f'Response_Map(E={self._E}, B={self._B}, l_B={self._l_B}, z_det={self._z_det}, tol={self._tol}, grid={self.values.shape[:2]}, max_error={self.max_error})'
+
+    def _integrate(self, log_qonms, log_uzs):
+        # end-of-fields states of particles starting from the origin, for all the (q/m, u_z) pairs of the given axes. no bottom electrode.
+        # the particles turning around in the B-field (cyclotron radius u_z / |qonm B| below l_B) would never leave it, so they are not integrated.
+        qq, uu = np.meshgrid(np.exp(log_qonms), np.exp(log_uzs), indexing='ij')
+        qonms, uzs = qq.ravel(), uu.ravel()
+        exiting = (np.abs(qonms * self._B) * self._l_B < uzs)
+        states = np.zeros((exiting.sum(), 6))
+        states[:, 5] = uzs[exiting]
+        values = np.full((qonms.size, 5), np.nan)
+        exited = np.zeros(qonms.size, dtype=bool)
+        exited_B, hit_E, final_states, steps_accepted, steps_rejected = RKint.DOPRI54integrator_batch(states, qonms[exiting], self._yscal, self._tol, self._l_B, np.inf, self._E, self._B)
+        values[exiting] = final_states[:, [0, 1, 3, 4, 5]]
+        exited[exiting] = (exited_B == 1)
+        return values.reshape(qq.shape + (5,)), exited.reshape(qq.shape)
+
+    def _build(self, qonm_range, uz_range, n_qonm, n_uz, max_refinements):
+        for refinement in range(max_refinements + 1):
+            self.log_qonms = np.linspace(np.log(qonm_range[0]), np.log(qonm_range[1]), n_qonm)
+            self.log_uzs = np.linspace(np.log(uz_range[0]), np.log(uz_range[1]), n_uz)
+            values, exited = self._integrate(self.log_qonms, self.log_uzs)
+            # nodes of particles which never exit (they turn around in the B-field, at low u_z) get the values of the first exiting node above them,
+            # so that the splines stay smooth. the cells touching them are never trusted.
+            for i in range(n_qonm):
+                if exited[i].any() and not exited[i].all():
+                    first = np.argmax(exited[i])
+                    values[i, ~exited[i]] = values[i, first]
+                elif not exited[i].any():
+                    values[i] = 0.0
+            self.values = values
+            self._fit_splines()
+
+            # validation at the centre of every cell
+            mid_qonms = 0.5 * (self.log_qonms[:-1] + self.log_qonms[1:])
+            mid_uzs = 0.5 * (self.log_uzs[:-1] + self.log_uzs[1:])
+            exact, mid_exited = self._integrate(mid_qonms, mid_uzs)
+            qq, uu = np.meshgrid(mid_qonms, mid_uzs, indexing='ij')
+            predicted = self._evaluate(qq.ravel(), uu.ravel()).reshape(exact.shape)
+            errors = np.max(np.abs(self._screen(predicted) - self._screen(exact)), axis=-1)
+            valid = mid_exited & exited[:-1, :-1] & exited[1:, :-1] & exited[:-1, 1:] & exited[1:, 1:]
+            self.trusted = valid & (errors <= self._error_bound)
+            self.max_error = float(np.max(errors[self.trusted])) if self.trusted.any() else np.inf
+            if self.trusted.sum() == valid.sum():
+                break
+            n_qonm, n_uz = 2 * n_qonm - 1, 2 * n_uz - 1 # halve the cells
+
+    def _fit_splines(self):
+        self._splines = [RectBivariateSpline(self.log_qonms, self.log_uzs, self.values[:, :, i], kx=3, ky=3) for i in range(5)]
+
+    def _evaluate(self, log_qonms, log_uzs):
+        return np.stack([spline.ev(log_qonms, log_uzs) for spline in self._splines], axis=-1)
+
+    def _screen(self, values):
+        # screen x, y of particles leaving the origin, from their interpolated / integrated exit values (dx, dy, ux, uy, uz)
+        drift_times = (self._z_det - self._l_B) / values[..., 4]
+        return np.stack([values[..., 0] + values[..., 2] * drift_times, values[..., 1] + values[..., 3] * drift_times], axis=-1)
+
+    def map_to_endoffields(self, states, qonms, y_bottom_elec):
+        """ Maps a batch of particles to their end-of-fields states, using the interpolated response.
+
+        Parameters
+        ----------
+        states : np.array shape (N, 6) (initial x,y,z, ux,uy,uz of each particle)
+        qonms : np.array shape (N, ) (charge/mass ratio of each particle, in SI)
+        y_bottom_elec : float (the y-coordinate of the bottom electrode, in SI (meters))
+
+        Returns
+        -------
+        exited_B, hit_E : np.arrays shape (N, ) of ints
+        final_states : np.array shape (N, 6) (end-of-fields states. nan for the particles hitting the bottom electrode, whose hit point is not mapped)
+        needs_integration : np.array shape (N, ) of bools (particles outside of the map, in untrusted cells, not starting at z = 0 with u_x = u_y = 0, or neutral)
+        """
+
+        states = np.asarray(states, dtype=float)
+        no_of_parts = states.shape[0]
+        qonms = np.broadcast_to(np.asarray(qonms, dtype=float), (no_of_parts,))
+        exited_B = np.zeros(no_of_parts, dtype=int)
+        hit_E = np.zeros(no_of_parts, dtype=int)
+        final_states = np.full((no_of_parts, 6), np.nan)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_qonms = np.log(qonms)
+            log_uzs = np.log(states[:, 5])
+        inside = (log_qonms >= self.log_qonms[0]) & (log_qonms <= self.log_qonms[-1]) & (log_uzs >= self.log_uzs[0]) & (log_uzs <= self.log_uzs[-1])
+        inside &= (states[:, 2] == 0.0) & (states[:, 3] == 0.0) & (states[:, 4] == 0.0)
+        # cell of each particle. the last nodes belong to the last cells (the protons sit exactly on the upper q/m edge of the default map)
+        i = np.clip(np.searchsorted(self.log_qonms, log_qonms, side='right') - 1, 0, self.log_qonms.size - 2)
+        j = np.clip(np.searchsorted(self.log_uzs, log_uzs, side='right') - 1, 0, self.log_uzs.size - 2)
+        mapped = np.zeros(no_of_parts, dtype=bool)
+        mapped[inside] = self.trusted[i[inside], j[inside]]
+        needs_integration = ~mapped
+
+        values = self._evaluate(log_qonms[mapped], log_uzs[mapped])
+        hits = states[mapped, 1] + np.maximum(values[:, 1], 0.0) >= y_bottom_elec
+        exits = ~hits
+        m = np.flatnonzero(mapped)
+        hit_E[m[hits]] = 1
+        exited_B[m[exits]] = 1
+        final_states[m[exits], 0] = states[m[exits], 0] + values[exits, 0]
+        final_states[m[exits], 1] = states[m[exits], 1] + values[exits, 1]
+        final_states[m[exits], 2] = self._l_B
+        final_states[m[exits], 3:6] = values[exits, 2:5]
+        return exited_B, hit_E, final_states, needs_integration
+
+
+def get_response_map(E, B, l_B, z_det, yscal, tol, **grid_settings):
+    """ Returns the Response_Map of this geometry, building it (or loading it from the disk cache) only the first time it is asked for in this process.
+
+    Parameters
+    ----------
+    E, B, l_B, z_det : floats (the geometry, in SI)
+    yscal : list of 3 floats, tol : float (integration settings of the grid)
+    **grid_settings : optional arguments of Response_Map (qonm_range, uz_range, n_qonm, n_uz, error_bound, max_refinements, cache_dir)
+
+    Returns
+    -------
+    Response_Map
+    """
+
+    key = utility_fns.geometry_key(E=E, B=B, l_B=l_B, z_det=z_det, yscal=yscal, tol=tol, **grid_settings)
+    if key not in _loaded_maps:
+        _loaded_maps[key] = Response_Map(E, B, l_B, z_det, yscal, tol, **grid_settings)
+    return _loaded_maps[key]
@@ -0,0 +1,263 @@
+""" Non-interactive runs of the simulation, driven by a run spec instead of the prompts of main.py, and sweeps over parameters of the run spec.
+
+A run spec is a dictionary (read from a .json or .toml file by the CLI) such as:
+
+    {"geometry": {"E": 1e5, "B": 0.5, "l_E": 0.05, "D_E": 0.45, "z_det": 0.5, "y_bottom_elec": 0.02},
+     "propagation_mode": "dopri54", "n_workers": 1, "seed": 1234,
+     "chunks": [{"species": "proton", "no_of_particles": 1000, "energy_MeV": 5.0, "tol": 1e-6, "option": 1, "sub_option": 2},
+                {"species": "C6+", "no_of_particles": 500, "energy_MeV": 3.0, "tol": 1e-6, "option": 2, "sub_option": 1,
+                 "aperture_x": true, "aperture_y": false, "Rx": 0.001, "Ry": 0.0, "seed": 42}],
+     "sweep": {"E": [1e5, 2e5], "B": [0.5, 1.0], "z_det": [0.5, 0.6]}}
+
+with the same meaning as the answers to the prompts of main.py (the geometry can also give "l_B", "z_E" and "z_B", for E and B regions which do not coincide,
+see regions.py; a chunk's "tol" can be "auto", to tune it to the "target_screen_accuracy" of the run spec, in meters, see tolerance_tuning.py;
+an optional "field_map" names the directory of a map of non-uniform fields, see fieldmap.py; "trajectory_particle_ids" lists particles (by their index over
+all the chunks) whose trajectories are recorded to results_trajectories.npy, see Trajectory.py; for sub-option 3, "velocity_file" names the file of initial velocities).
+Instead of "option" / "sub_option", a chunk can give a "source" (see sources.py), e.g.
+
+    {"species": "proton", "no_of_particles": 100000, "tol": 1e-6,
+     "source": {"type": "exponential", "T_MeV": 2.0, "E_min_MeV": 0.5, "E_cut_MeV": 20.0, "Rx": 0.001, "Ry": 0.001, "divergence": 0.01}}
+
+whose optional "sampling" ("importance" or "stratified", with "tail_decades") draws more particles in the high-energy tail, each carrying
+a statistical weight which the detector images and the hits file take into account (see sources.py). The chunks of sub-option 2 (Gaussian)
+take the same optional "sampling" and "tail_decades" keys (main.py's gaussian_sampling and gaussian_tail_decades in the interactive runs).
+
+Each chunk draws its particles from its own seed (its "seed" if given, else one derived from the "seed" of the run and the index of the chunk),
+so a run spec always gives the same particles.
+
+The optional "sweep" maps parameters to lists of values. A parameter is a key of "geometry", a top-level key of the run spec, or a dotted path
+(e.g. "chunks.0.energy_MeV"). The sweep is the cartesian product of all the lists. Identical points (same run spec once the sweep values are set)
+are run only once, each unique point has its own output directory (named after a hash of its run spec), the points already done are skipped,
+and the points are run in parallel, by a pool of processes.
+
+CLI:
+    $ python3 simulation.py run_spec.json --output out_dir [--parallel 4]
+"""
+
+import os, sys, json, copy, itertools, argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import Geometry, propagation, checkpoint, utility_fns, sources, instrumentation, tolerance_tuning, main
+
+geometry_keys = ['E', 'B', 'l_E', 'D_E', 'z_det', 'y_bottom_elec']
+optional_geometry_keys = ['l_B', 'z_E', 'z_B'] # l_B = l_E and z_E = z_B = 0 if not given
+default_spec = {'propagation_mode': 'rk45', 'n_workers': 1, 'seed': 0, 'yscal': [10.0, 0.01, 0.2], 'field_map': None, 'target_screen_accuracy': 1e-6, 'trajectory_particle_ids': []}
+default_chunk = {'option': 1, 'sub_option': 1, 'aperture_x': False, 'aperture_y': False, 'Rx': 0.0, 'Ry': 0.0}
+
+
+def load_spec(filename):
+    """ Reads a run spec from a .json or a .toml file. """
+
+    if filename.endswith('.toml'):
+        import tomllib # Python >= 3.11
+        with open(filename, 'rb') as f:
+            return tomllib.load(f)
+    with open(filename) as f:
+        return json.load(f)
+
+
+class Simulation:
+    """ One run of the simulation, fully described by a run spec (see the docstring of this module).
+
+    Attributes
+    ----------
+    spec : dict (the run spec, completed with the default values. its "sweep" entry, if any, is ignored)
+    key : str (hash of spec, see utility_fns.geometry_key())
+
+    Methods
+    -------
+    geometry():
+        Returns the geometry of the run, as the dict of parallel_exec.push_sub_batch() (without 'tol').
+    draw_particles():
+        Returns the list of Species.ParticleBatch of the chunks of the run.
+    run(output_dir, resume=True):
+        Runs the simulation, writing the results to output_dir, and returns the x,y coordinates on the screen of each chunk.
+    """
+
+    def __init__(self, spec):
+        spec = copy.deepcopy(spec)
+        spec.pop('sweep', None)
+        self.spec = {**default_spec, **spec}
+        missing = [key for key in geometry_keys if key not in self.spec.get('geometry', {})]
+        if missing:
+            raise ValueError("The geometry of the run spec misses {}.".format(missing))
+        if self.spec['propagation_mode'] not in propagation.propagation_modes:
+            raise ValueError("Unknown propagation mode '{}'. Choose from {}.".format(self.spec['propagation_mode'], propagation.propagation_modes))
+        self.spec['chunks'] = [{**default_chunk, **chunk} for chunk in self.spec.get('chunks', [])]
+        for chunk in self.spec['chunks']:
+            if chunk['species'] not in main.all_possible_names:
+                raise ValueError("Unknown species '{}'.".format(chunk['species']))
+        self.key = utility_fns.geometry_key(**self.spec)
+
+    def __repr__(self):
+        return f'Simulation(key={self.key}, geometry={self.spec["geometry"]}, chunks={[chunk["species"] for chunk in self.spec["chunks"]]})'
+
+    def _chunk_seed(self, j):
+        chunk = self.spec['chunks'][j]
+        if 'seed' in chunk:
+            return int(chunk['seed'])
+        return int(np.random.SeedSequence([int(self.spec['seed']), j]).generate_state(1)[0])
+
+    def geometry(self):
+        g = self.spec['geometry']
+        l_B, z_E, z_B = g.get('l_B', g['l_E']), g.get('z_E', 0.0), g.get('z_B', 0.0)
+        Efieldobj, Bfieldobj, detector_obj, electrode_bottom_obj = Geometry.create_Geometry_Objects(g['E'], g['l_E'], g['D_E'], g['B'], l_B, g['D_E'] + (z_E + g['l_E']) - (z_B + l_B),
+                                                                                                     g['z_det'], g['y_bottom_elec'], z_E, z_B)
+        return {'E': Efieldobj._strength, 'B': Bfieldobj._strength, 'l_B': Bfieldobj._l, 'y_bottom_elec': electrode_bottom_obj._y_electrode,
+                'z_det': detector_obj._z_det, 'yscal': np.array(self.spec['yscal'], dtype=float), 'field_map': self.spec['field_map'],
+                'l_E': Efieldobj._l, 'z_E': Efieldobj._z_start, 'z_B': Bfieldobj._z_start}
+
+    def draw_particles(self):
+        particle_batches = []
+        for j, chunk in enumerate(self.spec['chunks']):
+            if 'source' in chunk: # block-wise seeded streams, independent of the number of worker processes, drawn as the blocks are pushed
+                qonm = main.charges[chunk['species']] / main.masses[chunk['species']]
+                particle_batches.append(sources.Source_Batch(sources.source_from_spec(chunk['source']), chunk['no_of_particles'], self._chunk_seed(j), qonm,
+                                                             main.all_possible_names.index(chunk['species']), main.all_possible_names, block_size=main.batch_size))
+                continue
+            opt1_velosopt = chunk['sub_option'] if chunk['option'] == 1 else 0
+            opt2_velosopt = chunk['sub_option'] if chunk['option'] == 2 else 0
+            initial_coords, initial_uzs, weights = main.get_particles_init_conds(chunk['no_of_particles'], chunk['energy_MeV'], chunk['option'], chunk['aperture_x'], chunk['aperture_y'],
+                                                                                chunk['Rx'], chunk['Ry'], opt1_velosopt, opt2_velosopt, chunk.get('velocity_file'),
+                                                                                np.random.default_rng(self._chunk_seed(j)), chunk.get('sampling', 'plain'), chunk.get('tail_decades', 6))
+            particle_batches.append(main.create_ParticleBatch(chunk['species'], main.masses[chunk['species']], main.charges[chunk['species']], initial_coords, initial_uzs, chunk['no_of_particles'],
+                                                              weights))
+        return particle_batches
+
+    def run(self, output_dir, resume=True):
+        """ Runs the simulation. The results are written to output_dir: run_spec.json, results.npz, results.txt, results_image.npz
+        (the detector images, see histogram.py), results_metrics.json (if main.metrics_enabled, see instrumentation.py) and the results_hits directory (see hit_store.py).
+
+        Parameters
+        ----------
+        output_dir : str (created if needed)
+        resume : bool (if True and output_dir holds the checkpoint of an interrupted run of this run spec, the run is resumed from it)
+
+        Returns
+        -------
+        dictionary {name of the species of a chunk: np.array shape (n, 2) with the x,y on the screen of the n particles of this chunk reaching it}
+        """
+
+        os.makedirs(output_dir, exist_ok=True)
+        with open(os.path.join(output_dir, 'run_spec.json'), 'w') as f:
+            json.dump(self.spec, f, indent=1)
+        title_of_graph = os.path.join(output_dir, 'results')
+        checkpoint_file = '{}_checkpoint.pkl'.format(title_of_graph)
+        if resume and os.path.exists(checkpoint_file):
+            run_checkpoint = checkpoint.Run_Checkpoint.load(checkpoint_file)
+        else:
+            run_checkpoint = checkpoint.Run_Checkpoint(checkpoint_file)
+
+        instrumentation.configure_logging(main.log_level)
+        if main.metrics_enabled:
+            instrumentation.enable().info.update({'run': title_of_graph, 'key': self.key, 'propagation_mode': self.spec['propagation_mode'], 'n_workers': self.spec['n_workers']})
+        g = self.spec['geometry']
+        l_B, z_E, z_B = g.get('l_B', g['l_E']), g.get('z_E', 0.0), g.get('z_B', 0.0)
+        geometry = self.geometry()
+        names = [chunk['species'] for chunk in self.spec['chunks']]
+        tols = [None if chunk['tol'] == 'auto' else chunk['tol'] for chunk in self.spec['chunks']]
+        particle_batches = self.draw_particles()
+        with instrumentation.timer('tolerance_tuning'):
+            labels = [{key: value for key, value in chunk.items() if key not in ('no_of_particles', 'tol', 'seed')} for chunk in self.spec['chunks']]
+            tols, yscals = tolerance_tuning.tune_chunks(particle_batches, tols, labels, geometry, self.spec['propagation_mode'], self.spec['target_screen_accuracy'],
+                                                        '{}_tolerance_tunings'.format(title_of_graph))
+        final_coords_at_detectorscreen, big_dict, detector_histogram = main.push_chunks_to_screen(particle_batches, names, tols, geometry, self.spec['propagation_mode'],
+                                                                              self.spec['n_workers'], title_of_graph, run_checkpoint, yscals, self.spec['trajectory_particle_ids'])
+        with instrumentation.timer('output'):
+            main.save_results(title_of_graph, big_dict, g['E'], g['B'], g['l_E'], g['z_det'], g['y_bottom_elec'], tols, l_B, z_E, z_B)
+        if instrumentation.metrics is not None:
+            instrumentation.metrics.save('{}_metrics.json'.format(title_of_graph))
+            instrumentation.disable()
+        return big_dict
+
+
+def _set_parameter(spec, parameter, value):
+    # sets a parameter of the run spec: a key of "geometry", a top-level key, or a dotted path
+    if '.' not in parameter:
+        if parameter in geometry_keys or parameter in optional_geometry_keys:
+            spec['geometry'][parameter] = value
+        else:
+            spec[parameter] = value
+        return
+    target = spec
+    path = parameter.split('.')
+    for name in path[:-1]:
+        target = target[int(name)] if isinstance(target, list) else target[name]
+    if isinstance(target, list):
+        target[int(path[-1])] = value
+    else:
+        target[path[-1]] = value
+
+
+def expand_sweep(spec):
+    """ Expands the "sweep" of a run spec into the list of the run specs of its points.
+
+    Returns
+    -------
+    points : list of (dict {parameter: value}, Simulation), one per point of the sweep, in the order of the cartesian product
+    (a run spec without a "sweep" gives a single point)
+    """
+
+    sweep = spec.get('sweep', {})
+    parameters = list(sweep.keys())
+    points = []
+    for values in itertools.product(*[sweep[parameter] for parameter in parameters]):
+        point_spec = copy.deepcopy(spec)
+        point_spec.pop('sweep', None)
+        for parameter, value in zip(parameters, values):
+            _set_parameter(point_spec, parameter, value)
+        points.append((dict(zip(parameters, values)), Simulation(point_spec)))
+    return points
+
+
+def _run_point(simulation, output_dir):
+    simulation.run(output_dir)
+    with open(os.path.join(output_dir, 'done'), 'w') as f: # marks the point as done for later sweeps
+        f.write(simulation.key)
+    return output_dir
+
+
+def run_sweep(spec, output_root, n_parallel=1):
+    """ Runs all the unique points of the sweep of a run spec, n_parallel at a time, each point in output_root/point_<key of its run spec>.
+
+    The points whose output directory is marked as done are skipped; interrupted points are resumed from their checkpoints.
+    An index of the sweep (parameters values -> output directory of each point) is written to output_root/sweep_index.json.
+
+    Returns
+    -------
+    list of dict {'parameters': {parameter: value}, 'output_dir': str}, one per point of the sweep (duplicated points share their output_dir)
+    """
+
+    os.makedirs(output_root, exist_ok=True)
+    points = expand_sweep(spec)
+    index = [{'parameters': parameters, 'output_dir': os.path.join(output_root, 'point_{}'.format(simulation.key))} for parameters, simulation in points]
+    unique = dict() # key -> (simulation, output_dir). the duplicated points are run once
+    for (parameters, simulation), entry in zip(points, index):
+        unique.setdefault(simulation.key, (simulation, entry['output_dir']))
+    to_run = [(simulation, output_dir) for simulation, output_dir in unique.values() if not os.path.exists(os.path.join(output_dir, 'done'))]
+    print("Sweep of {} points: {} unique, {} already done, {} to run.".format(len(points), len(unique), len(unique) - len(to_run), len(to_run)))
+
+    if n_parallel <= 1:
+        for simulation, output_dir in to_run:
+            _run_point(simulation, output_dir)
+    else:
+        with ProcessPoolExecutor(max_workers=n_parallel) as pool:
+            for output_dir in pool.map(_run_point, [simulation for simulation, output_dir in to_run], [output_dir for simulation, output_dir in to_run]):
+                print("Sweep point done: {}".format(output_dir))
+
+    with open(os.path.join(output_root, 'sweep_index.json'), 'w') as f:
+        json.dump(index, f, indent=1)
+    return index
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="Runs the Thomson Parabola simulation (or a sweep of simulations) described by a .json / .toml run spec.")
+    parser.add_argument('spec', help="the run spec (.json or .toml)")
+    parser.add_argument('--output', default='runs', help="directory in which each point of the sweep gets its own output directory")
+    parser.add_argument('--parallel', type=int, default=1, help="how many points of the sweep are run at the same time")
+    args = parser.parse_args(argv)
+    return run_sweep(load_spec(args.spec), args.output, args.parallel)
+
+
+if __name__ == '__main__':
+    cli(sys.argv[1:])
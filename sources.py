@@ -0,0 +1,402 @@
+""" Seeded sources of particles entering the aperture, producing their initial x,y,z, ux,uy,uz as (N, 6) arrays.
+
+Every source draws its particles block by block. Block number b is drawn from its own numpy.random.Generator, seeded by the b-th child of
+np.random.SeedSequence(seed), so a source gives the same particles for the same seed and block size, whichever process draws which block
+(and however many worker processes the run uses). A Source_Batch holds the particles of a chunk as (source, seed, block size) only,
+and draws the blocks when they are sliced out of it, so the memory used does not grow with the number of particles of the chunk.
+
+Sources:
+--------
+Gaussian_Source : u_z drawn from a Gaussian with mean given by a kinetic energy and sigma = relative_sigma * mean (relative_sigma = 1/10 as in main.py)
+Maxwellian_Source : kinetic energies drawn from a Maxwell-Boltzmann distribution of temperature kT
+Exponential_Source : kinetic energies drawn from dN/dE ~ exp(-E/T) between E_min and E_cut (TNSA-like spectra)
+File_Source : velocities (or full initial states) of measured particles read from a .npy (memory-mapped) or .csv file
+
+All of them (but File_Source when the file holds the full states) place the particles uniformly over an aperture [0, Rx] x [0, Ry] at z = 0,
+as main.py does, and can add an angular divergence: the angles of the direction of each particle with the z-axis, in the x-z and in the y-z planes,
+are drawn from a Gaussian of standard deviation divergence (radians), the speed of the particle being kept.
+Kinetic energies are converted to velocities by utility_fns.from_KEineV_to_uzinit(), as everywhere else in the code.
+
+Variance-reduced sampling (the parametric sources, see Parametric_Source): with sampling = 'plain' the particles follow the spectrum of the source, so most of them
+land in its peak and few in its high-energy tail. The other samplings draw the value u of the CDF of the speeds of each particle
+(the speed being the inverse CDF at u, see speeds_from_cdf()) so as to spread the particles evenly over the decades of the tail probability
+1 - u, from 1 down to 10**(-tail_decades), and give each particle the statistical weight (probability of u under the source) / (probability of u
+as drawn). Any sum over the particles weighted by their weights (detector images, spectra) is then an unbiased estimate of the same sum
+for plain sampling, with about as many particles in each decade of the tail as in the peak:
+
+    'importance' : u drawn from the mixture of a uniform distribution (half of the particles, so the peak keeps its share) and of a distribution
+                   log-uniform in 1 - u over [10**(-tail_decades), 1], weight = 1 / (density of the mixture at u)
+    'stratified' : u drawn uniformly inside the strata 1 - u in [10**(-k-1), 10**(-k)] for k = 0 ... tail_decades - 1 and 1 - u < 10**(-tail_decades),
+                   with the same number of particles in each stratum, weight = (probability of the stratum) / (fraction of the particles drawn in it)
+
+Both are done block by block: the weights of a block sum to its number of particles (exactly when stratified, on average otherwise),
+so weighted images have the normalisation of plain ones.
+"""
+
+import os, abc
+import numpy as np
+from scipy.special import ndtri, gammaincinv
+import utility_fns, Species
+
+sampling_methods = ['plain', 'importance', 'stratified']
+
+
+def cdf_values(rng, n, sampling, tail_decades):
+    """ Draws the values u of the CDF of n particles and their statistical weights, see the docstring of this module.
+
+    Parameters
+    ----------
+    rng : numpy.random.Generator
+    n : int (number of particles)
+    sampling : str ('importance' or 'stratified')
+    tail_decades : int (number of decades of the tail probability 1 - u sampled evenly)
+
+    Returns
+    -------
+    us : np.array shape (n, ) (values of the CDF, in [0, 1))
+    weights : np.array shape (n, ) (statistical weight of each particle)
+    """
+
+    log_span = tail_decades * np.log(10.0)
+    if sampling == 'importance':
+        from_tail = (rng.uniform(0, 1, n) < 0.5)
+        tails = np.where(from_tail, np.exp(-log_span * rng.uniform(0, 1, n)), 1.0 - rng.uniform(0, 1, n)) # 1 - u, in (0, 1]
+        tail_density = np.where(tails >= 10.0**(-tail_decades), 1.0 / (tails * log_span), 0.0)
+        return 1.0 - tails, 1.0 / (0.5 + 0.5 * tail_density)
+    if sampling == 'stratified':
+        no_of_strata = max(1, min(int(tail_decades) + 1, n)) # every stratum gets particles, the last one reaching 1 - u = 0
+        bounds = np.append(10.0**(-np.arange(no_of_strata, dtype=float)), 0.0) # 1 - u at the edges of the strata
+        counts = np.full(no_of_strata, n // no_of_strata)
+        counts[:n % no_of_strata] += 1
+        strata = np.repeat(np.arange(no_of_strata), counts)
+        tails = bounds[strata + 1] + (bounds[strata] - bounds[strata + 1]) * rng.uniform(0, 1, n)
+        return 1.0 - tails, ((bounds[:-1] - bounds[1:]) * n / counts)[strata]
+    raise ValueError("Unknown sampling '{}'. Choose from {}.".format(sampling, sampling_methods))
+
+
+class Particle_Source(abc.ABC):
+    """ Base class of the sources: aperture, angular divergence and seeded block streams. Sub-classes implement draw_block().
+
+    Attributes
+    ----------
+    _Rx, _Ry : floats (size of the aperture along x and y, in SI (meters). 0 means pointlike along that axis)
+    _divergence : float (standard deviation of the angles of the direction of the particles with the z-axis, in the x-z and y-z planes, in radians)
+
+    Methods
+    -------
+    draw_block(rng, start, n):
+        Returns a np.array shape (n, 6) with the initial states of the particles start ... start + n - 1, drawn from rng.
+    draw_weighted_block(rng, start, n):
+        Returns the states of draw_block() and a np.array shape (n, ) with the statistical weights of the particles (all 1 here, see Parametric_Source).
+    block(no_of_parts, seed, block_size, b):
+        Returns the states and weights of the block number b, drawn from its own Generator.
+    blocks(no_of_parts, seed, block_size):
+        Yields (start, np.array shape (n, 6), np.array shape (n, )) (states and weights) for consecutive blocks of at most block_size particles,
+        each drawn from its own Generator.
+    sample(no_of_parts, seed, block_size):
+        Returns a np.array shape (no_of_parts, 6) with all the blocks (held in memory at once: use blocks() or a Source_Batch for large chunks).
+    sample_weighted(no_of_parts, seed, block_size):
+        Returns the states of sample() and a np.array shape (no_of_parts, ) with the statistical weights of the particles.
+    """
+
+    def __init__(self, Rx=0.0, Ry=0.0, divergence=0.0):
+        self._Rx = Rx
+        self._Ry = Ry
+        self._divergence = divergence
+
+    @abc.abstractmethod
+    def draw_block(self, rng, start, n):
+        pass
+
+    def _place(self, rng, speeds):
+        # initial states of particles of the given speeds, placed over the aperture, with the angular divergence
+        n = speeds.shape[0]
+        states = np.zeros((n, 6))
+        if self._Rx != 0.0:
+            states[:, 0] = rng.uniform(0, 1, n) * self._Rx
+        if self._Ry != 0.0:
+            states[:, 1] = rng.uniform(0, 1, n) * self._Ry
+        if self._divergence != 0.0:
+            directions = np.column_stack([np.tan(rng.normal(0.0, self._divergence, n)), np.tan(rng.normal(0.0, self._divergence, n)), np.ones(n)])
+            states[:, 3:6] = speeds[:, None] * directions / np.linalg.norm(directions, axis=1)[:, None]
+        else:
+            states[:, 5] = speeds
+        return states
+
+    def draw_weighted_block(self, rng, start, n):
+        return self.draw_block(rng, start, n), np.ones(n)
+
+    def block(self, no_of_parts, seed, block_size, b):
+        # the seed of the block b is the b-th child of np.random.SeedSequence(seed), as given by its spawn()
+        start = b * block_size
+        rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(b,)))
+        return self.draw_weighted_block(rng, start, min(block_size, no_of_parts - start))
+
+    def blocks(self, no_of_parts, seed, block_size=10**5):
+        block_size = max(1, int(block_size))
+        for b, start in enumerate(range(0, no_of_parts, block_size)):
+            yield (start,) + self.block(no_of_parts, seed, block_size, b)
+
+    def sample(self, no_of_parts, seed, block_size=10**5):
+        return self.sample_weighted(no_of_parts, seed, block_size)[0]
+
+    def sample_weighted(self, no_of_parts, seed, block_size=10**5):
+        states = np.empty((no_of_parts, 6))
+        weights = np.empty(no_of_parts)
+        for start, block, block_weights in self.blocks(no_of_parts, seed, block_size):
+            states[start:start + block.shape[0]] = block
+            weights[start:start + block.shape[0]] = block_weights
+        return states, weights
+
+
+class Parametric_Source(Particle_Source):
+    """ Base class of the sources whose speeds follow a distribution with an inverse CDF, which can therefore be drawn with variance-reduced sampling.
+    Sub-classes implement draw_speeds() and speeds_from_cdf().
+
+    Attributes
+    ----------
+    (those of Particle_Source)
+    _sampling : str (one of sampling_methods)
+    _tail_decades : int (number of decades of the tail probability sampled evenly, for the samplings other than 'plain')
+
+    Methods
+    -------
+    draw_speeds(rng, n):
+        Returns a np.array shape (n, ) of speeds (in SI (m/s)) drawn from rng.
+    speeds_from_cdf(us):
+        Returns the speeds (in SI (m/s)) at which the CDF of the speeds of the source is us (the inverse CDF).
+    draw_weighted_speeds(rng, n):
+        Returns n speeds (in SI (m/s)) drawn with the sampling of the source and their statistical weights (the speeds of draw_speeds() and 1's for 'plain').
+    draw_block(rng, start, n):
+        Returns the states of n particles of speeds from draw_speeds(), placed over the aperture.
+    draw_weighted_block(rng, start, n):
+        Returns the states and statistical weights of n particles drawn with the sampling of the source (the same particles as draw_block() for 'plain').
+    """
+
+    def __init__(self, sampling='plain', tail_decades=6, **aperture):
+        super().__init__(**aperture)
+        if sampling not in sampling_methods:
+            raise ValueError("Unknown sampling '{}'. Choose from {}.".format(sampling, sampling_methods))
+        self._sampling = sampling
+        self._tail_decades = int(tail_decades)
+
+    @abc.abstractmethod
+    def draw_speeds(self, rng, n):
+        pass
+
+    @abc.abstractmethod
+    def speeds_from_cdf(self, us):
+        pass
+
+    def draw_weighted_speeds(self, rng, n):
+        if self._sampling == 'plain':
+            return self.draw_speeds(rng, n), np.ones(n)
+        us, weights = cdf_values(rng, n, self._sampling, self._tail_decades)
+        return self.speeds_from_cdf(us), weights
+
+    def draw_block(self, rng, start, n):
+        return self._place(rng, self.draw_speeds(rng, n))
+
+    def draw_weighted_block(self, rng, start, n): # the same particles as draw_block() for the 'plain' sampling
+        speeds, weights = self.draw_weighted_speeds(rng, n)
+        return self._place(rng, speeds), weights
+
+
+class Gaussian_Source(Parametric_Source):
+    """ u_z drawn from a Gaussian of mean from_KEineV_to_uzinit(energy_MeV) and sigma = relative_sigma * mean. """
+
+    def __init__(self, energy_MeV, relative_sigma=0.1, **aperture):
+        super().__init__(**aperture)
+        self._mean = utility_fns.from_KEineV_to_uzinit(energy_MeV * (10**6))
+        self._sigma = relative_sigma * self._mean
+
+    def __repr__(self):
+        return f'Gaussian_Source(mean={self._mean}, sigma={self._sigma}, Rx={self._Rx}, Ry={self._Ry}, divergence={self._divergence}, sampling={self._sampling})'
+
+    def draw_speeds(self, rng, n):
+        return rng.normal(self._mean, self._sigma, n)
+
+    def speeds_from_cdf(self, us):
+        return self._mean + self._sigma * ndtri(us)
+
+
+class Maxwellian_Source(Parametric_Source):
+    """ Kinetic energies drawn from a Maxwell-Boltzmann distribution of temperature kT_MeV (a Gamma distribution of shape 3/2 and scale kT). """
+
+    def __init__(self, kT_MeV, **aperture):
+        super().__init__(**aperture)
+        self._kT = kT_MeV
+
+    def __repr__(self):
+        return f'Maxwellian_Source(kT_MeV={self._kT}, Rx={self._Rx}, Ry={self._Ry}, divergence={self._divergence}, sampling={self._sampling})'
+
+    def draw_speeds(self, rng, n):
+        return utility_fns.from_KEineV_to_uzinit(rng.gamma(1.5, self._kT, n) * (10**6))
+
+    def speeds_from_cdf(self, us):
+        return utility_fns.from_KEineV_to_uzinit(gammaincinv(1.5, us) * self._kT * (10**6))
+
+
+class Exponential_Source(Parametric_Source):
+    """ Kinetic energies drawn from dN/dE ~ exp(-E / T_MeV) between E_min_MeV and E_cut_MeV (TNSA-like spectrum), by inversion of its CDF. """
+
+    def __init__(self, T_MeV, E_min_MeV=0.0, E_cut_MeV=np.inf, **aperture):
+        super().__init__(**aperture)
+        self._T = T_MeV
+        self._E_min = E_min_MeV
+        self._E_cut = E_cut_MeV
+
+    def __repr__(self):
+        return f'Exponential_Source(T_MeV={self._T}, E_min_MeV={self._E_min}, E_cut_MeV={self._E_cut}, Rx={self._Rx}, Ry={self._Ry}, divergence={self._divergence}, sampling={self._sampling})'
+
+    def draw_speeds(self, rng, n):
+        return self.speeds_from_cdf(rng.uniform(0, 1, n))
+
+    def speeds_from_cdf(self, us):
+        # 1 - exp(-(E_cut - E_min)/T) is the fraction of the untruncated spectrum above E_min which lies below E_cut
+        energies = self._E_min - self._T * np.log1p(-us * -np.expm1(-(self._E_cut - self._E_min) / self._T))
+        return utility_fns.from_KEineV_to_uzinit(energies * (10**6))
+
+
+class File_Source(Particle_Source):
+    """ Particles read from a file of measured (or externally simulated) particles, one particle per row, in SI units:
+
+        1 column : u_z (the particles are placed over the aperture and get the angular divergence, as for the other sources)
+        3 columns : u_x, u_y, u_z (the particles are placed over the aperture)
+        6 columns : x, y, z, u_x, u_y, u_z (used as they are)
+
+    .npy files are memory-mapped, so only the rows in use are read. A .csv file (comma separated, lines starting with # ignored) is converted once,
+    block by block, to a .npy file next to it, which is then memory-mapped (and re-used as long as it is newer than the .csv file).
+    The particles are taken in the order of the rows; the random generator is only used for the aperture and the divergence.
+    The particles of the file all have a weight of 1 (there is no variance-reduced sampling of a file).
+    """
+
+    def __init__(self, filename, csv_block_rows=10**6, **aperture):
+        super().__init__(**aperture)
+        self._filename = filename
+        if filename.endswith('.csv'):
+            npy_filename = filename[:-len('.csv')] + '.npy'
+            if not (os.path.exists(npy_filename) and os.path.getmtime(npy_filename) >= os.path.getmtime(filename)):
+                self._convert_csv(filename, npy_filename, csv_block_rows)
+            filename = npy_filename
+        rows = np.load(filename, mmap_mode='r')
+        self._rows = rows.reshape(-1, 1) if rows.ndim == 1 else rows
+        if self._rows.shape[1] not in (1, 3, 6):
+            raise ValueError("{} has {} columns, 1 (u_z), 3 (u_x, u_y, u_z) or 6 (x, y, z, u_x, u_y, u_z) are expected.".format(self._filename, self._rows.shape[1]))
+
+    def __repr__(self):
+        return f'File_Source(filename={self._filename}, rows={self._rows.shape[0]}, columns={self._rows.shape[1]}, Rx={self._Rx}, Ry={self._Ry}, divergence={self._divergence})'
+
+    def __len__(self):
+        return self._rows.shape[0]
+
+    @staticmethod
+    def _convert_csv(filename, npy_filename, block_rows):
+        # 1st pass: count the rows and the columns. 2nd pass: fill the memory-mapped .npy file block_rows rows at a time
+        no_of_rows, no_of_columns = 0, 1
+        with open(filename) as f:
+            for line in f:
+                line = line.split('#')[0].strip()
+                if line:
+                    no_of_columns = line.count(',') + 1 if no_of_rows == 0 else no_of_columns
+                    no_of_rows += 1
+        out = np.lib.format.open_memmap(npy_filename, mode='w+', dtype=float, shape=(no_of_rows, no_of_columns))
+        start = 0
+        with open(filename) as f:
+            while start < no_of_rows:
+                block = np.loadtxt(f, delimiter=',', comments='#', max_rows=block_rows, ndmin=2)
+                out[start:start + block.shape[0]] = block
+                start += block.shape[0]
+        out.flush()
+
+    def _check_rows(self, stop):
+        if stop > len(self):
+            raise ValueError("{} only holds {} particles, {} are asked for.".format(self._filename, len(self), stop))
+
+    def read_uzs(self, no_of_parts):
+        """ Returns the u_z of the first no_of_parts particles of the file (sub-option 3 of main.py). """
+
+        self._check_rows(no_of_parts)
+        return np.array(self._rows[:no_of_parts, -1], dtype=float)
+
+    def draw_block(self, rng, start, n):
+        self._check_rows(start + n)
+        rows = np.array(self._rows[start:start + n], dtype=float)
+        if rows.shape[1] == 6:
+            return rows
+        states = self._place(rng, rows[:, -1])
+        if rows.shape[1] == 3:
+            states[:, 3:6] = rows
+        return states
+
+
+class Source_Batch:
+    """ The particles of a chunk drawn from a source, as a Species.ParticleBatch whose blocks are only drawn when they are sliced out of it.
+
+    Slicing it (batch[start:stop], or with an index array) draws the blocks of block_size particles holding the particles asked for,
+    each from its own Generator (see Particle_Source.block()), and returns them as a Species.ParticleBatch. The same particles are thus
+    drawn whatever the slices, and a chunk pushed a slice at a time (as main.push_chunks_to_screen() does) never holds all its states in memory.
+
+    Attributes
+    ----------
+    _source : Particle_Source
+    _no_of_parts : int (number of particles of the chunk)
+    _seed : int (seed of the chunk)
+    _block_size : int (number of particles drawn from each Generator)
+    _qonm : float (charge/mass ratio of the particles, in SI)
+    _species_id : int (index of the species of the particles in _species_names)
+    _species_names : list of str
+
+    Methods
+    -------
+    sub_batches(size):
+        Yields consecutive Species.ParticleBatch slices of at most size particles.
+    """
+
+    def __init__(self, source, no_of_parts, seed, qonm, species_id, species_names, block_size=10**5):
+        self._source = source
+        self._no_of_parts = int(no_of_parts)
+        self._seed = seed
+        self._block_size = max(1, int(block_size))
+        self._qonm = qonm
+        self._species_id = species_id
+        self._species_names = list(species_names)
+
+    def __repr__(self):
+        return f'Source_Batch(source={self._source!r}, no_of_parts={self._no_of_parts}, seed={self._seed}, block_size={self._block_size})'
+
+    def __len__(self):
+        return self._no_of_parts
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._no_of_parts)
+            rows = np.arange(start, stop, step)
+        else: # index array or mask
+            rows = np.arange(self._no_of_parts)[index].reshape(-1)
+        states, weights = np.zeros((rows.size, 6)), np.ones(rows.size)
+        blocks_of_rows = rows // self._block_size
+        for b in np.unique(blocks_of_rows).tolist():
+            in_block = (blocks_of_rows == b)
+            block_states, block_weights = self._source.block(self._no_of_parts, self._seed, self._block_size, b)
+            states[in_block] = block_states[rows[in_block] - b * self._block_size]
+            weights[in_block] = block_weights[rows[in_block] - b * self._block_size]
+        return Species.ParticleBatch(states, self._qonm, self._species_id, species_names=self._species_names, weights=weights)
+
+    def sub_batches(self, size):
+        for start in range(0, len(self), max(1, int(size))):
+            yield self[start:start + size]
+
+
+source_types = {'gaussian': Gaussian_Source, 'maxwellian': Maxwellian_Source, 'exponential': Exponential_Source, 'file': File_Source}
+
+
+def source_from_spec(spec):
+    """ Builds a source from a dictionary, e.g. {"type": "exponential", "T_MeV": 2.0, "E_cut_MeV": 20.0, "Rx": 0.001, "divergence": 0.01, "sampling": "stratified"}
+    ("type" is one of source_types, the other keys are the arguments of the corresponding class). """
+
+    spec = dict(spec)
+    source_type = spec.pop('type')
+    if source_type not in source_types:
+        raise ValueError("Unknown source type '{}'. Choose from {}.".format(source_type, list(source_types.keys())))
+    return source_types[source_type](**spec)
@@ -0,0 +1,269 @@
+""" Inverse problem: from the hits on the detector screen (or the pixels of a detector image) back to the species and the energy of the particles.
+
+Particles of one species entering the aperture at (0, 0) with velocities along z land, as their energy varies, on one curve of the screen:
+the theoretical parabola (trace) of this species. For a given geometry, a Dispersion_Index samples the trace of every charged species
+of databases.py on a log-spaced grid of energies, pushing all these particles at once through the same fields model as a run
+(parallel_exec.push_sub_batch(), hence the same E, B, l_B, z_det, separate E/B regions and field maps). The trace points of all the species
+are put in one k-d tree (scipy.spatial.cKDTree), so a whole array of screen positions is assigned in a few vectorized passes:
+
+    1) the k_candidates nearest trace points of each position (within max_distance) are found in the tree
+    2) each candidate is refined on the two segments of its trace around it (the position is projected on them), giving the distance to
+       the trace and the energy interpolated in log(energy) along the segment
+    3) the closest candidate gives the species and the energy; positions further than max_distance (in meters) from every trace are left unassigned
+
+The traces must go through the same fields model and integration as the hits they are matched with: the 'rk45' mode, for one, overshoots
+the end of the fields by a part of its last step, which shifts the hits far more than its tolerance (with traces of the closed-form
+solutions, the 5 MeV protons of an rk45 run at tol = 1e-6 are reconstructed at 1.2 to 1.4 MeV, and C6+ hits are taken for protons).
+So the hits of a run are reconstructed chunk by chunk (chunk_indices()), with the traces pushed in the propagation mode of the run at
+the tolerance of the chunk; the chunks whose tolerance was tuned ('auto', see tolerance_tuning.py) landing within the target accuracy
+of the exact positions, they are reconstructed with the closed-form traces.
+
+The energies are in MeV, with the meaning they have in the rest of the code: the initial u_z of a particle of energy E is
+utility_fns.from_KEineV_to_uzinit(E * 10**6), whatever its species (so a run with energy_MeV = 5 is reconstructed at 5 MeV).
+The neutral species are not in the index (they are not deflected, all their energies land on the same point), and hits from a wide aperture
+are offset from the traces by their initial x, y. The indices are cached on disk, in a .npz file named after a hash of the geometry and the grid.
+
+CLI:
+    $ python3 spectrum_reconstruction.py run_spec.json results_hits --energies 0.1 50 100 [--image results_image.npz] [--output name]
+(run_spec.json being the run spec of the run, as written next to its outputs by simulation.py) writes name_spectra.npz with the energy bin edges and the spectrum (summed weights of the hits in each energy bin) of each species found.
+"""
+
+import os, sys, argparse
+import numpy as np
+from scipy.spatial import cKDTree
+import parallel_exec, hit_store, histogram, databases, utility_fns, Species
+
+default_energy_range_MeV = (0.01, 100.0)
+
+
+class Dispersion_Index:
+    """ The sampled traces of all the charged species on the screen, for one geometry, with vectorized nearest-trace lookup.
+
+    Attributes
+    ----------
+    key : str (hash of the geometry and of the grid settings; name of the cache file)
+    species_ids : np.array shape (n_species, ) of ints (indices in databases.all_possible_names of the species of the traces)
+    log_energies : np.array shape (n_energies, ) (natural logarithm of the energies of the grid, in MeV)
+    traces : np.array shape (n_species, n_energies, 2) (x, y on the screen of each species at each energy. nan where the particle does not reach the screen)
+    _tree : scipy.spatial.cKDTree (on the trace points reaching the screen)
+    _point_indices : np.array of ints (flat index in traces.reshape(-1, 2) of each point of the tree)
+
+    Methods
+    -------
+    lookup(coords, max_distance=np.inf):
+        Returns the species id, energy and distance to the closest trace of screen positions.
+    spectra(coords, energy_edges_MeV, weights=None, max_distance=np.inf):
+        Returns the energy spectrum of each species found among screen positions.
+    spectra_from_image(image, x_edges, y_edges, energy_edges_MeV, max_distance=np.inf):
+        Same, for the pixels of a detector image.
+    spectra_from_hits(hits_dir, energy_edges_MeV, max_distance=np.inf, chunks=None):
+        Same, for the particles of a hits file which reached the screen (optionally, of some of its chunks only).
+    """
+
+    def __init__(self, geometry, mode=None, energy_range_MeV=default_energy_range_MeV, n_energies=8192, tol=10**(-10), k_candidates=4, cache_dir='dispersion_indices'):
+        if mode is None: # the closed-form solutions, unless the fields are not uniform
+            mode = 'analytic' if geometry.get('field_map') is None else 'dopri54'
+        settings = {**{name: value for name, value in geometry.items() if name != 'tol'}, 'tol': tol}
+        self.key = utility_fns.geometry_key(mode=mode, energy_range_MeV=energy_range_MeV, n_energies=n_energies, **settings)
+        self._k_candidates = k_candidates
+        filename = None if cache_dir is None else os.path.join(cache_dir, 'dispersion_index_{}.npz'.format(self.key))
+        if filename is not None and os.path.exists(filename):
+            cached = np.load(filename)
+            self.species_ids, self.log_energies, self.traces = cached['species_ids'], cached['log_energies'], cached['traces']
+        else:
+            self.species_ids = np.array([i for i, name in enumerate(databases.all_possible_names) if databases.charges[name] != 0.0])
+            self.log_energies = np.linspace(np.log(energy_range_MeV[0]), np.log(energy_range_MeV[1]), n_energies)
+            self.traces = self._push_traces(settings, mode)
+            if filename is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                np.savez_compressed(filename, species_ids=self.species_ids, log_energies=self.log_energies, traces=self.traces)
+        points = self.traces.reshape(-1, 2)
+        self._point_indices = np.flatnonzero(np.isfinite(points).all(axis=1))
+        self._tree = cKDTree(points[self._point_indices])
+
+    def __repr__(self):
+        return f'Dispersion_Index(key={self.key}, species={self.species_ids.shape[0]}, energies={self.log_energies.shape[0]}, points={self._point_indices.shape[0]})'
+
+    def _push_traces(self, geometry, mode):
+        # one particle per species and energy, from (0, 0) with its velocity along z, all pushed to the screen at once
+        n_species, n_energies = self.species_ids.shape[0], self.log_energies.shape[0]
+        states = np.zeros((n_species * n_energies, 6))
+        states[:, 5] = np.tile(utility_fns.from_KEineV_to_uzinit(np.exp(self.log_energies) * (10**6)), n_species)
+        names = [databases.all_possible_names[i] for i in self.species_ids]
+        qonms = np.repeat([databases.charges[name] / databases.masses[name] for name in names], n_energies)
+        pushed = parallel_exec.push_sub_batch(states, qonms, geometry, mode)
+        exited_B, coords_at_detector = pushed[0], pushed[5]
+        return np.where((exited_B == 1)[:, None], coords_at_detector, np.nan).reshape(n_species, n_energies, 2)
+
+    def lookup(self, coords, max_distance=np.inf):
+        """ Assigns screen positions to the closest trace, see the docstring of this module.
+
+        Parameters
+        ----------
+        coords : np.array shape (N, 2) (x, y on the screen, in SI (meters). rows with nan's are left unassigned)
+        max_distance : float (positions further than this from every trace, in meters, are left unassigned. it should be larger than the spacing
+                       of the trace points, a position being only refined on the traces if one of their points is within max_distance)
+
+        Returns
+        -------
+        species_ids : np.array shape (N, ) of ints (index in databases.all_possible_names of the species, -1 if unassigned)
+        energies_MeV : np.array shape (N, ) (energy, nan if unassigned)
+        distances : np.array shape (N, ) (distance to the closest trace, in meters. inf if the position has nan's or no trace point within max_distance)
+        """
+
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        species_ids = np.full(coords.shape[0], -1, dtype=np.int32)
+        energies = np.full(coords.shape[0], np.nan)
+        distances = np.full(coords.shape[0], np.inf)
+        valid = np.flatnonzero(np.isfinite(coords).all(axis=1))
+        if valid.shape[0] == 0 or self._point_indices.shape[0] == 0:
+            return species_ids, energies, distances
+        positions = coords[valid]
+        k = min(self._k_candidates, self._point_indices.shape[0])
+        _, nearest = self._tree.query(positions, k=k, distance_upper_bound=max_distance) # the positions far from every trace are cheap to reject
+        nearest = nearest.reshape(positions.shape[0], k)
+        near = (nearest[:, 0] < self._point_indices.shape[0]) # missing neighbours are returned as the number of points of the tree
+        valid, positions, nearest = valid[near], positions[near], np.where(nearest[near] < self._point_indices.shape[0], nearest[near], nearest[near][:, :1])
+        vertices = self._point_indices[nearest] # shape (n, k), flat indices in the traces
+        n_energies = self.log_energies.shape[0]
+        traces, (trace_of, j) = self.traces.reshape(-1, 2), np.divmod(vertices, n_energies)
+
+        # candidates: the vertex itself, and its projections on the segments (j - 1, j) and (j, j + 1) of its trace
+        candidate_distances = [np.linalg.norm(positions[:, None, :] - traces[vertices], axis=2)]
+        candidate_log_energies = [self.log_energies[j]]
+        for a in (j - 1, j):
+            b = a + 1
+            on_trace = (a >= 0) & (b < n_energies)
+            a, b = np.clip(a, 0, n_energies - 1), np.clip(b, 0, n_energies - 1)
+            start, end = traces[trace_of * n_energies + a], traces[trace_of * n_energies + b]
+            on_trace &= np.isfinite(start).all(axis=2) & np.isfinite(end).all(axis=2)
+            segment = end - start
+            lengths2 = np.einsum('nkj,nkj->nk', segment, segment)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = np.clip(np.einsum('nkj,nkj->nk', positions[:, None, :] - start, segment) / lengths2, 0.0, 1.0)
+            t = np.where(lengths2 > 0.0, t, 0.0)
+            closest = start + t[:, :, None] * segment
+            candidate_distances.append(np.where(on_trace, np.linalg.norm(positions[:, None, :] - closest, axis=2), np.inf))
+            candidate_log_energies.append(self.log_energies[a] + t * (self.log_energies[b] - self.log_energies[a]))
+        candidate_distances = np.concatenate(candidate_distances, axis=1) # shape (n, 3k)
+        best = np.argmin(candidate_distances, axis=1)
+        rows = np.arange(positions.shape[0])
+        distances[valid] = candidate_distances[rows, best]
+        assigned = (distances[valid] <= max_distance)
+        species_ids[valid[assigned]] = self.species_ids[np.tile(trace_of, 3)[rows, best]][assigned]
+        energies[valid[assigned]] = np.exp(np.concatenate(candidate_log_energies, axis=1)[rows, best])[assigned]
+        return species_ids, energies, distances
+
+    def spectra(self, coords, energy_edges_MeV, weights=None, max_distance=np.inf):
+        """ Energy spectra of the species found among screen positions.
+
+        Parameters
+        ----------
+        coords : np.array shape (N, 2) (x, y on the screen, in SI (meters))
+        energy_edges_MeV : np.array shape (n_bins + 1, ) (edges of the energy bins, in MeV, increasing)
+        weights : np.array shape (N, ) or None (weight of each position, e.g. the statistical weights of the particles or the values of pixels. None: 1 for all)
+        max_distance : float (see lookup())
+
+        Returns
+        -------
+        dict (species name -> np.array shape (n_bins, ) with the summed weights of the positions assigned to this species in each energy bin),
+        for the species with at least one position assigned inside the energy bins
+        """
+
+        species_ids, energies, _ = self.lookup(coords, max_distance)
+        energy_edges_MeV = np.asarray(energy_edges_MeV, dtype=float)
+        n_bins = energy_edges_MeV.shape[0] - 1
+        weights = np.ones(species_ids.shape[0]) if weights is None else np.asarray(weights, dtype=float).reshape(-1)
+        bins = np.searchsorted(energy_edges_MeV, energies, side='right') - 1 # nan energies go past the last bin
+        binned = (species_ids >= 0) & (bins >= 0) & (bins < n_bins)
+        n_names = len(databases.all_possible_names)
+        totals = np.bincount(species_ids[binned] * n_bins + bins[binned], weights=weights[binned], minlength=n_names * n_bins).reshape(n_names, n_bins)
+        found = np.zeros(n_names, dtype=bool)
+        found[species_ids[binned]] = True
+        return {databases.all_possible_names[i]: totals[i] for i in np.flatnonzero(found).tolist()}
+
+    def spectra_from_image(self, image, x_edges, y_edges, energy_edges_MeV, max_distance=np.inf):
+        """ Same as spectra(), for the pixels of an image of the screen (image[i, j] is the pixel x_i, y_j, as in histogram.Detector_Histogram),
+        each pixel being assigned as a whole from its centre and weighted by its value. """
+
+        x_centres, y_centres = 0.5 * (x_edges[1:] + x_edges[:-1]), 0.5 * (y_edges[1:] + y_edges[:-1])
+        pixels = np.flatnonzero(np.asarray(image).reshape(-1))
+        ix, iy = np.unravel_index(pixels, np.asarray(image).shape)
+        return self.spectra(np.column_stack([x_centres[ix], y_centres[iy]]), energy_edges_MeV, np.asarray(image).reshape(-1)[pixels], max_distance)
+
+    def spectra_from_hits(self, hits_dir, energy_edges_MeV, max_distance=np.inf, chunks=None):
+        """ Same as spectra(), for the particles of a hits file (see hit_store.py) which reached the screen, weighted by their statistical weights
+        (chunks : list of ints or None. if given, only the particles of these chunks). """
+
+        reader = hit_store.Hit_Reader(hits_dir)
+        exited = (np.asarray(reader.column('status')) == Species.status_exited)
+        if chunks is not None:
+            exited &= np.isin(np.asarray(reader.column('chunk')), chunks)
+        coords = np.column_stack([np.asarray(reader.column('screen_x'))[exited], np.asarray(reader.column('screen_y'))[exited]])
+        weights = np.asarray(reader.column('weight'))[exited] if reader.has_column('weight') else None # runs written before the weights were stored
+        return self.spectra(coords, energy_edges_MeV, weights, max_distance)
+
+
+def chunk_indices(spec, geometry, energy_range_MeV=default_energy_range_MeV):
+    """ Returns the Dispersion_Index matching the hits of each chunk of a run, see the docstring of this module.
+
+    Parameters
+    ----------
+    spec : dict (the run spec of the run, with the defaults filled in, see simulation.py)
+    geometry : dict (the geometry of the run, as returned by simulation.Simulation.geometry())
+    energy_range_MeV : (float, float) (see Dispersion_Index)
+
+    Returns
+    -------
+    list of Dispersion_Index (one per chunk of spec['chunks'], the chunks with the same mode and tolerance sharing the same index)
+    """
+
+    indices, by_settings = [], dict()
+    for chunk in spec['chunks']:
+        settings = (None, None) if chunk['tol'] == 'auto' else (spec['propagation_mode'], chunk['tol'])
+        if settings not in by_settings:
+            mode, tol = settings
+            by_settings[settings] = Dispersion_Index(geometry, mode, energy_range_MeV) if tol is None else Dispersion_Index(geometry, mode, energy_range_MeV, tol=tol)
+        indices.append(by_settings[settings])
+    return indices
+
+
+def add_spectra(total, spectra):
+    """ Adds the spectra of a dict returned by Dispersion_Index.spectra() to the dict total (same energy bins), which is returned. """
+
+    for name, counts in spectra.items():
+        total[name] = total[name] + counts if name in total else counts.copy()
+    return total
+
+
+def cli(argv=None):
+    import simulation # imports main.py and all the run machinery, only needed to build the geometry of a run spec
+    parser = argparse.ArgumentParser(description="Reconstructs the energy spectra of the species from the hits (or the detector images) of a run.")
+    parser.add_argument('run_spec', help="the run spec of the run (.json or .toml), for its geometry")
+    parser.add_argument('hits_dir', help="the hits directory of the run (name_hits)")
+    parser.add_argument('--energies', type=float, nargs=3, default=[0.1, 100.0, 100], metavar=('MIN_MeV', 'MAX_MeV', 'N_BINS'), help="log-spaced energy bins")
+    parser.add_argument('--image', default=None, help="reconstruct from the pixels of this detector image (name_image.npz) instead of the hits")
+    parser.add_argument('--max-distance', type=float, default=np.inf, help="largest distance to a trace of an assigned hit, in meters")
+    parser.add_argument('--output', default=None, help="prefix of the .npz archive written (default: the name of the run)")
+    args = parser.parse_args(argv)
+    sim = simulation.Simulation(simulation.load_spec(args.run_spec))
+    energy_edges = np.geomspace(args.energies[0], args.energies[1], int(args.energies[2]) + 1)
+    indices = chunk_indices(sim.spec, sim.geometry(), (min(args.energies[0], default_energy_range_MeV[0]), max(args.energies[1], default_energy_range_MeV[1])))
+    spectra = dict()
+    if args.image is not None:
+        image = histogram.Detector_Histogram.load(args.image)
+        for species in image.images: # one image per species in a simulated run, assigned independently of its species, with the traces of its (first) chunk
+            index = next((indices[j] for j, chunk in enumerate(sim.spec['chunks']) if chunk['species'] == species), indices[0])
+            add_spectra(spectra, index.spectra_from_image(image.images[species], *image.edges(species), energy_edges, args.max_distance))
+    else:
+        for index in dict.fromkeys(indices):
+            add_spectra(spectra, index.spectra_from_hits(args.hits_dir, energy_edges, args.max_distance, [j for j in range(len(indices)) if indices[j] is index]))
+    output = args.output if args.output is not None else args.hits_dir.rstrip('/\\')[:-len('_hits')] if args.hits_dir.rstrip('/\\').endswith('_hits') else args.hits_dir
+    np.savez_compressed('{}_spectra.npz'.format(output), energy_edges_MeV=energy_edges, **spectra)
+    for name, counts in spectra.items():
+        print("{}: {:.6g} in [{}, {}] MeV".format(name, counts.sum(), energy_edges[0], energy_edges[-1]))
+    print("Saved {}_spectra.npz".format(output))
+
+
+if __name__ == '__main__':
+    cli(sys.argv[1:])
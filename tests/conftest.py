@@ -0,0 +1,19 @@
+""" The modules of the package are imported by their names (as main.py does), from the directory above this one. """
+
+import os, sys, copy
+import pytest
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+small_spec = {'geometry': {'E': 1e5, 'B': 0.5, 'l_E': 0.05, 'D_E': 0.45, 'z_det': 0.5, 'y_bottom_elec': 1.25e-5},
+              'propagation_mode': 'dopri54', 'seed': 1,
+              'chunks': [{'species': 'proton', 'no_of_particles': 300, 'energy_MeV': 5.0, 'tol': 1e-6, 'option': 2, 'sub_option': 2, 'aperture_x': True, 'aperture_y': False, 'Rx': 0.001, 'Ry': 0.0},
+                         {'species': 'C6+', 'no_of_particles': 200, 'energy_MeV': 2.5, 'tol': 1e-6, 'option': 2, 'sub_option': 2, 'aperture_x': True, 'aperture_y': False, 'Rx': 0.001, 'Ry': 0.0}]}
+
+
+@pytest.fixture
+def run_spec():
+    """ A run spec of simulation.py small enough for a test: two chunks of a few hundred particles, about half of which clip the bottom electrode. """
+    return copy.deepcopy(small_spec)
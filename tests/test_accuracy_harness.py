@@ -0,0 +1,86 @@
+""" Accuracy-vs-cost harness (accuracy_harness.py): the exact screen positions, the tables of errors and costs, and the regressions flagged against a baseline. """
+
+import os, json, copy
+import numpy as np
+import pytest
+import accuracy_harness
+
+
+@pytest.mark.parametrize('name', list(accuracy_harness.scenarios))
+def test_exact_positions_are_those_of_a_tight_integration(name):
+    states, qonms = accuracy_harness.scenario_particles(name, 200)
+    scenario = accuracy_harness.scenarios[name]
+    exact = accuracy_harness.exact_screen_positions(states, qonms, scenario['E'], scenario['B'], accuracy_harness.geometry['l_B'], accuracy_harness.geometry['z_det'])
+    coords, evaluations = accuracy_harness.push_to_screen(states, qonms, scenario['E'], scenario['B'], 1e-12, 'dopri54')
+    assert np.isfinite(coords).all()
+    assert np.max(np.hypot(*(coords - exact).T)) < 1e-10
+
+
+def test_errors_shrink_with_the_tolerance(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    results = accuracy_harness.run_harness(['pure_E'], ['dopri54'], [1e-4, 1e-6, 1e-8, 1e-10], 100, 10)
+    errors = [row['max_error_m'] for row in results['rows']]
+    evaluations = [row['derivative_evaluations_per_particle'] for row in results['rows']]
+    assert errors == sorted(errors, reverse=True) and evaluations == sorted(evaluations)
+    assert os.listdir(tmp_path) == [] # everything written to a temporary directory, removed afterwards
+
+
+def test_rows_and_map_builds(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    results = accuracy_harness.run_harness(['EB_zero_divergence', 'EB_nonrelativistic'], ['rk45_scalar', 'dopri54', 'analytic', 'map'], [1e-6], 50, 10)
+    rows = {(row['scenario'], row['mode']): row for row in results['rows']}
+    assert len(rows) == 8 and all(row['outcome_mismatches'] == 0 for row in rows.values())
+    assert rows['EB_zero_divergence', 'rk45_scalar']['particles'] == 10 and rows['EB_zero_divergence', 'dopri54']['particles'] == 50
+    assert rows['EB_zero_divergence', 'analytic']['max_error_m'] < accuracy_harness.error_floor
+    assert rows['EB_zero_divergence', 'dopri54']['max_error_m'] < 1e-8
+    # the map interpolates the particles with no divergence, and falls back to integration with one
+    assert rows['EB_zero_divergence', 'map']['derivative_evaluations_per_particle'] == 0.0 and rows['EB_zero_divergence', 'map']['max_error_m'] < 1e-8
+    assert rows['EB_nonrelativistic', 'map']['derivative_evaluations_per_particle'] > 0.0
+    # one build for the two scenarios, which share E and B, its cost apart from the cost per particle
+    build, = results['map_builds']
+    assert (build['E'], build['B'], build['tol']) == (1e5, 0.5, 1e-6) and build['derivative_evaluations'] > 1000 * 50
+    assert os.listdir(tmp_path) == []
+
+
+def baseline_and_results():
+    baseline = {'rows': [{'scenario': 'pure_B', 'mode': 'dopri54', 'tol': 1e-6, 'particles': 100, 'max_error_m': 1e-9, 'rms_error_m': 1e-10, 'outcome_mismatches': 0, 'derivative_evaluations_per_particle': 15.0, 'wall_s': 0.01},
+                         {'scenario': 'pure_B', 'mode': 'analytic', 'tol': 1e-6, 'particles': 100, 'max_error_m': 1e-17, 'rms_error_m': 1e-18, 'outcome_mismatches': 0, 'derivative_evaluations_per_particle': 0.0, 'wall_s': 0.01}],
+                'map_builds': [{'E': 1e5, 'B': 0.5, 'tol': 1e-6, 'seconds': 2.0, 'derivative_evaluations': 10**6}]}
+    results = copy.deepcopy(baseline)
+    results['rows'].append({**baseline['rows'][0], 'scenario': 'drift'}) # not in the baseline: not compared
+    return baseline, results
+
+
+@pytest.mark.parametrize('row, metric, value, regressed', [(0, 'max_error_m', 1.05e-9, False), (0, 'max_error_m', 2e-9, True),
+                                                           (1, 'max_error_m', 1e-13, False), # below the error floor: round-off
+                                                           (0, 'outcome_mismatches', 1, True), (0, 'derivative_evaluations_per_particle', 20.0, True),
+                                                           (0, 'wall_s', 0.04, False), # noisy, and within the wall floor
+                                                           (0, 'wall_s', 0.5, True), (1, 'derivative_evaluations_per_particle', 0.0, False)])
+def test_compare_rows(row, metric, value, regressed):
+    baseline, results = baseline_and_results()
+    results['rows'][row][metric] = value
+    compared = accuracy_harness.compare(results, baseline, threshold=0.1)
+    assert set(entry[0] for entry in compared) == {'pure_B', 'map E=100000.0 B=0.5'}
+    assert [entry[3] for entry in compared if entry[-1]] == ([metric] if regressed else [])
+
+
+@pytest.mark.parametrize('metric, value, regressed', [('derivative_evaluations', 1.2 * 10**6, True), ('derivative_evaluations', 1.05 * 10**6, False),
+                                                      ('seconds', 3.0, False), ('seconds', 4.5, True)])
+def test_compare_map_builds(metric, value, regressed):
+    baseline, results = baseline_and_results()
+    results['map_builds'][0][metric] = value
+    assert [entry[3] for entry in accuracy_harness.compare(results, baseline, threshold=0.1) if entry[-1]] == ([metric] if regressed else [])
+
+
+def test_cli_exit_status(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    baseline, results = baseline_and_results()
+    with open('baseline.json', 'w') as f:
+        json.dump(baseline, f)
+    results['rows'][0]['max_error_m'] = 1e-8
+    monkeypatch.setattr(accuracy_harness, 'run_harness', lambda *args: results)
+    assert accuracy_harness.cli(['--scenarios', 'pure_B']) == 0
+    assert accuracy_harness.cli(['--scenarios', 'pure_B', '--baseline', 'baseline.json']) == 1
+    assert accuracy_harness.cli(['--scenarios', 'pure_B', '--baseline', 'baseline.json', '--threshold', '20']) == 0
+    with open('accuracy.json') as f:
+        assert json.load(f) == results
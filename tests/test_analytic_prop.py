@@ -0,0 +1,63 @@
+""" The closed-form propagation (analytic_prop.py) against the integration of the EOMs, and the pre-screen of the certain clips. """
+
+import numpy as np
+import RKint, analytic_prop, propagation, utility_fns
+from test_rkint import initial_states, qonm, yscal, l_B, y_bottom_elec, E, B
+
+
+def test_closed_form_matches_tight_integration():
+    states = initial_states(200)
+    exited_B, hit_E, final_states, needs_fallback = analytic_prop.analytic_propagator_batch(states, qonm, yscal, 1e-12, l_B, y_bottom_elec, E, B)
+    ref_exited_B, ref_hit_E, ref_states, _, _ = RKint.DOPRI54integrator_batch(states, qonm, yscal, 1e-12, l_B, y_bottom_elec, E, B)
+    assert not needs_fallback.any()
+    assert np.array_equal(exited_B, ref_exited_B) and np.array_equal(hit_E, ref_hit_E)
+    assert np.all(np.abs(final_states[:, :3] - ref_states[:, :3]) / yscal <= 1e-7)
+    assert np.all(np.abs(final_states[:, 3:] - ref_states[:, 3:]) <= 1e-7 * ref_states[:, 5:6])
+
+
+def test_closed_form_is_relativistic():
+    states = np.zeros((5, 6))
+    states[:, 5] = utility_fns.from_KEineV_to_uzinit(np.array([0.1, 0.3, 1.0, 3.0, 10.0]) * (10**9))
+    states[:, 3] = 0.01 * states[:, 5]
+    exited_B, _, final_states, needs_fallback = analytic_prop.analytic_propagator_batch(states, qonm, yscal, 1e-12, l_B, 1.0, 1e7, 2.0)
+    ref_exited_B, _, ref_states, _, _ = RKint.DOPRI54integrator_batch(states, qonm, yscal, 1e-12, l_B, 1.0, 1e7, 2.0)
+    assert not needs_fallback.any()
+    assert np.array_equal(exited_B, ref_exited_B)
+    assert np.all(np.abs(final_states[:, :3] - ref_states[:, :3]) / yscal <= 1e-10)
+    assert np.allclose(final_states[:, 3:], ref_states[:, 3:], rtol=1e-10, atol=0.0)
+
+
+def test_particles_turning_around_fall_back_to_integration():
+    states = np.zeros((3, 6))
+    states[:, 5] = 1e5 # the cyclotron radius is far below l_B
+    exited_B, hit_E, _, needs_fallback = analytic_prop.analytic_propagator_batch(states, qonm, yscal, 1e-6, l_B, 1.0, 0.0, B)
+    assert np.all(needs_fallback)
+    assert not (exited_B.any() or hit_E.any())
+
+
+def test_prescreen_is_certain():
+    states = initial_states(200)
+    certain_clip, certain_pass, at_electrode = analytic_prop.prescreen_batch(states, np.full(200, qonm), l_B, y_bottom_elec, E, B)
+    exited_B, hit_E, final_states, _, _ = RKint.DOPRI54integrator_batch(states, qonm, yscal, 1e-10, l_B, y_bottom_elec, E, B)
+    assert certain_clip.any() and certain_pass.any()
+    assert not (certain_clip & certain_pass).any()
+    assert np.all(hit_E[certain_clip] == 1) and np.all(exited_B[certain_pass] == 1)
+    assert np.all(np.abs(at_electrode[:, :3] - final_states[certain_clip, :3]) / yscal <= 1e-7)
+    assert np.all(np.abs(at_electrode[:, 3:] - final_states[certain_clip, 3:]) <= 1e-7 * final_states[certain_clip, 5:6])
+
+
+def test_prescreen_does_not_change_the_outcomes():
+    states = initial_states(200)
+    certain_clip, _, _ = analytic_prop.prescreen_batch(states, np.full(200, qonm), l_B, y_bottom_elec, E, B)
+    for mode in ('rk45', 'dopri54'):
+        screened = propagation.push_batch_to_endoffields(states, qonm, yscal, 1e-6, l_B, y_bottom_elec, E, B, mode=mode, prescreen=True)
+        integrated = propagation.push_batch_to_endoffields(states, qonm, yscal, 1e-6, l_B, y_bottom_elec, E, B, mode=mode, prescreen=False)
+        changed = (screened[0] != integrated[0])
+        if mode == 'dopri54':
+            assert not changed.any()
+        else: # only certain clips which the last rk45 step carried past l_B before checking the electrode
+            assert np.all(certain_clip[changed]) and np.all(integrated[2][changed, 1] >= y_bottom_elec)
+        assert np.array_equal(screened[0] + screened[1], np.ones(200, dtype=int))
+        rest = ~certain_clip
+        assert np.array_equal(screened[2][rest], integrated[2][rest]) # the others are integrated in both cases
+        assert screened[3].sum() < integrated[3].sum()
@@ -0,0 +1,64 @@
+""" Benchmark suite (benchmark.py): canonical scenarios measured through the code of a run, and regressions flagged against a baseline. """
+
+import os, json
+import pytest
+import benchmark
+
+
+def test_scenarios_are_scaled_to_the_particles():
+    for name in benchmark.scenarios:
+        spec = benchmark.scenario_spec(name, 5500, mode='dopri54', seed=3)
+        total = sum(chunk['no_of_particles'] for chunk in spec['chunks'])
+        assert abs(total - 5500) <= len(spec['chunks'])
+        assert spec['propagation_mode'] == 'dopri54' and spec['seed'] == 3
+    assert [chunk['species'] for chunk in benchmark.scenario_spec('Xe_charge_scan', 55)['chunks']] == ['Xe%d+' % i for i in range(55)]
+
+
+def test_run_scenario_measures_the_run(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    metrics = benchmark.run_scenario('aperture_option2', 300, mode='rk45')
+    again = benchmark.run_scenario('aperture_option2', 300, mode='rk45')
+    assert os.listdir(tmp_path) == [] # everything written to a temporary directory, removed afterwards
+    assert metrics['no_of_particles'] == 300 and metrics['particles_per_s'] > 0.0
+    assert all(metrics['stage_s'][stage] > 0.0 for stage in ['sampling', 'integration', 'output', 'plotting'])
+    # the work done is deterministic for a seed, only the times vary
+    for key in ['derivative_evaluations', 'steps_accepted', 'steps_rejected']:
+        assert metrics[key] == again[key] > 0
+    assert metrics['derivative_evaluations_per_particle'] == pytest.approx(metrics['derivative_evaluations'] / 300)
+
+
+def test_memo_shows_in_the_monoenergetic_scenario(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    metrics = benchmark.run_scenario('protons_mono', 1000)
+    assert metrics['memo_hit_rate'] == pytest.approx(0.999)
+    assert metrics['steps_per_particle'] < 1.0
+
+
+def baseline_and_results(**changes):
+    baseline = {'scenarios': {'protons_mono': {'particles_per_s': 1000.0, 'integration_particles_per_s': 2000.0, 'derivative_evaluations_per_particle': 60.0,
+                                               'steps_per_particle': 10.0, 'peak_rss_MB': 100.0}}}
+    results = {'scenarios': {'protons_mono': {**baseline['scenarios']['protons_mono'], **changes}, 'new_scenario': dict(baseline['scenarios']['protons_mono'])}}
+    return baseline, results
+
+
+@pytest.mark.parametrize('changes, regressed', [({}, set()), ({'particles_per_s': 950.0, 'peak_rss_MB': 105.0}, set()),
+                                                ({'particles_per_s': 800.0}, {'particles_per_s'}), ({'particles_per_s': 1500.0}, set()),
+                                                ({'derivative_evaluations_per_particle': 70.0, 'steps_per_particle': 5.0}, {'derivative_evaluations_per_particle'})])
+def test_compare_flags_what_got_worse(changes, regressed):
+    baseline, results = baseline_and_results(**changes)
+    rows = benchmark.compare(results, baseline, threshold=0.1)
+    assert set(row[0] for row in rows) == {'protons_mono'} # scenarios missing from the baseline are not compared
+    assert set(row[1] for row in rows if row[-1]) == regressed
+
+
+def test_cli_exit_status(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    baseline, results = baseline_and_results(particles_per_s=500.0)
+    with open('baseline.json', 'w') as f:
+        json.dump(baseline, f)
+    monkeypatch.setattr(benchmark, 'run_benchmarks', lambda *args: results)
+    assert benchmark.cli(['--scenarios', 'protons_mono']) == 0
+    assert benchmark.cli(['--scenarios', 'protons_mono', '--baseline', 'baseline.json']) == 1
+    assert benchmark.cli(['--scenarios', 'protons_mono', '--baseline', 'baseline.json', '--threshold', '0.6']) == 0
+    with open('benchmark.json') as f:
+        assert json.load(f) == results
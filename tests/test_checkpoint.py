@@ -0,0 +1,58 @@
+""" Checkpoint and resume (checkpoint.py): a run interrupted and resumed gives bit-for-bit the results of an uninterrupted run. """
+
+import numpy as np
+import pytest
+import checkpoint, simulation, hit_store, instrumentation, main
+from test_parallel_exec import assert_same_run
+
+
+class Crash(Exception):
+    pass
+
+
+@pytest.mark.parametrize('crash_at_flush', [2, 4]) # in the middle of the first chunk, and in the first block of the second one
+def test_resume_is_bit_for_bit(run_spec, tmp_path, monkeypatch, crash_at_flush):
+    monkeypatch.setattr(main, 'checkpoint_every', 100)
+    simulation.Simulation(run_spec).run(str(tmp_path / 'uninterrupted'))
+
+    flush = hit_store.Hit_Writer.flush
+    flushes = []
+
+    def crashing_flush(writer):
+        flush(writer) # the records of the block are on disk, but the checkpoint after them is not
+        flushes.append(writer.records_written)
+        if len(flushes) == crash_at_flush:
+            raise Crash()
+
+    with monkeypatch.context() as patched:
+        patched.setattr(hit_store.Hit_Writer, 'flush', crashing_flush)
+        with pytest.raises(Crash):
+            simulation.Simulation(run_spec).run(str(tmp_path / 'resumed'))
+    instrumentation.disable()
+    run_checkpoint = checkpoint.Run_Checkpoint.load(str(tmp_path / 'resumed' / 'results_checkpoint.pkl'))
+    assert run_checkpoint.records_written == flushes[-2] < flushes[-1] # the records of the last block are dropped when resuming
+
+    simulation.Simulation(run_spec).run(str(tmp_path / 'resumed'))
+    assert_same_run(tmp_path / 'uninterrupted', tmp_path / 'resumed')
+
+
+def test_a_new_run_does_not_resume(run_spec, tmp_path):
+    simulation.Simulation(run_spec).run(str(tmp_path / 'a'))
+    simulation.Simulation(run_spec).run(str(tmp_path / 'a'), resume=False)
+    simulation.Simulation(run_spec).run(str(tmp_path / 'b'))
+    assert_same_run(tmp_path / 'a', tmp_path / 'b') # not twice the particles
+
+
+def test_answers_and_seed_are_replayed(tmp_path, monkeypatch):
+    answers = iter(['run', '3', 'proton'])
+    monkeypatch.setattr('builtins.input', lambda prompt: next(answers))
+    run_checkpoint = checkpoint.Run_Checkpoint(str(tmp_path / 'run_checkpoint.pkl'))
+    asked = [run_checkpoint.ask('name? '), run_checkpoint.ask('chunks? '), run_checkpoint.ask('species? ')]
+    draws = np.random.default_rng(run_checkpoint.seed_sequence()).random(5)
+    run_checkpoint.save(1, 200, 1200)
+
+    monkeypatch.setattr('builtins.input', lambda prompt: pytest.fail('a recorded answer was asked again'))
+    resumed = checkpoint.Run_Checkpoint.load(str(tmp_path / 'run_checkpoint.pkl'))
+    assert resumed.resumed and (resumed.chunks_done, resumed.particles_done, resumed.records_written) == (1, 200, 1200)
+    assert [resumed.ask('name? '), resumed.ask('chunks? '), resumed.ask('species? ')] == asked
+    assert np.array_equal(np.random.default_rng(resumed.seed_sequence()).random(5), draws)
@@ -0,0 +1,92 @@
+""" Field maps (fieldmap.py): trilinear interpolation of the map, and particles pushed through a uniform map as through the uniform fields. """
+
+import numpy as np
+import pytest
+import fieldmap, propagation, instrumentation
+from test_rkint import initial_states, qonm, yscal, l_B, y_bottom_elec, E, B
+
+x_range, y_range, z_range = (-0.02, 0.02), (-0.02, 0.02), (0.0, l_B)
+
+
+def uniform_map(dirname, shape=(5, 5, 11)):
+    fields = np.zeros(tuple(shape) + (6,))
+    fields[..., 1] = E
+    fields[..., 4] = B
+    spacing = [(r[1] - r[0]) / (n - 1) for r, n in zip([x_range, y_range, z_range], shape)]
+    fieldmap.save_field_map(dirname, [x_range[0], y_range[0], z_range[0]], spacing, fields)
+    return dirname
+
+
+def test_trilinear_interpolation_is_exact_for_linear_fields(tmp_path):
+    rng = np.random.default_rng(0)
+    slopes, offsets = rng.normal(size=(3, 6)), rng.normal(size=6)
+    origin, spacing, shape = np.array([-1.0, -0.5, 0.0]), np.array([0.25, 0.1, 0.5]), (9, 11, 5)
+    nodes = origin + spacing * np.stack(np.meshgrid(*[np.arange(n) for n in shape], indexing='ij'), axis=-1)
+    fieldmap.save_field_map(str(tmp_path), origin, spacing, nodes @ slopes + offsets)
+    field_map = fieldmap.Field_Map(str(tmp_path), cache_slots=16) # fewer slots than cells, so that the cache gets overwritten
+    positions = origin + spacing * (np.array(shape) - 1) * rng.uniform(0.0, 1.0, (1000, 3))
+    positions[0] = origin + spacing * (np.array(shape) - 1) # the last node
+    for _ in range(2):
+        assert np.allclose(field_map.fields_at(positions), positions @ slopes + offsets, rtol=1e-12, atol=1e-12)
+    assert np.array_equal(field_map.fields_at((origin - 0.01)[None, :]), np.zeros((1, 6))) # 0 outside of the map
+
+
+def test_corner_values_are_cached(tmp_path):
+    field_map = fieldmap.Field_Map(uniform_map(str(tmp_path)))
+    positions = np.column_stack([np.zeros(100), np.zeros(100), np.linspace(0.0, l_B, 100)])
+    with instrumentation.collecting() as metrics:
+        first = field_map.fields_at(positions)
+    assert metrics.counters['fieldmap_cells_read'] == 10 and metrics.counters.get('fieldmap_cells_cached', 0) == 0
+    with instrumentation.collecting() as metrics:
+        assert np.array_equal(field_map.fields_at(positions), first)
+    assert metrics.counters['fieldmap_cells_cached'] == 10 and metrics.counters.get('fieldmap_cells_read', 0) == 0
+
+
+def test_mismatched_grid_is_refused(tmp_path):
+    uniform_map(str(tmp_path))
+    np.save(str(tmp_path / 'fields.npy'), np.zeros((5, 5, 10, 6)))
+    with pytest.raises(ValueError, match='grid.json'):
+        fieldmap.Field_Map(str(tmp_path))
+
+
+@pytest.mark.parametrize('mode', ['rk45', 'dopri54'])
+def test_uniform_map_gives_the_results_of_the_uniform_fields(tmp_path, mode):
+    dirname = uniform_map(str(tmp_path))
+    states = initial_states()
+    exited_B, hit_E, final_states, steps_accepted, steps_rejected = propagation.push_batch_to_endoffields(states, qonm, yscal, 1e-10, l_B, y_bottom_elec, E, B, mode=mode, prescreen=False)
+    on_map = propagation.push_batch_to_endoffields(states, qonm, yscal, 1e-10, l_B, y_bottom_elec, 0.0, 0.0, mode=mode, field_map=dirname)
+    assert 0 < exited_B.sum() < states.shape[0]
+    assert np.array_equal(on_map[0], exited_B) and np.array_equal(on_map[1], hit_E)
+    if mode == 'dopri54': # rk45 stops after the step which crosses the boundary, wherever the steps of each run fall
+        hit = (hit_E == 1)
+        assert np.all(np.abs(on_map[2][:, 0:3] - final_states[:, 0:3]) <= 1e-9 * np.array(yscal))
+        assert np.all(np.abs(on_map[2][hit, 3:6] - final_states[hit, 3:6]) <= 1e-9 * states[hit, 5:6])
+        # the step across the end of the map sees its fields drop to 0, and the error is only controlled on x,y,z
+        assert np.all(np.abs(on_map[2][:, 3:6] - final_states[:, 3:6]) <= 1e-4 * states[:, 5:6])
+
+
+def test_uniform_modes_are_refused_with_a_map(tmp_path):
+    dirname = uniform_map(str(tmp_path))
+    for mode in ['analytic', 'map']:
+        with pytest.raises(ValueError, match='uniform'):
+            propagation.push_batch_to_endoffields(initial_states(2), qonm, yscal, 1e-6, l_B, y_bottom_elec, E, B, mode=mode, field_map=dirname)
+
+
+def test_fringe_fields(tmp_path):
+    fringe, shape = 0.005, (3, 21, 201)
+    fieldmap.fringe_field_map(str(tmp_path), E, B, l_B, fringe, x_range, y_range, (-0.025, l_B + 0.025), shape)
+    fields = np.load(str(tmp_path / 'fields.npy'))
+    zs, ys = np.linspace(-0.025, l_B + 0.025, shape[2]), np.linspace(*y_range, shape[1])
+    middle, start = np.argmin(np.abs(zs - l_B / 2)), np.argmin(np.abs(zs))
+    assert fields[1, 10, middle, 1] == pytest.approx(E, rel=1e-3) and fields[1, 10, middle, 4] == pytest.approx(B, rel=1e-3)
+    assert fields[1, 10, start, 1] == pytest.approx(E / 2, rel=1e-3) # half of the field at the nominal edge
+    assert fields[1, 10, 0, 4] == pytest.approx(0.0, abs=1e-3 * B)
+    # curl-free: dEy/dz = dEz/dy (and the same for B), by finite differences between the nodes
+    for k in (1, 4):
+        d_dz = np.gradient(fields[1, :, :, k], zs, axis=1, edge_order=2)
+        d_dy = np.gradient(fields[1, :, :, k + 1], ys, axis=0, edge_order=2)
+        assert np.allclose(d_dz, d_dy, rtol=0.0, atol=1e-2 * np.abs(d_dy).max()) # the finite differences are second order in the spacing of the nodes
+    # the particles are pushed up to the end of the map
+    exited_B, hit_E, final_states, steps_accepted, steps_rejected = propagation.push_batch_to_endoffields(initial_states(), qonm, yscal, 1e-8, l_B, y_bottom_elec, 0.0, 0.0, mode='dopri54', field_map=str(tmp_path))
+    assert np.all(exited_B + hit_E == 1)
+    assert np.allclose(final_states[exited_B == 1, 2], l_B + 0.025, rtol=0.0, atol=1e-12)
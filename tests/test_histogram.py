@@ -0,0 +1,99 @@
+""" On-the-fly detector images (histogram.py): merged partial images are the image of all the hits, whatever the order of the blocks. """
+
+import os
+import numpy as np
+import pytest
+import histogram, databases, simulation
+
+mass, charge = databases.masses['proton'], databases.charges['proton']
+
+
+def hits(no_of_parts=20000, seed=0):
+    rng = np.random.default_rng(seed)
+    coords = np.column_stack([rng.normal(-0.05, 0.01, no_of_parts), rng.exponential(0.002, no_of_parts)])
+    final_states = np.zeros((no_of_parts, 6))
+    final_states[:, 5] = rng.uniform(1e6, 3e7, no_of_parts)
+    return coords, final_states
+
+
+def binned(blocks, weighting='counts', extents=None):
+    detector_histogram = histogram.Detector_Histogram((64, 32), weighting, extents)
+    for coords, final_states in blocks:
+        detector_histogram.add('proton', coords, mass, charge, final_states)
+    return detector_histogram
+
+
+def blocks_of(coords, final_states, order):
+    return [(coords[i], final_states[i]) for i in order]
+
+
+def test_grid_and_image_do_not_depend_on_the_order_of_the_blocks():
+    coords, final_states = hits()
+    pieces = np.array_split(np.arange(coords.shape[0]), 10)
+    whole = binned([(coords, final_states)])
+    for seed in range(3):
+        order = np.random.default_rng(seed).permutation(10)
+        in_blocks = binned(blocks_of(coords, final_states, [pieces[k] for k in order]))
+        assert in_blocks.extents['proton'] == whole.extents['proton']
+        assert np.array_equal(in_blocks.images['proton'], whole.images['proton'])
+    assert whole.images['proton'].sum() == coords.shape[0] # every hit is binned, the grid growing as needed
+
+
+def test_merged_partials_equal_the_whole_image():
+    coords, final_states = hits()
+    pieces = np.array_split(np.arange(coords.shape[0]), 4)
+    for weighting in histogram.histogram_weightings:
+        whole = binned([(coords, final_states)], weighting)
+        total = histogram.Detector_Histogram((64, 32), weighting)
+        for piece in pieces[::-1]: # each partial sets its own, narrower grid from its own hits
+            total += binned([(coords[piece], final_states[piece])], weighting)
+        assert total.extents['proton'] == whole.extents['proton']
+        assert np.allclose(total.images['proton'], whole.images['proton'], rtol=1e-12, atol=0.0)
+
+
+def test_fixed_grid_is_np_histogram2d():
+    coords, final_states = hits()
+    extents = {'proton': ((-0.08, -0.02), (0.0, 0.004))}
+    detector_histogram = binned([(coords, final_states)], extents=extents)
+    expected, _, _ = np.histogram2d(coords[:, 0], coords[:, 1], bins=(64, 32), range=extents['proton'])
+    assert np.array_equal(detector_histogram.images['proton'], expected)
+    assert detector_histogram.outside['proton'] == coords.shape[0] - expected.sum() > 0
+    x_edges, y_edges = detector_histogram.edges('proton')
+    assert np.allclose(x_edges, np.linspace(-0.08, -0.02, 65))
+
+
+def test_energy_weighting():
+    coords, final_states = hits(100)
+    energies_MeV = 0.5 * mass * final_states[:, 5]**2 / databases.charges['proton'] / (10**6)
+    assert binned([(coords, final_states)], 'energy').images['proton'].sum() == pytest.approx(energies_MeV.sum(), rel=1e-12)
+
+
+def test_mismatched_histograms_are_not_merged():
+    coords, final_states = hits(100)
+    with pytest.raises(ValueError):
+        binned([(coords, final_states)]).merge(histogram.Detector_Histogram((32, 32)))
+    with pytest.raises(ValueError):
+        binned([(coords, final_states)], extents={'proton': ((-1.0, 0.0), (0.0, 1.0))}).merge(binned([(coords, final_states)], extents={'proton': ((-2.0, 0.0), (0.0, 1.0))}))
+
+
+def test_save_and_load(tmp_path):
+    coords, final_states = hits()
+    detector_histogram = binned([(coords, final_states)])
+    detector_histogram.save(str(tmp_path / 'image.npz'))
+    loaded = histogram.Detector_Histogram.load(str(tmp_path / 'image.npz'))
+    assert loaded.extents == detector_histogram.extents and loaded.bounds == detector_histogram.bounds and loaded.fixed == detector_histogram.fixed
+    assert np.array_equal(loaded.images['proton'], detector_histogram.images['proton'])
+    more_coords, more_final_states = hits(seed=1) # the loaded histogram goes on growing as the original one
+    loaded.add('proton', more_coords, mass, charge, more_final_states)
+    detector_histogram.add('proton', more_coords, mass, charge, more_final_states)
+    assert np.array_equal(loaded.images['proton'], detector_histogram.images['proton'])
+
+
+def test_run_image_is_the_image_of_its_hits(run_spec, tmp_path):
+    simulation.Simulation(run_spec).run(str(tmp_path))
+    run_image = histogram.Detector_Histogram.load(os.path.join(tmp_path, 'results_image.npz'))
+    from_hits = histogram.histogram_from_hits(os.path.join(tmp_path, 'results_hits'), histogram.Detector_Histogram(run_image.n_bins, run_image.weighting))
+    assert sorted(from_hits.images) == sorted(run_image.images) == ['C6+', 'proton']
+    for species in run_image.images:
+        assert from_hits.extents[species] == run_image.extents[species]
+        assert np.array_equal(from_hits.images[species], run_image.images[species])
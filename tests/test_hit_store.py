@@ -0,0 +1,83 @@
+""" Streaming on-disk storage of the hits (hit_store.py): what the writers append is what the reader reads back. """
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import hit_store, Species
+
+
+def records(no_of_parts, first_id=0, chunk=0, seed=0):
+    rng = np.random.default_rng(seed)
+    status = rng.choice([Species.status_exited, Species.status_hit_electrode], no_of_parts).astype(np.int8)
+    return {'species_ids': rng.integers(0, 5, no_of_parts), 'particle_ids': first_id + np.arange(no_of_parts), 'chunk': chunk, 'status': status,
+            'coords_at_detector': rng.normal(size=(no_of_parts, 2)), 'final_states': rng.normal(size=(no_of_parts, 6)), 'weights': rng.uniform(0.5, 2.0, no_of_parts)}
+
+
+def write_shard(run_dir, writer_name, first_id, seed):
+    with hit_store.Hit_Writer(run_dir, writer_name=writer_name, block_size=64) as writer:
+        for start in range(0, 500, 100):
+            writer.append(**records(100, first_id + start, chunk=start // 100, seed=seed + start))
+    return writer_name
+
+
+def test_round_trip(tmp_path):
+    written = records(1000)
+    with hit_store.Hit_Writer(str(tmp_path), block_size=128) as writer:
+        writer.append(**written)
+    reader = hit_store.Hit_Reader(str(tmp_path))
+    reached = (written['status'] == Species.status_exited)
+    assert len(reader) == 1000
+    assert np.array_equal(reader.column('particle_id'), written['particle_ids'])
+    assert np.array_equal(reader.column('species_id'), written['species_ids']) and np.all(reader.column('chunk') == 0)
+    assert np.array_equal(reader.column('status'), written['status'])
+    assert np.array_equal(reader.column('screen_x')[reached], written['coords_at_detector'][reached, 0])
+    assert np.all(np.isnan(reader.column('screen_y')[~reached])) # the particles which do not reach the screen have no screen coordinates
+    for i, name in enumerate(['exit_x', 'exit_y', 'exit_z', 'exit_ux', 'exit_uy', 'exit_uz']):
+        assert np.array_equal(reader.column(name), written['final_states'][:, i])
+    assert np.array_equal(reader.column('weight'), written['weights'])
+    assert np.array_equal(reader.screen_coords(0), written['coords_at_detector'][reached])
+
+
+def test_default_weights_are_one(tmp_path):
+    with hit_store.Hit_Writer(str(tmp_path)) as writer:
+        writer.append(**{**records(10), 'weights': None})
+    assert np.all(hit_store.Hit_Reader(str(tmp_path)).column('weight') == 1.0)
+
+
+def test_several_processes_write_their_own_shards(tmp_path):
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        list(pool.map(write_shard, [str(tmp_path)] * 2, ['a', 'b'], [0, 500], [1, 2]))
+    reader = hit_store.Hit_Reader(str(tmp_path))
+    assert len(reader.shards()) == 2 and len(reader) == 1000
+    assert np.array_equal(np.sort(reader.column('particle_id')), np.arange(1000))
+    selected = reader.select(chunk=3, status=Species.status_exited)
+    assert np.all(selected['chunk'] == 3) and np.all(selected['status'] == Species.status_exited)
+    expected = [records(100, first_id + 300, chunk=3, seed=seed + 300) for first_id, seed in [(0, 1), (500, 2)]]
+    expected_ids = np.concatenate([r['particle_ids'][r['status'] == Species.status_exited] for r in expected])
+    assert np.array_equal(np.sort(selected['particle_id']), expected_ids)
+
+
+def test_a_run_can_be_read_while_it_is_written(tmp_path):
+    writer = hit_store.Hit_Writer(str(tmp_path), writer_name='main', block_size=100)
+    writer.append(**records(60))
+    reader = hit_store.Hit_Reader(str(tmp_path))
+    assert len(reader) == 0 # still buffered
+    writer.append(**records(60, 60, seed=1)) # a full block: written to disk
+    reader.refresh()
+    assert len(reader) == 120
+    # a record is complete once it is in all the columns: a torn write is not seen
+    with open(os.path.join(str(tmp_path), 'shard_main', 'particle_id.bin'), 'ab') as f:
+        f.write(np.array([999], dtype='<i8').tobytes())
+    reader.refresh()
+    assert len(reader) == 120
+    writer.close()
+
+
+def test_keep_records_cuts_the_shard_back(tmp_path):
+    with hit_store.Hit_Writer(str(tmp_path), writer_name='main') as writer:
+        writer.append(**records(300))
+    with hit_store.Hit_Writer(str(tmp_path), writer_name='main', keep_records=120) as writer:
+        assert writer.records_written == 120
+        writer.append(**records(10, 1000, seed=3))
+    reader = hit_store.Hit_Reader(str(tmp_path))
+    assert np.array_equal(reader.column('particle_id'), np.concatenate([np.arange(120), 1000 + np.arange(10)]))
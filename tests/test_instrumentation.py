@@ -0,0 +1,89 @@
+""" Instrumentation (instrumentation.py): counters and timers which add up, and progress logged at INFO level, rate-limited. """
+
+import os, json, logging
+import numpy as np
+import pytest
+import instrumentation, parallel_exec, simulation, RKint
+from test_rkint import initial_states, qonm, yscal, l_B, y_bottom_elec, E, B
+
+
+@pytest.mark.parametrize('integrator, evaluations_before_the_steps', [(RKint.RK45integrator_batch, 2), (RKint.DOPRI54integrator_batch, 3)])
+def test_derivative_evaluations_are_counted(integrator, evaluations_before_the_steps):
+    states = initial_states()
+    assert instrumentation.metrics is None
+    plain = integrator(states, qonm, yscal, 1e-6, l_B, y_bottom_elec, E, B)
+    with instrumentation.collecting() as metrics:
+        instrumented = integrator(states, qonm, yscal, 1e-6, l_B, y_bottom_elec, E, B)
+    assert instrumentation.metrics is None # restored after the block
+    for a, b in zip(plain, instrumented):
+        assert np.array_equal(a, b)
+    steps = (instrumented[3] + instrumented[4]).sum() # 6 new evaluations per step, plus the first step estimate (and the FSAL stage of DOPRI54)
+    assert metrics.timers['derivatives']['items'] == evaluations_before_the_steps * states.shape[0] + 6 * steps
+
+
+def test_snapshots_merge_by_summing():
+    total = instrumentation.Run_Metrics()
+    for n in (3, 4):
+        with instrumentation.collecting() as metrics:
+            instrumentation.count('particles_pushed', n)
+            with instrumentation.timer('integration', n):
+                pass
+        total.merge(metrics.snapshot())
+    assert total.counters['particles_pushed'] == 7
+    assert total.timers['integration']['calls'] == 2 and total.timers['integration']['items'] == 7
+
+
+def test_events_are_key_value_lines(caplog):
+    with caplog.at_level(logging.INFO, logger='ThomsonParabola'):
+        instrumentation.log_event(logging.INFO, 'chunk_done', chunk=0, species='proton')
+        instrumentation.log_event(logging.DEBUG, 'sub_batch_done', worker=1)
+    assert [record.getMessage() for record in caplog.records] == ['chunk_done chunk=0 species=proton']
+
+
+def progress_records(caplog, progress_interval):
+    states = initial_states(100)
+    geometry = {'E': E, 'B': B, 'l_B': l_B, 'y_bottom_elec': y_bottom_elec, 'z_det': 0.5, 'yscal': np.array(yscal), 'tol': 1e-6}
+    caplog.clear()
+    with caplog.at_level(logging.DEBUG, logger='ThomsonParabola'), parallel_exec.Parallel_Executor(2, 10, progress_interval) as executor:
+        executor.push_chunk(states, qonm, geometry, 'dopri54', 'proton')
+    return [record for record in caplog.records if record.getMessage().startswith('sub_batch_done')]
+
+
+def test_progress_is_rate_limited_at_info_level(caplog):
+    records = progress_records(caplog, 3600.0)
+    assert len(records) == 10 # one per sub-batch
+    info = [record for record in records if record.levelno == logging.INFO]
+    assert len(info) == 1 and info[0] is records[-1] # within the interval, only the end of the chunk
+    assert 'particles_done=100' in info[0].getMessage() and 'per_worker=' in info[0].getMessage()
+    assert len([record for record in progress_records(caplog, 0.0) if record.levelno == logging.INFO]) == 10
+    assert all(record.levelno == logging.DEBUG for record in progress_records(caplog, None))
+
+
+def test_metrics_file_of_a_run(run_spec, tmp_path):
+    simulation.Simulation(run_spec).run(str(tmp_path / 'serial'))
+    simulation.Simulation({**run_spec, 'n_workers': 2}).run(str(tmp_path / 'pool'))
+    assert instrumentation.metrics is None
+    with open(os.path.join(tmp_path, 'serial', 'results_metrics.json')) as f:
+        serial = json.load(f)
+    with open(os.path.join(tmp_path, 'pool', 'results_metrics.json')) as f:
+        pool = json.load(f)
+    assert serial['counters'] == pool['counters'] # the counters of the workers are merged into the ones of the run
+    assert serial['timers']['derivatives']['items'] == pool['timers']['derivatives']['items']
+    counters = serial['counters']
+    assert counters['particles_pushed'] == counters['particles_exited'] + counters['particles_hit_electrode'] + counters['particles_stuck'] == 500
+    assert [chunk['particles'] for chunk in serial['chunks']] == [300, 200]
+    assert sum(chunk['prescreened_clip'] for chunk in serial['chunks']) == counters['particles_prescreened_clip'] > 0
+    assert serial['info']['propagation_mode'] == 'dopri54' and serial['info']['memo']['misses'] == 500
+
+
+def test_sampling_profiler(tmp_path):
+    profiler = instrumentation.Sampling_Profiler(0.001)
+    profiler.start()
+    states = initial_states(2000)
+    for _ in range(20):
+        RKint.RK45integrator_batch(states, qonm, yscal, 1e-8, l_B, y_bottom_elec, E, B)
+    profiler.stop(str(tmp_path / 'profile.txt'))
+    with open(tmp_path / 'profile.txt') as f:
+        lines = f.read().splitlines()
+    assert len(lines) > 0 and all(line.rsplit(' ', 1)[1].isdigit() for line in lines)
+    assert any('RKint:RK45integrator_batch' in line for line in lines)
@@ -0,0 +1,86 @@
+""" Memoization of the pushing (memo.py): the memo fans out to identical particles exactly what pushing each of them would give. """
+
+import numpy as np
+import pytest
+import memo, parallel_exec, databases
+from test_rkint import initial_states, yscal, l_B, y_bottom_elec, E, B
+
+geometry = {'E': E, 'B': B, 'l_B': l_B, 'y_bottom_elec': y_bottom_elec, 'z_det': 0.5, 'yscal': np.array(yscal), 'tol': 1e-6}
+
+
+class Counting_Pusher:
+    """ push_unique of Propagation_Memo.push(), counting the particles it is asked to push. """
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, states, qonms):
+        self.calls.append(states.shape[0])
+        return parallel_exec.push_sub_batch(states, qonms, geometry, 'dopri54')[:6]
+
+
+def batch_with_duplicates(seed=0):
+    # 5 distinct initial states, 40 copies each, shared by a proton-like and a C6+-like q/m: 10 unique particles
+    rng = np.random.default_rng(seed)
+    distinct = initial_states(5, seed)
+    picks = rng.integers(0, 5, 400)
+    qonms = np.where(rng.random(400) < 0.5, databases.charges['proton'] / databases.masses['proton'], databases.charges['C6+'] / databases.masses['C6+'])
+    return distinct[picks], qonms
+
+
+def test_fan_out_equals_pushing_every_particle():
+    states, qonms = batch_with_duplicates()
+    pusher = Counting_Pusher()
+    memoized = memo.Propagation_Memo(100).push(states, qonms, geometry, 'dopri54', pusher)
+    direct = parallel_exec.push_sub_batch(states, qonms, geometry, 'dopri54')[:6]
+    assert pusher.calls == [10]
+    for i in (0, 1, 2, 5):
+        assert np.array_equal(memoized[i], direct[i], equal_nan=True)
+    # the steps are those of the one particle of each group actually pushed
+    unique_rows = np.unique(np.column_stack([qonms, states]), axis=0)
+    unique_steps = parallel_exec.push_sub_batch(unique_rows[:, 1:], unique_rows[:, 0], geometry, 'dopri54')[3]
+    assert memoized[3].sum() == unique_steps.sum() < direct[3].sum()
+
+
+def test_memo_is_hit_across_batches():
+    states, qonms = batch_with_duplicates()
+    propagation_memo = memo.Propagation_Memo(100)
+    pusher = Counting_Pusher()
+    first = propagation_memo.push(states, qonms, geometry, 'dopri54', pusher)
+    second = propagation_memo.push(states[::-1], qonms[::-1], geometry, 'dopri54', pusher)
+    assert pusher.calls == [10] # nothing pushed the second time
+    for i in (0, 1, 2, 5):
+        assert np.array_equal(second[i], first[i][::-1], equal_nan=True)
+    assert np.all(second[3] == 0)
+    assert (propagation_memo.hits, propagation_memo.misses) == (2 * 400 - 10, 10)
+    assert propagation_memo.hit_rate() == pytest.approx(790 / 800)
+
+
+def test_other_settings_do_not_hit():
+    states, qonms = batch_with_duplicates()
+    propagation_memo = memo.Propagation_Memo(100)
+    pusher = Counting_Pusher()
+    propagation_memo.push(states, qonms, geometry, 'dopri54', pusher)
+    propagation_memo.push(states, qonms, {**geometry, 'tol': 1e-8}, 'dopri54', pusher)
+    propagation_memo.push(states, qonms, geometry, 'rk45', pusher)
+    assert pusher.calls == [10, 10, 10]
+
+
+def test_least_recently_used_entries_are_evicted():
+    states, qonms = batch_with_duplicates()
+    propagation_memo = memo.Propagation_Memo(4)
+    pusher = Counting_Pusher()
+    propagation_memo.push(states, qonms, geometry, 'dopri54', pusher)
+    assert len(propagation_memo) == 4 and propagation_memo.evictions == 6
+    again = propagation_memo.push(states, qonms, geometry, 'dopri54', pusher)
+    assert pusher.calls[1] == 6 # the 4 last stored are still there
+    direct = parallel_exec.push_sub_batch(states, qonms, geometry, 'dopri54')[:6]
+    assert np.array_equal(again[2], direct[2]) and np.array_equal(again[5], direct[5], equal_nan=True)
+
+
+def test_distinct_particles_bypass_the_memo():
+    states = initial_states(50)
+    propagation_memo = memo.Propagation_Memo(100)
+    pusher = Counting_Pusher()
+    propagation_memo.push(states, np.full(50, databases.charges['proton'] / databases.masses['proton']), geometry, 'dopri54', pusher)
+    assert pusher.calls == [50] and len(propagation_memo) == 0 and propagation_memo.misses == 50
@@ -0,0 +1,54 @@
+""" Parallel pushing of the chunks (parallel_exec.py): for a fixed seed, the results do not depend on the number of workers or on the sub-batch size. """
+
+import os
+import numpy as np
+import parallel_exec, simulation, hit_store
+
+
+def hit_columns(output_dir):
+    hits = hit_store.Hit_Reader(os.path.join(output_dir, 'results_hits'))
+    order = np.argsort(hits.column('particle_id'), kind='stable')
+    return {name: np.asarray(hits.column(name))[order] for name, dtype in hit_store.hit_columns}
+
+
+def assert_same_run(dir_a, dir_b):
+    hits_a, hits_b = hit_columns(dir_a), hit_columns(dir_b)
+    for name in hits_a:
+        assert np.array_equal(hits_a[name], hits_b[name], equal_nan=True), name
+    with np.load(os.path.join(dir_a, 'results.npz')) as a, np.load(os.path.join(dir_b, 'results.npz')) as b:
+        assert sorted(a.files) == sorted(b.files)
+        for name in a.files:
+            assert np.array_equal(a[name], b[name])
+    with np.load(os.path.join(dir_a, 'results_image.npz')) as a, np.load(os.path.join(dir_b, 'results_image.npz')) as b:
+        for name in a.files:
+            assert np.array_equal(a[name], b[name])
+
+
+def test_push_chunk_does_not_depend_on_the_workers(run_spec):
+    sim = simulation.Simulation(run_spec)
+    geometry = {**sim.geometry(), 'tol': 1e-6}
+    batch = sim.draw_particles()[0]
+    with parallel_exec.Parallel_Executor(1, 10**4) as serial, parallel_exec.Parallel_Executor(2, 37) as pool:
+        pushed_serially = serial.push_chunk(batch.states, batch.qonms, geometry, 'dopri54')
+        pushed_by_the_pool = pool.push_chunk(batch.states, batch.qonms, geometry, 'dopri54')
+    for serial_result, pool_result in zip(pushed_serially, pushed_by_the_pool):
+        assert np.array_equal(serial_result, pool_result, equal_nan=True)
+    assert 0 < pushed_serially[0].sum() < len(batch)
+
+
+def test_fixed_seed_gives_identical_results(run_spec, tmp_path):
+    simulation.Simulation(run_spec).run(str(tmp_path / 'a'))
+    simulation.Simulation(run_spec).run(str(tmp_path / 'b'))
+    assert_same_run(tmp_path / 'a', tmp_path / 'b')
+
+
+def test_results_do_not_depend_on_the_number_of_workers(run_spec, tmp_path):
+    simulation.Simulation(run_spec).run(str(tmp_path / 'serial'))
+    simulation.Simulation({**run_spec, 'n_workers': 2}).run(str(tmp_path / 'pool'))
+    assert_same_run(tmp_path / 'serial', tmp_path / 'pool')
+
+
+def test_another_seed_draws_other_particles(run_spec):
+    states = simulation.Simulation(run_spec).draw_particles()[0].states
+    other_states = simulation.Simulation({**run_spec, 'seed': 2}).draw_particles()[0].states
+    assert not np.array_equal(states, other_states)
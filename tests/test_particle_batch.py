@@ -0,0 +1,71 @@
+""" The structure-of-arrays ParticleBatch (Species.py), and the Species views on its rows. """
+
+import numpy as np
+import Species, propagation, databases
+
+names = databases.all_possible_names
+
+
+def proton_batch(no_of_parts=10):
+    return Species.ParticleBatch.from_species('proton', databases.masses['proton'], databases.charges['proton'], np.linspace(0.0, 1e-3, no_of_parts), 0.0,
+                                              np.linspace(1e6, 1e7, no_of_parts), names)
+
+
+def test_from_species_layout():
+    batch = proton_batch()
+    assert batch.states.shape == (10, 6) and batch.states.flags['C_CONTIGUOUS']
+    assert np.array_equal(batch.x, np.linspace(0.0, 1e-3, 10)) and np.all(batch.y == 0.0) and np.all(batch.z == 0.0)
+    assert np.array_equal(batch.uz, np.linspace(1e6, 1e7, 10)) and np.all(batch.ux == 0.0) and np.all(batch.uy == 0.0)
+    assert np.all(batch.qonms == databases.charges['proton'] / databases.masses['proton'])
+    assert np.all(batch.species_ids == names.index('proton')) and np.all(batch.weights == 1.0)
+    assert np.all(batch.status == Species.status_in_flight)
+
+
+def test_slices_are_views_and_masks_are_copies():
+    batch = proton_batch()
+    view = batch[2:5]
+    view.states[:, 1] = 1.0
+    view.status[:] = Species.status_exited
+    assert np.all(batch.y[2:5] == 1.0) and np.all(batch.status[2:5] == Species.status_exited)
+    copy = batch[batch.uz > 5e6]
+    copy.states[:, 1] = 2.0
+    assert not np.any(batch.y == 2.0)
+
+
+def test_sub_batches_cover_the_batch_in_order():
+    batch = proton_batch(10)
+    sub_batches = list(batch.sub_batches(3))
+    assert [len(sub) for sub in sub_batches] == [3, 3, 3, 1]
+    assert np.array_equal(Species.ParticleBatch.concatenate(sub_batches).states, batch.states)
+    assert all(np.shares_memory(sub.states, batch.states) for sub in sub_batches)
+
+
+def test_set_outcomes():
+    batch = proton_batch(4)
+    batch.set_outcomes(np.array([1, 0, 0, 1]), np.array([0, 1, 0, 0]))
+    assert batch.status.tolist() == [Species.status_exited, Species.status_hit_electrode, Species.status_stuck, Species.status_exited]
+
+
+def test_species_views_read_and_write_the_batch():
+    batch = proton_batch()
+    particle = batch.particle(3)
+    assert particle.x == batch.x[3] and particle.uz == batch.uz[3] and particle._qonm == batch.qonms[3]
+    particle.y = 0.5
+    assert batch.y[3] == 0.5
+    assert np.array_equal(particle.Species_get_xyz(), batch.states[3, :3]) and np.array_equal(particle.Species_get_uxuyuz(), batch.states[3, 3:])
+    assert not hasattr(particle, '__dict__')
+
+
+def test_standalone_species_owns_a_batch_of_one():
+    particle = Species.Species('C6+', databases.masses['C6+'], databases.charges['C6+'], np.array([1e-3, 0.0, 0.0]), np.array([0.0, 0.0, 1e6]))
+    assert (particle.x, particle.uz) == (1e-3, 1e6)
+    assert particle._qonm == databases.charges['C6+'] / databases.masses['C6+']
+    assert len(particle._batch) == 1
+
+
+def test_drift_to_the_screen_matches_the_batch_version():
+    rng = np.random.default_rng(0)
+    final_states = np.column_stack([rng.normal(0.0, 1e-2, (20, 2)), np.full(20, 0.05), rng.normal(0.0, 1e5, (20, 2)), rng.uniform(1e6, 1e7, 20)])
+    coords = propagation.push_batch_from_endoffields_to_detector(final_states, 0.5)
+    for i in range(20):
+        assert np.allclose(Species.Species.Species_push_from_endoffields_to_detector(final_states[i], 0.5), coords[i], rtol=1e-14, atol=0.0)
@@ -0,0 +1,59 @@
+""" Pictures of the detector screen (plotting.py): the modes chosen by 'auto', and the size of the files for many particles. """
+
+import os
+import numpy as np
+import pytest
+import plotting, histogram, databases
+
+
+def layers(no_of_parts, seed=0):
+    rng = np.random.default_rng(seed)
+    return [(name, np.column_stack([rng.normal(-0.05 * (k + 1), 0.01, no_of_parts), rng.exponential(0.002, no_of_parts)])) for k, name in enumerate(['proton', 'C6+'])]
+
+
+def images_of(coords):
+    detector_histogram = histogram.Detector_Histogram((128, 128))
+    for name, values in coords:
+        detector_histogram.add(name, values, databases.masses[name], databases.charges[name], np.zeros((values.shape[0], 6)))
+    return detector_histogram
+
+
+def test_auto_mode(tmp_path):
+    filename = [str(tmp_path / 'picture.png')]
+    assert plotting.plot_detector_picture(filename, layers(100)) == 'scatter'
+    many = layers(plotting.vector_scatter_max)
+    assert plotting.plot_detector_picture(filename, many) == 'rasterized'
+    assert plotting.plot_detector_picture(filename, many, images_of(many)) == 'density'
+    assert plotting.plot_detector_picture(filename, None, images_of(many)) == 'density'
+
+
+def test_pictures_of_many_particles_stay_small(tmp_path):
+    coords = layers(20000)
+    sizes = dict()
+    for mode in ['scatter', 'rasterized', 'density']:
+        filename = str(tmp_path / '{}.pdf'.format(mode))
+        plotting.plot_detector_picture([filename], coords, images_of(coords), mode=mode, dpi=100)
+        sizes[mode] = os.path.getsize(filename)
+    assert sizes['rasterized'] < sizes['scatter'] / 5 and sizes['density'] < sizes['scatter'] / 5
+    # the density picture does not grow with the number of particles
+    more = layers(200000, seed=1)
+    plotting.plot_detector_picture([str(tmp_path / 'more.pdf')], None, images_of(more), mode='density', dpi=100)
+    assert os.path.getsize(tmp_path / 'more.pdf') < 2 * sizes['density']
+
+
+def test_one_file_per_format(tmp_path):
+    filenames = [str(tmp_path / 'picture.pdf'), str(tmp_path / 'picture.png')]
+    plotting.plot_detector_picture(filenames, layers(100), title='test')
+    with open(filenames[0], 'rb') as f:
+        assert f.read(4) == b'%PDF'
+    with open(filenames[1], 'rb') as f:
+        assert f.read(8) == b'\x89PNG\r\n\x1a\n'
+
+
+def test_missing_inputs_are_refused(tmp_path):
+    with pytest.raises(ValueError, match='Choose from'):
+        plotting.plot_detector_picture([str(tmp_path / 'picture.png')], layers(10), mode='hexbin')
+    with pytest.raises(ValueError, match='detector images'):
+        plotting.plot_detector_picture([str(tmp_path / 'picture.png')], layers(10), mode='density')
+    with pytest.raises(ValueError, match='coordinates'):
+        plotting.plot_detector_picture([str(tmp_path / 'picture.png')], None, images_of(layers(10)), mode='rasterized')
@@ -0,0 +1,85 @@
+""" Separate E-field and B-field regions (regions.py): the segments of the beamline, and the particles pushed through them segment by segment. """
+
+import numpy as np
+import pytest
+import regions, propagation, RKint
+from test_rkint import initial_states, qonm, yscal, l_B, y_bottom_elec, E, B
+
+
+def assert_close_states(states_a, states_b, uzs, tol):
+    assert np.all(np.abs(states_a[:, 0:3] - states_b[:, 0:3]) <= tol * np.array(yscal))
+    assert np.all(np.abs(states_a[:, 3:6] - states_b[:, 3:6]) <= tol * uzs[:, None])
+
+
+def test_segments():
+    assert not regions.needs_regions(None, l_B) and not regions.needs_regions(l_B, l_B)
+    assert regions.needs_regions(0.03, l_B) and regions.needs_regions(l_B, l_B, z_E=0.01)
+    assert regions.field_segments(E, 0.03, 0.01, B, l_B, 0.0) == [(0.0, 0.01, 0.0, B, False), (0.01, 0.04, E, B, True), (0.04, l_B, 0.0, B, False)]
+    assert [regions.segment_kind(*segment[2:4]) for segment in regions.field_segments(E, 0.02, 0.0, B, 0.02, 0.03)] == ['E', 'drift', 'B']
+    with pytest.raises(ValueError):
+        regions.field_segments(E, 0.0, 0.0, B, l_B, 0.0)
+
+
+def test_one_region_is_the_integrator():
+    states = initial_states()
+    direct = RKint.DOPRI54integrator_batch(states, qonm, yscal, 1e-8, l_B, y_bottom_elec, E, B)
+    through_regions = regions.push_batch_through_regions(states, qonm, yscal, 1e-8, regions.field_segments(E, l_B, 0.0, B, l_B, 0.0), y_bottom_elec)
+    for a, b in zip(direct, through_regions):
+        assert np.array_equal(a, b)
+
+
+def test_cutting_a_region_in_two_does_not_change_the_particles():
+    states = initial_states()
+    whole = regions.push_batch_through_regions(states, qonm, yscal, 1e-11, [(0.0, l_B, E, B, True)], y_bottom_elec)
+    cut = regions.push_batch_through_regions(states, qonm, yscal, 1e-11, [(0.0, 0.02, E, B, True), (0.02, l_B, E, B, True)], y_bottom_elec)
+    assert 0 < whole[0].sum() < states.shape[0]
+    assert np.array_equal(whole[0], cut[0]) and np.array_equal(whole[1], cut[1])
+    assert_close_states(whole[2], cut[2], states[:, 5], 1e-9)
+
+
+def test_drift_is_a_straight_line():
+    states = initial_states()
+    exited_B, hit_E, final_states, steps_accepted, steps_rejected = regions.push_batch_through_regions(states, qonm, yscal, 1e-8, [(0.0, l_B, 0.0, 0.0, False)], y_bottom_elec)
+    assert np.all(exited_B == 1) and np.all(steps_accepted == 0) # no electrode outside of the plates, and no integration
+    assert np.allclose(final_states[:, 0:2], states[:, 0:2] + states[:, 3:5] / states[:, 5:6] * l_B, rtol=1e-12, atol=1e-15)
+    assert np.allclose(final_states[:, 3:6], states[:, 3:6], rtol=1e-12, atol=0.0)
+
+
+def test_particles_beyond_the_electrode_hit_its_front_edge():
+    states = initial_states(2)
+    states[:, 4] = 0.0
+    states[0, 1] = 2 * y_bottom_elec # already beyond the electrode when reaching the plates
+    exited_B, hit_E, final_states, steps_accepted, steps_rejected = regions.push_batch_through_regions(states, qonm, yscal, 1e-8, regions.field_segments(E, 0.03, 0.01, 0.0, l_B, 0.0), y_bottom_elec)
+    assert hit_E[0] == 1 and exited_B[0] == 0
+    assert final_states[0, 2] == pytest.approx(0.01, rel=1e-12) and final_states[0, 1] == 2 * y_bottom_elec # stopped where it reaches the plates
+    assert final_states[1, 2] > 0.01 # the other particle goes on between the plates
+
+
+@pytest.mark.parametrize('l_E, z_E, z_B', [(0.03, 0.0, 0.0), (0.03, 0.01, 0.0), (l_B, 0.02, 0.0), (0.02, 0.0, 0.03)])
+def test_closed_forms_match_the_integration(l_E, z_E, z_B):
+    states = initial_states()
+    segments = regions.field_segments(E, l_E, z_E, B, l_B, z_B)
+    analytic = regions.push_batch_through_regions(states, qonm, yscal, 1e-12, segments, y_bottom_elec, mode='analytic')
+    # every segment integrated, one after the other
+    exited_B, hit_E, final_states = np.ones(states.shape[0], dtype=int), np.zeros(states.shape[0], dtype=int), states.copy()
+    for z_start, z_end, E_s, B_s, electrode in segments:
+        if electrode: # the particles which reach the plates above the electrode hit its front edge
+            hit_E[(exited_B == 1) & (final_states[:, 1] >= y_bottom_elec)] = 1
+            exited_B[hit_E == 1] = 0
+        idx = np.flatnonzero(exited_B)
+        exited, hit, final_states[idx], accepted, rejected = RKint.DOPRI54integrator_batch(final_states[idx], qonm, yscal, 1e-12, z_end, y_bottom_elec if electrode else np.inf, E_s, B_s)
+        exited_B[idx] = exited
+        hit_E[idx] = hit
+    assert 0 < hit_E.sum() < states.shape[0]
+    assert np.array_equal(analytic[0], exited_B) and np.array_equal(analytic[1], hit_E)
+    assert_close_states(analytic[2], final_states, states[:, 5], 1e-7)
+
+
+def test_propagation_goes_through_the_regions():
+    states = initial_states()
+    expected = regions.push_batch_through_regions(states, qonm, yscal, 1e-8, regions.field_segments(E, 0.03, 0.0, B, l_B, 0.0), y_bottom_elec, mode='rk45')
+    pushed = propagation.push_batch_to_endoffields(states, qonm, yscal, 1e-8, l_B, y_bottom_elec, E, B, mode='rk45', l_E=0.03)
+    for a, b in zip(expected, pushed):
+        assert np.array_equal(a, b)
+    with pytest.raises(ValueError, match="'map'"):
+        propagation.push_batch_to_endoffields(states, qonm, yscal, 1e-8, l_B, y_bottom_elec, E, B, mode='map', l_E=0.03)
@@ -0,0 +1,31 @@
+""" Re-projection of a finished run (reprojection.py): bit-for-bit the screen pictures of fresh runs with the other z_det's. """
+
+import os
+import numpy as np
+import reprojection, propagation, simulation
+
+
+def test_reproject_is_the_drift_to_each_screen():
+    rng = np.random.default_rng(0)
+    final_states = np.column_stack([rng.normal(0.0, 1e-2, (50, 2)), np.full(50, 0.05), rng.normal(0.0, 1e5, (50, 2)), rng.uniform(1e6, 1e7, 50)])
+    screens = reprojection.reproject(final_states, [0.3, 0.5, 0.9])
+    for m, z_det in enumerate([0.3, 0.5, 0.9]):
+        assert np.array_equal(screens[m], propagation.push_batch_from_endoffields_to_detector(final_states, z_det))
+
+
+def test_reprojection_matches_fresh_runs(run_spec, tmp_path, monkeypatch):
+    simulation.Simulation(run_spec).run(str(tmp_path / 'run'))
+    z_dets = [0.4, 0.5, 0.65]
+    pictures = reprojection.reproject_run(str(tmp_path / 'run' / 'results_hits'), z_dets, block_size=64)
+    for z_det, picture in zip(z_dets, pictures):
+        simulation.Simulation({**run_spec, 'geometry': {**run_spec['geometry'], 'z_det': z_det}}).run(str(tmp_path / 'fresh_{}'.format(z_det)))
+        with np.load(os.path.join(tmp_path, 'fresh_{}'.format(z_det), 'results.npz')) as fresh:
+            assert sorted(fresh.files) == sorted(picture)
+            for name in fresh.files:
+                assert np.array_equal(picture[name], fresh[name])
+
+    monkeypatch.chdir(tmp_path)
+    reprojection.cli([os.path.join('run', 'results_hits'), '0.65'])
+    with np.load(os.path.join(tmp_path, 'run', 'results_zdet_0.65.npz')) as written, np.load(os.path.join(tmp_path, 'fresh_0.65', 'results.npz')) as fresh:
+        for name in fresh.files:
+            assert np.array_equal(written[name], fresh[name])
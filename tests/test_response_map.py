@@ -0,0 +1,73 @@
+""" The precomputed response map (response_map.py) against the integration of the particles it maps, and its disk cache. """
+
+import numpy as np
+import pytest
+import response_map, propagation, RKint
+from test_rkint import qonm, l_B, E, B
+
+yscal = [0.05, 0.02, 0.05]
+z_det, tol = 0.5, 1e-9
+grid_settings = {'qonm_range': (qonm / 6, qonm), 'uz_range': (10**6, 10**8), 'n_qonm': 9, 'n_uz': 9} # protons down to C6+, a small map quick to build
+
+
+def aperture_particles(no_of_parts=500, seed=0):
+    rng = np.random.default_rng(seed)
+    states = np.zeros((no_of_parts, 6))
+    states[:, 5] = np.exp(rng.uniform(np.log(2e6), np.log(9e7), no_of_parts))
+    states[:, 0] = rng.uniform(0.0, 1e-3, no_of_parts)
+    states[:, 1] = rng.uniform(0.0, 1e-5, no_of_parts)
+    return states, qonm / rng.integers(1, 7, no_of_parts)
+
+
+@pytest.fixture
+def the_map(tmp_path):
+    return response_map.Response_Map(E, B, l_B, z_det, yscal, tol, cache_dir=str(tmp_path), **grid_settings)
+
+
+def test_mapped_particles_are_within_the_error_bound(the_map):
+    states, qonms = aperture_particles()
+    exited_B, hit_E, final_states, needs_integration = the_map.map_to_endoffields(states, qonms, 1e-3)
+    ref_exited_B, ref_hit_E, ref_states, _, _ = RKint.DOPRI54integrator_batch(states, qonms, yscal, tol, l_B, 1e-3, E, B)
+    mapped = ~needs_integration
+    assert mapped.mean() > 0.9 and the_map.max_error <= 10**(-6)
+    assert np.array_equal(exited_B[mapped], ref_exited_B[mapped]) and np.array_equal(hit_E[mapped], ref_hit_E[mapped])
+    reached = mapped & (exited_B == 1)
+    coords = propagation.push_batch_from_endoffields_to_detector(final_states[reached], z_det)
+    ref_coords = propagation.push_batch_from_endoffields_to_detector(ref_states[reached], z_det)
+    assert np.max(np.abs(coords - ref_coords)) <= 2 * 10**(-6) # validated at the centres of the cells, so a little above the bound elsewhere
+
+
+def test_particles_off_the_map_are_left_to_the_integrator(the_map):
+    states, qonms = aperture_particles(10)
+    states[0, 3] = 1e4 # not along z at the aperture
+    states[1, 5] = 10**9 # beyond the velocities of the map
+    qonms = qonms.copy()
+    qonms[2] = qonm / 50 # beyond the q/m's of the map
+    _, _, _, needs_integration = the_map.map_to_endoffields(states, qonms, 1e-3)
+    assert np.all(needs_integration[:3])
+
+
+def test_maps_are_cached_on_disk(the_map, tmp_path, monkeypatch):
+    monkeypatch.setattr(response_map.Response_Map, '_build', lambda *args: pytest.fail('the cached map was built again'))
+    cached = response_map.Response_Map(E, B, l_B, z_det, yscal, tol, cache_dir=str(tmp_path), **grid_settings)
+    assert cached.key == the_map.key
+    assert np.array_equal(cached.values, the_map.values, equal_nan=True) and np.array_equal(cached.trusted, the_map.trusted)
+    states, qonms = aperture_particles()
+    for a, b in zip(cached.map_to_endoffields(states, qonms, 1e-3), the_map.map_to_endoffields(states, qonms, 1e-3)):
+        assert np.array_equal(a, b, equal_nan=True)
+    assert len(list(tmp_path.glob('response_map_*.npz'))) == 1
+
+
+def test_map_mode_matches_dopri54(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path) # where the mode caches its map
+    monkeypatch.setattr(response_map, '_loaded_maps', dict()) # not one built by another test in this process
+    states, qonms = aperture_particles(200)
+    qonms = np.full(200, qonm) # the default map spans all the species, protons sitting on its upper edge
+    mapped = propagation.push_batch_to_endoffields(states, qonms, yscal, 1e-6, l_B, 1e-3, E, B, mode='map', z_det=z_det)
+    integrated = propagation.push_batch_to_endoffields(states, qonms, yscal, 1e-6, l_B, 1e-3, E, B, mode='dopri54')
+    assert np.array_equal(mapped[0], integrated[0])
+    reached = (mapped[0] == 1)
+    coords = propagation.push_batch_from_endoffields_to_detector(mapped[2][reached], z_det)
+    ref_coords = propagation.push_batch_from_endoffields_to_detector(integrated[2][reached], z_det)
+    assert np.max(np.abs(coords - ref_coords)) <= 2 * 10**(-6)
+    assert len(list((tmp_path / 'response_maps').glob('response_map_*.npz'))) == 1
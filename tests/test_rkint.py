@@ -0,0 +1,58 @@
+""" The batch integrators (RKint.py) against the per-particle RK45integrator(), and the Dormand-Prince boundary location. """
+
+import numpy as np
+import pytest
+import RKint, databases, utility_fns
+
+qonm = databases.charges['proton'] / databases.masses['proton']
+yscal = [0.05, 0.02, 0.05]
+l_B, y_bottom_elec, E, B = 0.05, 3e-5, 1e5, 0.5 # the electrode is close enough for about half of the particles to hit it
+
+
+def initial_states(no_of_parts=40, seed=0):
+    rng = np.random.default_rng(seed)
+    uzs = utility_fns.from_KEineV_to_uzinit(rng.uniform(0.3, 10.0, no_of_parts) * (10**6))
+    states = np.zeros((no_of_parts, 6))
+    states[:, 5] = uzs
+    states[:, 3] = uzs * rng.normal(0.0, 0.01, no_of_parts)
+    states[:, 4] = uzs * rng.normal(0.0, 0.01, no_of_parts)
+    return states
+
+
+def test_batch_rk45_matches_the_per_particle_integrator():
+    states = initial_states()
+    exited_B, hit_E, final_states, steps_accepted, steps_rejected = RKint.RK45integrator_batch(states, qonm, yscal, 1e-6, l_B, y_bottom_elec, E, B)
+    assert 0 < exited_B.sum() < states.shape[0] # both outcomes are exercised
+    assert np.all(exited_B + hit_E == 1)
+    for i, state in enumerate(states):
+        exited, hit, vec, accepted, rejected = RKint.RK45integrator(*state, yscal, 1e-6, l_B, y_bottom_elec, qonm, E, B)
+        assert (exited, hit) == (exited_B[i], hit_E[i])
+        assert (accepted, rejected) == (steps_accepted[i], steps_rejected[i])
+        assert np.allclose(vec, final_states[i], rtol=1e-12, atol=1e-15)
+
+
+def test_first_step_is_not_the_old_tiny_try():
+    state = initial_states(1)[0]
+    dt = RKint.initial_step_size(state, qonm, E, B, yscal, 1e-6)
+    assert 1e-12 < dt < 10 * l_B / state[5] # of the order of the transit time, not 1e-50 s
+    assert RKint.initial_step_size_batch(state[None, :], np.array([qonm]), E, B, np.array(yscal), 1e-6)[0] == pytest.approx(dt, rel=1e-12)
+
+
+def test_dopri54_ends_on_the_boundaries():
+    states = initial_states()
+    exited_B, hit_E, final_states, _, _ = RKint.DOPRI54integrator_batch(states, qonm, yscal, 1e-6, l_B, y_bottom_elec, E, B)
+    rk45_exited_B, _, _, _, _ = RKint.RK45integrator_batch(states, qonm, yscal, 1e-6, l_B, y_bottom_elec, E, B)
+    assert np.array_equal(exited_B, rk45_exited_B)
+    assert np.all(final_states[exited_B == 1, 2] == l_B)
+    assert np.all(final_states[hit_E == 1, 1] == y_bottom_elec)
+
+
+def test_dopri54_error_is_within_the_tolerance():
+    states = initial_states()
+    exited_B, _, final_states, steps_accepted, steps_rejected = RKint.DOPRI54integrator_batch(states, qonm, yscal, 1e-6, l_B, y_bottom_elec, E, B)
+    ref_exited_B, _, ref_states, _, _ = RKint.DOPRI54integrator_batch(states, qonm, yscal, 1e-12, l_B, y_bottom_elec, E, B)
+    assert np.array_equal(exited_B, ref_exited_B)
+    assert np.all(np.abs(final_states[:, :3] - ref_states[:, :3]) / yscal <= 1e-6)
+    # one order more accurate for about the same number of steps as RK45 at the same tolerance
+    _, _, _, rk45_accepted, rk45_rejected = RKint.RK45integrator_batch(states, qonm, yscal, 1e-6, l_B, y_bottom_elec, E, B)
+    assert (steps_accepted + steps_rejected).sum() <= (rk45_accepted + rk45_rejected).sum()
@@ -0,0 +1,52 @@
+""" Run specs and sweeps (simulation.py): each unique point of a sweep is run once, as a direct run of its spec would be. """
+
+import os, json
+import pytest
+import simulation
+from test_parallel_exec import assert_same_run
+
+
+def test_sweep_is_the_cartesian_product(run_spec):
+    run_spec['sweep'] = {'E': [1e5, 2e5], 'z_det': [0.5, 0.6, 0.7], 'chunks.1.energy_MeV': [2.5]}
+    points = simulation.expand_sweep(run_spec)
+    assert [parameters for parameters, sim in points] == [{'E': E, 'z_det': z_det, 'chunks.1.energy_MeV': 2.5} for E in (1e5, 2e5) for z_det in (0.5, 0.6, 0.7)]
+    for parameters, sim in points:
+        assert sim.spec['geometry']['E'] == parameters['E'] and sim.spec['geometry']['z_det'] == parameters['z_det']
+        assert 'sweep' not in sim.spec
+    assert len(set(sim.key for parameters, sim in points)) == 6
+    assert 'sweep' in run_spec # the spec itself is left alone
+
+
+def test_identical_points_share_their_key(run_spec):
+    run_spec['sweep'] = {'propagation_mode': ['dopri54', 'dopri54'], 'seed': [1]}
+    (_, a), (_, b) = simulation.expand_sweep(run_spec)
+    assert a.key == b.key == simulation.Simulation(run_spec).key
+
+
+def test_sweep_points_are_run_once_and_as_direct_runs(run_spec, tmp_path, monkeypatch):
+    run_spec['sweep'] = {'z_det': [0.5, 0.6, 0.5]}
+    index = simulation.run_sweep(run_spec, str(tmp_path / 'sweep'), n_parallel=2)
+    assert index[0]['output_dir'] == index[2]['output_dir'] != index[1]['output_dir']
+    assert sorted(os.listdir(tmp_path / 'sweep')) == sorted([os.path.basename(index[0]['output_dir']), os.path.basename(index[1]['output_dir']), 'sweep_index.json'])
+    with open(tmp_path / 'sweep' / 'sweep_index.json') as f:
+        assert json.load(f) == index
+    simulation.Simulation({**run_spec, 'geometry': {**run_spec['geometry'], 'z_det': 0.6}}).run(str(tmp_path / 'direct'))
+    assert_same_run(index[1]['output_dir'], tmp_path / 'direct')
+
+    monkeypatch.setattr(simulation.Simulation, 'run', lambda *args: pytest.fail('a point already done was run again'))
+    assert simulation.run_sweep(run_spec, str(tmp_path / 'sweep')) == index
+
+
+@pytest.mark.parametrize('change, message', [({'geometry': {'E': 1e5}}, 'misses'), ({'propagation_mode': 'euler'}, 'Choose from'),
+                                             ({'chunks': [{'species': 'unobtainium', 'no_of_particles': 1, 'energy_MeV': 1.0, 'tol': 1e-6}]}, 'Unknown species')])
+def test_invalid_specs_are_refused(run_spec, change, message):
+    with pytest.raises(ValueError, match=message):
+        simulation.Simulation({**run_spec, **change})
+
+
+def test_json_and_toml_specs(tmp_path):
+    with open(tmp_path / 'spec.json', 'w') as f:
+        json.dump({'geometry': {'E': 1e5}, 'seed': 3}, f)
+    with open(tmp_path / 'spec.toml', 'w') as f:
+        f.write('seed = 3\n[geometry]\nE = 1e5\n')
+    assert simulation.load_spec(str(tmp_path / 'spec.json')) == simulation.load_spec(str(tmp_path / 'spec.toml')) == {'geometry': {'E': 1e5}, 'seed': 3}
@@ -0,0 +1,110 @@
+""" Seeded sources and variance-reduced sampling (sources.py): the weighted images and spectra are unbiased estimates of the plain ones. """
+
+import numpy as np
+import pytest
+import sources, propagation, histogram, databases, utility_fns
+
+qonm = databases.charges['proton'] / databases.masses['proton']
+l_B, z_det, E, B = 0.05, 0.5, 1e5, 0.5
+
+
+def exponential_source(sampling):
+    return sources.Exponential_Source(2.0, E_min_MeV=0.5, E_cut_MeV=20.0, sampling=sampling, tail_decades=4)
+
+
+def kinetic_energies_MeV(states):
+    # inverse of utility_fns.from_KEineV_to_uzinit(), by bisection on the energy
+    lows, highs = np.full(states.shape[0], 1e-3), np.full(states.shape[0], 1e3)
+    for _ in range(80):
+        mids = np.sqrt(lows * highs)
+        below = utility_fns.from_KEineV_to_uzinit(mids * (10**6)) < states[:, 5]
+        lows, highs = np.where(below, mids, lows), np.where(below, highs, mids)
+    return np.sqrt(lows * highs)
+
+
+def assert_within_statistical_error(plain, plain_variance, weighted, weighted_variance, n_sigmas=5.0):
+    sigmas = np.sqrt(plain_variance + weighted_variance)
+    filled = (sigmas > 0.0)
+    assert np.all(np.abs(weighted - plain)[filled] <= n_sigmas * sigmas[filled])
+    assert np.all(weighted[~filled] == plain[~filled])
+
+
+@pytest.mark.parametrize('sampling', ['importance', 'stratified'])
+def test_weighted_spectrum_matches_plain(sampling):
+    plain_states, plain_weights = exponential_source('plain').sample_weighted(40000, 1, 4096)
+    states, weights = exponential_source(sampling).sample_weighted(40000, 2, 4096)
+    edges = np.geomspace(0.5, 20.0, 25)
+    plain, _ = np.histogram(kinetic_energies_MeV(plain_states), edges, weights=plain_weights)
+    weighted, _ = np.histogram(kinetic_energies_MeV(states), edges, weights=weights)
+    weighted_variance, _ = np.histogram(kinetic_energies_MeV(states), edges, weights=weights**2)
+    assert_within_statistical_error(plain, plain, weighted, weighted_variance)
+    # the point of the sampling: the last decade of the tail probability gets far more particles than plainly
+    tail = (kinetic_energies_MeV(states) > 2.0 * np.log(10.0**3))
+    assert tail.sum() > 10 * (kinetic_energies_MeV(plain_states) > 2.0 * np.log(10.0**3)).sum()
+
+
+@pytest.mark.parametrize('sampling', ['importance', 'stratified'])
+def test_weighted_image_matches_plain(sampling):
+    def image(states, weights):
+        exited_B, hit_E, final_states, _, _ = propagation.push_batch_to_endoffields(states, qonm, np.array([0.05, 1.0, 0.05]), 1e-6, l_B, 1.0, E, B, mode='analytic')
+        assert np.all(exited_B == 1)
+        coords = propagation.push_batch_from_endoffields_to_detector(final_states, z_det)
+        extents = {'proton': ((-0.13, -0.01), (0.0, 0.003))}
+        images = []
+        for pixel_weights in (weights, weights**2):
+            detector_histogram = histogram.Detector_Histogram((8, 8), extents=extents)
+            detector_histogram.add('proton', coords, databases.masses['proton'], databases.charges['proton'], final_states, pixel_weights)
+            assert detector_histogram.outside.get('proton', 0.0) == 0.0
+            images.append(detector_histogram.images['proton'])
+        return images
+
+    plain, _ = image(*exponential_source('plain').sample_weighted(40000, 3, 4096))
+    weighted, weighted_variance = image(*exponential_source(sampling).sample_weighted(40000, 4, 4096))
+    assert_within_statistical_error(plain, plain, weighted, weighted_variance)
+
+
+@pytest.mark.parametrize('no_of_parts, block_size', [(10000, 4096), (2500, 1000), (3, 3)])
+def test_stratified_weights_sum_to_block_size(no_of_parts, block_size):
+    source = sources.Gaussian_Source(5.0, sampling='stratified', tail_decades=6)
+    for start, states, weights in source.blocks(no_of_parts, 7, block_size):
+        assert weights.sum() == pytest.approx(states.shape[0], rel=1e-12)
+
+
+def test_plain_sampling_has_unit_weights_and_the_particles_of_draw_block():
+    source = sources.Maxwellian_Source(1.0, Rx=1e-3, divergence=0.01)
+    states, weights = source.block(1000, 5, 500, 1)
+    rng = np.random.default_rng(np.random.SeedSequence(5, spawn_key=(1,)))
+    assert np.array_equal(states, source.draw_block(rng, 500, 500))
+    assert np.all(weights == 1.0)
+
+
+def test_blocks_do_not_depend_on_how_the_chunk_is_sliced():
+    batch = sources.Source_Batch(exponential_source('stratified'), 1000, 11, qonm, 0, databases.all_possible_names, block_size=128)
+    whole = batch[0:1000]
+    pieces = [batch[start:start + 300] for start in range(0, 1000, 300)]
+    assert np.array_equal(whole.states, np.concatenate([piece.states for piece in pieces]))
+    assert np.array_equal(whole.weights, np.concatenate([piece.weights for piece in pieces]))
+    states, weights = exponential_source('stratified').sample_weighted(1000, 11, 128)
+    assert np.array_equal(whole.states, states) and np.array_equal(whole.weights, weights)
+
+
+def test_file_source_only_has_unit_weights(tmp_path):
+    filename = str(tmp_path / 'uzs.npy')
+    np.save(filename, np.linspace(1e7, 2e7, 50))
+    states, weights = sources.File_Source(filename, Rx=1e-3).sample_weighted(50, 1, 20)
+    assert np.array_equal(states[:, 5], np.linspace(1e7, 2e7, 50))
+    assert np.all(weights == 1.0)
+    assert not isinstance(sources.File_Source(filename), sources.Parametric_Source)
+    with pytest.raises(TypeError):
+        sources.Particle_Source()
+
+
+@pytest.mark.parametrize('option, sub_option', [(1, 2), (2, 2)])
+def test_gaussian_sub_option_carries_weights(option, sub_option):
+    import main
+    coords, uzs, weights = main.get_particles_init_conds(5000, 5.0, option, True, True, 1e-3, 1e-3, sub_option if option == 1 else 0, sub_option if option == 2 else 0,
+                                                         None, np.random.default_rng(0), 'stratified', 6)
+    assert weights.sum() == pytest.approx(5000, rel=1e-12)
+    assert weights.min() < 1e-3 # the tail particles
+    batch = main.create_ParticleBatch('proton', databases.masses['proton'], databases.charges['proton'], coords, uzs, 5000, weights)
+    assert np.array_equal(batch.weights, weights)
@@ -0,0 +1,96 @@
+""" Spectrum reconstruction (spectrum_reconstruction.py): the species and energies of the particles found back from their positions on the screen. """
+
+import os
+import numpy as np
+import pytest
+import spectrum_reconstruction, simulation, parallel_exec, hit_store, databases, utility_fns, Species
+
+energy_grid_MeV = np.geomspace(0.01, 100.0, 10**5)
+
+
+def energies_of(uzs):
+    # inverse of utility_fns.from_KEineV_to_uzinit(), in MeV
+    return np.interp(uzs, utility_fns.from_KEineV_to_uzinit(energy_grid_MeV * (10**6)), energy_grid_MeV)
+
+
+@pytest.fixture
+def geometry(run_spec):
+    return {**simulation.Simulation(run_spec).geometry(), 'y_bottom_elec': 1.0} # the electrode out of the way of the traces
+
+
+def screen_positions(geometry, names, energies_MeV):
+    states = np.zeros((len(names), 6))
+    states[:, 5] = utility_fns.from_KEineV_to_uzinit(np.asarray(energies_MeV) * (10**6))
+    qonms = np.array([databases.charges[name] / databases.masses[name] for name in names])
+    return parallel_exec.push_sub_batch(states, qonms, {**geometry, 'tol': 1e-10}, 'analytic')[5]
+
+
+def test_positions_on_the_traces_are_found_back(geometry, tmp_path):
+    index = spectrum_reconstruction.Dispersion_Index(geometry, cache_dir=str(tmp_path))
+    assert databases.all_possible_names[index.species_ids[0]] == 'proton' and all(databases.charges[databases.all_possible_names[i]] != 0.0 for i in index.species_ids)
+    rng = np.random.default_rng(0)
+    names = ['proton', 'C6+', 'proton', 'C6+'] * 25
+    energies = np.exp(rng.uniform(np.log(0.1), np.log(50.0), len(names))) # between the points of the traces
+    species_ids, found_energies, distances = index.lookup(screen_positions(geometry, names, energies))
+    assert [databases.all_possible_names[i] for i in species_ids] == names
+    assert np.allclose(found_energies, energies, rtol=1e-4, atol=0.0)
+    assert np.all(distances < 1e-6)
+
+
+def test_positions_off_the_traces_are_not_assigned(geometry, tmp_path):
+    index = spectrum_reconstruction.Dispersion_Index(geometry, cache_dir=str(tmp_path))
+    on_trace = screen_positions(geometry, ['proton'], [5.0])[0]
+    species_ids, energies, distances = index.lookup(np.array([on_trace, on_trace + [0.0, 0.05], [np.nan, 0.0]]), max_distance=1e-3)
+    assert species_ids.tolist() == [0, -1, -1] and np.isnan(energies[1:]).all() and np.isinf(distances[1:]).all()
+
+
+def test_index_is_cached(geometry, tmp_path, monkeypatch):
+    index = spectrum_reconstruction.Dispersion_Index(geometry, n_energies=512, cache_dir=str(tmp_path))
+    monkeypatch.setattr(spectrum_reconstruction.Dispersion_Index, '_push_traces', lambda *args: pytest.fail('traces pushed again'))
+    cached = spectrum_reconstruction.Dispersion_Index(geometry, n_energies=512, cache_dir=str(tmp_path))
+    assert cached.key == index.key and np.array_equal(cached.traces, index.traces, equal_nan=True)
+    with pytest.raises(pytest.fail.Exception): # another tolerance, another index
+        spectrum_reconstruction.Dispersion_Index(geometry, 'dopri54', n_energies=512, tol=1e-6, cache_dir=str(tmp_path))
+
+
+def test_spectra_of_positions_and_of_pixels(geometry, tmp_path):
+    index = spectrum_reconstruction.Dispersion_Index(geometry, cache_dir=str(tmp_path))
+    coords = screen_positions(geometry, ['proton', 'proton', 'C6+', 'proton'], [1.5, 1.7, 3.0, 20.0])
+    edges = np.array([1.0, 2.0, 5.0, 10.0])
+    spectra = index.spectra(coords, edges, weights=[1.0, 2.0, 4.0, 8.0])
+    assert sorted(spectra) == ['C6+', 'proton'] # the 20 MeV proton is past the last bin
+    assert spectra['proton'].tolist() == [3.0, 0.0, 0.0] and spectra['C6+'].tolist() == [0.0, 4.0, 0.0]
+    # the same from an image with a small pixel centred on each position (the traces of C5+ and C6+ are closer than the usual pixel sizes)
+    x_edges, y_edges = [np.sort(np.concatenate([coords[:, k] - 1e-9, coords[:, k] + 1e-9])) for k in (0, 1)]
+    image, _, _ = np.histogram2d(coords[:, 0], coords[:, 1], bins=(x_edges, y_edges), weights=[1.0, 2.0, 4.0, 8.0])
+    from_image = index.spectra_from_image(image, x_edges, y_edges, edges, max_distance=1e-3)
+    assert from_image.keys() == spectra.keys() and all(np.array_equal(from_image[name], spectra[name]) for name in spectra)
+
+
+def test_run_reconstructed_chunk_by_chunk(run_spec, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for chunk in run_spec['chunks']:
+        chunk['Rx'] = 1e-7 # a point-like aperture: the hits lie on the traces
+    sim = simulation.Simulation(run_spec)
+    sim.run('run')
+    indices = spectrum_reconstruction.chunk_indices(sim.spec, sim.geometry())
+    assert indices[0] is indices[1] # the same mode and tolerance: pushed in the mode of the run, at the tolerance of the chunks
+    reader = hit_store.Hit_Reader(os.path.join('run', 'results_hits'))
+    chunks, particle_ids = np.asarray(reader.column('chunk')), np.asarray(reader.column('particle_id'))
+    exited = (np.asarray(reader.column('status')) == Species.status_exited)
+    coords = np.column_stack([np.asarray(reader.column('screen_x')), np.asarray(reader.column('screen_y'))])
+    edges = np.geomspace(0.1, 100.0, 101)
+    first_id = 0
+    for j, batch in enumerate(sim.draw_particles()):
+        mine = exited & (chunks == j)
+        species_ids, energies, _ = indices[j].lookup(coords[mine])
+        assert np.all(species_ids == databases.all_possible_names.index(run_spec['chunks'][j]['species']))
+        assert np.allclose(energies, energies_of(batch.states[particle_ids[mine] - first_id, 5]), rtol=1e-4, atol=0.0)
+        spectra = indices[j].spectra_from_hits(os.path.join('run', 'results_hits'), edges, chunks=[j])
+        assert list(spectra) == [run_spec['chunks'][j]['species']] and spectra[run_spec['chunks'][j]['species']].sum() == pytest.approx(mine.sum())
+        first_id += len(batch)
+
+    spectrum_reconstruction.cli([os.path.join('run', 'run_spec.json'), os.path.join('run', 'results_hits'), '--energies', '0.1', '100', '100'])
+    with np.load(os.path.join('run', 'results_spectra.npz')) as written:
+        assert np.allclose(written['energy_edges_MeV'], edges)
+        assert written['proton'].sum() + written['C6+'].sum() == pytest.approx(exited.sum())
@@ -0,0 +1,67 @@
+""" Tuning of the tolerance to a target accuracy on the screen (tolerance_tuning.py): the target met, the cheapest tolerance kept, the choices cached. """
+
+import os, json
+import numpy as np
+import pytest
+import tolerance_tuning, parallel_exec, simulation
+from test_rkint import initial_states, qonm, l_B, y_bottom_elec, E, B
+
+geometry = {'E': E, 'B': B, 'l_B': l_B, 'y_bottom_elec': y_bottom_elec, 'z_det': 0.5}
+
+
+def test_yscal_and_probes():
+    assert np.array_equal(tolerance_tuning.derive_yscal(geometry), [l_B, y_bottom_elec, l_B])
+    assert np.array_equal(tolerance_tuning.derive_yscal({**geometry, 'l_E': 0.03, 'z_E': 0.04}), [0.07, y_bottom_elec, 0.07])
+    probes = tolerance_tuning.probe_indices(1000)
+    assert probes.shape[0] == tolerance_tuning.n_probes and probes[0] == 0 and probes[-1] == 999
+    assert np.array_equal(tolerance_tuning.probe_indices(10), np.arange(10))
+
+
+def screen_coords(states, tol, mode):
+    pushed = parallel_exec.push_sub_batch(states, qonm, {**geometry, 'yscal': tolerance_tuning.derive_yscal(geometry), 'tol': tol}, mode)
+    return np.where((pushed[0] == 1)[:, None], pushed[5], np.nan)
+
+
+def test_tuned_tolerance_meets_the_target(tmp_path):
+    states = initial_states(100)
+    choices = tolerance_tuning.tune_tolerance(states, qonm, geometry, 'dopri54', 1e-9, cache_dir=str(tmp_path))
+    assert choices['within_target'] and choices['max_error'] <= 1e-9 and choices['tol'] in tolerance_tuning.tol_ladder
+    # the cheapest of the tolerances within the target
+    within = [step for step in choices['ladder'] if step['max_error'] <= 1e-9]
+    assert choices['derivative_evaluations'] == min(step['derivative_evaluations'] for step in within)
+    assert choices['ladder'][0]['max_error'] > 1e-9 # the target is not met by the loosest tolerance
+    # every particle of the chunk, and not only the probes, within the target
+    reference = screen_coords(states, tolerance_tuning.reference_tol, 'dopri54')
+    tuned = screen_coords(states, choices['tol'], 'dopri54')
+    assert np.array_equal(np.isnan(tuned[:, 0]), np.isnan(reference[:, 0])) and np.isnan(reference[:, 0]).any()
+    assert np.nanmax(np.hypot(*(tuned - reference).T)) <= 1e-9
+
+
+def test_choices_are_cached(tmp_path, monkeypatch):
+    states = initial_states(100)
+    choices = tolerance_tuning.tune_tolerance(states, qonm, geometry, 'dopri54', 1e-9, {'species': 'proton'}, str(tmp_path))
+    assert len(os.listdir(tmp_path)) == 1
+    monkeypatch.setattr(tolerance_tuning, '_ladder', lambda *args: pytest.fail('tuned again'))
+    assert tolerance_tuning.tune_tolerance(states, qonm, geometry, 'dopri54', 1e-9, {'species': 'proton'}, str(tmp_path)) == json.loads(json.dumps(choices))
+    assert tolerance_tuning.tune_tolerance(states, qonm, geometry, 'map', 1e-9, {'species': 'proton'}, str(tmp_path))['tol'] == choices['tol'] # 'map' is tuned as 'dopri54'
+    with pytest.raises(pytest.fail.Exception):
+        tolerance_tuning.tune_tolerance(states, qonm, geometry, 'dopri54', 1e-9, {'species': 'C6+'}, str(tmp_path))
+
+
+def test_missed_target_is_an_error():
+    states = initial_states(100)
+    with pytest.raises(ValueError, match='Use a larger target'):
+        tolerance_tuning.tune_tolerance(states, qonm, geometry, 'dopri54', 1e-18, cache_dir=None)
+    # the overshoot of the end of the fields by rk45 does not shrink with the tolerance, dopri54 is suggested instead
+    with pytest.raises(ValueError, match="The 'dopri54' mode reaches it at tol = "):
+        tolerance_tuning.tune_tolerance(states, qonm, geometry, 'rk45', 1e-6, cache_dir=None)
+
+
+def test_run_with_auto_tolerances(run_spec, tmp_path):
+    run_spec['chunks'][0]['tol'] = 'auto'
+    run_spec['target_screen_accuracy'] = 1e-7
+    simulation.Simulation(run_spec).run(str(tmp_path))
+    assert len(os.listdir(tmp_path / 'results_tolerance_tunings')) == 1 # only the 'auto' chunk
+    with open(tmp_path / 'results_metrics.json') as f:
+        tuning, = json.load(f)['info']['tolerance_tuning']
+    assert tuning['label']['species'] == 'proton' and tuning['max_error'] <= 1e-7
@@ -0,0 +1,64 @@
+""" History-free integration (Trajectory.py): recording the trajectories of a few particles does not change any result. """
+
+import os
+import numpy as np
+import pytest
+import RKint, Trajectory, simulation, hit_store
+from test_rkint import initial_states, qonm, yscal, l_B, y_bottom_elec, E, B
+
+
+@pytest.mark.parametrize('integrator', [RKint.RK45integrator_batch, RKint.DOPRI54integrator_batch])
+def test_recording_does_not_change_the_integration(integrator):
+    states = initial_states()
+    recorded_ids = [0, 3, 17]
+    recorder = Trajectory.Trajectory_Recorder(recorded_ids, 10**3)
+    with_recorder = integrator(states, qonm, yscal, 1e-6, l_B, y_bottom_elec, E, B, recorder=recorder)
+    without = integrator(states, qonm, yscal, 1e-6, l_B, y_bottom_elec, E, B)
+    for a, b in zip(with_recorder, without):
+        assert np.array_equal(a, b)
+    final_states, steps_accepted = with_recorder[2], with_recorder[3]
+    for i in recorded_ids:
+        trajectory = recorder.get_trajectory(i)
+        assert np.array_equal(trajectory[0], states[i]) and np.array_equal(trajectory[-1], final_states[i])
+        assert trajectory.shape[0] == steps_accepted[i] + 1 # every accepted step, the last one ending on the final state
+        assert np.all(np.diff(trajectory[:, 2]) > 0.0)
+
+
+def test_scalar_integrator_records_the_same_samples():
+    state = initial_states(1)[0]
+    recorder = Trajectory.Trajectory_Recorder([0], 10**3)
+    batch_recorder = Trajectory.Trajectory_Recorder([0], 10**3)
+    RKint.RK45integrator(*state, yscal, 1e-6, l_B, y_bottom_elec, qonm, E, B, recorder=recorder)
+    RKint.RK45integrator_batch(state[None, :], qonm, yscal, 1e-6, l_B, y_bottom_elec, E, B, recorder=batch_recorder)
+    assert np.allclose(recorder.get_trajectory(0), batch_recorder.get_trajectory(0), rtol=1e-12, atol=1e-15)
+
+
+def test_decimation_and_dropped_samples():
+    states = initial_states()
+    _, _, final_states, steps_accepted, _ = RKint.RK45integrator_batch(states, qonm, yscal, 1e-10, l_B, y_bottom_elec, E, B)
+    i = int(np.argmax(steps_accepted))
+    assert steps_accepted[i] >= 4
+    every_second = Trajectory.Trajectory_Recorder([i], 10**3, every_k_steps=2)
+    capped = Trajectory.Trajectory_Recorder([i], 3)
+    RKint.RK45integrator_batch(states, qonm, yscal, 1e-10, l_B, y_bottom_elec, E, B, recorder=every_second)
+    RKint.RK45integrator_batch(states, qonm, yscal, 1e-10, l_B, y_bottom_elec, E, B, recorder=capped)
+    assert every_second.get_trajectory(i).shape[0] == 1 + steps_accepted[i] // 2 + steps_accepted[i] % 2 # the initial state, every 2nd step, the final state
+    assert np.array_equal(every_second.get_trajectory(i)[-1], final_states[i])
+    assert capped.get_trajectory(i).shape[0] == 3 and capped._dropped[0] == (1 + steps_accepted[i] + 1) - 3 # the final state is offered again, the buffer being full
+
+
+def test_run_records_to_a_memory_mapped_file(run_spec, tmp_path):
+    simulation.Simulation({**run_spec, 'n_workers': 2, 'trajectory_particle_ids': [1, 450]}).run(str(tmp_path / 'recorded'))
+    simulation.Simulation(run_spec).run(str(tmp_path / 'plain'))
+    samples = np.load(os.path.join(tmp_path, 'recorded', 'results_trajectories.npy'))
+    assert samples.shape[0] == 2
+    recorded = hit_store.Hit_Reader(os.path.join(tmp_path, 'recorded', 'results_hits'))
+    plain = hit_store.Hit_Reader(os.path.join(tmp_path, 'plain', 'results_hits'))
+    for name, dtype in hit_store.hit_columns:
+        assert np.array_equal(np.sort(recorded.column(name)), np.sort(plain.column(name)), equal_nan=True)
+    ids = recorded.column('particle_id')
+    for row, particle_id in enumerate([1, 450]):
+        trajectory = samples[row][~np.isnan(samples[row, :, 0])]
+        exit_state = [recorded.column(name)[ids == particle_id][0] for name in ('exit_x', 'exit_y', 'exit_z', 'exit_ux', 'exit_uy', 'exit_uz')]
+        assert trajectory.shape[0] >= 2 and trajectory[0, 2] == 0.0 # from the aperture
+        assert np.array_equal(trajectory[-1], exit_state)
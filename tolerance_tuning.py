@@ -0,0 +1,162 @@
+""" Tuning of the integration tolerance of a chunk of particles to a target accuracy on the detector screen, in meters.
+
+A raw tol is hard to choose: it is a relative error per step, scaled by yscal (the sizes of the x,y,z coordinates in the fields), and the
+error it gives on the screen depends on the species, the energies and the geometry. Instead, for a chunk whose tol is 'auto':
+
+    1) yscal is derived from the geometry (derive_yscal()): the length of the fields along x and z, the height of the bottom electrode along y
+    2) a small probe set of the particles of the chunk (n_probes of them, evenly spread over the chunk) is pushed to the screen with a very
+       tight Dormand-Prince 5(4) integration (reference_tol), as the reference
+    3) the probes are pushed in the propagation mode of the run at each tolerance of tol_ladder, counting the derivatives evaluations,
+       and their screen positions are compared to the reference ones (a probe exiting in one and not in the other counts as an infinite error)
+    4) the tolerance with the fewest derivatives evaluations among those within the target accuracy is kept
+
+If no tolerance of the ladder is within the target, the tuning fails (ValueError) instead of running with a tolerance which misses it:
+the error gives the best accuracy reached and, for the 'rk45' mode (whose overshoot of the end of the fields does not shrink with the
+tolerance), the tolerance at which the 'dopri54' mode reaches the target, if any.
+
+The choices are saved in cache_dir (main.py and simulation.py use a directory next to the other outputs of the run), in a .json file named
+after a hash of the geometry, the mode, the target and the label of the chunk (species, energy, ...), and reused as they are by the next runs
+of the same geometry writing to the same place.
+"""
+
+import os, json, logging
+import numpy as np
+import parallel_exec, fieldmap, instrumentation, utility_fns
+
+tol_ladder = [10.0**(-k) for k in range(2, 13)] # tolerances tried, from the loosest to the tightest
+reference_tol = 1e-13
+n_probes = 64
+
+
+def derive_yscal(geometry):
+    """ Returns the yscal (np.array shape (3, )) of a geometry (dict with keys 'l_B', 'y_bottom_elec' and optionally 'field_map', 'l_E', 'z_E', 'z_B'):
+    the z at which the last field region ends, for the x and z coordinates, and the height of the bottom electrode, for the y coordinate. """
+
+    z_end = geometry['l_B']
+    if geometry.get('l_E') is not None:
+        z_end = max(geometry.get('z_E', 0.0) + geometry['l_E'], geometry.get('z_B', 0.0) + geometry['l_B'])
+    if geometry.get('field_map') is not None:
+        z_end = max(z_end, fieldmap.get_field_map(geometry['field_map']).z_end)
+    return np.array([z_end, abs(geometry['y_bottom_elec']), z_end])
+
+
+def probe_indices(no_of_parts):
+    """ Returns the indices of the (at most n_probes) probes, evenly spread over a chunk of no_of_parts particles. """
+
+    return np.unique(np.linspace(0, no_of_parts - 1, min(n_probes, no_of_parts)).astype(int))
+
+
+def _push_probes(states, qonms, geometry, mode):
+    # screen positions of the probes (nan if they do not reach it) and derivatives evaluations, kept out of the metrics of the run
+    with instrumentation.collecting() as probe_metrics:
+        pushed = parallel_exec.push_sub_batch(states, qonms, geometry, mode)
+    exited_B, coords_at_detector = pushed[0], pushed[5]
+    coords_at_detector = np.where((exited_B == 1)[:, None], coords_at_detector, np.nan)
+    return coords_at_detector, probe_metrics.timers.get('derivatives', {}).get('items', 0)
+
+
+def _ladder(states, qonms, probe_geometry, mode, reference):
+    # max_error and derivatives evaluations per probe at each tolerance of tol_ladder
+    ladder = []
+    for tol in tol_ladder:
+        coords, evaluations = _push_probes(states, qonms, {**probe_geometry, 'tol': tol}, mode)
+        same_outcome = (np.isnan(coords[:, 0]) == np.isnan(reference[:, 0]))
+        errors = np.hypot(coords[:, 0] - reference[:, 0], coords[:, 1] - reference[:, 1])
+        max_error = float(np.max(np.where(same_outcome, np.nan_to_num(errors, nan=0.0), np.inf))) if states.shape[0] > 0 else 0.0
+        ladder.append({'tol': tol, 'max_error': max_error, 'derivative_evaluations': evaluations / max(states.shape[0], 1)})
+    return ladder
+
+
+def tune_tolerance(states, qonms, geometry, mode, target, label=None, cache_dir='tolerance_tunings'):
+    """ Finds the cheapest tolerance which pushes a chunk of particles to the screen within target (in meters), see the docstring of this module.
+
+    Parameters
+    ----------
+    states : np.array shape (N, 6) (initial x,y,z, ux,uy,uz of the particles of the chunk)
+    qonms : np.array shape (N, ) (charge/mass ratio of each particle, in SI)
+    geometry : dict with keys 'E', 'B', 'l_B', 'y_bottom_elec', 'z_det' (and optionally 'field_map', 'l_E', 'z_E', 'z_B'), see parallel_exec.push_sub_batch()
+    mode : str (one of propagation.propagation_modes. the 'map' mode is tuned as 'dopri54', the integrator of the particles outside of its trusted cells)
+    target : float (accuracy wanted on the screen, in SI (meters))
+    label : dict or None (what the chunk is, e.g. {'species': 'proton', 'energy_MeV': 5.0}. part of the name of the cached choices)
+    cache_dir : str or None (directory of the cached choices. None: no cache)
+
+    Returns
+    -------
+    dict with keys 'tol', 'yscal' (list of 3 floats), 'max_error' (in meters, of the probes at this tolerance), 'derivative_evaluations'
+    (per probe, at this tolerance), 'within_target' (bool, always True) and 'ladder' (the max_error and derivative_evaluations at each tolerance tried)
+
+    Raises
+    ------
+    ValueError if no tolerance of tol_ladder is within target (the message suggests the 'dopri54' mode when it would be)
+    """
+
+    yscal = derive_yscal(geometry)
+    mode = 'dopri54' if mode == 'map' else mode
+    settings = {name: value for name, value in geometry.items() if name not in ('yscal', 'tol')}
+    key = utility_fns.geometry_key(mode=mode, target=target, label=json.dumps(label, sort_keys=True), **settings)
+    filename = None if cache_dir is None else os.path.join(cache_dir, 'tolerance_{}.json'.format(key))
+    if filename is not None and os.path.exists(filename):
+        with open(filename) as f:
+            choices = json.load(f)
+        if choices['within_target']:
+            return choices
+
+    states = np.asarray(states, dtype=float)
+    qonms = np.broadcast_to(np.asarray(qonms, dtype=float), (states.shape[0],))
+    probes = probe_indices(states.shape[0])
+    states, qonms = states[probes], qonms[probes]
+    probe_geometry = {**settings, 'yscal': yscal}
+    reference, _ = _push_probes(states, qonms, {**probe_geometry, 'tol': reference_tol}, 'dopri54')
+
+    ladder = _ladder(states, qonms, probe_geometry, mode, reference)
+    within = [step for step in ladder if step['max_error'] <= target]
+    if not within:
+        closest = min(ladder, key=lambda step: step['max_error'])
+        instrumentation.log_event(logging.ERROR, 'tolerance_target_missed', label=label, mode=mode, target=target, tol=closest['tol'], max_error=closest['max_error'])
+        message = "No tolerance of the '{}' mode reaches the target screen accuracy of {} m for {} (best: {} m at tol = {}).".format(mode, target, label, closest['max_error'], closest['tol'])
+        if mode != 'dopri54':
+            within_dopri54 = [step for step in _ladder(states, qonms, probe_geometry, 'dopri54', reference) if step['max_error'] <= target]
+            if within_dopri54:
+                message += " The 'dopri54' mode reaches it at tol = {}: use it, or a larger target.".format(min(within_dopri54, key=lambda step: step['derivative_evaluations'])['tol'])
+                raise ValueError(message)
+        raise ValueError(message + " Use a larger target.")
+    best = min(within, key=lambda step: step['derivative_evaluations']) # min() keeps the loosest of equally cheap ones
+    choices = {**best, 'yscal': yscal.tolist(), 'within_target': True, 'ladder': ladder}
+    if filename is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(filename, 'w') as f:
+            json.dump(choices, f, indent=1)
+    return choices
+
+
+def tune_chunks(particle_batches, tols, labels, geometry, mode, target, cache_dir='tolerance_tunings'):
+    """ Tunes the tolerance of the chunks whose tol is None ('auto'), the others being kept as they are.
+
+    Parameters
+    ----------
+    particle_batches : list of Species.ParticleBatch or sources.Source_Batch (one per chunk of particles. only the probes are taken out of them)
+    tols : list of floats or None's (tolerance of each chunk, None to tune it)
+    labels : list of dicts (what each chunk is, see tune_tolerance())
+    geometry, mode, target, cache_dir : see tune_tolerance() (a run passes a directory next to its other outputs)
+
+    Returns
+    -------
+    tols : list of floats (the tolerance of each chunk)
+    yscals : list of np.arrays shape (3, ) or None's (the yscal of each tuned chunk, None for the others, which keep the yscal of the run)
+    """
+
+    tuned_tols, yscals = [], []
+    for batch, tol, label in zip(particle_batches, tols, labels):
+        if tol is not None:
+            tuned_tols.append(tol)
+            yscals.append(None)
+            continue
+        probes = batch[probe_indices(len(batch))]
+        choices = tune_tolerance(probes.states, probes.qonms, geometry, mode, target, label, cache_dir)
+        instrumentation.log_event(logging.INFO, 'tolerance_tuned', label=label, target=target, tol=choices['tol'], yscal=choices['yscal'],
+                                  max_error=choices['max_error'], derivative_evaluations=choices['derivative_evaluations'])
+        if instrumentation.metrics is not None:
+            instrumentation.metrics.info.setdefault('tolerance_tuning', []).append({'label': label, 'target': target, **choices})
+        tuned_tols.append(choices['tol'])
+        yscals.append(np.array(choices['yscal']))
+    return tuned_tols, yscals
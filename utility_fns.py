@@ -1,3 +1,4 @@
+import hashlib, json
 import numpy as np
 from scipy.constants import c, m_p
 
@@ -33,4 +34,22 @@ def from_KEineV_to_KEinJ(KE): # utility function
     """
 
     KE_in_J = (1.60217662 * 10**(-19)) * KE # KE in eV
-    return KE_in_J
\ No newline at end of file
+    return KE_in_J
+
+
+def geometry_key(**settings): # utility function
+    """ Returns a short hash identifying a set of geometry / integration settings, used to name cached results on disk.
+
+    Parameters
+    ----------
+    **settings : floats, ints, strs or lists of them (e.g. E=..., B=..., l_B=..., z_det=..., tol=...)
+
+    Returns
+    -------
+    key : str (16 hexadecimal characters; the same settings always give the same key)
+
+    """
+
+    canonical = json.dumps({name: np.asarray(value).tolist() for name, value in settings.items()}, sort_keys=True)
+    key = hashlib.sha1(canonical.encode()).hexdigest()[:16]
+    return key